@@ -0,0 +1,132 @@
+#
+# Copyright (C) 2020-2023 by Ilkka Tuohela <hile@iki.fi>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+"""
+Benchmark the native sync engine against rsync with a synthetic source tree
+
+Creates a source tree of many small files and a few large files and pushes it to local
+destination directories with rsync and with the native engine, first to an empty
+destination, then unchanged and finally after touching a part of the files. Run from the
+repository root:
+
+    python benchmarks/bench_native.py [--files 100000] [--large-files 4] [--large-file-size 256]
+
+The rsync pushes are skipped if rsync is not installed. Copies of large files are fastest
+on filesystems supporting reflinks, such as btrfs and XFS.
+"""
+import argparse
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from pathlib import Path
+
+import yaml
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+# pylint: disable=wrong-import-position
+from treesync.configuration import Configuration  # noqa: E402
+from treesync.native import get_native_engine  # noqa: E402
+from treesync.target import Target  # noqa: E402
+
+
+def create_source(source: Path, files: int, large_files: int, large_file_size: int) -> None:
+    """
+    Create small files of 100 bytes and large files of large_file_size megabytes
+    """
+    created = set()
+    for index in range(files):
+        directory = source.joinpath(f'dir{index % 64}', f'sub{index // 64 // 1000}')
+        if directory not in created:
+            directory.mkdir(parents=True, exist_ok=True)
+            created.add(directory)
+        directory.joinpath(f'file{index}.dat').write_bytes(b'x' * 100)
+    source.joinpath('large').mkdir(parents=True, exist_ok=True)
+    block = os.urandom(1024 * 1024)
+    for index in range(large_files):
+        with source.joinpath('large', f'large{index}.dat').open('wb') as handle:
+            for _block in range(large_file_size):
+                handle.write(block)
+
+
+def touch_files(source: Path, fraction: int) -> None:
+    """
+    Update modification time of every fraction:th small file
+    """
+    for index, path in enumerate(sorted(source.glob('dir*/sub*/*.dat'))):
+        if index % fraction == 0:
+            path.touch()
+
+
+def create_target(path: Path, source: Path, destination: Path, engine: str) -> Target:
+    """
+    Create a sync target pushing source to local destination directory with an engine
+    """
+    settings = {
+        'source': str(source),
+        'destination': str(destination),
+        'flags': ['--archive', '--delete'],
+        'ignore_default_excludes': True,
+        'engine': engine,
+    }
+    path.write_text(yaml.safe_dump({'targets': {'bench': settings}}), encoding='utf-8')
+    return Configuration(path).sync_targets.get('bench')
+
+
+def measure(target: Target) -> float:
+    """
+    Return seconds spent pushing the target
+    """
+    start = time.monotonic()
+    target.push(output=io.StringIO(), stats=True)
+    return time.monotonic() - start
+
+
+def main() -> None:
+    """
+    Run the benchmarks
+    """
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', type=int, default=100000, help='Number of small files')
+    parser.add_argument('--large-files', type=int, default=4, help='Number of large files')
+    parser.add_argument('--large-file-size', type=int, default=256, help='Size of large files in megabytes')
+    args = parser.parse_args()
+
+    engines = ['native']
+    if shutil.which('rsync') is not None:
+        engines.insert(0, 'rsync')
+    else:
+        print('rsync command not found, measuring only the native engine')
+
+    with tempfile.TemporaryDirectory(prefix='treesync-bench-') as directory:
+        directory = Path(directory)
+        source = directory.joinpath('source')
+        create_source(source, args.files, args.large_files, args.large_file_size)
+        print(f'{args.files} small files, {args.large_files} files of {args.large_file_size} MB')
+        targets = {}
+        for engine in engines:
+            config = directory.joinpath(f'config-{engine}.yml')
+            targets[engine] = create_target(config, source, directory.joinpath(f'destination-{engine}'), engine)
+        print(f'{"engine":8} {"initial s":>12} {"unchanged s":>12} {"1% touched s":>12}')
+        results = {engine: [measure(target)] for engine, target in targets.items()}
+        for engine, target in targets.items():
+            results[engine].append(measure(target))
+        touch_files(source, 100)
+        for engine, target in targets.items():
+            results[engine].append(measure(target))
+        for engine, (initial, unchanged, touched) in results.items():
+            print(f'{engine:8} {initial:12.3f} {unchanged:12.3f} {touched:12.3f}')
+
+        native = get_native_engine(targets['native'], source, str(directory.joinpath('destination-copy')))
+        native.run(output=io.StringIO())
+        print('native copy methods:', ', '.join(f'{key} {value}' for key, value in native.copy_methods.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+#
+# Copyright (C) 2020-2023 by Ilkka Tuohela <hile@iki.fi>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+"""
+Benchmark sharded pushes with a synthetic source tree
+
+Creates a source tree of many small files in many top-level directories or a few large
+sparse files, and compares a normal push to local destination directories with a push in
+shards. Requires rsync. Run from the repository root:
+
+    python benchmarks/bench_shards.py [--files 1000000] [--directories 64] [--shards 4]
+    python benchmarks/bench_shards.py --huge-files 4 --huge-file-size 4096 [--shards 4]
+
+Local pushes measure the overhead of walking and comparing trees, the speedup of shards
+over a network depends on the latency and bandwidth of the connection.
+"""
+import argparse
+import io
+import shutil
+import sys
+import tempfile
+import time
+
+from pathlib import Path
+
+import yaml
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+# pylint: disable=wrong-import-position
+from treesync.configuration import Configuration  # noqa: E402
+from treesync.target import Target  # noqa: E402
+
+
+def create_small_files(source: Path, files: int, directories: int) -> None:
+    """
+    Create files of 100 bytes to top-level directories in source
+    """
+    created = set()
+    for index in range(files):
+        directory = source.joinpath(f'dir{index % directories}', f'sub{index // directories // 1000}')
+        if directory not in created:
+            directory.mkdir(parents=True, exist_ok=True)
+            created.add(directory)
+        directory.joinpath(f'file{index}.dat').write_bytes(b'x' * 100)
+
+
+def create_huge_files(source: Path, files: int, size: int) -> None:
+    """
+    Create sparse files of size megabytes, each in its own top-level directory
+    """
+    for index in range(files):
+        directory = source.joinpath(f'dir{index}')
+        directory.mkdir(parents=True)
+        with directory.joinpath('huge.dat').open('wb') as handle:
+            handle.truncate(size * 1024 * 1024)
+
+
+def create_target(path: Path, source: Path, destination: Path, shards: int, shard_by: str) -> Target:
+    """
+    Create a sync target pushing source to local destination directory
+    """
+    settings = {
+        'source': str(source),
+        'destination': str(destination),
+        'flags': ['--archive', '--delete'],
+        'ignore_default_excludes': True,
+    }
+    if shards:
+        settings.update(shards=shards, shard_by=shard_by)
+    path.write_text(yaml.safe_dump({'targets': {'bench': settings}}), encoding='utf-8')
+    return Configuration(path).sync_targets.get('bench')
+
+
+def measure(target: Target) -> float:
+    """
+    Return seconds spent pushing the target
+    """
+    start = time.monotonic()
+    target.push(output=io.StringIO(), stats=True)
+    return time.monotonic() - start
+
+
+def main() -> None:
+    """
+    Run the benchmarks
+    """
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', type=int, default=1000000, help='Number of small files')
+    parser.add_argument('--directories', type=int, default=64, help='Number of top-level directories')
+    parser.add_argument('--huge-files', type=int, default=0, help='Number of large sparse files instead')
+    parser.add_argument('--huge-file-size', type=int, default=4096, help='Size of large files in megabytes')
+    parser.add_argument('--shards', type=int, default=4, help='Number of concurrent shards')
+    parser.add_argument('--shard-by', choices=('directory', 'size', 'files'), default='files')
+    args = parser.parse_args()
+
+    if shutil.which('rsync') is None:
+        parser.error('rsync command not found')
+
+    with tempfile.TemporaryDirectory(prefix='treesync-bench-') as directory:
+        directory = Path(directory)
+        source = directory.joinpath('source')
+        if args.huge_files:
+            create_huge_files(source, args.huge_files, args.huge_file_size)
+            print(f'{args.huge_files} files of {args.huge_file_size} MB')
+        else:
+            create_small_files(source, args.files, args.directories)
+            print(f'{args.files} files in {args.directories} top-level directories')
+        print(f'{"push":24} {"initial s":>12} {"unchanged s":>12}')
+
+        for label, shards in (('single rsync', None), (f'{args.shards} shards by {args.shard_by}', args.shards)):
+            destination = directory.joinpath(f'destination-{shards}')
+            config = directory.joinpath(f'config-{shards}.yml')
+            target = create_target(config, source, destination, shards, args.shard_by)
+            initial = measure(target)
+            unchanged = measure(target)
+            print(f'{label:24} {initial:12.3f} {unchanged:12.3f}')
+
+
+if __name__ == '__main__':
+    main()
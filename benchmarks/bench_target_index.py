@@ -0,0 +1,148 @@
+#
+# Copyright (C) 2020-2023 by Ilkka Tuohela <hile@iki.fi>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+"""
+Benchmark target lookups and pattern matching with synthetic sync targets
+
+Compares the TargetList index with linear scans over all targets, as done before the
+index was added. Run from the repository root:
+
+    python benchmarks/bench_target_index.py [--targets 10000] [--hosts 100]
+"""
+import argparse
+import sys
+import timeit
+
+from fnmatch import fnmatch
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+# pylint: disable=wrong-import-position
+from treesync.target import Target, TargetList  # noqa: E402
+
+PATTERNS = (
+    ['host42'],
+    ['host42:tree7'],
+    ['tree7'],
+    ['host4*'],
+    ['host42:tree1*'],
+    ['*:tree99'],
+)
+
+
+def create_targets(count: int, hosts: int) -> TargetList:
+    """
+    Create synthetic sync targets
+    """
+    targets = TargetList()
+    for index in range(count):
+        hostname = f'host{index % hosts}'
+        name = f'{hostname}:tree{index // hosts}'
+        targets.append(Target(hostname, name, f'/data/{name}', f'{hostname}:/backup/{name}', None))
+    return targets
+
+
+def linear_filter(targets: TargetList, patterns):
+    """
+    Filter targets by matching every pattern to every target
+    """
+    def match_patterns(patterns, target):
+        for pattern in patterns:
+            if target.hostname and fnmatch(target.hostname, pattern):
+                return True
+            if str(target.name) == pattern or fnmatch(str(target.name), pattern):
+                return True
+            try:
+                _host, name = target.name.split(':', 1)
+                if fnmatch(name, pattern):
+                    return True
+            except ValueError:
+                pass
+        return False
+    return [target for target in targets if match_patterns(patterns, target)]
+
+
+def linear_get(targets: TargetList, name: str):
+    """
+    Find target by name with a linear scan
+    """
+    for item in targets:
+        if str(item) == name:
+            return item
+    return None
+
+
+def linear_dedup(targets: TargetList) -> list:
+    """
+    Deduplicate targets with list membership checks
+    """
+    unique = []
+    for target in targets:
+        if target not in unique:
+            unique.append(target)
+    return unique
+
+
+def set_dedup(targets: TargetList) -> list:
+    """
+    Deduplicate targets with a set of target keys
+    """
+    names = set()
+    unique = []
+    for target in targets:
+        if (target.hostname, target.name) not in names:
+            names.add((target.hostname, target.name))
+            unique.append(target)
+    return unique
+
+
+def measure(callback, repeat: int) -> float:
+    """
+    Return best time of callback in milliseconds
+    """
+    return min(timeit.repeat(callback, number=1, repeat=repeat)) * 1000
+
+
+def main() -> None:
+    """
+    Run the benchmarks
+    """
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--targets', type=int, default=10000, help='Number of synthetic targets')
+    parser.add_argument('--hosts', type=int, default=100, help='Number of synthetic hosts')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of repeats for each measurement')
+    args = parser.parse_args()
+
+    targets = create_targets(args.targets, args.hosts)
+    print(f'{len(targets)} targets on {args.hosts} hosts, best of {args.repeat} runs')
+    print(f'{"operation":32} {"linear ms":>12} {"indexed ms":>12}')
+
+    build = measure(targets.build_index, args.repeat)
+    print(f'{"build index":32} {"":>12} {build:12.3f}')
+
+    for patterns in PATTERNS:
+        expected = linear_filter(targets, patterns)
+        assert targets.filter(patterns) == expected
+        linear = measure(lambda patterns=patterns: linear_filter(targets, patterns), args.repeat)
+        indexed = measure(lambda patterns=patterns: targets.filter(patterns), args.repeat)
+        label = f'filter {" ".join(patterns)} ({len(expected)})'
+        print(f'{label:32} {linear:12.3f} {indexed:12.3f}')
+
+    name = targets[-1].name
+    linear = measure(lambda: linear_get(targets, name), args.repeat)
+    indexed = measure(lambda: targets.get(name), args.repeat)
+    print(f'{"get last target":32} {linear:12.3f} {indexed:12.3f}')
+
+    if args.targets <= 20000:
+        linear = measure(lambda: linear_dedup(targets), 1)
+    else:
+        linear = float('nan')
+    indexed = measure(lambda: set_dedup(targets), args.repeat)
+    print(f'{"deduplicate targets":32} {linear:12.3f} {indexed:12.3f}')
+
+
+if __name__ == '__main__':
+    main()
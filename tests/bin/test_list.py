@@ -137,3 +137,26 @@ def test_cli_treesync_list_filter_name_prefix(
     assert len(errors) == 0
     lines = captured.out.splitlines()
     assert len(lines) == 2
+
+
+# pylint: disable=unused-argument
+def test_cli_treesync_list_config_snapshot(
+        mock_config_host_sources,
+        capsys,
+        monkeypatch) -> None:
+    """
+    Test listing targets with and without cached configuration snapshot
+    """
+    outputs = []
+    for testargs in (
+            ['treesync', 'list'],
+            ['treesync', 'list'],
+            ['treesync', 'list', '--no-config-cache']):
+        script = Treesync()
+        with monkeypatch.context() as context:
+            validate_script_run_exception_with_args(script, context, testargs, exit_code=0)
+        captured = capsys.readouterr()
+        assert captured.err == ''
+        outputs.append(captured.out)
+    assert outputs[0] != ''
+    assert outputs[0] == outputs[1] == outputs[2]
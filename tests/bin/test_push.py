@@ -6,8 +6,22 @@
 """
 Unit tests for 'treesync push' command
 """
+import json
+import re
+
+from pathlib import Path
+from subprocess import CalledProcessError
+
+import yaml
+
 from cli_toolkit.tests.script import validate_script_run_exception_with_args
+from sys_toolkit.tests.mock import MockCalledMethod, MockException
+
 from treesync.bin.treesync.main import Treesync
+from treesync.scheduler import SyncJob
+
+from ..conftest import DUMMY_TARGET_NAME, EXCLUDES_FILE
+from ..utils import create_mock_rsync, create_source_directory, create_test_config
 
 
 def test_cli_treesync_push_no_targets(monkeypatch) -> None:
@@ -28,3 +42,258 @@ def test_cli_treesync_push_invalid_targets(monkeypatch) -> None:
     testargs = ['treesync', 'push', 'invalid-target-name']
     with monkeypatch.context() as context:
         validate_script_run_exception_with_args(script, context, testargs, exit_code=1)
+
+
+# pylint: disable=unused-argument
+def test_cli_treesync_push_invalid_jobs(mock_config_old_format_server_flags, monkeypatch) -> None:
+    """
+    Test running 'treesync push' with invalid number of parallel jobs
+    """
+    script = Treesync()
+    testargs = ['treesync', 'push', '--jobs', '0', DUMMY_TARGET_NAME]
+    with monkeypatch.context() as context:
+        validate_script_run_exception_with_args(script, context, testargs, exit_code=1)
+
+
+# pylint: disable=unused-argument
+def test_cli_treesync_push_parallel_errors(mock_no_user_sync_config, tmpdir, capsys, monkeypatch) -> None:
+    """
+    Test running 'treesync push' with parallel jobs and errors in running the commands
+    """
+    mock_called_process_error = MockException(CalledProcessError, cmd='mock command', returncode=1)
+    monkeypatch.setattr('treesync.target.run', mock_called_process_error)
+    _source, destination, config_file = create_source_directory(tmpdir, EXCLUDES_FILE)
+
+    script = Treesync()
+    testargs = ['treesync', 'push', '--jobs', '4', '--config', str(config_file), 'test']
+    with monkeypatch.context() as context:
+        validate_script_run_exception_with_args(script, context, testargs, exit_code=1)
+    assert not destination.exists()
+
+    captured = capsys.readouterr()
+    assert captured.out.startswith('push ')
+    assert 'mock command' in captured.err
+
+
+# pylint: disable=unused-argument
+def test_cli_treesync_push_ssh_multiplexing(mock_no_user_sync_config, tmpdir, capsys, monkeypatch) -> None:
+    """
+    Test running 'treesync push' with shared ssh connections
+    """
+    mock_ssh_run = MockCalledMethod()
+    mock_rsync_run = MockCalledMethod()
+    monkeypatch.setattr('treesync.ssh.run', mock_ssh_run)
+    monkeypatch.setattr('treesync.target.run', mock_rsync_run)
+    # Transfer time is measured around the scheduler run, not summed from job durations
+    monkeypatch.setattr(SyncJob, 'duration', 100.0)
+    source, _destination, config_file = create_source_directory(tmpdir, EXCLUDES_FILE)
+    create_test_config(config_file, 'test', source, 'server:/backup/test')
+
+    script = Treesync()
+    testargs = ['treesync', 'push', '--ssh-multiplexing', '--config', str(config_file), 'test']
+    with monkeypatch.context() as context:
+        validate_script_run_exception_with_args(script, context, testargs, exit_code=0)
+
+    # Master connection is opened and closed
+    assert mock_ssh_run.call_count == 2
+    assert mock_rsync_run.call_count == 1
+    rsync_args = mock_rsync_run.args[0][0]
+    assert len([arg for arg in rsync_args if arg.startswith('--rsh=ssh -o ControlMaster=no')]) == 1
+    captured = capsys.readouterr()
+    assert 'ssh connection setup' in captured.out
+    assert float(re.search(r'transfer ([0-9.]+)s', captured.out).group(1)) < 100
+
+
+# pylint: disable=unused-argument
+def test_cli_treesync_push_skip_unchanged(mock_no_user_sync_config, tmpdir, capsys, monkeypatch) -> None:
+    """
+    Test running 'treesync push' skipping targets not modified since last push
+    """
+    mock_rsync_run = MockCalledMethod()
+    monkeypatch.setattr('treesync.target.run', mock_rsync_run)
+    source, _destination, config_file = create_source_directory(tmpdir, EXCLUDES_FILE)
+
+    script = Treesync()
+    testargs = ['treesync', 'push', '--skip-unchanged', '--config', str(config_file), 'test']
+    for _run in range(2):
+        with monkeypatch.context() as context:
+            validate_script_run_exception_with_args(script, context, testargs, exit_code=0)
+    assert mock_rsync_run.call_count == 1
+    captured = capsys.readouterr()
+    assert 'pushed 1 targets, skipped 0 unchanged, 0 failed' in captured.out
+    assert 'pushed 0 targets, skipped 1 unchanged, 0 failed' in captured.out
+
+    source.joinpath('modified.txt').write_text('modified\n', encoding='utf-8')
+    with monkeypatch.context() as context:
+        validate_script_run_exception_with_args(script, context, testargs, exit_code=0)
+    assert mock_rsync_run.call_count == 2
+
+
+# pylint: disable=unused-argument
+def test_cli_treesync_push_report(mock_no_user_sync_config, tmpdir, monkeypatch) -> None:
+    """
+    Test running 'treesync push' with a JSONL report of the targets
+    """
+    monkeypatch.setattr('treesync.target.run', MockCalledMethod())
+    _source, _destination, config_file = create_source_directory(tmpdir, EXCLUDES_FILE)
+    report = Path(tmpdir, 'report.jsonl')
+
+    script = Treesync()
+    testargs = ['treesync', 'push', '--report', str(report), '--config', str(config_file), 'test']
+    with monkeypatch.context() as context:
+        validate_script_run_exception_with_args(script, context, testargs, exit_code=0)
+
+    records = [json.loads(line) for line in report.read_text(encoding='utf-8').splitlines()]
+    assert len(records) == 2
+    assert records[0]['type'] == 'target'
+    assert records[0]['target'] == 'test'
+    assert records[0]['status'] == 'succeeded'
+    assert records[0]['exit_code'] == 0
+    assert records[0]['command'][0] == 'rsync'
+    assert records[0]['finished'] >= records[0]['started']
+    assert records[1]['type'] == 'summary'
+    assert records[1]['targets'] == 1
+    assert records[1]['succeeded'] == 1
+
+
+# pylint: disable=unused-argument
+def test_cli_treesync_push_metrics(mock_no_user_sync_config, tmpdir, monkeypatch) -> None:
+    """
+    Test running 'treesync push' writing Prometheus metrics
+    """
+    monkeypatch.setattr('treesync.target.run', MockCalledMethod())
+    _source, _destination, config_file = create_source_directory(tmpdir, EXCLUDES_FILE)
+    metrics = Path(tmpdir, 'metrics.prom')
+
+    script = Treesync()
+    testargs = ['treesync', 'push', '--metrics-file', str(metrics), '--config', str(config_file), 'test']
+    with monkeypatch.context() as context:
+        validate_script_run_exception_with_args(script, context, testargs, exit_code=0)
+    lines = metrics.read_text(encoding='utf-8').splitlines()
+    assert 'treesync_target_runs_total{target="test",action="push"} 1' in lines
+    assert 'treesync_run_targets{action="push",status="succeeded"} 1' in lines
+
+
+# pylint: disable=unused-argument
+def test_cli_treesync_push_incremental(mock_no_user_sync_config, tmpdir, capsys, monkeypatch) -> None:
+    """
+    Test running 'treesync push' pushing only paths changed since last push
+    """
+    mock_rsync_run = MockCalledMethod()
+    monkeypatch.setattr('treesync.target.run', mock_rsync_run)
+    source, _destination, config_file = create_source_directory(tmpdir, EXCLUDES_FILE)
+
+    script = Treesync()
+    testargs = ['treesync', 'push', '--incremental', '--config', str(config_file), 'test']
+    for _run in range(2):
+        with monkeypatch.context() as context:
+            validate_script_run_exception_with_args(script, context, testargs, exit_code=0)
+    assert mock_rsync_run.call_count == 1
+    assert not any(arg.startswith('--files-from') for arg in mock_rsync_run.args[0][0])
+    captured = capsys.readouterr()
+    assert 'pushed 0 targets, skipped 1 unchanged, 0 failed' in captured.out
+
+    source.joinpath('modified.txt').write_text('modified\n', encoding='utf-8')
+    with monkeypatch.context() as context:
+        validate_script_run_exception_with_args(script, context, testargs, exit_code=0)
+    assert mock_rsync_run.call_count == 2
+    assert '--from0' in mock_rsync_run.args[1][0]
+
+
+# pylint: disable=unused-argument
+def test_cli_treesync_push_batch(mock_no_user_sync_config, tmp_path, capsys, monkeypatch) -> None:
+    """
+    Test running 'treesync push' pushing small targets to the same host with one rsync command
+    """
+    rsync = create_mock_rsync(tmp_path.joinpath('rsync'), output='.vim/vimrc\n.zsh/zshrc\n')
+    targets = {}
+    for name in ('.vim', '.zsh'):
+        tmp_path.joinpath('home', name).mkdir(parents=True)
+        targets[name.lstrip('.')] = {
+            'source': str(tmp_path.joinpath('home', name)),
+            'destination': f'server:/home/user/{name}',
+        }
+    config_file = tmp_path.joinpath('test.yml')
+    config_file.write_text(
+        yaml.safe_dump({'defaults': {'rsync_command': str(rsync)}, 'targets': targets}),
+        encoding='utf-8'
+    )
+
+    script = Treesync()
+    testargs = ['treesync', 'push', '--batch', '--report', str(tmp_path.joinpath('report.jsonl')),
+                '--config', str(config_file), 'vim', 'zsh']
+    with monkeypatch.context() as context:
+        validate_script_run_exception_with_args(script, context, testargs, exit_code=0)
+    captured = capsys.readouterr()
+    assert captured.out.splitlines() == [
+        'push 2 targets -> server:/home/user',
+        f'push {tmp_path}/home/.vim -> server:/home/user/.vim',
+        '.vim/vimrc',
+        f'push {tmp_path}/home/.zsh -> server:/home/user/.zsh',
+        '.zsh/zshrc',
+    ]
+    records = [json.loads(line) for line in tmp_path.joinpath('report.jsonl').read_text(encoding='utf-8').splitlines()]
+    assert [record.get('target') for record in records] == ['vim', 'zsh', None]
+    assert records[2]['succeeded'] == 2
+
+
+# pylint: disable=unused-argument
+def test_cli_treesync_push_fan_out(mock_no_user_sync_config, tmp_path, capsys, monkeypatch) -> None:
+    """
+    Test running 'treesync push' pushing one source to many mirrors with a fan-out push
+    """
+    mock_rsync_run = MockCalledMethod()
+    monkeypatch.setattr('treesync.target.run', mock_rsync_run)
+    tmp_path.joinpath('data').mkdir()
+    config_file = tmp_path.joinpath('test.yml')
+    config_file.write_text(
+        yaml.safe_dump({
+            'sources': [{'name': 'data', 'path': str(tmp_path.joinpath('data'))}],
+            'hosts': [
+                {'name': name, 'targets': [{'source': 'data', 'destination': f'{name}:/srv/data'}]}
+                for name in ('mirror1', 'mirror2', 'mirror3')
+            ],
+        }),
+        encoding='utf-8'
+    )
+
+    script = Treesync()
+    testargs = ['treesync', 'push', '--fan-out', '--config', str(config_file), 'data']
+    with monkeypatch.context() as context:
+        validate_script_run_exception_with_args(script, context, testargs, exit_code=0)
+    assert mock_rsync_run.call_count == 3
+    assert any(arg.startswith('--write-batch=') for arg in mock_rsync_run.args[0][0])
+    captured = capsys.readouterr()
+    assert captured.out.splitlines()[0] == f'push {tmp_path}/data to 3 mirrors'
+
+
+# pylint: disable=unused-argument
+def test_cli_treesync_push_seed(mock_no_user_sync_config, tmp_path, capsys, monkeypatch) -> None:
+    """
+    Test running 'treesync push --seed' seeding an empty destination before the rsync push
+    """
+    rsync = create_mock_rsync(tmp_path.joinpath('rsync'), output='')
+    source = tmp_path.joinpath('source')
+    source.mkdir()
+    source.joinpath('file.txt').write_text('data\n', encoding='utf-8')
+    destination = tmp_path.joinpath('destination')
+    config_file = tmp_path.joinpath('test.yml')
+    config_file.write_text(
+        yaml.safe_dump({
+            'defaults': {'rsync_command': str(rsync)},
+            'targets': {'seeded': {'source': str(source), 'destination': str(destination)}},
+        }),
+        encoding='utf-8'
+    )
+
+    script = Treesync()
+    testargs = ['treesync', 'push', '--seed', '--jobs', '2', '--report', str(tmp_path.joinpath('report.jsonl')),
+                '--config', str(config_file), 'seeded']
+    with monkeypatch.context() as context:
+        validate_script_run_exception_with_args(script, context, testargs, exit_code=0)
+    captured = capsys.readouterr()
+    assert f'push {source} -> {destination}: seeded with tar, throughput tar' in captured.out
+    assert destination.joinpath('file.txt').read_text(encoding='utf-8') == 'data\n'
+    records = [json.loads(line) for line in tmp_path.joinpath('report.jsonl').read_text(encoding='utf-8').splitlines()]
+    assert records[0]['seed']['files'] == 1
+    assert 'tar' in records[0]['throughput']
@@ -0,0 +1,100 @@
+#
+# Copyright (C) 2020-2023 by Ilkka Tuohela <hile@iki.fi>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+"""
+Unit tests for 'treesync watch' command
+"""
+import json
+
+from cli_toolkit.tests.script import validate_script_run_exception_with_args
+from sys_toolkit.tests.mock import MockCalledMethod
+
+from treesync.bin.treesync.main import Treesync
+
+from ..conftest import EXCLUDES_FILE
+from ..utils import create_source_directory
+
+
+class MockWatcherWait:
+    """
+    Mock TreeWatcher.wait returning the watched targets once, then interrupting the command
+    """
+    def __init__(self) -> None:
+        self.call_count = 0
+
+    def __get__(self, watcher, owner=None):
+        return lambda timeout=None: self(watcher, timeout)
+
+    def __call__(self, watcher, timeout=None):
+        self.call_count += 1
+        if self.call_count > 1:
+            raise KeyboardInterrupt
+        return [tree.target for tree in watcher.trees]
+
+
+def test_cli_treesync_watch_no_targets(monkeypatch) -> None:
+    """
+    Test running 'treesync watch' without targets
+    """
+    script = Treesync()
+    testargs = ['treesync', 'watch']
+    with monkeypatch.context() as context:
+        validate_script_run_exception_with_args(script, context, testargs, exit_code=1)
+
+
+# pylint: disable=unused-argument
+def test_cli_treesync_watch(mock_no_user_sync_config, tmpdir, monkeypatch) -> None:
+    """
+    Test running 'treesync watch' pushes targets initially and when changed
+    """
+    mock_rsync_run = MockCalledMethod()
+    mock_wait = MockWatcherWait()
+    monkeypatch.setattr('treesync.target.run', mock_rsync_run)
+    monkeypatch.setattr('treesync.watch.TreeWatcher.wait', mock_wait)
+    _source, _destination, config_file = create_source_directory(tmpdir, EXCLUDES_FILE)
+
+    script = Treesync()
+    testargs = ['treesync', 'watch', '--debounce', '0.1', '--config', str(config_file), 'test']
+    with monkeypatch.context() as context:
+        validate_script_run_exception_with_args(script, context, testargs, exit_code=0)
+    assert mock_wait.call_count == 2
+    assert mock_rsync_run.call_count == 2
+
+    mock_wait.call_count = 0
+    testargs = ['treesync', 'watch', '--no-initial-push', '--config', str(config_file), 'test']
+    with monkeypatch.context() as context:
+        validate_script_run_exception_with_args(script, context, testargs, exit_code=0)
+    assert mock_rsync_run.call_count == 3
+
+
+# pylint: disable=unused-argument
+def test_cli_treesync_watch_report(mock_no_user_sync_config, tmpdir, monkeypatch) -> None:
+    """
+    Test running 'treesync watch' writes records of all pushes to the report file
+    """
+    monkeypatch.setattr('treesync.target.run', MockCalledMethod())
+    monkeypatch.setattr('treesync.watch.TreeWatcher.wait', MockWatcherWait())
+    _source, _destination, config_file = create_source_directory(tmpdir, EXCLUDES_FILE)
+    report = tmpdir.join('report.jsonl')
+    report.write('stale\n')
+
+    script = Treesync()
+    testargs = ['treesync', 'watch', '--report', str(report), '--config', str(config_file), 'test']
+    with monkeypatch.context() as context:
+        validate_script_run_exception_with_args(script, context, testargs, exit_code=0)
+    records = [json.loads(line) for line in report.read().splitlines()]
+    assert [record['type'] for record in records] == ['target', 'summary', 'target', 'summary']
+
+
+# pylint: disable=unused-argument
+def test_cli_treesync_watch_invalid_debounce(mock_no_user_sync_config, tmpdir, monkeypatch) -> None:
+    """
+    Test running 'treesync watch' with invalid debounce seconds
+    """
+    _source, _destination, config_file = create_source_directory(tmpdir, EXCLUDES_FILE)
+    script = Treesync()
+    testargs = ['treesync', 'watch', '--debounce', '-1', '--config', str(config_file), 'test']
+    with monkeypatch.context() as context:
+        validate_script_run_exception_with_args(script, context, testargs, exit_code=1)
@@ -11,6 +11,8 @@ from pathlib import Path
 
 import pytest
 
+from sys_toolkit.exceptions import ConfigurationError as ConfigurationFileError
+
 from treesync.configuration.sources import SourcesConfigurationSection
 from treesync.configuration import Configuration
 from treesync.constants import (
@@ -340,3 +342,42 @@ def test_cofiguration_sync_targets_mixed_list(mock_no_user_sync_config) -> None:
     assert b >= a
     assert a >= a  # pylint: disable=comparison-with-itself
     assert b >= str(b)
+
+
+def test_configuration_max_parallel_limits() -> None:
+    """
+    Test loading max_parallel limits from hosts and servers configuration sections
+    """
+    config = Configuration(HOST_SOURCES_CONFIG)
+    assert config.defaults.max_parallel is None
+    assert config.hosts.get(VALID_HOST_NAME).max_parallel == 2
+    assert config.hosts.get(NO_FLAGS_HOST_NAME).max_parallel is None
+    for target in config.sync_targets:
+        if target.hostname == VALID_HOST_NAME:
+            assert target.max_parallel == 2
+        else:
+            assert target.max_parallel is None
+
+    config = Configuration(OLD_FORMAT_SERVER_FLAGS_CONFIG)
+    assert config.targets.get('data').max_parallel == 4
+    assert config.targets.get('data-remote').max_parallel is None
+    assert config.targets.get(DUMMY_TARGET_NAME).max_parallel is None
+
+
+def test_configuration_max_parallel_invalid(tmpdir) -> None:
+    """
+    Test loading invalid max_parallel limits
+    """
+    config_file = Path(tmpdir, 'invalid.yml')
+    config_file.write_text('defaults:\n  max_parallel: 0\n', encoding='utf-8')
+    with pytest.raises(ConfigurationFileError):
+        Configuration(config_file)
+
+    config_file.write_text(
+        'servers:\n  server1:\n    max_parallel: -1\n'
+        'targets:\n  data:\n    source: /data\n    destination: server1:/data\n',
+        encoding='utf-8'
+    )
+    config = Configuration(config_file)
+    with pytest.raises(ConfigurationError):
+        config.targets.get('data').max_parallel  # pylint: disable=pointless-statement
@@ -0,0 +1,108 @@
+#
+# Copyright (C) 2020-2023 by Ilkka Tuohela <hile@iki.fi>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+"""
+Unit tests for treesync.configuration.snapshot module
+"""
+import shutil
+
+from pathlib import Path
+
+from treesync.configuration import Configuration
+from treesync.configuration.snapshot import (
+    ConfigurationSnapshot,
+    ConfigurationSnapshotCache,
+    SnapshotTarget,
+    load_configuration,
+)
+from treesync.directories import user_cache_directory
+
+from ..conftest import (
+    EXCLUDES_CONFIG,
+    EXPECTED_HOSTS_TOTAL_TARGETS_COUNT,
+    HOST_INVALID_SOURCE_CONFIG,
+    HOST_SOURCES_CONFIG,
+    VALID_HOST_NAME,
+)
+
+
+def test_user_cache_directory(monkeypatch) -> None:
+    """
+    Test detecting user cache directory
+    """
+    monkeypatch.delenv('XDG_CACHE_HOME')
+    assert user_cache_directory() == Path('~/.cache/treesync').expanduser()
+
+
+# pylint: disable=unused-argument
+def test_configuration_snapshot_no_files(mock_no_user_sync_config) -> None:
+    """
+    Test loading configuration without configuration files
+    """
+    config = load_configuration()
+    assert isinstance(config, Configuration)
+    assert not user_cache_directory().exists()
+
+
+# pylint: disable=unused-argument
+def test_configuration_snapshot_load(mock_no_user_sync_config, tmpdir) -> None:
+    """
+    Test compiling and loading a configuration snapshot
+    """
+    config_file = Path(tmpdir, 'treesync.yml')
+    shutil.copyfile(HOST_SOURCES_CONFIG, config_file)
+
+    config = load_configuration(config_file)
+    assert isinstance(config, Configuration)
+    cache = ConfigurationSnapshotCache(config_file)
+    assert cache.cache_file.is_file()
+
+    snapshot = load_configuration(config_file)
+    assert isinstance(snapshot, ConfigurationSnapshot)
+    assert isinstance(snapshot.__repr__(), str)
+    assert len(snapshot.sync_targets) == EXPECTED_HOSTS_TOTAL_TARGETS_COUNT
+    for target, cached in zip(config.sync_targets, snapshot.sync_targets):
+        assert isinstance(cached, SnapshotTarget)
+        assert cached.name == target.name
+        assert cached.hostname == target.hostname
+        assert cached.source == target.source
+        assert cached.max_parallel == target.max_parallel
+        assert cached.excluded == target.excluded
+        assert cached.host_configuration is None
+        assert cached.get_push_command_args()[:-3] == target.get_push_command_args()[:-3]
+    assert snapshot.filter_sync_targets([VALID_HOST_NAME]) == config.filter_sync_targets([VALID_HOST_NAME])
+
+    assert isinstance(load_configuration(config_file, use_cache=False), Configuration)
+
+    # Modified configuration file invalidates the snapshot
+    with config_file.open('a', encoding='utf-8') as handle:
+        handle.write('\n')
+    assert isinstance(load_configuration(config_file), Configuration)
+    assert isinstance(load_configuration(config_file), ConfigurationSnapshot)
+
+
+# pylint: disable=unused-argument
+def test_configuration_snapshot_invalid_cache_file(mock_no_user_sync_config) -> None:
+    """
+    Test loading configuration with invalid snapshot cache file contents
+    """
+    cache = ConfigurationSnapshotCache(HOST_SOURCES_CONFIG)
+    cache.cache_file.parent.mkdir(parents=True)
+    for data in ('invalid', '[]', '{"version": 0}'):
+        cache.cache_file.write_text(data, encoding='utf-8')
+        assert cache.read(cache.get_fingerprints()) is None
+        assert isinstance(cache.load(), Configuration)
+    assert isinstance(cache.load(), ConfigurationSnapshot)
+
+
+# pylint: disable=unused-argument
+def test_configuration_snapshot_not_compiled(mock_no_user_sync_config) -> None:
+    """
+    Test configurations that can't be compiled to snapshots
+    """
+    for path in (HOST_INVALID_SOURCE_CONFIG, EXCLUDES_CONFIG):
+        cache = ConfigurationSnapshotCache(path)
+        assert isinstance(cache.load(), Configuration)
+        assert not cache.cache_file.exists()
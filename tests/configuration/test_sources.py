@@ -29,3 +29,17 @@ def test_configuration_sources_get_source_valid(mock_config_host_sources) -> Non
     config = Configuration(HOST_SOURCES_CONFIG)
     source = config.sources.get(DUMMY_TARGET_NAME)
     assert isinstance(source, SourceConfiguration)
+
+
+def test_configuration_sources_lookup_modified() -> None:
+    """
+    Test looking up sources after modifying the sources list
+    """
+    config = Configuration(HOST_SOURCES_CONFIG)
+    source = config.sources.get(DUMMY_TARGET_NAME)
+    config.sources.append(SourceConfiguration({'name': INVALID_TARGET_NAME, 'path': '/tmp'}))
+    assert config.sources.get(INVALID_TARGET_NAME) is not None
+    config.sources[-1] = source
+    assert config.sources.get(INVALID_TARGET_NAME) is None
+    config.sources.insert(0, SourceConfiguration({'name': DUMMY_TARGET_NAME, 'path': '/tmp'}))
+    assert config.sources.get(DUMMY_TARGET_NAME) is config.sources[0]
@@ -59,13 +59,24 @@ OLD_FORMAT_SERVER_FLAGS_CONFIG = TEST_DATA.joinpath('old_format_servers.yml')
 
 
 @pytest.fixture(autouse=True)
-def common_fixtures(cli_mock_argv) -> None:
+def common_fixtures(cli_mock_argv, mock_user_directories) -> None:
     """
     Wrap cli_mock_argv to be used in all tests
     """
     print('mock CLI argv', cli_mock_argv)
 
 
+@pytest.fixture
+def mock_user_directories(monkeypatch, tmp_path) -> Iterator[Path]:
+    """
+    Mock user cache, data and state directories to a temporary directory
+    """
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path.joinpath('cache')))
+    monkeypatch.setenv('XDG_DATA_HOME', str(tmp_path.joinpath('data')))
+    monkeypatch.setenv('XDG_STATE_HOME', str(tmp_path.joinpath('state')))
+    yield tmp_path
+
+
 @pytest.fixture
 def mock_no_user_sync_config(monkeypatch) -> None:
     """
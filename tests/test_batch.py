@@ -0,0 +1,187 @@
+#
+# Copyright (C) 2020-2023 by Ilkka Tuohela <hile@iki.fi>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+"""
+Unit tests for treesync.batch module
+"""
+import pytest
+import yaml
+
+from treesync.batch import (
+    BatchSyncJob,
+    get_batch_key,
+    get_batch_roots,
+    has_unbatchable_flags,
+    plan_batches,
+)
+from treesync.configuration import Configuration
+from treesync.exceptions import SyncError
+from treesync.scheduler import SyncJob
+from treesync.state import SyncStateStore
+
+#: Test target source paths and destinations
+TEST_TARGETS = {
+    'vim': ('home/.vim', 'server:/home/user/.vim'),
+    'zsh': ('home/.zsh', 'server:/home/user/.zsh'),
+    'nvim': ('home/.config/nvim', 'server:/home/user/.config/nvim'),
+    'renamed': ('home/data', 'server:/srv/backup'),
+    'other': ('home/.emacs.d', 'other:/home/user/.emacs.d'),
+    'local': ('home/.local', 'home/backup/.local'),
+}
+
+
+class MockStreamedCommand:
+    """
+    Mock Target.run_sync_command_streamed writing output lines
+    """
+    def __init__(self, lines, error: bool = False) -> None:
+        self.lines = lines
+        self.error = error
+        self.args = []
+
+    def __call__(self, *args, output=None, stats=False):
+        self.args.append(args)
+        for line in self.lines:
+            output.write(f'{line}\n')
+        if self.error:
+            raise SyncError('batch failed')
+
+
+def create_batch_targets(tmp_path, **kwargs):
+    """
+    Create targets for batch tests
+    """
+    targets = {}
+    for name, (source, destination) in TEST_TARGETS.items():
+        tmp_path.joinpath(source).mkdir(parents=True)
+        tmp_path.joinpath(source, 'file.txt').write_text('data\n', encoding='utf-8')
+        if not destination.startswith(('server:', 'other:')):
+            destination = str(tmp_path.joinpath(destination))
+        targets[name] = {'source': str(tmp_path.joinpath(source)), 'destination': destination, **kwargs}
+    config_file = tmp_path.joinpath('test.yml')
+    config_file.write_text(yaml.safe_dump({'targets': targets}), encoding='utf-8')
+    config = Configuration(config_file)
+    return {name: config.sync_targets.get(name) for name in TEST_TARGETS}
+
+
+def create_jobs(targets, expected_duration=1.0, **kwargs):
+    """
+    Create push jobs for targets with expected durations
+    """
+    jobs = []
+    for target in targets.values():
+        job = SyncJob(target, 'push', **kwargs)
+        job.expected_duration = expected_duration
+        jobs.append(job)
+    return jobs
+
+
+def test_batch_unbatchable_flags() -> None:
+    """
+    Test detecting rsync flags preventing batches
+    """
+    assert not has_unbatchable_flags(['--archive', '--delete', '-av'])
+    assert has_unbatchable_flags(['--relative'])
+    assert has_unbatchable_flags(['-aR'])
+    assert has_unbatchable_flags(['--include=*.txt'])
+
+
+# pylint: disable=unused-argument
+def test_batch_keys_and_roots(mock_no_user_sync_config, tmp_path) -> None:
+    """
+    Test grouping keys and common roots of targets
+    """
+    targets = create_batch_targets(tmp_path)
+    assert get_batch_key(targets['vim']) == get_batch_key(targets['nvim'])
+    assert get_batch_key(targets['vim']) != get_batch_key(targets['other'])
+    assert get_batch_key(targets['local']) is None
+    assert get_batch_roots(targets['vim']) == [('/home/user', 1)]
+    assert get_batch_roots(targets['nvim']) == [('/home/user/.config', 1), ('/home/user', 2)]
+    assert get_batch_roots(targets['renamed']) == []
+
+    targets = create_batch_targets(tmp_path.joinpath('excludes'), excludes=['/build'])
+    assert get_batch_key(targets['vim']) is None
+
+
+# pylint: disable=unused-argument
+def test_batch_plan(mock_no_user_sync_config, tmp_path) -> None:
+    """
+    Test combining jobs of compatible small targets to batches
+    """
+    targets = create_batch_targets(tmp_path)
+    jobs = create_jobs(targets)
+    planned = plan_batches(jobs)
+    assert len(planned) == 4
+    batch = planned[0]
+    assert isinstance(batch, BatchSyncJob)
+    assert [str(job.target) for job in batch.members] == ['vim', 'zsh', 'nvim']
+    assert batch.expected_duration == 3.0
+    assert planned[1:] == jobs[3:]
+    assert all(job.batch is batch for job in jobs[:3])
+
+    args = batch.target_batch.get_push_command_args()
+    assert args[-5:-4] == ['--no-implied-dirs']
+    assert args[-4:] == [
+        f'{tmp_path}/home/./.vim/',
+        f'{tmp_path}/home/./.zsh/',
+        f'{tmp_path}/home/./.config/nvim/',
+        'server:/home/user/',
+    ]
+
+    for jobs in (create_jobs(targets, expected_duration=3600), create_jobs(targets, skip_unchanged=True)):
+        assert plan_batches(jobs) == jobs
+
+
+# pylint: disable=unused-argument
+def test_batch_run(mock_no_user_sync_config, tmp_path) -> None:
+    """
+    Test running a batch job and splitting the results to the targets
+    """
+    targets = create_batch_targets(tmp_path)
+    state = SyncStateStore()
+    jobs = create_jobs(targets, state=state)
+    batch = plan_batches(jobs)[0]
+    mock_command = MockStreamedCommand([
+        'sending incremental file list',
+        '.vim/file.txt',
+        'deleting .zsh/removed.txt',
+        '.config/nvim/file.txt',
+        'sent 100 bytes  received 20 bytes',
+    ])
+    targets['vim'].run_sync_command_streamed = mock_command
+    batch.run()
+    assert len(mock_command.args) == 1
+    vim, zsh, nvim = batch.members
+    assert vim.output.splitlines() == [
+        'sending incremental file list',
+        '.vim/file.txt',
+        'sent 100 bytes  received 20 bytes',
+    ]
+    assert 'deleting .zsh/removed.txt' in zsh.output
+    assert '.vim/file.txt' not in zsh.output
+    assert nvim.status == 'succeeded'
+    assert nvim.result.args == list(mock_command.args[0])
+    assert nvim.summary.endswith('(batch of 3 targets)')
+    nvim.stats = True
+    assert nvim.result.stats is None
+    assert nvim.summary.endswith('statistics not available for targets in a batch')
+    nvim.stats = False
+    assert len(state.get_history('zsh', 'push')) == 1
+    assert sum(job.duration for job in batch.members) == pytest.approx(batch.duration)
+    assert state.get_last('zsh', 'push').duration == pytest.approx(zsh.duration)
+
+    # Duration of the batch is split by the expected durations of the targets
+    batch.started, batch.finished = 0.0, 6.0
+    vim.expected_duration = 4.0
+    assert batch.get_member_durations() == [4.0, 1.0, 1.0]
+    vim.expected_duration = None
+    assert batch.get_member_durations() == [2.0, 2.0, 2.0]
+    vim.expected_duration = 1.0
+
+    targets['vim'].run_sync_command_streamed = MockStreamedCommand([], error=True)
+    batch.run()
+    assert all(job.failed for job in batch.members)
+    assert len(state.get_history('nvim', 'push')) == 2
+    state.close()
@@ -0,0 +1,167 @@
+#
+# Copyright (C) 2020-2023 by Ilkka Tuohela <hile@iki.fi>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+"""
+Unit tests for treesync.capabilities module
+"""
+from subprocess import CalledProcessError
+
+import pytest
+
+from treesync.capabilities import CapabilityProbe, RsyncCapabilities, get_capability_flags, parse_rsync_version
+from treesync.exceptions import SyncError
+from treesync.state import SyncStateStore
+
+from .utils import create_remote_target
+
+RSYNC_327_VERSION = """rsync  version 3.2.7  protocol version 31
+Copyright (C) 1996-2022 by Andrew Tridgell, Wayne Davison, and others.
+Web site: https://rsync.samba.org/
+Capabilities:
+    64-bit files, 64-bit inums, 64-bit timestamps, 64-bit long ints,
+    socketpairs, symlinks, symtimes, hardlinks, hardlink-specials,
+    hardlink-symlinks, IPv6, atimes, batchfiles, inplace, append, ACLs,
+    xattrs, optional secluded-args, iconv, prealloc, stop-at, no crtimes
+Optimizations:
+    SIMD-roll, no asm-roll, openssl-crypto, no asm-MD5
+Checksum list:
+    xxh128 xxh3 xxh64 (xxhash) md5 md4 sha1 none
+Compress list:
+    zstd lz4 zlibx zlib none
+Daemon auth list:
+    sha512 sha256 sha1 md5 md4
+
+rsync comes with ABSOLUTELY NO WARRANTY.  This is free software, and you
+are welcome to redistribute it under certain conditions.
+"""
+
+RSYNC_31_VERSION = """rsync  version 3.1.3  protocol version 31
+Copyright (C) 1996-2018 by Andrew Tridgell, Wayne Davison, and others.
+Web site: http://rsync.samba.org/
+Capabilities:
+    64-bit files, 64-bit inums, 64-bit timestamps, 64-bit long ints,
+    socketpairs, hardlinks, symlinks, IPv6, batchfiles, inplace,
+    append, ACLs, xattrs, iconv, symtimes, prealloc
+
+rsync comes with ABSOLUTELY NO WARRANTY.
+"""
+
+RSYNC_MACOS_VERSION = """openrsync: protocol version 29
+rsync version 2.6.9 compatible
+"""
+
+
+class MockRun:
+    """
+    Mock subprocess.run returning rsync --version output
+    """
+    def __init__(self, local: str = RSYNC_327_VERSION, remote: str = RSYNC_327_VERSION) -> None:
+        self.local = local
+        self.remote = remote
+        self.commands = []
+
+    def __call__(self, args, **kwargs):
+        self.commands.append(args)
+        output = self.local if args[0] == 'rsync' else self.remote
+        if output is None:
+            raise CalledProcessError(255, args)
+
+        # pylint: disable=too-few-public-methods
+        class Result:
+            """
+            Mock process result
+            """
+            stdout = output.encode('utf-8')
+        return Result()
+
+
+def test_capabilities_parse_version() -> None:
+    """
+    Test parsing rsync --version output
+    """
+    capabilities = parse_rsync_version(RSYNC_327_VERSION)
+    assert capabilities.version == '3.2.7'
+    assert capabilities.protocol == 31
+    assert 'inplace' in capabilities.features
+    assert 'no crtimes' in capabilities.features
+    assert capabilities.checksums == ['xxh128', 'xxh3', 'xxh64', 'md5', 'md4', 'sha1', 'none']
+    assert capabilities.compressions == ['zstd', 'lz4', 'zlibx', 'zlib', 'none']
+    assert RsyncCapabilities.from_json(capabilities.to_json()) == capabilities
+
+    capabilities = parse_rsync_version(RSYNC_31_VERSION)
+    assert capabilities.version == '3.1.3'
+    assert not capabilities.checksums
+    assert not capabilities.compressions
+
+    capabilities = parse_rsync_version(RSYNC_MACOS_VERSION)
+    assert capabilities.version is None
+    assert capabilities.protocol == 29
+
+    with pytest.raises(ValueError):
+        RsyncCapabilities.from_json('{"unknown": 1}')
+
+
+def test_capabilities_flags() -> None:
+    """
+    Test choosing algorithms supported by both sides
+    """
+    local = parse_rsync_version(RSYNC_327_VERSION)
+    remote = RsyncCapabilities(checksums=['xxh64', 'md5'], compressions=['lz4', 'zlib'])
+    assert get_capability_flags(['-a'], local, remote) == ['--checksum-choice=xxh64']
+    assert get_capability_flags(['-az'], local, remote) == ['--checksum-choice=xxh64', '--compress-choice=lz4']
+    assert get_capability_flags(['-a', '--compress', '--cc=md5'], local, remote) == ['--compress-choice=lz4']
+    assert get_capability_flags(['-az', '--zc=zlib', '--checksum-choice=md5'], local, remote) == []
+    assert get_capability_flags(['-az'], local, parse_rsync_version(RSYNC_31_VERSION)) == []
+
+
+# pylint: disable=unused-argument
+def test_capabilities_probe(mock_no_user_sync_config, tmp_path, monkeypatch) -> None:
+    """
+    Test probing target hosts with results cached in the state store
+    """
+    mock_run = MockRun(remote=RSYNC_327_VERSION.replace('zstd ', ''))
+    monkeypatch.setattr('treesync.capabilities.run', mock_run)
+    target = create_remote_target(tmp_path, flags=['-az', '--rsh=ssh -p 2222', '--rsync-path=/opt/bin/rsync'])
+    assert not target.probe_capabilities
+    assert CapabilityProbe.get_probe_command(target) == [
+        'ssh', '-p', '2222', 'server', '/opt/bin/rsync --version'
+    ]
+
+    state = SyncStateStore()
+    host = CapabilityProbe(state).update(target)
+    assert host is target.target_host
+    assert target.remote_rsync_path == '/opt/bin/rsync'
+    assert host.capabilities['/opt/bin/rsync'].version == '3.2.7'
+    assert '--checksum-choice=xxh128' in target.flags
+    assert '--compress-choice=lz4' in target.flags
+    assert len(mock_run.commands) == 2
+
+    # Hosts are probed once and cached results are used until they expire
+    assert CapabilityProbe(state).update(target) is None
+    host.capabilities.clear()
+    assert CapabilityProbe(state).update(target) is host
+    assert len(mock_run.commands) == 3
+    host.capabilities.clear()
+    assert CapabilityProbe(state, ttl=-1).update(target) is host
+    assert len(mock_run.commands) == 5
+
+    # Each remote rsync command of a host is probed and cached separately
+    other = create_remote_target(tmp_path.joinpath('other'), flags=['-az'])
+    assert CapabilityProbe(state).update(other) is other.target_host
+    assert len(mock_run.commands) == 7
+    assert mock_run.commands[-1][-1] == 'rsync --version'
+    assert list(other.target_host.capabilities) == ['rsync']
+    host.capabilities = {'rsync': other.target_host.capabilities['rsync']}
+    assert '--checksum-choice=xxh128' not in target.flags
+    state.close()
+
+    target = create_remote_target(tmp_path.joinpath('failed'), defaults={'probe_capabilities': True})
+    assert target.probe_capabilities
+    mock_run.remote = None
+    probe = CapabilityProbe()
+    with pytest.raises(SyncError):
+        probe.update(target)
+    assert probe.update(target) is None
+    assert target.target_host.capabilities == {}
@@ -0,0 +1,196 @@
+#
+# Copyright (C) 2020-2023 by Ilkka Tuohela <hile@iki.fi>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+"""
+Unit tests for treesync.compression module
+"""
+import json
+
+from treesync.compression import (
+    FAST_COMPRESSION_LEVEL,
+    SLOW_LINK_COMPRESSION_LEVEL,
+    CompressionPolicy,
+    HostTransferProfile,
+    configures_compression,
+    decide_compression,
+)
+from treesync.report import RunReport
+from treesync.scheduler import SyncJob
+from treesync.state import SyncStateStore, TransferSample
+from treesync.stats import SyncResult, SyncStats
+
+from .utils import create_remote_target
+
+MB = 1024 ** 2
+
+
+def create_sample(duration: float, literal_data: int, sent: int, compressed: bool = False) -> TransferSample:
+    """
+    Create a transfer sample to host server
+    """
+    return TransferSample(
+        host='server',
+        finished=1000.0,
+        duration=duration,
+        compressed=compressed,
+        literal_data=literal_data,
+        bytes_sent=sent,
+        bytes_received=0,
+    )
+
+
+def create_compression_target(tmp_path, adaptive_compression=True, **kwargs):
+    """
+    Create a remote target with adaptive compression
+    """
+    defaults = {'adaptive_compression': adaptive_compression, 'skip_compress': 'gz/.zst'}
+    return create_remote_target(tmp_path, defaults=defaults, **kwargs)
+
+
+def test_compression_configured_flags() -> None:
+    """
+    Test detecting compression configured in rsync flags
+    """
+    assert not configures_compression(['--archive', '--delete'])
+    assert configures_compression(['-avz'])
+    assert configures_compression(['--archive', '--no-compress'])
+    assert configures_compression(['--skip-compress=gz'])
+    assert configures_compression(['--zc=zstd'])
+
+
+def test_compression_profile() -> None:
+    """
+    Test calculating transfer profiles of hosts
+    """
+    profile = HostTransferProfile.from_samples([
+        create_sample(10, 100 * MB, 100 * MB),
+        create_sample(10, 100 * MB, 20 * MB, compressed=True),
+        create_sample(1, 1000, 1000),
+    ])
+    assert profile.samples == 2
+    assert profile.compressed_samples == 1
+    assert profile.link_bandwidth == 10 * MB
+    assert profile.compressed_throughput == 10 * MB
+    assert profile.compression_ratio == 5
+    assert profile.cpu_bound
+    assert profile.as_dict()['compressed_wire_rate'] == 2 * MB
+
+
+def test_compression_decisions() -> None:
+    """
+    Test deciding compression from transfer profiles
+    """
+    decision = decide_compression(HostTransferProfile())
+    assert not decision.compress
+    assert decision.flags == []
+    assert decision.reason == 'no measured transfers'
+
+    # Fast LAN links are not compressed, slow links are
+    decision = decide_compression(HostTransferProfile.from_samples([create_sample(1, 500 * MB, 500 * MB)]))
+    assert not decision.compress
+    assert 'above' in decision.reason
+    decision = decide_compression(HostTransferProfile.from_samples([create_sample(10, 50 * MB, 50 * MB)]), 'gz')
+    assert decision.compress
+    assert decision.level is None
+    assert decision.flags == ['--compress', '--skip-compress=gz']
+    decision = decide_compression(HostTransferProfile.from_samples([create_sample(100, 20 * MB, 20 * MB)]), '')
+    assert decision.flags == ['--compress', f'--compress-level={SLOW_LINK_COMPRESSION_LEVEL}']
+
+    # Measured throughput with and without compression decides
+    decision = decide_compression(HostTransferProfile.from_samples([
+        create_sample(10, 50 * MB, 50 * MB),
+        create_sample(2, 50 * MB, 10 * MB, compressed=True),
+    ]))
+    assert decision.compress
+    assert decision.level is None
+    assert decision.as_dict()['basis']['compression_ratio'] == 5
+    decision = decide_compression(HostTransferProfile.from_samples([
+        create_sample(1, 500 * MB, 500 * MB),
+        create_sample(5, 500 * MB, 100 * MB, compressed=True),
+    ]))
+    assert not decision.compress
+    decision = decide_compression(HostTransferProfile.from_samples([
+        create_sample(10, 50 * MB, 50 * MB),
+        create_sample(5, 50 * MB, 10 * MB, compressed=True),
+    ]))
+    assert decision.compress
+    assert decision.level == FAST_COMPRESSION_LEVEL
+    assert 'CPU bound' in decision.reason
+
+    # Incompressible data is not compressed
+    decision = decide_compression(HostTransferProfile.from_samples([
+        create_sample(10, 50 * MB, 48 * MB, compressed=True),
+    ]))
+    assert not decision.compress
+    assert decision.reason.startswith('data compresses only')
+
+
+# pylint: disable=unused-argument
+def test_compression_policy(mock_no_user_sync_config, tmp_path) -> None:
+    """
+    Test choosing compression for targets from transfers recorded in the state store
+    """
+    state = SyncStateStore()
+    target = create_compression_target(tmp_path)
+    assert target.adaptive_compression
+    assert target.compression is None
+    assert target.default_settings.skip_compress == 'gz/zst'
+
+    # Transfers of successful jobs with statistics are recorded for the host
+    target.run_sync_command_streamed = lambda *args, output=None, stats=False: SyncStats(
+        literal_data=50 * MB,
+        bytes_sent=50 * MB,
+        bytes_received=100,
+    )
+    job = SyncJob(target, 'push', state=state, stats=True).run(capture_output=True)
+    samples = state.get_transfers('server')
+    assert len(samples) == 1
+    assert not samples[0].compressed
+    assert samples[0].duration == job.result.duration
+    assert job.result.duration <= job.duration
+
+    # Fan-out pushes and pushes without measured rsync time are not sampled
+    job = SyncJob(target, 'push', state=state, stats=True)
+    job.fan_out_run = 'run'
+    job.run(capture_output=True)
+    target.run_sync = lambda action, args, output=None, stats=False: SyncResult(
+        target=str(target),
+        action=action,
+        args=args,
+        stats=SyncStats(literal_data=50 * MB, bytes_sent=50 * MB, bytes_received=100),
+    )
+    SyncJob(target, 'push', state=state, stats=True).run(capture_output=True)
+    assert len(state.get_transfers('server')) == 1
+    del target.run_sync
+
+    for _count in range(2):
+        state.record_transfer(create_sample(10, 50 * MB, 50 * MB))
+    host = CompressionPolicy(state, 'gz/zst').update(target)
+    assert host.compression.compress
+    assert CompressionPolicy(state).update(target) is None
+    assert '--compress' in target.flags
+    assert '--skip-compress=gz/zst' in target.flags
+
+    # Compression configured in target flags takes precedence
+    target = create_compression_target(tmp_path.joinpath('flags'), flags=['--archive', '--no-compress'])
+    target.target_host.compression = host.compression
+    assert target.compression.compress is None
+    assert '--compress' not in target.flags
+
+    target = create_compression_target(tmp_path.joinpath('disabled'), adaptive_compression=False)
+    target.target_host.compression = host.compression
+    assert target.compression is None
+    assert '--compress' not in target.flags
+
+    # Decisions are written to the run report
+    target = create_compression_target(tmp_path.joinpath('report'))
+    CompressionPolicy(state).update(target)
+    report_file = tmp_path.joinpath('report.jsonl')
+    with RunReport(report_file, 'push') as report:
+        report.add_job(job)
+    record = json.loads(report_file.read_text(encoding='utf-8').splitlines()[0])
+    assert record['compression']['compress']
+    assert record['compression']['basis']['samples'] == 3
+    state.close()
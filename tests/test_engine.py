@@ -0,0 +1,135 @@
+#
+# Copyright (C) 2020-2023 by Ilkka Tuohela <hile@iki.fi>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+"""
+Unit tests for treesync.engine module
+"""
+import asyncio
+import time
+
+import pytest
+
+from treesync.configuration import Configuration
+from treesync.engine import AsyncSyncCommand
+from treesync.exceptions import SyncError
+from treesync.target import Target
+
+from .test_stats import EXPECTED_STATS, RSYNC_STATS_OUTPUT
+from .utils import create_mock_rsync, create_test_config_with_rsync
+
+
+def create_target(tmp_path, output: str = '', exit_code: int = 0, delay: int = 0, **kwargs) -> Target:
+    """
+    Create a sync target using a mock rsync command
+    """
+    source = tmp_path.joinpath('source')
+    source.mkdir(parents=True)
+    rsync = create_mock_rsync(tmp_path.joinpath('rsync'), output, exit_code=exit_code, delay=delay)
+    config_file = tmp_path.joinpath('test.yml')
+    create_test_config_with_rsync(config_file, 'test', source, tmp_path.joinpath('destination'), rsync, **kwargs)
+    return Configuration(config_file).sync_targets.get('test')
+
+
+# pylint: disable=unused-argument
+def test_engine_events(mock_no_user_sync_config, tmp_path) -> None:
+    """
+    Test iterating events of an asynchronous push command
+    """
+    target = create_target(tmp_path, RSYNC_STATS_OUTPUT)
+
+    async def collect():
+        return [event async for event in target.sync_events('push', stats=True)]
+
+    events = asyncio.run(collect())
+    assert events[0].type == 'started'
+    assert ''.join(event.line for event in events if event.type == 'output') == RSYNC_STATS_OUTPUT
+    assert events[-1].type == 'finished'
+    result = events[-1].result
+    assert result.returncode == 0
+    assert result.stats == EXPECTED_STATS
+    assert '--stats' in result.args
+
+
+# pylint: disable=unused-argument
+def test_engine_push_pull(mock_no_user_sync_config, tmp_path) -> None:
+    """
+    Test running asynchronous push and pull commands of several targets concurrently
+    """
+    target = create_target(tmp_path, 'file.txt\n')
+    lines = []
+
+    async def sync():
+        return await asyncio.gather(
+            target.push_async(output=lines.append),
+            target.pull_async(dry_run=True, output=lines.append),
+        )
+
+    push, pull = asyncio.run(sync())
+    assert push.action == 'push'
+    assert pull.action == 'pull'
+    assert '--dry-run' in pull.args
+    assert push.stats is None
+    assert lines == ['file.txt\n', 'file.txt\n']
+
+    with pytest.raises(ValueError):
+        AsyncSyncCommand(target, 'copy')
+
+
+# pylint: disable=unused-argument
+def test_engine_errors(mock_no_user_sync_config, tmp_path) -> None:
+    """
+    Test errors from asynchronous sync commands
+    """
+    target = create_target(tmp_path, exit_code=23)
+    with pytest.raises(SyncError):
+        asyncio.run(target.push_async())
+    delayed = create_target(tmp_path.joinpath('delayed'), exit_code=23, delay=0.1)
+    with pytest.raises(SyncError):
+        asyncio.run(delayed.push_async())
+
+    target.source.rmdir()
+    with pytest.raises(SyncError):
+        asyncio.run(target.push_async())
+
+
+# pylint: disable=unused-argument
+def test_engine_sync_methods(mock_no_user_sync_config, tmp_path) -> None:
+    """
+    Test asynchronous commands are only run for targets synced with a single rsync command
+    """
+    target = create_target(tmp_path, large_file_size=1024)
+    assert target.get_sync_method('push') == ('rsync', None)
+    assert asyncio.run(target.push_async()).action == 'push'
+
+    target.source.joinpath('large.bin').write_bytes(b'0' * 2048)
+    assert target.get_sync_method('push') == ('large files', ['large.bin'])
+    assert target.get_sync_method('push', files_from=tmp_path.joinpath('files')) == ('rsync', None)
+    assert target.get_sync_method('pull') == ('rsync', None)
+    with pytest.raises(SyncError):
+        asyncio.run(target.push_async())
+    assert asyncio.run(target.pull_async()).action == 'pull'
+
+
+# pylint: disable=unused-argument
+def test_engine_cancel(mock_no_user_sync_config, tmp_path) -> None:
+    """
+    Test cancelling an asynchronous sync command terminates the rsync process
+    """
+    target = create_target(tmp_path, 'started\n', delay=30)
+    command = AsyncSyncCommand(target, 'push')
+
+    async def cancel():
+        task = asyncio.create_task(command.run())
+        while command.process is None:
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.1)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    start = time.monotonic()
+    asyncio.run(cancel())
+    assert time.monotonic() - start < 10
+    assert command.process.returncode == 143
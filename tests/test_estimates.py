@@ -0,0 +1,92 @@
+#
+# Copyright (C) 2020-2023 by Ilkka Tuohela <hile@iki.fi>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+"""
+Unit tests for treesync.estimates module
+"""
+from treesync.configuration import Configuration
+from treesync.estimates import DEFAULT_TRANSFER_RATE, DurationEstimator
+from treesync.scheduler import SyncJob, order_by_expected_duration
+from treesync.state import SyncRecord, SyncStateStore
+
+from .conftest import EXCLUDES_FILE
+from .test_scheduler import MockTarget
+from .utils import create_source_directory
+
+
+def create_record(target: str, duration: float, exit_code: int = 0, transferred: int = None) -> SyncRecord:
+    """
+    Create a sync record for tests
+    """
+    return SyncRecord(
+        target=target,
+        action='push',
+        started=1000.0,
+        finished=1000.0 + duration,
+        duration=duration,
+        exit_code=exit_code,
+        bytes=transferred,
+    )
+
+
+def test_estimates_from_history() -> None:
+    """
+    Test estimating durations from recorded results
+    """
+    state = SyncStateStore()
+    for duration in (10, 30, 20):
+        state.record(create_record('recorded', duration, transferred=int(duration * 1000)))
+    state.record(create_record('failed', 5, exit_code=23, transferred=4000))
+    state.record(create_record('failed', 5, exit_code=23))
+
+    estimator = DurationEstimator(state)
+    assert estimator.get_transfer_rate('push') == 1000
+    assert estimator.get_transfer_rate('pull') == DEFAULT_TRANSFER_RATE
+
+    jobs = [SyncJob(MockTarget(name), 'push') for name in ('recorded', 'failed', 'unknown')]
+    estimator.update(jobs)
+    assert [job.expected_duration for job in jobs] == [20, 4, None]
+    state.close()
+
+
+# pylint: disable=unused-argument
+def test_estimates_from_source_size(mock_no_user_sync_config, tmpdir) -> None:
+    """
+    Test estimating duration from size of the source tree
+    """
+    _source, _destination, config_file = create_source_directory(tmpdir, EXCLUDES_FILE)
+    target = Configuration(config_file).sync_targets.get('test')
+    estimator = DurationEstimator(SyncStateStore())
+    size, truncated = estimator.get_source_size(SyncJob(target, 'push'))
+    assert size > 0
+    assert not truncated
+    assert estimator.estimate(SyncJob(target, 'push')) == size / DEFAULT_TRANSFER_RATE
+    assert estimator.estimate(SyncJob(target, 'pull')) is None
+
+    # Scans of large trees are truncated, returning a lower bound of the size
+    partial, truncated = estimator.get_source_size(SyncJob(target, 'push'), max_entries=1)
+    assert truncated
+    assert partial < size
+    assert estimator.get_source_size(SyncJob(target, 'push'), timeout=-1) == (0, True)
+
+
+# pylint: disable=unused-argument
+def test_estimates_truncated_order(mock_no_user_sync_config, tmpdir, monkeypatch) -> None:
+    """
+    Test jobs with truncated source tree scans are ordered before jobs with known sizes
+    """
+    _source, _destination, config_file = create_source_directory(tmpdir, EXCLUDES_FILE)
+    target = Configuration(config_file).sync_targets.get('test')
+    estimator = DurationEstimator(SyncStateStore())
+    small = SyncJob(target, 'push')
+    estimator.update([small])
+    assert not small.expected_duration_lower_bound
+
+    monkeypatch.setattr(estimator, 'get_source_size', lambda job: DurationEstimator.get_source_size(job, 1))
+    large = SyncJob(target, 'push')
+    estimator.update([large])
+    assert large.expected_duration_lower_bound
+    assert large.expected_duration < small.expected_duration
+    assert order_by_expected_duration([small, large]) == [large, small]
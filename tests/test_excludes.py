@@ -0,0 +1,74 @@
+#
+# Copyright (C) 2020-2023 by Ilkka Tuohela <hile@iki.fi>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+"""
+Unit tests for treesync.excludes module
+"""
+import os
+import time
+
+from treesync.configuration import Configuration
+from treesync.directories import user_cache_directory
+from treesync.excludes import ExcludesFileCache
+
+from .conftest import HOST_SOURCES_CONFIG
+
+TEST_EXCLUDES = ('*.pyc', '__pycache__/')
+
+
+def test_excludes_file_cache_get() -> None:
+    """
+    Test writing excludes files by content to the cache directory
+    """
+    cache = ExcludesFileCache()
+    assert cache.directory == user_cache_directory().joinpath('excludes')
+    assert cache.cleanup() == 0
+
+    path = cache.get(TEST_EXCLUDES)
+    assert path.parent == cache.directory
+    assert path.read_text(encoding='utf-8').splitlines() == list(TEST_EXCLUDES)
+    assert cache.get(list(TEST_EXCLUDES)) == path
+    assert cache.get(TEST_EXCLUDES[:1]) != path
+    assert len(list(cache.directory.iterdir())) == 2
+
+    # Another run reuses the same file
+    other = ExcludesFileCache()
+    assert other.get(TEST_EXCLUDES) == path
+    assert len(list(cache.directory.iterdir())) == 2
+
+
+def test_excludes_file_cache_cleanup(tmp_path) -> None:
+    """
+    Test removing expired excludes files from the cache directory
+    """
+    cache = ExcludesFileCache(tmp_path)
+    expired = cache.get(TEST_EXCLUDES)
+    stale_tempfile = tmp_path.joinpath('.stale')
+    stale_tempfile.write_text('', encoding='utf-8')
+    other_file = tmp_path.joinpath('other.txt')
+    other_file.write_text('', encoding='utf-8')
+    timestamp = time.time() - 3600
+    for path in (expired, stale_tempfile, other_file):
+        os.utime(path, (timestamp, timestamp))
+
+    cache = ExcludesFileCache(tmp_path)
+    current = cache.get(TEST_EXCLUDES[:1])
+    assert cache.cleanup(max_age=60) == 2
+    assert current.is_file()
+    assert not expired.exists()
+    assert not stale_tempfile.exists()
+    assert other_file.exists()
+
+
+def test_excludes_file_cache_shared_by_targets() -> None:
+    """
+    Test targets with identical excludes share the same excludes file
+    """
+    config = Configuration(HOST_SOURCES_CONFIG)
+    paths = {str(target.excludes_file) for target in config.sync_targets}
+    assert len(paths) == 1
+    assert len(config.excludes_file_cache.used) == 1
+    for target in config.sync_targets:
+        assert f'--exclude-from={target.excludes_file}' in target.flags
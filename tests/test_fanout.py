@@ -0,0 +1,159 @@
+#
+# Copyright (C) 2020-2023 by Ilkka Tuohela <hile@iki.fi>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+"""
+Unit tests for treesync.fanout module
+"""
+from pathlib import Path
+from subprocess import CalledProcessError
+
+import yaml
+
+from treesync.configuration import Configuration
+from treesync.fanout import FanOutSyncJob, plan_fan_out
+from treesync.scheduler import SyncJob, SyncScheduler
+from treesync.state import SyncStateStore
+
+#: Hosts pushing the same source, last one with different flags
+TEST_HOSTS = ('mirror1', 'mirror2', 'mirror3', 'other')
+
+
+class MockRsync:
+    """
+    Mock subprocess.run for rsync commands, writing batch files and failing to apply batch
+    files to specified destinations
+    """
+    def __init__(self, fail_read_batch=()) -> None:
+        self.fail_read_batch = fail_read_batch
+        self.args = []
+
+    def __call__(self, args, **kwargs):
+        self.args.append(args)
+        for arg in args:
+            if arg.startswith('--write-batch='):
+                Path(arg.split('=', 1)[1]).write_bytes(b'batch\n')
+            if arg.startswith('--read-batch=') and args[-1] in self.fail_read_batch:
+                raise CalledProcessError(23, args)
+
+
+def create_mirror_targets(tmp_path):
+    """
+    Create host targets pushing one source to mirrors
+    """
+    tmp_path.joinpath('data').mkdir()
+    hosts = []
+    for name in TEST_HOSTS:
+        host = {'name': name, 'targets': [{'source': 'data', 'destination': f'{name}:/srv/data'}]}
+        if name == 'other':
+            host['flags'] = ['--compress']
+        hosts.append(host)
+    config_file = tmp_path.joinpath('test.yml')
+    config_file.write_text(
+        yaml.safe_dump({'sources': [{'name': 'data', 'path': str(tmp_path.joinpath('data'))}], 'hosts': hosts}),
+        encoding='utf-8'
+    )
+    config = Configuration(config_file)
+    return [config.sync_targets.get(f'{name}:data') for name in TEST_HOSTS]
+
+
+# pylint: disable=unused-argument
+def test_fan_out_plan(mock_no_user_sync_config, tmp_path) -> None:
+    """
+    Test combining jobs of targets with the same source to fan-out jobs
+    """
+    targets = create_mirror_targets(tmp_path)
+    jobs = [SyncJob(target, 'push') for target in targets]
+    planned = plan_fan_out(jobs)
+    assert len(planned) == 2
+    fan_out = planned[0]
+    assert isinstance(fan_out, FanOutSyncJob)
+    assert [str(job.target) for job in fan_out.jobs] == ['mirror1:data', 'mirror2:data', 'mirror3:data']
+    assert fan_out.members == jobs[:1]
+    assert all(job.fan_out_run == fan_out.fan_out_run for job in jobs[:3])
+    assert planned[1] is jobs[3]
+    assert str(fan_out) == f'push {tmp_path}/data to 3 mirrors'
+
+    batch_file = tmp_path.joinpath('batch')
+    args = fan_out.fan_out_push.get_write_batch_args(batch_file)
+    assert args[-3:] == [f'--write-batch={batch_file}', f'{tmp_path}/data/', 'mirror1:/srv/data/']
+    args = fan_out.fan_out_push.get_read_batch_args(targets[1], batch_file)
+    assert args[-2:] == [f'--read-batch={batch_file}', 'mirror2:/srv/data/']
+
+    assert plan_fan_out(jobs[:2]) == jobs[:2]
+    jobs = [SyncJob(target, 'push', dry_run=True) for target in targets]
+    assert plan_fan_out(jobs) == jobs
+
+
+def run_fan_out(targets, state, jobs: int = 2):
+    """
+    Run a fan-out push of targets with the scheduler, returning jobs of the targets
+    """
+    fan_out = plan_fan_out([SyncJob(target, 'push', state=state) for target in targets])[0]
+    SyncScheduler(jobs=jobs).run([fan_out])
+    assert fan_out.batch_file is None or not fan_out.batch_file.exists()
+    return fan_out.jobs
+
+
+# pylint: disable=unused-argument
+def test_fan_out_run(mock_no_user_sync_config, tmp_path, monkeypatch) -> None:
+    """
+    Test fan-out pushes applying batch files to mirrors in sync with the reference
+    """
+    targets = create_mirror_targets(tmp_path)[:3]
+    state = SyncStateStore()
+
+    mock_rsync = MockRsync()
+    monkeypatch.setattr('treesync.target.run', mock_rsync)
+    jobs = run_fan_out(targets, state)
+    # Mirrors without recorded fan-out pushes are pushed normally
+    assert [job.fan_out for job in jobs] == [
+        'reference',
+        'fallback, mirror may have drifted',
+        'fallback, mirror may have drifted',
+    ]
+    assert not any(arg.startswith('--read-batch') for args in mock_rsync.args for arg in args)
+    assert all(job.status == 'succeeded' for job in jobs)
+
+    mock_rsync = MockRsync(fail_read_batch=('mirror3:/srv/data/',))
+    monkeypatch.setattr('treesync.target.run', mock_rsync)
+    reference, mirror2, mirror3 = run_fan_out(targets, state, jobs=1)
+    assert mirror2.fan_out == 'batch'
+    assert mirror2.summary.endswith('(fan-out batch)')
+    assert mirror3.fan_out == 'fallback, applying batch failed'
+    assert all(job.status == 'succeeded' for job in (reference, mirror2, mirror3))
+    assert len(mock_rsync.args) == 4
+    # Failed attempts to apply the batch are not recorded
+    assert all(record.succeeded for record in state.get_history('mirror3:data', 'push'))
+    assert len(state.get_history('mirror3:data', 'push')) == 2
+
+    # Mirrors pushed on their own after the fan-out push may have drifted
+    SyncJob(targets[1], 'push', state=state).run(capture_output=True)
+    mock_rsync = MockRsync()
+    monkeypatch.setattr('treesync.target.run', mock_rsync)
+    _reference, mirror2, mirror3 = run_fan_out(targets, state)
+    assert mirror2.fan_out == 'fallback, mirror may have drifted'
+    assert mirror3.fan_out == 'batch'
+    state.close()
+
+
+# pylint: disable=unused-argument
+def test_fan_out_host_limits(mock_no_user_sync_config, tmp_path, monkeypatch) -> None:
+    """
+    Test mirrors of fan-out pushes are scheduled as separate jobs with host limits
+    """
+    targets = create_mirror_targets(tmp_path)[:3]
+    monkeypatch.setattr('treesync.target.run', MockRsync())
+    fan_out = plan_fan_out([SyncJob(target, 'push') for target in targets])[0]
+    assert fan_out.get_next_jobs() == []
+    started = []
+    completed = SyncScheduler(jobs=4, started=started.append).run([fan_out])
+    assert [str(job) for job in started] == [
+        f'push {tmp_path}/data to 3 mirrors',
+        f'push {tmp_path}/data -> mirror2:/srv/data',
+        f'push {tmp_path}/data -> mirror3:/srv/data',
+    ]
+    assert [job.host for job in started[1:]] == ['mirror2', 'mirror3']
+    assert completed[0] is fan_out.jobs[0]
+    assert sorted(str(job.target) for job in completed[1:]) == ['mirror2:data', 'mirror3:data']
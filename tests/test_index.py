@@ -0,0 +1,113 @@
+#
+# Copyright (C) 2020-2023 by Ilkka Tuohela <hile@iki.fi>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+"""
+Unit tests for treesync.index module
+"""
+from fnmatch import fnmatch
+
+import pytest
+
+from treesync.index import TargetIndex, is_glob_pattern
+from treesync.target import Target, TargetList
+
+TEST_TARGETS = (
+    ('server1', 'server1:data'),
+    ('server1', 'server1:dummy'),
+    ('server2', 'server2:data'),
+    ('nas-server', 'nas:documents'),
+    ('nas-server', 'nas:music'),
+    ('laptop', 'music'),
+    (None, 'local'),
+    ('server1', 'server1:a:b'),
+)
+TEST_PATTERNS = (
+    'server1', 'server*', 'data', 'd*', 'nas', 'nas:*', 'nas:m*', 'nas-server', '*:music',
+    'music', 'mus?c', '[ln]*', 'local', 'a:b', 'a:*', 'server1:a:*', '*', 'no-such-target',
+    's*:d*', 'server[12]:data',
+)
+
+
+def match_target(pattern: str, target: Target) -> bool:
+    """
+    Reference implementation of matching target to pattern without index
+    """
+    if target.hostname and fnmatch(target.hostname, pattern):
+        return True
+    if fnmatch(str(target.name), pattern):
+        return True
+    if ':' in target.name:
+        return fnmatch(target.name.split(':', 1)[1], pattern)
+    return False
+
+
+@pytest.fixture
+def test_targets() -> TargetList:
+    """
+    Create a list of test targets
+    """
+    targets = TargetList()
+    for hostname, name in TEST_TARGETS:
+        targets.append(Target(hostname, name, '/src', '/dst', None))
+    return targets
+
+
+def test_index_is_glob_pattern() -> None:
+    """
+    Test detecting glob patterns
+    """
+    assert not is_glob_pattern('server1:data')
+    for pattern in ('*', 'server?', '[ab]'):
+        assert is_glob_pattern(pattern)
+
+
+# pylint: disable=redefined-outer-name
+def test_index_match_patterns(test_targets) -> None:
+    """
+    Test matching patterns with index compared to matching all targets
+    """
+    index = TargetIndex(test_targets)
+    for pattern in TEST_PATTERNS:
+        expected = [target for target in test_targets if match_target(pattern, target)]
+        assert index.filter([pattern]) == expected, pattern
+
+    expected = [target for target in test_targets if match_target('nas', target) or match_target('local', target)]
+    assert index.filter(['local', 'nas']) == expected
+
+
+# pylint: disable=redefined-outer-name
+def test_index_get(test_targets) -> None:
+    """
+    Test looking up targets by full name
+    """
+    index = TargetIndex(test_targets)
+    assert index.get('nas:music') == test_targets[4]
+    assert index.get('music') == test_targets[5]
+    assert index.get('server1') is None
+
+
+# pylint: disable=redefined-outer-name
+def test_target_list_index_invalidation(test_targets) -> None:
+    """
+    Test target list index is rebuilt when the list is modified
+    """
+    index = test_targets.index
+    assert test_targets.index is index
+    assert test_targets.filter([]) is test_targets
+    assert test_targets.get('local') is not None
+
+    del test_targets[-2]
+    assert test_targets.get('local') is None
+    test_targets.insert(0, Target('demo', 'demo:local', '/src', '/dst', None))
+    assert test_targets.filter(['local']) == [test_targets[0]]
+    test_targets[0] = Target('demo', 'demo:other', '/src', '/dst', None)
+    assert test_targets.filter(['local']) == []
+    test_targets.sort(key=lambda target: target.name, reverse=True)
+    assert test_targets.index is not index
+    assert test_targets.filter(['server1']) == [
+        test_targets.get('server1:dummy'),
+        test_targets.get('server1:data'),
+        test_targets.get('server1:a:b'),
+    ]
@@ -0,0 +1,149 @@
+#
+# Copyright (C) 2020-2023 by Ilkka Tuohela <hile@iki.fi>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+"""
+Unit tests for treesync.journal module
+"""
+import io
+import os
+
+from treesync.journal import (
+    JOURNAL_MAX_PATHS,
+    PushJournal,
+    PushManifest,
+    diff_manifest_entries,
+    has_delete_flags,
+)
+from treesync.state import SyncStateStore
+from treesync.target import Target
+
+from .utils import create_test_target
+
+
+def create_journal_target(tmp_path, **kwargs) -> Target:
+    """
+    Create a target with a small source tree for journal tests
+    """
+    source = tmp_path.joinpath('source')
+    source.joinpath('a').mkdir(parents=True)
+    source.joinpath('a/file.txt').write_text('data\n', encoding='utf-8')
+    source.joinpath('other.txt').write_text('data\n', encoding='utf-8')
+    return create_test_target(tmp_path, source, tmp_path.joinpath('destination'), **kwargs)
+
+
+def test_journal_diff_manifest_entries() -> None:
+    """
+    Test comparing manifest entries
+    """
+    old = {'a': ['d', 0o755, None, None, None], 'a/b': ['f', 0o644, 1, 1, None], 'c': ['f', 0o644, 1, 1, None]}
+    new = {'a': ['d', 0o755, None, None, None], 'a/b': ['f', 0o644, 2, 2, None], 'd': ['f', 0o644, 1, 1, None]}
+    assert diff_manifest_entries(old, new) == (['a/b', 'd'], ['c'])
+    assert has_delete_flags(['--archive', '--delete-after'])
+    assert not has_delete_flags(['--archive'])
+
+
+# pylint: disable=unused-argument
+def test_journal_manifest(mock_no_user_sync_config, tmp_path) -> None:
+    """
+    Test saving and loading push manifests
+    """
+    target = create_journal_target(tmp_path)
+    manifest = PushManifest(target)
+    assert manifest.load('settings') is None
+    manifest.save('settings', {'a': ['d', 0o755, None, None, None]})
+    assert manifest.load('settings') == {'a': ['d', 0o755, None, None, None]}
+    assert manifest.load('other') is None
+    manifest.path.write_bytes(b'invalid')
+    assert manifest.load('settings') is None
+
+
+# pylint: disable=unused-argument
+def test_journal_plan_scan(mock_no_user_sync_config, tmp_path) -> None:
+    """
+    Test planning incremental pushes by comparing source tree to manifest
+    """
+    target = create_journal_target(tmp_path)
+    state = SyncStateStore()
+    journal = PushJournal(target, state)
+
+    plan = journal.plan()
+    assert plan.full
+    assert plan.reason == 'push settings changed'
+    journal.commit(plan)
+    assert journal.plan().paths == []
+
+    target.source.joinpath('a/file.txt').write_text('modified\n', encoding='utf-8')
+    target.source.joinpath('b').mkdir()
+    target.source.joinpath('b/new.txt').write_text('new\n', encoding='utf-8')
+    plan = journal.plan()
+    assert not plan.full
+    assert plan.paths == ['a/file.txt', 'b', 'b/new.txt']
+    assert str(plan) == 'incremental push of 3 paths'
+    handle = io.BytesIO()
+    journal.write_files_from(plan, handle)
+    assert handle.getvalue() == b'a/file.txt\0b\0b/new.txt\0'
+    journal.commit(plan)
+
+    target.source.joinpath('other.txt').unlink()
+    plan = journal.plan()
+    assert plan.full
+    assert plan.reason == 'deleted paths'
+
+    journal.full_sync_interval = 0
+    assert journal.plan().reason == 'full sync interval reached'
+    state.close()
+
+
+# pylint: disable=unused-argument
+def test_journal_plan_journal_paths(mock_no_user_sync_config, tmp_path) -> None:
+    """
+    Test planning incremental pushes from paths recorded to the journal
+    """
+    target = create_journal_target(tmp_path, flags=['--archive'], ignore_default_excludes=True)
+    state = SyncStateStore()
+    journal = PushJournal(target, state, scan=False)
+    journal.commit(journal.plan())
+
+    target.source.joinpath('a/sub').mkdir()
+    target.source.joinpath('a/sub/file.txt').write_text('new\n', encoding='utf-8')
+    state.add_journal_paths(str(target), ['a/sub', 'removed.txt'], JOURNAL_MAX_PATHS)
+    plan = journal.plan()
+    assert not plan.full
+    assert plan.paths == ['a/sub', 'a/sub/file.txt']
+    assert plan.journal_paths == ['a/sub', 'removed.txt']
+    assert plan.manifest is None
+    journal.commit(plan)
+    assert state.get_journal(str(target)).paths == []
+
+    state.add_journal_paths(str(target), None, JOURNAL_MAX_PATHS)
+    plan = journal.plan()
+    assert plan.full
+    assert plan.reason == 'journal overflowed'
+    journal.commit(plan)
+    assert not journal.plan().full
+    state.close()
+
+
+# pylint: disable=unused-argument
+def test_journal_plan_unsupported(mock_no_user_sync_config, tmp_path) -> None:
+    """
+    Test targets with unsupported flags or unreadable trees are pushed in full
+    """
+    target = create_journal_target(tmp_path, flags=['--archive', '--copy-links'])
+    state = SyncStateStore()
+    plan = PushJournal(target, state).plan()
+    assert plan.full
+    assert plan.reason == 'rsync flags or filter rules not supported'
+    state.close()
+
+    target = create_journal_target(tmp_path.joinpath('other'))
+    os.chmod(target.source.joinpath('a'), 0)
+    try:
+        if not os.access(target.source.joinpath('a'), os.R_OK):
+            state = SyncStateStore()
+            assert PushJournal(target, state).plan().reason == 'source tree can not be scanned'
+            state.close()
+    finally:
+        os.chmod(target.source.joinpath('a'), 0o755)
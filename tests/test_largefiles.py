@@ -0,0 +1,134 @@
+#
+# Copyright (C) 2020-2023 by Ilkka Tuohela <hile@iki.fi>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+"""
+Unit tests for treesync.largefiles module
+"""
+import io
+
+import pytest
+
+from sys_toolkit.exceptions import ConfigurationError as ConfigurationFileError
+
+from treesync.configuration import Configuration
+from treesync.exceptions import SyncError
+from treesync.largefiles import LARGE_FILE_BLOCK_SIZE, LargeFilePush, find_large_files, parse_size
+from treesync.scheduler import SyncJob
+from treesync.stats import SyncStats
+
+from .utils import TEST_REMOTE_DESTINATION, create_test_config, create_test_target
+
+
+class MockStreamedCommand:
+    """
+    Mock Target.run_sync_command_streamed recording filter rules and listed files
+    """
+    def __init__(self, fail: bool = False) -> None:
+        self.fail = fail
+        self.args = []
+        self.filters = []
+        self.files = []
+
+    def __call__(self, *args, output=None, stats=False):
+        self.args.append(args)
+        for arg in args:
+            if arg.startswith('--filter=merge '):
+                with open(arg.split(' ', 1)[1], encoding='utf-8') as handle:
+                    self.filters.append(handle.read().splitlines())
+            if arg.startswith('--files-from='):
+                with open(arg.split('=', 1)[1], 'rb') as handle:
+                    self.files.append(handle.read().split(b'\0')[:-1])
+        if self.fail:
+            raise SyncError('push failed')
+        return SyncStats(files=1, total_file_size=1000, bytes_sent=400, bytes_received=100)
+
+
+def create_large_file_target(tmp_path, **kwargs):
+    """
+    Create a target with small and large files in the source tree
+    """
+    source = tmp_path.joinpath('source')
+    source.joinpath('src').mkdir(parents=True)
+    source.joinpath('images').mkdir()
+    source.joinpath('build').mkdir()
+    source.joinpath('src/main.c').write_bytes(b'x' * 100)
+    source.joinpath('images/disk*.img').write_bytes(b'0' * 4096)
+    source.joinpath('images/small.img').write_bytes(b'0' * 10)
+    source.joinpath('build/large.o').write_bytes(b'0' * 4096)
+    return create_test_target(tmp_path, source, TEST_REMOTE_DESTINATION, excludes=['/build'], **kwargs)
+
+
+def test_large_files_parse_size() -> None:
+    """
+    Test parsing sizes with suffixes
+    """
+    assert parse_size(1000) == 1000
+    assert parse_size('512') == 512
+    assert parse_size('10K') == 10240
+    assert parse_size('1g') == 1024 ** 3
+    assert parse_size('2 MB') == 2 * 1024 ** 2
+    for value in ('', 'large', '1X', 0, '-1', True):
+        with pytest.raises(ValueError):
+            parse_size(value)
+
+
+# pylint: disable=unused-argument
+def test_large_files_find(mock_no_user_sync_config, tmp_path) -> None:
+    """
+    Test finding large files in the source tree
+    """
+    target = create_large_file_target(tmp_path, large_file_size='1K')
+    assert target.large_file_size == 1024
+    assert target.large_file_block_size == LARGE_FILE_BLOCK_SIZE
+    assert find_large_files(target, target.large_file_size) == ['images/disk*.img']
+    assert find_large_files(target, 10000) == []
+
+    config_file = tmp_path.joinpath('invalid.yml')
+    create_test_config(config_file, 'test', tmp_path, tmp_path, large_file_block_size='1M')
+    with pytest.raises(ConfigurationFileError):
+        Configuration(config_file).sync_targets.get('test')
+
+
+# pylint: disable=unused-argument
+def test_large_files_push(mock_no_user_sync_config, tmp_path) -> None:
+    """
+    Test pushing large files with a separate rsync pass
+    """
+    target = create_large_file_target(tmp_path, large_file_size='1K', large_file_block_size='64K')
+    mock_command = MockStreamedCommand()
+    target.run_sync_command_streamed = mock_command
+    result = target.push(output=io.StringIO(), stats=True)
+
+    files_args, large_args = mock_command.args
+    assert mock_command.filters == [['H /images/disk\\*.img', 'P /images/disk\\*.img']]
+    assert mock_command.files == [[b'images/disk*.img']]
+    assert '--inplace' not in files_args
+    assert {'--inplace', '--partial', '--no-whole-file', '--block-size=65536'} <= set(large_args)
+    assert list(large_args) == result.args
+    assert [item.name for item in result.passes] == ['files', 'large files']
+    assert result.passes[1].throughput is not None
+    assert result.duration == sum(item.duration for item in result.passes)
+    assert result.passes[1].as_dict()['stats']['bytes_sent'] == 400
+    assert result.stats.bytes_sent == 800
+
+    job = SyncJob(target, 'push')
+    job.run(capture_output=True)
+    assert 'rsync large files' in job.throughput
+    assert job.result.stats is None
+    assert job.summary.endswith('(2 passes)')
+
+    mock_command = MockStreamedCommand(fail=True)
+    target.run_sync_command_streamed = mock_command
+    with pytest.raises(SyncError):
+        LargeFilePush(target, ['images/disk*.img']).run(output=io.StringIO())
+    assert len(mock_command.args) == 1
+
+    # Targets without large files are pushed with a single rsync command
+    target = create_large_file_target(tmp_path.joinpath('small'), large_file_size='1M')
+    mock_command = MockStreamedCommand()
+    target.run_sync_command_streamed = mock_command
+    result = target.push(output=io.StringIO(), stats=True)
+    assert len(mock_command.args) == 1
+    assert not result.passes
@@ -0,0 +1,65 @@
+#
+# Copyright (C) 2020-2023 by Ilkka Tuohela <hile@iki.fi>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+"""
+Unit tests for treesync.metrics module
+"""
+from treesync.metrics import MetricsFile, format_labels
+from treesync.state import RunSummary, SyncRecord, SyncStateStore
+
+
+def create_record(target: str, exit_code: int = 0, finished: float = 1010.0) -> SyncRecord:
+    """
+    Create a sync record for tests
+    """
+    return SyncRecord(
+        target=target,
+        action='push',
+        started=finished - 10,
+        finished=finished,
+        duration=10.0,
+        exit_code=exit_code,
+        bytes=2048 if exit_code == 0 else None,
+        files=3 if exit_code == 0 else None,
+    )
+
+
+def test_metrics_format_labels() -> None:
+    """
+    Test formatting metric labels with special characters
+    """
+    assert format_labels({'target': 'a"b\\c\nd', 'action': 'push'}) == '{target="a\\"b\\\\c\\nd",action="push"}'
+
+
+def test_metrics_file(tmp_path) -> None:
+    """
+    Test writing metrics from the sync state store
+    """
+    state = SyncStateStore()
+    path = tmp_path.joinpath('textfile', 'treesync.prom')
+    metrics = MetricsFile(path, state)
+    metrics.write()
+    assert path.read_text(encoding='utf-8') == ''
+
+    state.record(create_record('server:data'))
+    state.record(create_record('server:data', exit_code=23, finished=2010.0))
+    state.record(create_record('laptop'))
+    state.record_run(RunSummary(action='push', started=2000.0, finished=2020.0, succeeded=1, failed=1, bytes=2048))
+    metrics.write()
+    state.close()
+
+    lines = path.read_text(encoding='utf-8').splitlines()
+    assert '# TYPE treesync_target_failures_total counter' in lines
+    assert 'treesync_target_runs_total{target="server:data",action="push"} 2' in lines
+    assert 'treesync_target_failures_total{target="server:data",action="push"} 1' in lines
+    assert 'treesync_target_last_exit_code{target="server:data",action="push"} 23' in lines
+    assert 'treesync_target_last_success_timestamp_seconds{target="server:data",action="push"} 1010.0' in lines
+    assert 'treesync_target_last_bytes_transferred{target="laptop",action="push"} 2048' in lines
+    # Statistics are not reported for the latest failed command
+    assert not [line for line in lines if line.startswith('treesync_target_last_bytes_transferred{target="server')]
+    assert 'treesync_run_duration_seconds{action="push"} 20.0' in lines
+    assert 'treesync_run_targets{action="push",status="failed"} 1' in lines
+    assert [item.name for item in path.parent.iterdir()] == ['treesync.prom']
+    assert path.stat().st_mode & 0o777 == 0o644
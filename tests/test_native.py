@@ -0,0 +1,217 @@
+#
+# Copyright (C) 2020-2023 by Ilkka Tuohela <hile@iki.fi>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+"""
+Unit tests for treesync.native module
+"""
+import io
+import os
+
+from pathlib import Path
+
+import pytest
+
+from sys_toolkit.exceptions import ConfigurationError as ConfigurationFileError
+
+from treesync.exceptions import SyncError
+from treesync.native import (
+    NativeSyncEngine,
+    copy_file_data,
+    get_native_engine,
+    is_local_destination,
+    parse_native_options,
+)
+from treesync.scanner import ExcludeMatcher
+
+from .utils import create_test_target
+
+
+def create_source_tree(path):
+    """
+    Create a source tree for native engine tests
+    """
+    path.joinpath('data/nested').mkdir(parents=True)
+    path.joinpath('build').mkdir()
+    path.joinpath('top.txt').write_text('top\n', encoding='utf-8')
+    path.joinpath('data/file.dat').write_bytes(b'0123456789' * 1000)
+    path.joinpath('data/nested/deep.txt').write_text('deep\n', encoding='utf-8')
+    path.joinpath('build/output.o').write_bytes(b'object')
+    path.joinpath('data/script.sh').write_text('#!/bin/sh\n', encoding='utf-8')
+    path.joinpath('data/script.sh').chmod(0o750)
+    os.symlink('file.dat', path.joinpath('data/link'))
+    os.utime(path.joinpath('top.txt'), (1600000000, 1600000000))
+    return path
+
+
+def create_engine(tmp_path, flags=('--archive', '--delete', '--verbose'), excluded=('/build',)):
+    """
+    Create native engine syncing source to destination in tmp_path
+    """
+    source = create_source_tree(tmp_path.joinpath('source'))
+    return NativeSyncEngine(
+        source,
+        tmp_path.joinpath('destination'),
+        parse_native_options(flags),
+        ExcludeMatcher(list(excluded)),
+        workers=4,
+    )
+
+
+def test_native_parse_options() -> None:
+    """
+    Test parsing native engine options from rsync flags
+    """
+    options = parse_native_options(['--archive', '--delete', '--protect-args', '--verbose'])
+    assert {'recursive', 'links', 'perms', 'times', 'delete', 'verbose'} <= options
+    assert 'delete_excluded' not in options
+    assert 'delete_excluded' in parse_native_options(['-av', '--delete-excluded'])
+    assert parse_native_options(['-avz']) is None
+    assert parse_native_options(['--archive', '--compress']) is None
+    assert parse_native_options(['--links', '--times']) is None
+
+
+def test_native_local_destinations() -> None:
+    """
+    Test detecting local rsync destinations
+    """
+    assert is_local_destination('/srv/backup')
+    assert is_local_destination('backup/data')
+    assert is_local_destination('./a:b')
+    assert not is_local_destination('server:/srv/backup')
+    assert not is_local_destination('server::module/path')
+    assert not is_local_destination('rsync://server/module')
+
+
+def test_native_copy_file_data(tmp_path) -> None:
+    """
+    Test copying file data with and without reflinks
+    """
+    source = tmp_path.joinpath('source')
+    source.write_bytes(os.urandom(100000))
+    for index, reflink in enumerate((True, False)):
+        destination = tmp_path.joinpath(f'destination{index}')
+        with source.open('rb') as source_handle, destination.open('wb') as destination_handle:
+            method = copy_file_data(source_handle.fileno(), destination_handle.fileno(), reflink=reflink)
+        assert method in ('reflink', 'copy_file_range', 'copy')
+        assert destination.read_bytes() == source.read_bytes()
+
+
+def test_native_sync(tmp_path) -> None:
+    """
+    Test syncing a tree with the native engine
+    """
+    engine = create_engine(tmp_path)
+    destination = engine.destination
+    output = io.StringIO()
+    stats = engine.run(output=output)
+    assert destination.joinpath('data/file.dat').read_bytes() == b'0123456789' * 1000
+    assert destination.joinpath('data/nested/deep.txt').is_file()
+    assert not destination.joinpath('build').exists()
+    assert os.readlink(destination.joinpath('data/link')) == 'file.dat'
+    assert destination.joinpath('data/script.sh').stat().st_mode & 0o777 == 0o750
+    assert destination.joinpath('top.txt').stat().st_mtime == 1600000000
+    assert stats.files_transferred == 4
+    assert stats.transferred_file_size == stats.total_file_size
+    assert 'data/nested/deep.txt' in output.getvalue().splitlines()
+    assert sum(engine.copy_methods.values()) == 4
+
+    # Unchanged files are not copied again
+    output = io.StringIO()
+    stats = engine.run(output=output)
+    assert stats.files_transferred == 0
+    assert stats.created_files == 0
+    assert 'top.txt' not in output.getvalue().splitlines()
+
+    engine.source.joinpath('top.txt').write_text('changed\n', encoding='utf-8')
+    destination.joinpath('extra').mkdir()
+    destination.joinpath('extra/file.txt').write_text('extra\n', encoding='utf-8')
+    destination.joinpath('build').mkdir()
+    output = io.StringIO()
+    stats = engine.run(dry_run=True, output=output)
+    assert stats.files_transferred == 1
+    assert destination.joinpath('extra').is_dir()
+    assert destination.joinpath('top.txt').read_text(encoding='utf-8') == 'top\n'
+
+    output = io.StringIO()
+    stats = engine.run(output=output)
+    lines = output.getvalue().splitlines()
+    assert 'deleting extra/' in lines
+    assert 'top.txt' in lines
+    assert stats.deleted_files == 1
+    assert not destination.joinpath('extra').exists()
+    # Excluded paths are not deleted without delete_excluded
+    assert destination.joinpath('build').is_dir()
+    assert destination.joinpath('top.txt').read_text(encoding='utf-8') == 'changed\n'
+
+
+def test_native_sync_type_changes(tmp_path) -> None:
+    """
+    Test replacing destination paths of different type
+    """
+    engine = create_engine(tmp_path, flags=('-a', '--delete-excluded'))
+    destination = engine.destination
+    destination.joinpath('top.txt').mkdir(parents=True)
+    destination.joinpath('data').write_text('file\n', encoding='utf-8')
+    destination.joinpath('build').mkdir()
+    engine.run(output=io.StringIO())
+    assert destination.joinpath('top.txt').read_text(encoding='utf-8') == 'top\n'
+    assert destination.joinpath('data/nested/deep.txt').is_file()
+    assert not destination.joinpath('build').exists()
+
+
+def test_native_sync_errors(tmp_path) -> None:
+    """
+    Test errors syncing with the native engine
+    """
+    engine = NativeSyncEngine(tmp_path.joinpath('missing'), tmp_path.joinpath('destination'), ['recursive'],
+                              ExcludeMatcher([]))
+    with pytest.raises(SyncError):
+        engine.run(output=io.StringIO())
+    engine = create_engine(tmp_path)
+    engine.destination = tmp_path.joinpath('missing/destination')
+    with pytest.raises(SyncError):
+        engine.run(output=io.StringIO())
+
+
+# pylint: disable=unused-argument
+def test_native_target(mock_no_user_sync_config, tmp_path, monkeypatch) -> None:
+    """
+    Test pushing and pulling targets with the native engine
+    """
+    source = create_source_tree(tmp_path.joinpath('source'))
+    destination = tmp_path.joinpath('destination')
+    target = create_test_target(tmp_path, source, destination, engine='native', excludes=['/build'])
+    assert target.engine == 'native'
+    assert get_native_engine(target, target.source, target.destination) is not None
+
+    def mock_run(*args, **kwargs):
+        raise AssertionError('rsync was run')
+
+    monkeypatch.setattr('treesync.target.run', mock_run)
+    result = target.push(output=io.StringIO(), stats=True)
+    assert result.args[0] == 'native'
+    assert result.stats.files_transferred == 4
+    assert destination.joinpath('data/file.dat').is_file()
+
+    source.joinpath('top.txt').unlink()
+    result = target.pull(output=io.StringIO())
+    assert result.action == 'pull'
+    assert result.stats is None
+    assert source.joinpath('top.txt').is_file()
+
+    target = create_test_target(tmp_path, source, destination, engine='native', flags=['--compress'])
+    assert get_native_engine(target, target.source, target.destination) is None
+    target = create_test_target(tmp_path, source, f'server:{destination}', engine='native')
+    assert get_native_engine(target, target.source, target.destination) is None
+    assert get_native_engine(target, Path(target.destination), str(target.source)) is None
+    assert target.get_sync_method('pull') == ('rsync', None)
+    assert target.get_sync_method('push') == ('rsync', None)
+    with pytest.raises(AssertionError, match='rsync was run'):
+        target.pull()
+    target = create_test_target(tmp_path, source, destination)
+    assert get_native_engine(target, target.source, target.destination) is None
+
+    with pytest.raises(ConfigurationFileError):
+        create_test_target(tmp_path, source, destination, engine='robocopy')
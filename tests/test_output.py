@@ -0,0 +1,70 @@
+#
+# Copyright (C) 2020-2023 by Ilkka Tuohela <hile@iki.fi>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+"""
+Unit tests for treesync.output module
+"""
+from subprocess import PIPE, Popen
+
+from treesync.directories import user_state_directory
+from treesync.output import LogFile, TargetOutput, read_process_output
+
+TEST_SCRIPT = """
+for i in 1 2 3; do
+    echo "stdout $i"
+    echo "stderr $i" >&2
+done
+printf partial
+"""
+
+
+def test_output_read_process_output() -> None:
+    """
+    Test reading stdout and stderr of a process from non-blocking pipes
+    """
+    lines = []
+    with Popen(['sh', '-c', TEST_SCRIPT], stdout=PIPE, stderr=PIPE) as process:
+        read_process_output(process, lines.append)
+        assert process.wait() == 0
+    assert [line for line in lines if line.startswith('stdout')] == ['stdout 1\n', 'stdout 2\n', 'stdout 3\n']
+    assert [line for line in lines if line.startswith('stderr')] == ['stderr 1\n', 'stderr 2\n', 'stderr 3\n']
+    assert lines[-1] == 'partial'
+
+
+def test_output_log_file_rotation(tmp_path) -> None:
+    """
+    Test rotating log files over the maximum size
+    """
+    path = tmp_path.joinpath('logs', 'test.log')
+    log = LogFile(path, max_size=100, backup_count=2)
+    for index in range(10):
+        log.write(f'{index}' * 40 + '\n')
+    log.close()
+    assert path.stat().st_size <= 123
+    assert path.with_name('test.log.1').is_file()
+    assert path.with_name('test.log.2').is_file()
+    assert not path.with_name('test.log.3').exists()
+    assert path.read_text(encoding='utf-8').endswith('9' * 40 + '\n')
+
+    # Log file over the maximum size is rotated when opened
+    log = LogFile(path, max_size=10, backup_count=0)
+    log.open()
+    log.close()
+    assert path.stat().st_size == 0
+
+
+def test_output_target_output() -> None:
+    """
+    Test writing target output to log file and ring buffer
+    """
+    with TargetOutput('server:data', lines=2) as output:
+        output.write('line 1\n')
+        output.write('line 2\nline 3\n')
+    assert output.tail == 'line 2\nline 3\n'
+    assert output.line_count == 3
+    assert output.log.path == user_state_directory().joinpath('logs', 'server%3Adata.log')
+    lines = output.log.path.read_text(encoding='utf-8').splitlines()
+    assert lines[0].startswith('=== ')
+    assert lines[1:] == ['line 1', 'line 2', 'line 3']
@@ -0,0 +1,52 @@
+#
+# Copyright (C) 2020-2023 by Ilkka Tuohela <hile@iki.fi>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+"""
+Unit tests for treesync.report module
+"""
+import json
+
+from treesync.report import RunReport
+from treesync.scheduler import SyncJob
+
+from .test_scheduler import MockTarget
+
+
+def read_records(path) -> list:
+    """
+    Read JSONL records from report file
+    """
+    return [json.loads(line) for line in path.read_text(encoding='utf-8').splitlines()]
+
+
+def test_report_records(tmp_path) -> None:
+    """
+    Test writing report records for finished jobs and run summary
+    """
+    path = tmp_path.joinpath('reports', 'run.jsonl')
+    with RunReport(path, 'push') as report:
+        report.add_job(SyncJob(MockTarget('ok'), 'push', stats=True).run())
+        # Records are written immediately
+        assert len(read_records(path)) == 1
+        report.add_job(SyncJob(MockTarget('broken', fail=True), 'push').run())
+
+    records = read_records(path)
+    assert [record['type'] for record in records] == ['target', 'target', 'summary']
+    assert records[0]['target'] == 'ok'
+    assert records[0]['host'] == 'server'
+    assert records[0]['stats']['bytes_sent'] == 1000
+    assert records[1]['status'] == 'failed'
+    assert records[1]['exit_code'] == 1
+    assert records[1]['error'] == 'push failed for broken'
+    assert records[1]['stats'] is None
+
+    summary = records[2]
+    assert summary['action'] == 'push'
+    assert summary['targets'] == 2
+    assert summary['succeeded'] == 1
+    assert summary['failed'] == 1
+    assert summary['skipped'] == 0
+    assert summary['bytes_transferred'] == 1024
+    assert summary['duration'] >= 0
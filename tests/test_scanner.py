@@ -0,0 +1,141 @@
+#
+# Copyright (C) 2020-2023 by Ilkka Tuohela <hile@iki.fi>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+"""
+Unit tests for treesync.scanner module
+"""
+import os
+
+from pathlib import Path
+
+from treesync.configuration import Configuration
+from treesync.scanner import (
+    ExcludeMatcher,
+    TreeScanner,
+    get_target_digest,
+    has_unsupported_flags,
+)
+
+from .conftest import EXCLUDES_FILE
+from .utils import create_source_directory
+
+TEST_EXCLUDES = (
+    '*.tmp',
+    '.git/',
+    '/build',
+    'cache/*.dat',
+    'logs/**/old',
+    'data/***',
+    'file[0-9].txt',
+)
+TEST_EXCLUDED_PATHS = (
+    ('a.tmp', False),
+    ('sub/dir/b.tmp', False),
+    ('.git', True),
+    ('sub/.git', True),
+    ('build', False),
+    ('build', True),
+    ('cache/x.dat', False),
+    ('sub/cache/x.dat', False),
+    ('logs/a/b/old', True),
+    ('data', True),
+    ('data/file', False),
+    ('file1.txt', False),
+)
+TEST_INCLUDED_PATHS = (
+    ('a.tmp.txt', False),
+    ('.git', False),
+    ('sub/build', True),
+    ('cache/sub/x.dat', False),
+    ('logs/old', False),
+    ('database', True),
+    ('filex.txt', False),
+)
+
+
+def create_tree(path: Path) -> Path:
+    """
+    Create a small directory tree for scanner tests
+    """
+    path.joinpath('sub/cache').mkdir(parents=True)
+    path.joinpath('file.txt').write_text('test\n', encoding='utf-8')
+    path.joinpath('sub/file.tmp').write_text('temporary\n', encoding='utf-8')
+    path.joinpath('sub/cache/data').write_text('cached\n', encoding='utf-8')
+    path.joinpath('link').symlink_to('file.txt')
+    return path
+
+
+def test_scanner_exclude_matcher() -> None:
+    """
+    Test matching rsync exclude patterns to relative paths
+    """
+    matcher = ExcludeMatcher(TEST_EXCLUDES)
+    assert matcher.exact
+    for path, is_directory in TEST_EXCLUDED_PATHS:
+        assert matcher.match(path, Path(path).name, is_directory), path
+    for path, is_directory in TEST_INCLUDED_PATHS:
+        assert not matcher.match(path, Path(path).name, is_directory), path
+
+
+def test_scanner_exclude_matcher_rules() -> None:
+    """
+    Test parsing exclude rules and comments in excludes file format
+    """
+    matcher = ExcludeMatcher(['# comment', '', '- *.bak'])
+    assert matcher.exact
+    assert len(matcher.patterns) == 1
+    assert matcher.match('a.bak', 'a.bak', False)
+
+    assert not ExcludeMatcher(['+ keep.bak', '*.bak']).exact
+
+
+def test_scanner_unsupported_flags() -> None:
+    """
+    Test detecting rsync flags not supported by the scanner
+    """
+    assert not has_unsupported_flags(['-av', '--delete', '--exclude=*.tmp'])
+    for flag in ('--include=*.txt', '--files-from=list', '-aL', '-F', '--copy-links'):
+        assert has_unsupported_flags(['-a', flag]), flag
+
+
+def test_scanner_tree_digest(tmp_path) -> None:
+    """
+    Test tree digest changes only when included files are modified
+    """
+    tree = create_tree(tmp_path.joinpath('tree'))
+    scanner = TreeScanner(tree, ExcludeMatcher(['*.tmp', 'cache/']))
+    scan = scanner.scan()
+    assert scan.files == 2
+    assert scan.directories == 1
+    assert scan.size == len('test\n')
+    assert scanner.scan() == scan
+
+    tree.joinpath('sub/file.tmp').write_text('modified\n', encoding='utf-8')
+    tree.joinpath('sub/cache/new').write_text('new\n', encoding='utf-8')
+    assert scanner.scan().digest == scan.digest
+
+    os.utime(tree.joinpath('file.txt'), ns=(0, 0))
+    modified = scanner.scan()
+    assert modified.digest != scan.digest
+
+    tree.joinpath('sub/new.txt').write_text('new\n', encoding='utf-8')
+    assert scanner.scan().digest != modified.digest
+
+
+def test_scanner_target_digest(tmp_path) -> None:
+    """
+    Test calculating digest of a sync target source tree
+    """
+    source, _destination, config_file = create_source_directory(tmp_path, EXCLUDES_FILE)
+    target = Configuration(config_file).sync_targets.get('test')
+    digest = get_target_digest(target)
+    assert digest is not None
+    assert get_target_digest(target) == digest
+
+    # Files matching patterns in the tree excludes file are not part of the digest
+    source.joinpath('ignored.tmp').write_text('ignored\n', encoding='utf-8')
+    assert get_target_digest(target) == digest
+    source.joinpath('included.txt').write_text('included\n', encoding='utf-8')
+    assert get_target_digest(target) != digest
@@ -0,0 +1,367 @@
+#
+# Copyright (C) 2020-2023 by Ilkka Tuohela <hile@iki.fi>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+"""
+Unit tests for treesync.scheduler module
+"""
+import threading
+import time
+
+from collections import Counter
+from typing import Optional
+
+import pytest
+
+from treesync.directories import user_state_directory
+from treesync.exceptions import SyncError
+from treesync.scheduler import SyncJob, SyncScheduler, estimate_run_time, order_by_expected_duration
+from treesync.state import SyncStateStore
+from treesync.stats import SyncResult, SyncStats
+
+TEST_JOB_COUNT = 8
+
+
+class MockConcurrencyCounter:
+    """
+    Record maximum number of concurrent calls per host and start order of targets
+    """
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.running = Counter()
+        self.maximum = Counter()
+        self.order = []
+
+    def start(self, target: 'MockTarget') -> None:
+        """
+        Record start of a mock sync command
+        """
+        with self.lock:
+            self.order.append(target.remote_host)
+            self.running[target.remote_host] += 1
+            self.maximum[target.remote_host] = max(
+                self.maximum[target.remote_host],
+                self.running[target.remote_host]
+            )
+
+    def stop(self, target: 'MockTarget') -> None:
+        """
+        Record end of a mock sync command
+        """
+        with self.lock:
+            self.running[target.remote_host] -= 1
+
+
+class MockTarget:
+    """
+    Mock sync target recording calls to pull and push methods
+    """
+    def __init__(self,
+                 name: str,
+                 hostname: str = 'server',
+                 max_parallel: Optional[int] = None,
+                 fail: bool = False,
+                 delay: float = 0,
+                 counter: Optional['MockConcurrencyCounter'] = None,
+                 shard_workers: Optional[int] = None,
+                 server: Optional[str] = None) -> None:
+        self.name = name
+        self.hostname = hostname
+        self.max_parallel = max_parallel
+        self.shard_workers = shard_workers
+        self.counter = counter
+        self.source = f'/src/{name}'
+        self.remote_host = server if server is not None else hostname
+        self.destination = f'{self.remote_host}:/dst/{name}' if self.remote_host else f'/dst/{name}'
+        self.compression = None
+        self.excluded = []
+        self.fail = fail
+        self.delay = delay
+        self.calls = []
+
+    def __repr__(self) -> str:
+        return self.name
+
+    def __sync__(self, action, dry_run, output, stats=False):
+        self.calls.append((action, dry_run, threading.current_thread().name))
+        if self.counter is not None:
+            self.counter.start(self)
+        if self.delay:
+            time.sleep(self.delay)
+        if self.counter is not None:
+            self.counter.stop(self)
+        if output is not None:
+            output.write(f'{action} {self.name}\n')
+        if self.fail:
+            raise SyncError(f'{action} failed for {self.name}')
+        return SyncResult(
+            target=self.name,
+            action=action,
+            args=[],
+            stats=SyncStats(bytes_sent=1000, bytes_received=24, files_transferred=2) if stats else None
+        )
+
+    def pull(self, dry_run: bool = False, output=None, stats: bool = False) -> SyncResult:
+        """
+        Mock pull
+        """
+        return self.__sync__('pull', dry_run, output, stats)
+
+    def push(self, dry_run: bool = False, output=None, stats: bool = False) -> SyncResult:
+        """
+        Mock push
+        """
+        return self.__sync__('push', dry_run, output, stats)
+
+
+def test_sync_job_invalid_action() -> None:
+    """
+    Test creating sync job with invalid action
+    """
+    with pytest.raises(ValueError):
+        SyncJob(MockTarget('test'), 'copy')
+
+
+def test_sync_job_run_passthrough() -> None:
+    """
+    Test running a sync job without capturing output
+    """
+    target = MockTarget('test')
+    job = SyncJob(target, 'pull', dry_run=True)
+    assert job.duration is None
+    assert job.__repr__() == f'pull {target.destination} -> {target.source}'
+
+    job.run()
+    assert not job.failed
+    assert job.output == ''
+    assert job.duration >= 0
+    assert target.calls[0][:2] == ('pull', True)
+
+
+def test_sync_job_run_capture_output_error() -> None:
+    """
+    Test running a failing sync job with output captured
+    """
+    target = MockTarget('test', fail=True)
+    job = SyncJob(target, 'push')
+    assert job.__repr__() == f'push {target.source} -> {target.destination}'
+
+    job.run(capture_output=True)
+    assert job.failed
+    assert isinstance(job.error, SyncError)
+    assert job.output == 'push test\n'
+
+
+def test_sync_job_log_output(mock_user_directories) -> None:
+    """
+    Test running sync jobs with output written to target log files
+    """
+    job = SyncJob(MockTarget('test', fail=True), 'push', log_output=True).run(capture_output=True)
+    assert job.failed
+    assert job.output == 'push test\n'
+    assert job.log_file.parent == user_state_directory().joinpath('logs')
+    assert job.log_file.read_text(encoding='utf-8').endswith('push test\n')
+    assert job.summary.startswith('push /src/test -> server:/dst/test: failed with exit code 1 in ')
+
+    job = SyncJob(MockTarget('test'), 'push', log_output=True, stats=True).run()
+    assert job.summary.endswith(', 2 files, 1024 bytes transferred')
+    assert job.log_file.read_text(encoding='utf-8').count('push test\n') == 2
+
+
+def test_sync_job_record_state(tmp_path) -> None:
+    """
+    Test recording results of sync jobs to the state store
+    """
+    state = SyncStateStore(tmp_path.joinpath('state.sqlite'))
+    job = SyncJob(MockTarget('test'), 'push', state=state, stats=True).run()
+    assert job.result.stats.bytes_transferred == 1024
+    SyncJob(MockTarget('test', fail=True), 'pull', state=state).run(capture_output=True)
+    SyncJob(MockTarget('test'), 'pull', dry_run=True, state=state).run()
+
+    push = state.get_last('test', 'push')
+    assert push.succeeded
+    assert push.bytes == 1024
+    assert push.files == 2
+    assert push.finished >= push.started
+    pull = state.get_last('test', 'pull')
+    assert pull.exit_code == 1
+    assert pull.bytes is None
+    assert len(state.get_history('test', 'pull')) == 1
+    state.close()
+
+
+def test_sync_scheduler_invalid_jobs() -> None:
+    """
+    Test creating scheduler with invalid number of jobs
+    """
+    with pytest.raises(ValueError):
+        SyncScheduler(jobs=0)
+
+
+def test_sync_scheduler_serial() -> None:
+    """
+    Test running jobs with the default single job scheduler
+    """
+    started = []
+    finished = []
+    targets = [MockTarget(f'target{index}') for index in range(TEST_JOB_COUNT)]
+    scheduler = SyncScheduler(started=started.append, finished=finished.append)
+    assert not scheduler.capture_output
+
+    jobs = scheduler.run(SyncJob(target, 'push') for target in targets)
+    assert [job.target for job in jobs] == targets
+    assert started == jobs
+    assert finished == jobs
+    main_thread = threading.current_thread().name
+    for target in targets:
+        assert target.calls[0][2] == main_thread
+
+
+def test_sync_scheduler_parallel() -> None:
+    """
+    Test running jobs in parallel with errors in some of the jobs
+    """
+    finished = []
+    targets = [
+        MockTarget(f'target{index}', fail=index % 2 == 0, delay=0.05)
+        for index in range(TEST_JOB_COUNT)
+    ]
+    scheduler = SyncScheduler(jobs=4, finished=finished.append)
+    assert scheduler.capture_output
+
+    start = time.monotonic()
+    jobs = scheduler.run(SyncJob(target, 'pull') for target in targets)
+    # Serial run would take at least TEST_JOB_COUNT * 0.05 seconds
+    assert time.monotonic() - start < TEST_JOB_COUNT * 0.05
+    assert len(jobs) == TEST_JOB_COUNT
+    assert finished == jobs
+    assert len([job for job in jobs if job.failed]) == TEST_JOB_COUNT / 2
+    for job in jobs:
+        assert job.output == f'pull {job.target.name}\n'
+
+
+def test_sync_scheduler_global_limit() -> None:
+    """
+    Test the global max_parallel cap for the number of jobs
+    """
+    assert SyncScheduler(jobs=8, max_parallel=2).jobs == 2
+    assert SyncScheduler(jobs=2, max_parallel=8).jobs == 2
+    assert not SyncScheduler(jobs=8, max_parallel=1).capture_output
+
+
+def test_sync_scheduler_host_limits() -> None:
+    """
+    Test per host limits and fair scheduling between hosts
+    """
+    counter = MockConcurrencyCounter()
+    targets = [
+        MockTarget(f'big{index}', hostname='big', max_parallel=2, delay=0.02, counter=counter)
+        for index in range(TEST_JOB_COUNT)
+    ]
+    targets.extend([
+        MockTarget(f'small{index}', hostname='small', delay=0.02, counter=counter)
+        for index in range(2)
+    ])
+    jobs = SyncScheduler(jobs=4).run(SyncJob(target, 'push') for target in targets)
+    assert len(jobs) == TEST_JOB_COUNT + 2
+    assert counter.maximum['big'] == 2
+    assert counter.maximum['small'] == 2
+    # Hosts are rotated: the small host does not wait for the big host targets
+    assert counter.order[:4].count('small') == 2
+
+
+def test_sync_scheduler_server_limits() -> None:
+    """
+    Test jobs are queued and limited by the destination server of the targets
+    """
+    counter = MockConcurrencyCounter()
+    targets = [
+        MockTarget(f'first{index}', hostname=None, server='first', max_parallel=1, delay=0.02, counter=counter)
+        for index in range(3)
+    ]
+    targets.extend([
+        MockTarget(f'second{index}', hostname=None, server='second', max_parallel=1, delay=0.02, counter=counter)
+        for index in range(3)
+    ])
+    # Targets in different hosts entries pushed to the same server share the lowest limit
+    targets.extend([
+        MockTarget(f'shared{index}', hostname=f'host{index}', server='shared', delay=0.02, counter=counter)
+        for index in range(3)
+    ])
+    targets[-1].max_parallel = 2
+    jobs = SyncScheduler(jobs=6).run(SyncJob(target, 'push') for target in targets)
+    assert len(jobs) == 9
+    assert counter.maximum['first'] == 1
+    assert counter.maximum['second'] == 1
+    assert counter.maximum['shared'] == 2
+    assert counter.order[:2] == ['first', 'second']
+
+
+def test_sync_scheduler_job_streams() -> None:
+    """
+    Test jobs running several rsync commands count as several jobs
+    """
+    counter = MockConcurrencyCounter()
+    targets = [
+        MockTarget('sharded', hostname='server', max_parallel=3, shard_workers=3, delay=0.05, counter=counter),
+    ]
+    targets.extend([
+        MockTarget(f'target{index}', hostname='server', max_parallel=3, delay=0.02, counter=counter)
+        for index in range(3)
+    ])
+    jobs = [SyncJob(target, 'push') for target in targets]
+    jobs[0].expected_duration = 10
+    assert jobs[0].streams == 3
+    assert SyncJob(targets[0], 'pull').streams == 1
+    assert len(SyncScheduler(jobs=4).run(jobs)) == 4
+    # The other targets wait for the sharded push using all host slots
+    assert min(job.started for job in jobs[1:]) >= jobs[0].finished
+    assert counter.maximum['server'] == 3
+
+
+def test_sync_scheduler_longest_expected_first() -> None:
+    """
+    Test parallel jobs are started longest expected duration first
+    """
+    started = []
+    jobs = []
+    for index, expected in enumerate((1, None, 5, 3)):
+        job = SyncJob(MockTarget(f'target{index}', hostname=f'host{index}'), 'push')
+        job.expected_duration = expected
+        jobs.append(job)
+    SyncScheduler(jobs=2, started=started.append).run(jobs)
+    assert [job.host for job in started] == ['host2', 'host3', 'host0', 'host1']
+
+
+def test_sync_scheduler_estimate_run_time() -> None:
+    """
+    Test estimating run time of jobs run in specified order
+    """
+    durations = {'a': 1, 'b': 1, 'c': 1, 'd': 3}
+    jobs = []
+    for name, duration in durations.items():
+        job = SyncJob(MockTarget(name, hostname=None), 'push')
+        job.expected_duration = duration
+        jobs.append(job)
+
+    def get_duration(job: SyncJob) -> float:
+        return durations[job.target.name]
+
+    assert estimate_run_time(jobs, 2, get_duration) == 4
+    assert estimate_run_time(order_by_expected_duration(jobs), 2, get_duration) == 3
+    assert estimate_run_time(jobs, 1, get_duration) == 6
+
+    # Host limits are honored
+    for job in jobs:
+        job.target.max_parallel = 1
+    assert estimate_run_time(jobs, 2, get_duration) == 6
+
+
+def test_sync_scheduler_local_targets() -> None:
+    """
+    Test running parallel jobs for targets without a remote host
+    """
+    targets = [MockTarget(f'local{index}', hostname=None) for index in range(TEST_JOB_COUNT)]
+    jobs = SyncScheduler(jobs=2).run(SyncJob(target, 'push') for target in targets)
+    assert len(jobs) == TEST_JOB_COUNT
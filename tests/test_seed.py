@@ -0,0 +1,107 @@
+#
+# Copyright (C) 2020-2023 by Ilkka Tuohela <hile@iki.fi>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+"""
+Unit tests for treesync.seed module
+"""
+import io
+
+import pytest
+
+from treesync.exceptions import SyncError
+from treesync.scheduler import SyncJob
+from treesync.seed import SeedResult, get_tar_seeder, is_seed_candidate
+from treesync.state import SyncStateStore
+
+from .utils import create_test_target
+
+
+def create_seed_target(tmp_path, destination=None, **kwargs):
+    """
+    Create a target with a small source tree for seeding tests
+    """
+    source = tmp_path.joinpath('source')
+    source.joinpath('data/nested').mkdir(parents=True)
+    source.joinpath('build').mkdir()
+    source.joinpath('data/file.txt').write_text('data\n', encoding='utf-8')
+    source.joinpath('data/nested/deep.txt').write_text('deep\n', encoding='utf-8')
+    source.joinpath('build/output.o').write_bytes(b'object')
+    if destination is None:
+        destination = tmp_path.joinpath('destination')
+    return create_test_target(tmp_path, source, destination, excludes=['/build'], **kwargs)
+
+
+def test_seed_result() -> None:
+    """
+    Test throughput of seeding results
+    """
+    assert SeedResult(files=1, bytes=1000, duration=2.0).throughput == 500
+    assert SeedResult().as_dict()['throughput'] is None
+
+
+# pylint: disable=unused-argument
+def test_seed_remote_commands(mock_no_user_sync_config, tmp_path) -> None:
+    """
+    Test commands for probing and seeding remote destinations
+    """
+    target = create_seed_target(tmp_path, destination='server:/srv/my data', flags=['--rsh=ssh -p 2222'])
+    seeder = get_tar_seeder(target)
+    assert seeder.get_probe_command()[:4] == ['ssh', '-p', '2222', 'server']
+    assert "'/srv/my data'" in seeder.get_probe_command()[-1]
+    assert seeder.get_extract_command()[-1] == "mkdir -p '/srv/my data' && tar -x -p -f - -C '/srv/my data'"
+
+    target = create_seed_target(tmp_path.joinpath('daemon'), destination='server::module/data')
+    assert get_tar_seeder(target) is None
+    target = create_seed_target(tmp_path.joinpath('native'), engine='native')
+    assert get_tar_seeder(target) is None
+
+
+# pylint: disable=unused-argument
+def test_seed_local(mock_no_user_sync_config, tmp_path, monkeypatch) -> None:
+    """
+    Test seeding a local destination with a tar stream
+    """
+    target = create_seed_target(tmp_path)
+    seeder = get_tar_seeder(target)
+    assert seeder.is_destination_empty()
+    result = seeder.seed(io.StringIO())
+    destination = tmp_path.joinpath('destination')
+    assert destination.joinpath('data/nested/deep.txt').read_text(encoding='utf-8') == 'deep\n'
+    assert not destination.joinpath('build').exists()
+    assert result.files == 2
+    assert result.bytes == 10
+    assert not seeder.is_destination_empty()
+
+    monkeypatch.setattr('treesync.seed.TAR_EXTRACT_COMMAND', 'false')
+    with pytest.raises(SyncError):
+        seeder.seed(io.StringIO())
+
+
+# pylint: disable=unused-argument
+def test_seed_job(mock_no_user_sync_config, tmp_path, monkeypatch) -> None:
+    """
+    Test sync jobs seeding empty destinations before the rsync push
+    """
+    target = create_seed_target(tmp_path)
+    state = SyncStateStore()
+    assert is_seed_candidate(target, state)
+    rsync_args = []
+    monkeypatch.setattr('treesync.target.run', lambda args, **kwargs: rsync_args.append(args))
+
+    job = SyncJob(target, 'push', state=state, seed=True).run(capture_output=True)
+    assert job.status == 'succeeded'
+    assert job.seeded.files == 2
+    assert 'tar' in job.throughput
+    assert '(seeded 2 files, 10 bytes in' in job.summary
+    assert len(rsync_args) == 1
+    assert tmp_path.joinpath('destination/data/file.txt').is_file()
+
+    # Destinations which are not empty are only pushed with rsync
+    job = SyncJob(target, 'push', state=state, seed=True).run(capture_output=True)
+    assert job.seeded is None
+    assert len(rsync_args) == 2
+    assert not is_seed_candidate(target, state)
+    assert not SyncJob(target, 'push', dry_run=True, seed=True).seed
+    state.close()
@@ -0,0 +1,162 @@
+#
+# Copyright (C) 2020-2023 by Ilkka Tuohela <hile@iki.fi>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+"""
+Unit tests for treesync.shards module
+"""
+import io
+
+import pytest
+
+from treesync.exceptions import SyncError
+from treesync.scheduler import SyncJob
+from treesync.shards import Shard, ShardedPush, balance_shards, plan_shards
+from treesync.stats import SyncStats
+from treesync.target import Target
+
+from .utils import create_test_target
+
+#: Test source tree directories with number of files of 1000 bytes
+TEST_DIRECTORIES = {
+    'large': 6,
+    'medium': 3,
+    'small': 2,
+    'tiny': 1,
+    '__pycache__': 10,
+}
+
+
+class MockStreamedCommand:
+    """
+    Mock Target.run_sync_command_streamed writing output and returning statistics
+    """
+    def __init__(self, fail: bool = False) -> None:
+        self.fail = fail
+        self.args = []
+        self.filters = []
+
+    def __call__(self, *args, output=None, stats=False):
+        self.args.append(args)
+        for arg in args:
+            if arg.startswith('--include-from='):
+                with open(arg.split('=', 1)[1], encoding='utf-8') as handle:
+                    self.filters.append(handle.read().splitlines())
+        output.write(f'command {len(self.args)}\n')
+        if self.fail and len(self.filters) == 1:
+            raise SyncError('shard failed')
+        return SyncStats(files=1, total_file_size=1000, bytes_sent=400, bytes_received=100) if stats else None
+
+
+def create_sharded_target(tmp_path, **kwargs) -> Target:
+    """
+    Create a target with several top-level directories in the source tree
+    """
+    source = tmp_path.joinpath('source')
+    for name, count in TEST_DIRECTORIES.items():
+        source.joinpath(name).mkdir(parents=True)
+        for index in range(count):
+            source.joinpath(name, f'{index}.dat').write_bytes(b'0' * 1000)
+    source.joinpath('top.txt').write_text('data\n', encoding='utf-8')
+    return create_test_target(tmp_path, source, tmp_path.joinpath('destination'), **kwargs)
+
+
+def test_shard_filter_rules() -> None:
+    """
+    Test include rules of shards escape wildcards only in names with wildcards
+    """
+    shard = Shard(names=['plain', 'back\\slash', 'star*[x]'])
+    assert shard.get_filter_rules() == ['/plain', '/back\\slash', '/star\\*\\[x]']
+
+
+def test_shard_balance() -> None:
+    """
+    Test balancing shards to buckets by size
+    """
+    shards = [Shard(names=[name], size=size) for name, size in (('a', 5), ('b', 4), ('c', 3), ('d', 3))]
+    buckets = balance_shards(shards, 2, 'size')
+    assert [bucket.names for bucket in buckets] == [['a', 'd'], ['b', 'c']]
+    assert [bucket.size for bucket in buckets] == [8, 7]
+    assert len(balance_shards(shards, 8, 'size')) == 4
+
+
+# pylint: disable=unused-argument
+def test_shard_plan(mock_no_user_sync_config, tmp_path) -> None:
+    """
+    Test splitting target source trees to shards
+    """
+    target = create_sharded_target(tmp_path, shards=2, shard_by='files')
+    assert target.shards == 2
+    assert target.shard_by == 'files'
+    shards = plan_shards(target, 4, 'directory')
+    assert [shard.names for shard in shards] == [['large'], ['medium'], ['small'], ['tiny']]
+    shards = plan_shards(target, 2, 'files')
+    assert [shard.names for shard in shards] == [['large'], ['medium', 'small', 'tiny']]
+    assert [shard.files for shard in shards] == [6, 6]
+    assert [shard.size for shard in plan_shards(target, 2, 'size')] == [6000, 6000]
+    with pytest.raises(ValueError):
+        plan_shards(target, 2, 'invalid')
+
+    target = create_sharded_target(tmp_path.joinpath('flags'), flags=['--delete-excluded'])
+    assert target.shards is None
+    assert plan_shards(target, 2) is None
+
+
+# pylint: disable=unused-argument
+def test_shard_workers(mock_no_user_sync_config, tmp_path, monkeypatch) -> None:
+    """
+    Test concurrent shard commands are limited by the host limit of the target
+    """
+    target = create_sharded_target(tmp_path, shards=4)
+    assert target.shard_workers == 4
+    assert SyncJob(target, 'push').streams == 4
+    monkeypatch.setattr(Target, 'max_parallel', property(lambda self: 2))
+    assert target.shard_workers == 2
+    assert SyncJob(target, 'push').streams == 2
+    target = create_sharded_target(tmp_path.joinpath('single'))
+    assert target.shard_workers is None
+    assert SyncJob(target, 'push').streams == 1
+
+
+# pylint: disable=unused-argument
+def test_shard_push(mock_no_user_sync_config, tmp_path, monkeypatch) -> None:
+    """
+    Test pushing a target in shards with a final pass
+    """
+    target = create_sharded_target(tmp_path, shards=2, shard_by='size')
+    mock_command = MockStreamedCommand()
+    monkeypatch.setattr(target, 'run_sync_command_streamed', mock_command)
+    output = io.StringIO()
+    result = target.push(output=output, stats=True)
+
+    assert sorted(mock_command.filters) == [['/large'], ['/medium', '/small', '/tiny']]
+    assert len(mock_command.args) == 3
+    for args in mock_command.args[:2]:
+        assert '--exclude=/*' in args
+    assert mock_command.args[-1] == tuple(result.args)
+    assert result.args[-4:-2] == ['--no-recursive', '--dirs']
+    assert result.stats.files == 3
+    assert result.stats.bytes_transferred == 1500
+    assert result.stats.speedup == 2.0
+    assert output.getvalue().count('command') == 3
+
+    target.push(files_from=tmp_path.joinpath('files'), output=output, stats=True)
+    assert len(mock_command.args) == 4
+    assert '--no-recursive' not in mock_command.args[-1]
+
+
+# pylint: disable=unused-argument
+def test_shard_push_error(mock_no_user_sync_config, tmp_path) -> None:
+    """
+    Test errors in shards skip the final pass
+    """
+    target = create_sharded_target(tmp_path, shards=1)
+    mock_command = MockStreamedCommand(fail=True)
+    target.run_sync_command_streamed = mock_command
+    shards = plan_shards(target, 1)
+    output = io.StringIO()
+    with pytest.raises(SyncError):
+        ShardedPush(target, shards, workers=1).run(output=output)
+    assert len(mock_command.args) == len(shards)
+    assert not any('--no-recursive' in args for args in mock_command.args)
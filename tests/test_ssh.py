@@ -0,0 +1,127 @@
+#
+# Copyright (C) 2020-2023 by Ilkka Tuohela <hile@iki.fi>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+"""
+Unit tests for treesync.ssh module
+"""
+from subprocess import CalledProcessError
+
+import pytest
+
+from sys_toolkit.tests.mock import MockCalledMethod, MockException
+
+from treesync.configuration import Configuration
+from treesync.exceptions import SyncError
+from treesync.host import TargetHost
+from treesync.ssh import SSHControlMaster, SSHMultiplexer, get_remote_shell, has_rsh_flag
+
+from .conftest import HOST_SOURCES_CONFIG, HOST_TARGET_NAME, VALID_HOST_NAME
+
+
+def test_ssh_has_rsh_flag() -> None:
+    """
+    Test detecting custom remote shell flags for rsync
+    """
+    assert not has_rsh_flag([])
+    assert not has_rsh_flag(['--archive', '--exclude=-e'])
+    assert has_rsh_flag(['--archive', '--rsh=ssh -p 2222'])
+    assert has_rsh_flag(['-e', 'ssh -p 2222'])
+    assert has_rsh_flag(['-essh'])
+
+
+def test_ssh_get_remote_shell(monkeypatch) -> None:
+    """
+    Test detecting remote shell command from rsync flags
+    """
+    monkeypatch.delenv('RSYNC_RSH', raising=False)
+    assert get_remote_shell(['--archive']) == ['ssh']
+    assert get_remote_shell(['--rsh=ssh -p 2222']) == ['ssh', '-p', '2222']
+    assert get_remote_shell(['-e', 'ssh -l user']) == ['ssh', '-l', 'user']
+    monkeypatch.setenv('RSYNC_RSH', 'ssh -4')
+    assert get_remote_shell([]) == ['ssh', '-4']
+
+
+def test_ssh_control_master_connect_close(monkeypatch, tmpdir) -> None:
+    """
+    Test connecting and closing a ssh master connection
+    """
+    mock_run = MockCalledMethod()
+    monkeypatch.setattr('treesync.ssh.run', mock_run)
+    master = SSHControlMaster(VALID_HOST_NAME, tmpdir.join('socket'))
+    assert master.__repr__() == f'ssh {VALID_HOST_NAME}'
+    assert f'ControlPath={tmpdir.join("socket")}' in master.rsh
+
+    master.close()
+    assert mock_run.call_count == 0
+
+    master.connect()
+    master.connect()
+    assert master.connected
+    assert master.setup_time >= 0
+    assert mock_run.call_count == 1
+    args = mock_run.args[0][0]
+    assert 'ControlMaster=yes' in args
+    assert args[-1] == VALID_HOST_NAME
+
+    master.close()
+    assert not master.connected
+    assert mock_run.call_count == 2
+    assert mock_run.args[1][0][-3:] == ['-O', 'exit', VALID_HOST_NAME]
+
+
+def test_ssh_control_master_connect_error(monkeypatch, tmpdir) -> None:
+    """
+    Test errors connecting a ssh master connection
+    """
+    monkeypatch.setattr(
+        'treesync.ssh.run',
+        MockException(CalledProcessError, cmd='ssh', returncode=255)
+    )
+    master = SSHControlMaster(VALID_HOST_NAME, tmpdir.join('socket'))
+    with pytest.raises(SyncError):
+        master.connect()
+    assert not master.connected
+
+
+def test_ssh_multiplexer_connect_hosts(monkeypatch) -> None:
+    """
+    Test connecting target hosts with the multiplexer
+    """
+    mock_run = MockCalledMethod()
+    monkeypatch.setattr('treesync.ssh.run', mock_run)
+    host = TargetHost(VALID_HOST_NAME)
+    assert host.rsh is None
+
+    with SSHMultiplexer() as multiplexer:
+        master = multiplexer.connect(host)
+        assert multiplexer.connect(host) == master
+        assert host.control_master == master
+        assert host.rsh == master.rsh
+        assert multiplexer.directory.is_dir()
+        directory = multiplexer.directory
+        assert multiplexer.setup_time >= 0
+    assert mock_run.call_count == 2
+    assert not directory.exists()
+    assert host.rsh is None
+
+
+def test_target_remote_host_rsh_flag(monkeypatch) -> None:
+    """
+    Test remote host detection and rsync remote shell flag for target with shared connection
+    """
+    monkeypatch.setattr('treesync.ssh.run', MockCalledMethod())
+    config = Configuration(HOST_SOURCES_CONFIG)
+    target = config.sync_targets.get(HOST_TARGET_NAME)
+    assert target.remote_host == VALID_HOST_NAME
+    assert not has_rsh_flag(target.flags)
+
+    with SSHMultiplexer() as multiplexer:
+        master = multiplexer.connect(target.target_host)
+        assert f'--rsh={master.rsh}' in target.flags
+
+    for destination in ('/local/path', './local:path', 'server::module', 'rsync://server/module'):
+        target.destination = destination
+        assert target.remote_host is None
+        assert target.target_host is None
@@ -0,0 +1,189 @@
+#
+# Copyright (C) 2020-2023 by Ilkka Tuohela <hile@iki.fi>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+"""
+Unit tests for treesync.state module
+"""
+import threading
+
+import pytest
+
+from treesync.directories import user_data_directory
+from treesync.exceptions import StateStoreError
+from treesync.state import STATE_HISTORY_LENGTH, SyncRecord, SyncStateStore, TransferSample
+
+TEST_TARGET = 'server:data'
+
+
+def create_record(index: int, exit_code: int = 0, target: str = TEST_TARGET) -> SyncRecord:
+    """
+    Create a sync record for tests
+    """
+    return SyncRecord(
+        target=target,
+        action='push',
+        started=1000.0 + index,
+        finished=1001.0 + index,
+        duration=1.0,
+        exit_code=exit_code,
+        bytes=index * 1024,
+        files=index,
+    )
+
+
+def test_state_store_records() -> None:
+    """
+    Test recording and reading sync command results
+    """
+    state = SyncStateStore()
+    assert state.path.parent == user_data_directory()
+    assert state.get_last(TEST_TARGET, 'push') is None
+
+    state.record(create_record(1))
+    state.record(create_record(2, exit_code=23))
+    last = state.get_last(TEST_TARGET, 'push')
+    assert last == create_record(2, exit_code=23)
+    assert not last.succeeded
+    assert state.get_history(TEST_TARGET, 'push') == [create_record(2, exit_code=23), create_record(1)]
+    assert state.get_last(TEST_TARGET, 'pull') is None
+
+    # State is persistent between store instances
+    state.close()
+    assert SyncStateStore().get_last(TEST_TARGET, 'push') == last
+
+
+def test_state_store_history_length() -> None:
+    """
+    Test old records are removed from the history
+    """
+    state = SyncStateStore()
+    for index in range(STATE_HISTORY_LENGTH + 5):
+        state.record(create_record(index))
+    history = state.get_history(TEST_TARGET, 'push')
+    assert len(history) == STATE_HISTORY_LENGTH
+    assert history[-1] == create_record(5)
+
+
+def test_state_store_digests() -> None:
+    """
+    Test recording tree digests of targets
+    """
+    state = SyncStateStore()
+    assert state.get_digest(TEST_TARGET) is None
+    state.set_digest(TEST_TARGET, 'abcd')
+    state.set_digest(TEST_TARGET, 'efgh')
+    assert state.get_digest(TEST_TARGET) == 'efgh'
+    assert state.get_digest('other') is None
+
+
+def test_state_store_fan_out_runs() -> None:
+    """
+    Test recording fan-out pushes of targets
+    """
+    state = SyncStateStore()
+    assert state.get_fan_out_run(TEST_TARGET) is None
+    state.set_fan_out_run(TEST_TARGET, 'abcd')
+    assert state.get_fan_out_run(TEST_TARGET) == 'abcd'
+    state.set_fan_out_run(TEST_TARGET, None)
+    assert state.get_fan_out_run(TEST_TARGET) is None
+
+
+def test_state_store_host_capabilities() -> None:
+    """
+    Test recording rsync capabilities of hosts
+    """
+    state = SyncStateStore()
+    assert state.get_host_capabilities('server', 'rsync', 60) is None
+    state.set_host_capabilities('server', 'rsync', '{}')
+    assert state.get_host_capabilities('server', 'rsync', 60) == '{}'
+    assert state.get_host_capabilities('server', 'rsync', -1) is None
+    assert state.get_host_capabilities('server', '/opt/bin/rsync', 60) is None
+
+
+def test_state_store_host_transfers() -> None:
+    """
+    Test recording transfer statistics of hosts
+    """
+    state = SyncStateStore()
+    for index in range(STATE_HISTORY_LENGTH + 5):
+        state.record_transfer(TransferSample('server', index, 1.0, index % 2 == 0, 1000, 500, 10))
+    samples = state.get_transfers('server')
+    assert len(samples) == STATE_HISTORY_LENGTH
+    assert samples[0].finished == STATE_HISTORY_LENGTH + 4
+    assert samples[0].compressed
+    assert samples[0].bytes_transferred == 510
+    assert state.get_transfers('other') == []
+
+
+def test_state_store_journal() -> None:
+    """
+    Test recording journals of changed paths of targets
+    """
+    state = SyncStateStore()
+    journal = state.get_journal(TEST_TARGET)
+    assert journal.paths == []
+    assert journal.settings is None
+    assert journal.last_full_sync is None
+
+    state.add_journal_paths(TEST_TARGET, ['b', 'a'], max_paths=3)
+    state.add_journal_paths(TEST_TARGET, ['a', 'c'], max_paths=3)
+    assert state.get_journal(TEST_TARGET).paths == ['a', 'b', 'c']
+    assert state.get_journal('other').paths == []
+
+    state.clear_journal(TEST_TARGET, 'settings', ['a', 'b'])
+    journal = state.get_journal(TEST_TARGET)
+    assert journal.paths == ['c']
+    assert journal.settings == 'settings'
+    assert journal.last_full_sync is None
+
+    state.add_journal_paths(TEST_TARGET, ['d', 'e', 'f'], max_paths=3)
+    journal = state.get_journal(TEST_TARGET)
+    assert journal.overflowed
+    assert journal.paths == []
+    state.add_journal_paths(TEST_TARGET, ['g'], max_paths=3)
+    assert state.get_journal(TEST_TARGET).paths == []
+
+    state.clear_journal(TEST_TARGET, 'settings', [], full_sync=2000.0)
+    journal = state.get_journal(TEST_TARGET)
+    assert not journal.overflowed
+    assert journal.last_full_sync == 2000.0
+
+    state.add_journal_paths(TEST_TARGET, None, max_paths=3)
+    assert state.get_journal(TEST_TARGET).overflowed
+
+
+def test_state_store_parallel_writers() -> None:
+    """
+    Test recording state from several threads and store instances at the same time
+    """
+    stores = [SyncStateStore(), SyncStateStore()]
+
+    def record(store: SyncStateStore, index: int) -> None:
+        for count in range(10):
+            store.record(create_record(count, target=f'target{index}'))
+
+    threads = [
+        threading.Thread(target=record, args=(stores[index % 2], index))
+        for index in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for index in range(8):
+        assert len(stores[0].get_history(f'target{index}', 'push')) == 10
+    for store in stores:
+        store.close()
+
+
+def test_state_store_error(tmp_path) -> None:
+    """
+    Test errors opening the state database
+    """
+    path = tmp_path.joinpath('file')
+    path.write_text('not a directory\n', encoding='utf-8')
+    state = SyncStateStore(path.joinpath('state.sqlite'))
+    with pytest.raises(StateStoreError):
+        state.get_last(TEST_TARGET, 'push')
@@ -0,0 +1,122 @@
+#
+# Copyright (C) 2020-2023 by Ilkka Tuohela <hile@iki.fi>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+"""
+Unit tests for treesync.stats module
+"""
+import io
+
+import pytest
+
+from treesync.exceptions import SyncError
+from treesync.stats import RsyncStatsParser, SyncStats, merge_stats
+from treesync.target import Target
+
+RSYNC_STATS_OUTPUT = """sending incremental file list
+./
+data/file.txt
+
+Number of files: 1,234 (reg: 1,000, dir: 234)
+Number of created files: 3 (reg: 3)
+Number of deleted files: 1 (reg: 1)
+Number of regular files transferred: 12
+Total file size: 12,345,678 bytes
+Total transferred file size: 45,678 bytes
+Literal data: 40,000 bytes
+Matched data: 5,678 bytes
+File list size: 0
+File list generation time: 0.001 seconds
+File list transfer time: 0.000 seconds
+Total bytes sent: 41,234
+Total bytes received: 567
+
+sent 41,234 bytes  received 567 bytes  83,602.00 bytes/sec
+total size is 12,345,678  speedup is 295.34
+"""
+EXPECTED_STATS = SyncStats(
+    files=1234,
+    created_files=3,
+    deleted_files=1,
+    files_transferred=12,
+    total_file_size=12345678,
+    transferred_file_size=45678,
+    literal_data=40000,
+    matched_data=5678,
+    bytes_sent=41234,
+    bytes_received=567,
+    speedup=295.34,
+)
+
+
+def test_stats_parser() -> None:
+    """
+    Test parsing rsync --stats output
+    """
+    stats = RsyncStatsParser().parse(RSYNC_STATS_OUTPUT.splitlines())
+    assert stats == EXPECTED_STATS
+    assert stats.bytes_transferred == 41801
+    assert stats.as_dict()['speedup'] == 295.34
+
+
+def test_stats_parser_human_readable() -> None:
+    """
+    Test values with unit suffixes in rsync --stats output are not parsed
+    """
+    parser = RsyncStatsParser()
+    stats = parser.parse([
+        'Number of files: 1.234 (reg: 1.000, dir: 234)',
+        'Total file size: 1.23G bytes',
+        'Literal data: 512.00K bytes',
+        'Total bytes sent: 1,023',
+    ])
+    assert stats.files == 1234
+    assert stats.total_file_size is None
+    assert stats.literal_data is None
+    assert stats.bytes_sent == 1023
+    with pytest.raises(ValueError):
+        RsyncStatsParser.__parse_integer__('1.23')
+    assert RsyncStatsParser().parse(['Total file size: 1.23G bytes']) is None
+
+
+def test_stats_parser_no_stats() -> None:
+    """
+    Test parsing rsync output without statistics
+    """
+    assert RsyncStatsParser().parse(['sending incremental file list', 'file.txt']) is None
+    assert SyncStats().bytes_transferred is None
+
+
+def test_stats_run_sync_command(tmp_path) -> None:
+    """
+    Test parsing statistics from command output while running the command
+    """
+    output_file = tmp_path.joinpath('output.txt')
+    output_file.write_text(RSYNC_STATS_OUTPUT, encoding='utf-8')
+
+    output = io.StringIO()
+    stats = Target.run_sync_command_streamed('cat', str(output_file), output=output, stats=True)
+    assert stats == EXPECTED_STATS
+    assert output.getvalue() == RSYNC_STATS_OUTPUT
+
+    assert Target.run_sync_command_streamed('true', output=output, stats=True) is None
+    with pytest.raises(SyncError):
+        Target.run_sync_command_streamed('false', output=output, stats=True)
+
+
+def test_stats_merge() -> None:
+    """
+    Test summing statistics of several rsync commands
+    """
+    stats = merge_stats([
+        SyncStats(files=2, total_file_size=1000, bytes_sent=100, bytes_received=100, speedup=5.0),
+        None,
+        SyncStats(files=1, total_file_size=500, bytes_sent=50),
+    ])
+    assert stats.files == 3
+    assert stats.total_file_size == 1500
+    assert stats.bytes_sent == 150
+    assert stats.bytes_received == 100
+    assert stats.speedup == 6.0
+    assert merge_stats([None]) is None
@@ -6,18 +6,27 @@
 """
 Unit tests for treesync.target module
 """
+from dataclasses import FrozenInstanceError
+from pathlib import Path
 from typing import List, Optional
 
+import pytest
+
+from sys_toolkit.tests.mock import MockCalledMethod
+
 from treesync.configuration import Configuration
-from treesync.target import Target, TargetList
+from treesync.stats import SyncResult
+from treesync.target import Target, TargetList, TargetPlan
 
 from .conftest import (
+    EXCLUDES_FILE,
     EXPECTED_HOSTS_TOTAL_TARGETS_COUNT,
     EXPECTED_HOST_TARGET_FLAGS,
     HOST_TARGET_NAME,
     VALID_HOST_NAME,
     VALID_TARGET_NAME,
 )
+from .utils import create_source_directory
 
 
 def get_first_sync_target(hostname: str, sync_targets: List) -> Optional[Target]:
@@ -99,3 +108,71 @@ def test_sync_targets_get_target(mock_config_host_sources) -> None:
     config = Configuration()
     target = config.sync_targets.get(HOST_TARGET_NAME)
     assert isinstance(target, Target)
+
+
+# pylint: disable=unused-argument
+def test_target_plan_memoized(mock_config_host_sources) -> None:
+    """
+    Test the resolved target plan is computed once and is immutable
+    """
+    config = Configuration()
+    target = config.sync_targets.get(HOST_TARGET_NAME)
+    plan = target.plan
+    assert isinstance(plan, TargetPlan)
+    assert target.plan is plan
+    assert target.get_pull_command_args()[1:-2] == target.get_push_command_args()[1:-2]
+    assert target.plan is plan
+    assert len(plan.flags) == len(set(plan.flags))
+    assert list(plan.excluded) == target.excluded
+    with pytest.raises(FrozenInstanceError):
+        plan.flags = ()
+
+
+# pylint: disable=unused-argument
+def test_target_plan_excludes_file_modified(mock_no_user_sync_config, tmpdir) -> None:
+    """
+    Test the target plan and temporary excludes file are updated when excludes file is modified
+    """
+    source, _destination, config_file = create_source_directory(tmpdir, EXCLUDES_FILE)
+    target = Configuration(config_file).sync_targets.get('test')
+    plan = target.plan
+    excludes_file = target.excludes_file
+    assert plan.tree_excludes_file_signature is not None
+    assert target.excludes_file is excludes_file
+
+    with source.joinpath(EXCLUDES_FILE.name).open('a', encoding='utf-8') as handle:
+        handle.write('added-exclude-pattern\n')
+    assert target.plan is not plan
+    assert 'added-exclude-pattern' in target.plan.excluded
+    assert target.excludes_file is not excludes_file
+    assert Path(str(target.excludes_file)).read_text(encoding='utf-8').splitlines() == target.excluded
+
+
+# pylint: disable=unused-argument
+def test_target_push_pull_result(mock_no_user_sync_config, tmpdir, monkeypatch) -> None:
+    """
+    Test results returned by target push and pull methods
+    """
+    mock_run = MockCalledMethod()
+    monkeypatch.setattr('treesync.target.run', mock_run)
+    _source, _destination, config_file = create_source_directory(tmpdir, EXCLUDES_FILE)
+    target = Configuration(config_file).sync_targets.get('test')
+
+    result = target.push()
+    assert isinstance(result, SyncResult)
+    assert result.action == 'push'
+    assert result.target == 'test'
+    assert result.stats is None
+    assert tuple(result.args) == mock_run.args[0][0]
+    assert '--stats' not in result.args
+    assert '--no-human-readable' not in result.args
+
+    mock_popen = MockCalledMethod()
+    monkeypatch.setattr(target, 'run_sync_command_streamed', mock_popen)
+    result = target.pull(stats=True)
+    assert result.action == 'pull'
+    assert '--stats' in mock_popen.args[0]
+    assert '--no-human-readable' in mock_popen.args[0]
+
+    args = target.get_push_command_args(files_from=Path('/tmp/files'))
+    assert args[-4:-2] == ['--from0', '--files-from=/tmp/files']
@@ -0,0 +1,128 @@
+#
+# Copyright (C) 2020-2023 by Ilkka Tuohela <hile@iki.fi>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+"""
+Unit tests for treesync.watch module
+"""
+from treesync.target import Target
+from treesync.watch import IN_ISDIR, IN_Q_OVERFLOW, InotifyEvent, TreeWatcher
+
+from .utils import create_test_target
+
+#: Seconds to wait for events in tests
+WAIT_TIMEOUT = 5
+
+
+def create_watched_target(tmp_path) -> Target:
+    """
+    Create a target with a source tree containing normal and excluded directories
+    """
+    source = tmp_path.joinpath('source')
+    for directory in ('a/b', 'c', '__pycache__/sub', 'logs'):
+        source.joinpath(directory).mkdir(parents=True)
+    return create_test_target(tmp_path, source, tmp_path.joinpath('destination'), excludes=['logs/'])
+
+
+# pylint: disable=unused-argument
+def test_watch_directories(mock_no_user_sync_config, tmp_path) -> None:
+    """
+    Test watching directories of a source tree skips excluded directories
+    """
+    target = create_watched_target(tmp_path)
+    with TreeWatcher([target], debounce=0.05) as watcher:
+        tree = watcher.trees[0]
+        assert not tree.incomplete
+        assert watcher.watch_count == 4
+        paths = sorted(tree.get_path(wd) for wd in tree.directories)
+        assert paths == ['a', 'a/b', 'c']
+        assert tree.get_path(tree.root) == ''
+        assert tree.get_path(-1) is None
+
+
+# pylint: disable=unused-argument
+def test_watch_changes(mock_no_user_sync_config, tmp_path) -> None:
+    """
+    Test detecting changes in watched source trees
+    """
+    target = create_watched_target(tmp_path)
+    with TreeWatcher([target], debounce=0.05) as watcher:
+        assert watcher.wait(timeout=0.1) == []
+
+        target.source.joinpath('a/b/file.txt').write_text('data\n', encoding='utf-8')
+        target.source.joinpath('c/file.txt').write_text('data\n', encoding='utf-8')
+        assert watcher.wait(timeout=WAIT_TIMEOUT) == [target]
+        assert watcher.wait(timeout=0.1) == []
+
+        target.source.joinpath('a/module.pyc').write_text('data\n', encoding='utf-8')
+        target.source.joinpath('__pycache__/sub/module.pyc').write_text('data\n', encoding='utf-8')
+        target.source.joinpath('logs/out.log').write_text('data\n', encoding='utf-8')
+        assert watcher.wait(timeout=0.2) == []
+
+        new = target.source.joinpath('new/sub')
+        new.mkdir(parents=True)
+        assert watcher.wait(timeout=WAIT_TIMEOUT) == [target]
+        new.joinpath('file.txt').write_text('data\n', encoding='utf-8')
+        assert watcher.wait(timeout=WAIT_TIMEOUT) == [target]
+        assert 'new/sub' in [watcher.trees[0].get_path(wd) for wd in watcher.trees[0].directories]
+
+
+# pylint: disable=unused-argument
+def test_watch_moved_directory(mock_no_user_sync_config, tmp_path) -> None:
+    """
+    Test directories moved within the tree are tracked with the new path
+    """
+    target = create_watched_target(tmp_path)
+    with TreeWatcher([target], debounce=0.05) as watcher:
+        tree = watcher.trees[0]
+        target.source.joinpath('a/b').rename(target.source.joinpath('c/moved'))
+        assert watcher.wait(timeout=WAIT_TIMEOUT) == [target]
+        assert sorted(tree.get_path(wd) for wd in tree.directories) == ['a', 'c', 'c/moved']
+
+
+# pylint: disable=unused-argument
+def test_watch_debounce(mock_no_user_sync_config, tmp_path) -> None:
+    """
+    Test changes are coalesced within the debounce window and limited by maximum delay
+    """
+    target = create_watched_target(tmp_path)
+    with TreeWatcher([target], debounce=10, max_delay=20) as watcher:
+        watcher.process_event(InotifyEvent(wd=watcher.trees[0].root, mask=0, cookie=0, name='a.txt'), 100)
+        watcher.process_event(InotifyEvent(wd=watcher.trees[0].root, mask=0, cookie=0, name='b.txt'), 105)
+        assert watcher.get_timeout(105) == 10
+        assert watcher.get_changed(114) == []
+        assert watcher.get_changed(115) == [target]
+        assert watcher.get_timeout(115) is None
+
+        for timestamp in range(100, 120, 5):
+            watcher.process_event(InotifyEvent(wd=watcher.trees[0].root, mask=0, cookie=0, name='a.txt'), timestamp)
+        assert watcher.get_changed(119) == []
+        assert watcher.get_changed(120) == [target]
+
+        watcher.process_event(InotifyEvent(wd=-1, mask=IN_Q_OVERFLOW, cookie=0, name=''), 200)
+        assert watcher.get_changed(210) == [target]
+        watcher.process_event(
+            InotifyEvent(wd=watcher.trees[0].root, mask=IN_ISDIR, cookie=0, name='__pycache__'),
+            300
+        )
+        assert watcher.get_timeout(300) is None
+
+
+# pylint: disable=unused-argument
+def test_watch_changed_paths(mock_no_user_sync_config, tmp_path) -> None:
+    """
+    Test collecting changed paths of watched source trees
+    """
+    target = create_watched_target(tmp_path)
+    with TreeWatcher([target], debounce=0.05, max_paths=3) as watcher:
+        target.source.joinpath('a/b/file.txt').write_text('data\n', encoding='utf-8')
+        target.source.joinpath('a/module.pyc').write_text('data\n', encoding='utf-8')
+        assert watcher.wait(timeout=WAIT_TIMEOUT) == [target]
+        assert watcher.pop_changed_paths(target) == ['a/b/file.txt']
+        assert watcher.pop_changed_paths(target) == []
+
+        for name in ('1', '2', '3', '4'):
+            target.source.joinpath(f'c/{name}.txt').write_text('data\n', encoding='utf-8')
+        assert watcher.wait(timeout=WAIT_TIMEOUT) == [target]
+        assert watcher.pop_changed_paths(target) is None
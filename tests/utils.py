@@ -13,10 +13,17 @@ from pathlib import Path
 
 import yaml
 
+from treesync.configuration import Configuration
 
-def create_test_config(path, name, source, destination, **kwargs):
+#: Destination of test targets on a remote host
+TEST_REMOTE_DESTINATION = 'server:/srv/data'
+
+
+def create_test_config(path, name, source, destination, defaults=None, **kwargs):
     """
     Create a test configuration file with one target
+
+    Settings in defaults are written to the defaults section
     """
     data = {
         name: {
@@ -25,13 +32,31 @@ def create_test_config(path, name, source, destination, **kwargs):
         }
     }
     data[name].update(**kwargs)
-    data = yaml.safe_dump({
-        'targets': data
-    })
+    config = {'targets': data}
+    if defaults:
+        config['defaults'] = defaults
+    data = yaml.safe_dump(config)
     with open(path, 'w', encoding='utf-8') as filedescriptor:
         filedescriptor.write(f'{data}\n')
 
 
+def create_test_target(tmp_path, source, destination, defaults=None, **kwargs):
+    """
+    Create a test configuration file with one target in tmp_path and return the target
+    """
+    config_file = Path(tmp_path, 'test.yml')
+    create_test_config(config_file, 'test', source, destination, defaults=defaults, **kwargs)
+    return Configuration(config_file).sync_targets.get('test')
+
+
+def create_remote_target(tmp_path, defaults=None, **kwargs):
+    """
+    Create a target with tmp_path as source and a remote shell destination
+    """
+    tmp_path.mkdir(parents=True, exist_ok=True)
+    return create_test_target(tmp_path, tmp_path, TEST_REMOTE_DESTINATION, defaults=defaults, **kwargs)
+
+
 def create_source_directory(tmpdir, excludes_file=None):
     """
     Create temporary source directory for tests
@@ -58,3 +83,30 @@ def create_source_directory(tmpdir, excludes_file=None):
     )
 
     return source, destination, config_file
+
+
+def create_mock_rsync(path, output='', exit_code=0, delay=0):
+    """
+    Create a mock rsync command script writing specified output and exiting with exit code
+
+    With delay the script sleeps before exiting. Terminating the script stops the sleep and
+    exits with the exit code of a process terminated by SIGTERM.
+    """
+    path = Path(path)
+    path.with_suffix('.out').write_text(output, encoding='utf-8')
+    script = '\n'.join([
+        '#!/bin/sh',
+        f'cat "{path.with_suffix(".out")}"',
+        *([f'sleep {delay} &', "trap 'kill $!; exit 143' TERM", 'wait $!'] if delay else []),
+        f'exit {exit_code}',
+    ])
+    path.write_text(f'{script}\n', encoding='utf-8')
+    path.chmod(0o755)
+    return path
+
+
+def create_test_config_with_rsync(path, name, source, destination, rsync_command, **kwargs):
+    """
+    Create a test configuration file with one target and custom rsync command
+    """
+    create_test_config(path, name, source, destination, defaults={'rsync_command': str(rsync_command)}, **kwargs)
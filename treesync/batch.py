@@ -0,0 +1,331 @@
+#
+# Copyright (C) 2020-2023 by Ilkka Tuohela <hile@iki.fi>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+"""
+Batched pushes of small sync targets to the same host with a single rsync command
+
+Targets pushed to the same remote host with the same rsync flags and excludes, with
+destinations under a common root directory, are pushed with one rsync command. Each source
+is passed to rsync with --relative and a /./ marker, so that the path after the marker is
+created under the common root. This requires the destination of each target to end with the
+same path components as the source. The output of the command is split to the targets by the
+relative paths in the output lines.
+"""
+import io
+import time
+
+from contextlib import ExitStack
+from pathlib import Path, PurePosixPath
+from typing import Dict, IO, List, Optional, Tuple, TYPE_CHECKING
+
+from .exceptions import SyncError
+from .output import TargetOutput
+from .scanner import ExcludeMatcher, has_unsupported_flags
+from .scheduler import SyncJob
+from .stats import SyncResult
+
+if TYPE_CHECKING:  # pragma: no cover
+    from .target import Target
+
+#: Maximum expected duration in seconds of targets pushed in batches
+BATCH_MAX_EXPECTED_DURATION = 60.0
+#: Minimum number of targets pushed as a batch
+BATCH_MIN_TARGETS = 2
+#: rsync long flags conflicting with pushing several sources with --relative
+UNBATCHABLE_LONG_FLAGS = (
+    '--relative',
+    '--no-relative',
+    '--no-R',
+    '--implied-dirs',
+    '--no-implied-dirs',
+)
+#: rsync short flags conflicting with pushing several sources with --relative
+UNBATCHABLE_SHORT_FLAGS = 'R'
+
+
+def has_unbatchable_flags(flags: List[str]) -> bool:
+    """
+    Check if rsync flags prevent pushing the target in a batch
+    """
+    if has_unsupported_flags(flags):
+        return True
+    for flag in flags:
+        if flag.startswith('--'):
+            if flag.split('=', 1)[0] in UNBATCHABLE_LONG_FLAGS:
+                return True
+        elif flag.startswith('-') and any(character in UNBATCHABLE_SHORT_FLAGS for character in flag[1:]):
+            return True
+    return False
+
+
+def get_batch_key(target: 'Target') -> Optional[Tuple]:
+    """
+    Return key for targets which can be pushed in the same batch, or None if the target
+    can't be pushed in a batch
+
+    Excludes must only match file names, because patterns matching paths would match the
+    paths relative to the common root differently.
+    """
+    remote_host = target.remote_host
+    if remote_host is None or target.shards is not None or target.large_file_size is not None:
+        return None
+    flags = target.plan.flags
+    if flags is None or has_unbatchable_flags(flags):
+        return None
+    matcher = ExcludeMatcher(target.excluded)
+    if not matcher.exact or any(pattern.match_path for pattern in matcher.patterns):
+        return None
+    return remote_host, tuple(target.flags)
+
+
+def get_destination_path(target: 'Target') -> PurePosixPath:
+    """
+    Return path of the target destination on the remote host
+    """
+    path = target.destination.split(':', 1)[1]
+    return PurePosixPath(path.rstrip('/') or path or '.')
+
+
+def get_batch_roots(target: 'Target') -> List[Tuple[str, int]]:
+    """
+    Return possible common roots for the target destination
+
+    Roots are returned as tuples of root path and number of path components after the
+    root, which must be the same in the source and destination paths
+    """
+    destination = get_destination_path(target).parts
+    source = target.source.parts
+    limit = min(len(destination) - 1 if destination[:1] == ('/',) else len(destination), len(source) - 1)
+    roots = []
+    for count in range(1, limit + 1):
+        if destination[-count] != source[-count] or destination[-count] in ('.', '..'):
+            break
+        roots.append((str(PurePosixPath(*destination[:-count])), count))
+    return roots
+
+
+class TargetBatch:
+    """
+    Sync targets pushed to a common root directory on a remote host with one rsync command
+    """
+    def __init__(self, remote_host: str, root: str, targets: List['Target'], counts: List[int]) -> None:
+        self.remote_host = remote_host
+        self.root = root
+        self.targets = targets
+        self.relative_paths = [
+            str(PurePosixPath(*target.source.parts[-count:])) for target, count in zip(targets, counts)
+        ]
+        self.base_paths = [Path(*target.source.parts[:-count]) for target, count in zip(targets, counts)]
+
+    def __repr__(self) -> str:
+        return f'{self.remote_host}:{self.root}'
+
+    def get_push_command_args(self, dry_run: bool = False, stats: bool = False) -> List[str]:
+        """
+        Return rsync command arguments for pushing all targets of the batch
+        """
+        args = self.targets[0].get_rsync_cmd_args(dry_run=dry_run, stats=stats)
+        args.extend(['--relative', '--no-implied-dirs'])
+        for base, relative in zip(self.base_paths, self.relative_paths):
+            args.append(f"{str(base).rstrip('/')}/./{relative}/")
+        args.append(f"{self.remote_host}:{self.root.rstrip('/')}/")
+        return args
+
+    def get_target_index(self, line: str) -> Optional[int]:
+        """
+        Return index of the target an output line refers to, or None for common lines
+
+        Paths are matched at the start of the line or after the first word, to match
+        deleted paths and itemized changes
+        """
+        text = line.rstrip('\n')
+        candidates = [text]
+        if ' ' in text:
+            candidates.append(text.split(' ', 1)[1])
+        for candidate in candidates:
+            for index, relative in enumerate(self.relative_paths):
+                if candidate == relative or candidate.startswith(f'{relative}/'):
+                    return index
+        return None
+
+    def push(self, outputs: List[IO], dry_run: bool = False, stats: bool = False) -> SyncResult:
+        """
+        Push the targets, writing output lines to the outputs of the targets
+
+        Raises SyncError if the command fails
+        """
+        args = self.get_push_command_args(dry_run=dry_run, stats=stats)
+        output = BatchOutput(self, outputs)
+        return SyncResult(
+            target=str(self),
+            action='push',
+            args=args,
+            stats=self.targets[0].run_sync_command_streamed(*args, output=output, stats=stats),
+        )
+
+
+class BatchOutput:
+    """
+    Output of a batch command, split to outputs of the targets
+
+    Lines not referring to the path of any target are written to all outputs
+    """
+    def __init__(self, batch: TargetBatch, outputs: List[IO]) -> None:
+        self.batch = batch
+        self.outputs = outputs
+
+    def write(self, text: str) -> None:
+        """
+        Write output lines to the target outputs
+        """
+        for line in text.splitlines(keepends=True):
+            index = self.batch.get_target_index(line)
+            if index is not None:
+                self.outputs[index].write(line)
+            else:
+                for output in self.outputs:
+                    output.write(line)
+
+
+class BatchSyncJob(SyncJob):
+    """
+    Push jobs of several targets run with a single rsync command
+
+    The results of the command are copied to the jobs of the targets, which are reported
+    and recorded as separate jobs. Each job gets a share of the duration of the command, so
+    that the recorded history of a target does not contain the duration of the whole batch.
+    Statistics of the command are not split to the targets.
+    """
+    def __init__(self, batch: TargetBatch, jobs: List[SyncJob]) -> None:
+        super().__init__(jobs[0].target, 'push', dry_run=jobs[0].dry_run, stats=jobs[0].stats)
+        self.target_batch = batch
+        self.jobs = jobs
+        durations = [job.expected_duration for job in jobs if job.expected_duration is not None]
+        self.expected_duration = sum(durations) if durations else None
+        for job in jobs:
+            job.batch = self
+
+    def __repr__(self) -> str:
+        return f'push {len(self.jobs)} targets -> {self.target_batch}'
+
+    @property
+    def members(self) -> List[SyncJob]:
+        """
+        Return jobs of the targets in the batch
+        """
+        return self.jobs
+
+    def get_member_durations(self) -> List[float]:
+        """
+        Split duration of the batch command to the jobs by their share of the expected duration
+
+        The duration is split evenly if any of the jobs has no expected duration
+        """
+        duration = self.duration or 0.0
+        expected = [job.expected_duration for job in self.jobs]
+        if any(value is None for value in expected) or not sum(expected):
+            return [duration / len(self.jobs)] * len(self.jobs)
+        total = sum(expected)
+        return [duration * value / total for value in expected]
+
+    def run(self, capture_output: bool = False) -> 'SyncJob':
+        """
+        Run the batch command and copy the results to the jobs of the targets
+
+        Output of the command is always captured to split it to the targets
+        """
+        self.timestamp = time.time()
+        self.started = time.monotonic()
+        with ExitStack() as stack:
+            outputs = []
+            for job in self.jobs:
+                if job.log_output:
+                    output = stack.enter_context(TargetOutput(str(job.target)))
+                    job.log_file = output.log.path
+                else:
+                    output = io.StringIO()
+                outputs.append(output)
+            try:
+                self.result = self.target_batch.push(outputs, dry_run=self.dry_run, stats=self.stats)
+            except SyncError as error:
+                self.error = error
+            except OSError as error:
+                self.error = SyncError(f'Error running {self}: {error}')
+            finally:
+                self.finished = time.monotonic()
+                for job, output in zip(self.jobs, outputs):
+                    job.output = output.tail if isinstance(output, TargetOutput) else output.getvalue()
+
+        for job, duration in zip(self.jobs, self.get_member_durations()):
+            job.timestamp = self.timestamp
+            job.started = self.started
+            job.finished = self.started + duration
+            job.error = self.error
+            if self.result is not None:
+                job.result = SyncResult(target=str(job.target), action='push', args=self.result.args)
+            if not job.dry_run:
+                job.__record_state__(None)
+        return self
+
+
+def plan_batches(jobs: List[SyncJob], max_expected_duration: float = BATCH_MAX_EXPECTED_DURATION) -> List[SyncJob]:
+    """
+    Combine push jobs of small compatible targets to batch jobs
+
+    Jobs with an expected duration below max_expected_duration are batched, unless the
+    expected duration is only a lower bound. Each batch replaces the first of its jobs in
+    the returned list. Common roots shared by most jobs are used first. Jobs seeding empty
+    destinations are not batched.
+    """
+    candidates: Dict[Tuple, List[Tuple[SyncJob, int]]] = {}
+    for job in jobs:
+        if job.action != 'push' or job.skip_unchanged or job.journal is not None or job.members != [job]:
+            continue
+        if job.seed:
+            continue
+        if job.expected_duration is None or job.expected_duration > max_expected_duration:
+            continue
+        if job.expected_duration_lower_bound:
+            continue
+        key = get_batch_key(job.target)
+        if key is None:
+            continue
+        for root, count in get_batch_roots(job.target):
+            candidates.setdefault((key, root), []).append((job, count))
+
+    batches: Dict[int, BatchSyncJob] = {}
+    batched = set()
+    while candidates:
+        (key, root), members = max(
+            candidates.items(),
+            key=lambda item: sum(1 for job, _count in item[1] if id(job) not in batched)
+        )
+        del candidates[(key, root)]
+        selected: List[Tuple[SyncJob, int]] = []
+        relative_paths: List[PurePosixPath] = []
+        for job, count in members:
+            if id(job) in batched:
+                continue
+            relative = PurePosixPath(*job.target.source.parts[-count:])
+            # Nested destinations would delete files of each other
+            if any(relative == other or relative in other.parents or other in relative.parents
+                   for other in relative_paths):
+                continue
+            selected.append((job, count))
+            relative_paths.append(relative)
+        if len(selected) < BATCH_MIN_TARGETS:
+            continue
+        batch = TargetBatch(key[0], root, [job.target for job, _count in selected], [count for _job, count in selected])
+        batch_job = BatchSyncJob(batch, [job for job, _count in selected])
+        batches[id(selected[0][0])] = batch_job
+        batched.update(id(job) for job, _count in selected)
+
+    planned = []
+    for job in jobs:
+        if id(job) in batches:
+            planned.append(batches[id(job)])
+        elif id(job) not in batched:
+            planned.append(job)
+    return planned
@@ -6,12 +6,28 @@
 """
 Common base class for 'treesync' CLI commands
 """
+import time
+
 from argparse import ArgumentParser, Namespace
-from typing import List
+from typing import List, Optional, Union
 
 from cli_toolkit.command import Command
 
+from treesync.batch import plan_batches
+from treesync.capabilities import CapabilityProbe
+from treesync.compression import CompressionPolicy
 from treesync.configuration import Configuration
+from treesync.configuration.snapshot import ConfigurationSnapshot, load_configuration
+from treesync.exceptions import StateStoreError, SyncError
+from treesync.fanout import plan_fan_out
+from treesync.journal import PushJournal
+from treesync.metrics import MetricsFile
+from treesync.report import RunReport
+from treesync.estimates import DurationEstimator
+from treesync.seed import is_seed_candidate
+from treesync.scheduler import SyncJob, SyncScheduler, estimate_run_time, order_by_expected_duration
+from treesync.ssh import SSHMultiplexer, has_rsh_flag
+from treesync.state import RunSummary, SyncStateStore
 from treesync.target import Target
 
 
@@ -19,7 +35,12 @@ class TreesyncCommand(Command):
     """
     Common base class for treesync subcommands
     """
-    config: Configuration = None
+    config: Union[Configuration, ConfigurationSnapshot] = None
+    scheduler: SyncScheduler = None
+    state: SyncStateStore = None
+    report: RunReport = None
+    summary: RunSummary = None
+    scan_changes: bool = True
 
     @staticmethod
     def register_common_arguments(parser: ArgumentParser) -> ArgumentParser:
@@ -27,6 +48,11 @@ class TreesyncCommand(Command):
         Add parser arguments common to all commands
         """
         parser.add_argument('--config', help='Configuration file path')
+        parser.add_argument(
+            '--no-config-cache',
+            action='store_true',
+            help='Do not use cached configuration snapshot'
+        )
         parser.add_argument('targets', nargs='*', help='Sync command targets')
         return parser
 
@@ -40,13 +66,42 @@ class TreesyncCommand(Command):
             action='store_true',
             help='Run rsync with --dry-run flag'
         )
+        parser.add_argument(
+            '-j', '--jobs',
+            type=int,
+            default=1,
+            help='Number of targets to sync in parallel'
+        )
+        parser.add_argument(
+            '--ssh-multiplexing',
+            action='store_true',
+            help='Share one ssh connection per host for all rsync commands'
+        )
+        parser.add_argument(
+            '--stats',
+            action='store_true',
+            help='Run rsync with --stats and record transfer statistics of targets'
+        )
+        parser.add_argument(
+            '--log-output',
+            action='store_true',
+            help='Write rsync output to per-target log files and show a summary line per target'
+        )
+        parser.add_argument(
+            '--report',
+            help='Write JSONL report of the synced targets to specified file'
+        )
+        parser.add_argument(
+            '--metrics-file',
+            help='Write Prometheus metrics of synced targets to specified file'
+        )
         return parser
 
     def parse_args(self, args: Namespace = None, namespace: Namespace = None) -> Namespace:
         """
         Parse arguments and append config to command
         """
-        self.config = Configuration(args.config)
+        self.config = load_configuration(args.config, use_cache=not args.no_config_cache)
         return args
 
     def filter_targets(self, patterns: List[str]) -> List[Target]:
@@ -54,3 +109,266 @@ class TreesyncCommand(Command):
         Filter targets by list of string patterns, returning list of Target objects
         """
         return self.config.filter_sync_targets(patterns)
+
+    def sync_job_started(self, job: SyncJob) -> None:
+        """
+        Show sync job details when a job is started
+
+        When output is captured or logged the details are shown when the job finishes
+        """
+        if not self.scheduler.capture_output and not job.log_output:
+            self.message(f'{job}')
+
+    def sync_job_finished(self, job: SyncJob) -> None:
+        """
+        Show sync job output and errors when a job is finished
+        """
+        self.summary.add(job.status, job.bytes_transferred)
+        if self.report is not None:
+            self.report.add_job(job)
+        if job.skipped:
+            if self.scheduler.capture_output or job.log_output:
+                self.message(job.summary)
+            else:
+                self.message('unchanged, skipped')
+            return
+        if job.log_output:
+            self.message(job.summary)
+            if job.failed and job.output:
+                self.message(job.output.rstrip('\n'))
+            if job.failed and job.log_file is not None:
+                self.message(f'Full output in {job.log_file}')
+        elif self.scheduler.capture_output or job.batch is not None or job.fan_out is not None:
+            self.message(f'{job}')
+            if job.output:
+                self.message(job.output.rstrip('\n'))
+        if job.seeded is not None:
+            throughput = ', '.join(f'{mode} {value / 1000000:.2f} MB/s' for mode, value in job.throughput.items())
+            self.message(f'{job}: seeded with tar, throughput {throughput}')
+        if job.failed:
+            self.error(job.error)
+        if job.state_error is not None:
+            self.error(job.state_error)
+
+    def get_sync_targets(self, args: Namespace) -> List[Target]:
+        """
+        Return targets specified in arguments for sync commands
+        """
+        if not args.targets:
+            self.exit(1, 'No targets specified')
+        targets = self.filter_targets(args.targets)
+        if not targets:
+            self.exit(1, 'No targets specified')
+        if args.jobs < 1:
+            self.exit(1, f'Invalid number of parallel jobs: {args.jobs}')
+        return targets
+
+    def run_sync_jobs(self,
+                      args: Namespace,
+                      action: str,
+                      targets: Optional[List[Target]] = None,
+                      append_report: bool = False) -> List[SyncJob]:
+        """
+        Run pull or push sync jobs for specified targets or targets specified in arguments
+
+        With append_report the records are added to the existing report file instead of
+        replacing it. Returns list of finished jobs
+        """
+        if targets is None:
+            targets = self.get_sync_targets(args)
+
+        self.scheduler = SyncScheduler(
+            jobs=args.jobs,
+            max_parallel=self.config.defaults.max_parallel,
+            started=self.sync_job_started,
+            finished=self.sync_job_finished,
+        )
+        if args.report:
+            self.report = RunReport(args.report, action, append=append_report)
+            try:
+                self.report.open()
+            except OSError as error:
+                self.exit(1, f'Error opening report file {args.report}: {error}')
+        self.state = SyncStateStore()
+        self.summary = RunSummary(action=action, started=time.time())
+        try:
+            jobs = self.__run_scheduled_jobs__(args, action, targets)
+            self.show_scheduling_savings(jobs, targets)
+            return jobs
+        finally:
+            self.summary.finished = time.time()
+            if not args.dry_run:
+                self.write_metrics(args)
+            self.state.close()
+            if self.report is not None:
+                self.report.close()
+            self.config.excludes_file_cache.cleanup()
+
+    def write_metrics(self, args: Namespace) -> None:
+        """
+        Record summary of the run to the state store and write the metrics file if enabled
+
+        Errors are reported but do not fail the command
+        """
+        path = args.metrics_file or self.config.defaults.metrics_file
+        try:
+            self.state.record_run(self.summary)
+            if path:
+                MetricsFile(path, self.state).write()
+        except (OSError, StateStoreError) as error:
+            self.error(f'Error writing metrics: {error}')
+
+    def show_scheduling_savings(self, jobs: List[SyncJob], targets: List[Target]) -> None:
+        """
+        Show estimated time saved by starting parallel jobs longest expected first
+
+        The run time in configuration order is estimated with the actual job durations
+        """
+        if not self.scheduler.capture_output or all(job.expected_duration is None for job in jobs):
+            return
+        positions = {id(target): index for index, target in enumerate(targets)}
+        configuration_order = sorted(jobs, key=lambda job: positions[id(job.target)])
+
+        def get_duration(job: SyncJob) -> float:
+            return job.duration or 0
+
+        saved = (
+            estimate_run_time(configuration_order, self.scheduler.jobs, get_duration) -
+            estimate_run_time(order_by_expected_duration(configuration_order), self.scheduler.jobs, get_duration)
+        )
+        self.message(f'longest expected first order saved {saved:.2f}s compared to configuration order')
+
+    def get_push_journal(self, args: Namespace, target: Target) -> Optional[PushJournal]:
+        """
+        Return journal of changed paths for incremental push of target, or None if not enabled
+        """
+        if not getattr(args, 'incremental', False):
+            return None
+        return PushJournal(
+            target,
+            self.state,
+            scan=self.scan_changes,
+            full_sync_interval=self.config.defaults.full_sync_interval,
+        )
+
+    def get_sync_jobs(self, args: Namespace, action: str, targets: List[Target]) -> List[SyncJob]:
+        """
+        Return sync jobs for targets
+
+        Expected durations of jobs are estimated for ordering when jobs are run in parallel,
+        and for finding small targets to push in batches when batches are enabled
+        """
+        skip_unchanged = getattr(args, 'skip_unchanged', False)
+        batch = getattr(args, 'batch', False)
+        seed = getattr(args, 'seed', False)
+        jobs = [
+            SyncJob(
+                target,
+                action,
+                dry_run=args.dry_run,
+                state=self.state,
+                skip_unchanged=skip_unchanged,
+                stats=args.stats or target.adaptive_compression,
+                log_output=args.log_output,
+                journal=self.get_push_journal(args, target),
+                seed=seed and is_seed_candidate(target, self.state),
+            )
+            for target in targets
+        ]
+        if self.scheduler.capture_output or batch:
+            DurationEstimator(self.state).update(jobs)
+        if getattr(args, 'fan_out', False):
+            jobs = plan_fan_out(jobs)
+        if batch:
+            jobs = plan_batches(jobs)
+        return jobs
+
+    def __run_scheduled_jobs__(self, args: Namespace, action: str, targets: List[Target]) -> List[SyncJob]:
+        """
+        Run sync jobs with the scheduler, with shared ssh connections if enabled
+        """
+        if not args.ssh_multiplexing and not self.config.defaults.ssh_multiplexing:
+            self.probe_target_hosts(targets)
+            self.plan_compression(targets)
+            return self.scheduler.run(self.get_sync_jobs(args, action, targets))
+
+        multiplexer = SSHMultiplexer(ssh_command=self.config.defaults.ssh_command)
+        try:
+            self.connect_target_hosts(multiplexer, targets)
+            self.probe_target_hosts(targets)
+            self.plan_compression(targets)
+            jobs = self.get_sync_jobs(args, action, targets)
+            started = time.monotonic()
+            jobs = self.scheduler.run(jobs)
+            transfer_time = time.monotonic() - started
+        finally:
+            try:
+                multiplexer.close()
+            except SyncError as error:
+                self.error(error)
+        self.message(f'ssh connection setup {multiplexer.setup_time:.2f}s, transfer {transfer_time:.2f}s')
+        return jobs
+
+    def connect_target_hosts(self, multiplexer: SSHMultiplexer, targets: List[Target]) -> None:
+        """
+        Open shared ssh connections to the remote hosts of targets
+
+        Targets with a custom rsync remote shell command are skipped. Errors opening the
+        connections are reported and rsync is left to open its own connection to the host.
+        """
+        for target in targets:
+            host = target.target_host
+            if host is None or host.name in multiplexer.masters or has_rsh_flag(target.flags):
+                continue
+            try:
+                master = multiplexer.connect(host)
+                self.debug(f'{master} connected in {master.setup_time:.2f}s')
+            except SyncError as error:
+                self.error(error)
+
+    def probe_target_hosts(self, targets: List[Target]) -> None:
+        """
+        Probe rsync capabilities of the remote hosts of targets with probe_capabilities enabled
+
+        Errors probing a host are reported and targets on the host are synced without
+        choosing the rsync algorithms.
+        """
+        probe = CapabilityProbe(
+            state=self.state,
+            rsync_command=self.config.defaults.rsync_command,
+            ttl=self.config.defaults.capabilities_ttl,
+        )
+        for target in targets:
+            if not target.probe_capabilities:
+                continue
+            try:
+                host = probe.update(target)
+            except SyncError as error:
+                self.error(error)
+                continue
+            if host is not None:
+                capabilities = host.capabilities[target.remote_rsync_path]
+                self.debug(
+                    f'{host} {target.remote_rsync_path} version {capabilities.version} '
+                    f'protocol {capabilities.protocol}'
+                )
+
+    def plan_compression(self, targets: List[Target]) -> None:
+        """
+        Decide compression for the remote hosts of targets with adaptive_compression enabled
+
+        Errors reading the measured transfers are reported and targets on the host are
+        synced with the configured flags.
+        """
+        policy = CompressionPolicy(self.state, skip_compress=self.config.defaults.skip_compress or '')
+        for target in targets:
+            if not target.adaptive_compression:
+                continue
+            try:
+                host = policy.update(target)
+            except StateStoreError as error:
+                self.error(error)
+                continue
+            if host is not None:
+                compress = 'compress' if host.compression.compress else 'no compression'
+                self.debug(f'{host} {compress}: {host.compression.reason}')
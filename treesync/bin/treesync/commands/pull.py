@@ -8,7 +8,6 @@ Treesync 'pull' subcommand
 """
 from argparse import ArgumentParser, Namespace
 
-from treesync.exceptions import SyncError
 from .base import TreesyncCommand
 
 DESCRIPTION = """
@@ -33,19 +32,6 @@ class Pull(TreesyncCommand):
         """
         Pull specified sync targets
         """
-        if not args.targets:
-            self.exit(1, 'No targets specified')
-        targets = self.filter_targets(args.targets)
-        if not targets:
-            self.exit(1, 'No targets specified')
-
-        errors = False
-        for target in targets:
-            self.message(f'pull {target.destination} -> {target.source}')
-            try:
-                target.pull(dry_run=args.dry_run)
-            except SyncError as error:
-                self.error(error)
-                errors = True
-        if errors:
+        jobs = self.run_sync_jobs(args, 'pull')
+        if any(job.failed for job in jobs):
             self.exit(1, 'Errors pulling targets')
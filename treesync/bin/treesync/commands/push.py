@@ -8,8 +8,6 @@ Treesync 'push' subcommand
 """
 from argparse import ArgumentParser, Namespace
 
-from treesync.exceptions import SyncError
-
 from .base import TreesyncCommand
 
 DESCRIPTION = """
@@ -26,27 +24,44 @@ class Push(TreesyncCommand):
 
     def register_parser_arguments(self, parser: ArgumentParser) -> ArgumentParser:
         """
-        Register arguments for 'pull' command
+        Register arguments for 'push' command
         """
-        return super().register_rsync_arguments(parser)
+        parser = super().register_rsync_arguments(parser)
+        parser.add_argument(
+            '--skip-unchanged',
+            action='store_true',
+            help='Scan source trees and skip targets not changed since last successful push'
+        )
+        parser.add_argument(
+            '--incremental',
+            action='store_true',
+            help='Push only paths changed since last push, with periodic full pushes'
+        )
+        parser.add_argument(
+            '--batch',
+            action='store_true',
+            help='Push small targets to the same host and destination root with a single rsync command'
+        )
+        parser.add_argument(
+            '--fan-out',
+            action='store_true',
+            help='Push sources with many mirrors to one mirror and apply the changes to others with a batch file'
+        )
+        parser.add_argument(
+            '--seed',
+            action='store_true',
+            help='Copy source trees to empty destinations with a tar stream before pushing with rsync'
+        )
+        return parser
 
     def run(self, args: Namespace) -> None:
         """
         Push specified targets
         """
-        if not args.targets:
-            self.exit(1, 'No targets specified')
-        targets = self.filter_targets(args.targets)
-        if not targets:
-            self.exit(1, 'No targets specified')
-
-        errors = False
-        for target in targets:
-            try:
-                self.message(f'push {target.source} -> {target.destination}')
-                target.push(dry_run=args.dry_run)
-            except SyncError as error:
-                self.error(error)
-                errors = True
-        if errors:
+        jobs = self.run_sync_jobs(args, 'push')
+        if args.skip_unchanged or args.incremental:
+            skipped = sum(1 for job in jobs if job.skipped)
+            failed = sum(1 for job in jobs if job.failed)
+            self.message(f'pushed {len(jobs) - skipped - failed} targets, skipped {skipped} unchanged, {failed} failed')
+        if any(job.failed for job in jobs):
             self.exit(1, 'Errors pushing targets')
@@ -0,0 +1,104 @@
+#
+# Copyright (C) 2020-2023 by Ilkka Tuohela <hile@iki.fi>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+"""
+Treesync 'watch' subcommand
+"""
+from argparse import ArgumentParser, Namespace
+from typing import List
+
+from treesync.exceptions import StateStoreError, SyncError
+from treesync.journal import JOURNAL_MAX_PATHS
+from treesync.state import SyncStateStore
+from treesync.target import Target
+from treesync.watch import TreeWatcher
+
+from .base import TreesyncCommand
+
+DESCRIPTION = """
+Watch source directories for changes and push changed targets
+"""
+
+
+class Watch(TreesyncCommand):
+    """
+    Tree watch subcommand
+    """
+    description = DESCRIPTION
+    name = 'watch'
+
+    def register_parser_arguments(self, parser: ArgumentParser) -> ArgumentParser:
+        """
+        Register arguments for 'watch' command
+        """
+        parser = super().register_rsync_arguments(parser)
+        parser.add_argument(
+            '--debounce',
+            type=float,
+            help='Seconds without changes before a changed target is pushed'
+        )
+        parser.add_argument(
+            '--incremental',
+            action='store_true',
+            help='Push only paths changed since last push, with periodic full pushes'
+        )
+        parser.add_argument(
+            '--no-initial-push',
+            action='store_true',
+            help='Do not push the targets when starting to watch them'
+        )
+        return parser
+
+    def run(self, args: Namespace) -> None:
+        """
+        Watch specified targets and push targets when source directories are changed
+        """
+        targets = self.get_sync_targets(args)
+        debounce = args.debounce if args.debounce is not None else self.config.defaults.watch_debounce
+        if debounce < 0:
+            self.exit(1, f'Invalid debounce seconds: {debounce}')
+        try:
+            watcher = TreeWatcher(
+                targets,
+                debounce=debounce,
+                max_paths=JOURNAL_MAX_PATHS if args.incremental else None,
+            )
+        except SyncError as error:
+            self.exit(1, error)
+        with watcher:
+            for tree in watcher.trees:
+                if tree.incomplete:
+                    self.error(f'{tree}: inotify watch limit reached, changes in some directories are not seen')
+            self.debug(f'watching {watcher.watch_count} directories')
+            # Pushes after the first one add records to the same report file
+            append_report = False
+            if not args.no_initial_push:
+                self.run_sync_jobs(args, 'push', targets)
+                append_report = True
+            # Later incremental pushes use the paths collected by the watcher
+            self.scan_changes = False
+            try:
+                while True:
+                    changed = watcher.wait()
+                    if changed:
+                        if args.incremental:
+                            self.record_changed_paths(watcher, changed)
+                        self.run_sync_jobs(args, 'push', changed, append_report=append_report)
+                        append_report = True
+            except KeyboardInterrupt:
+                pass
+
+    def record_changed_paths(self, watcher: TreeWatcher, targets: List[Target]) -> None:
+        """
+        Record paths changed in target source trees to the journals of the targets
+        """
+        state = SyncStateStore()
+        try:
+            for target in targets:
+                state.add_journal_paths(str(target), watcher.pop_changed_paths(target), JOURNAL_MAX_PATHS)
+        except StateStoreError as error:
+            self.error(error)
+        finally:
+            state.close()
@@ -12,6 +12,7 @@ from .commands.list import List
 from .commands.pull import Pull
 from .commands.push import Push
 from .commands.show import Show
+from .commands.watch import Watch
 
 DESCRIPTION = """
 Synchrohize directory trees with known parameters using rsync pull and push
@@ -28,6 +29,7 @@ class Treesync(Script):
         Pull,
         Push,
         Show,
+        Watch,
     )
 
 
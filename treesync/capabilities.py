@@ -0,0 +1,297 @@
+#
+# Copyright (C) 2020-2023 by Ilkka Tuohela <hile@iki.fi>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+"""
+Probing rsync capabilities of target hosts
+
+The rsync version, protocol version, features and the checksum and compression algorithms
+of the local rsync and the rsync on each remote host are read from the output of
+rsync --version. Probe results of remote hosts are cached in the state store by host and
+remote rsync command for a configurable time. Rsync flags choosing the fastest checksum and compression algorithms
+supported by both sides are added to the flags of targets on probed hosts.
+"""
+import json
+import re
+
+from dataclasses import asdict, dataclass, field
+from subprocess import DEVNULL, PIPE, CalledProcessError, TimeoutExpired, run
+from typing import Dict, Iterable, List, Optional, Set, Tuple, TYPE_CHECKING
+
+from .exceptions import StateStoreError, SyncError
+from .ssh import get_remote_shell
+
+if TYPE_CHECKING:  # pragma: no cover
+    from .host import TargetHost
+    from .state import SyncStateStore
+    from .target import Target
+
+#: Checksum algorithms in order of preference
+CHECKSUM_PREFERENCE = (
+    'xxh128',
+    'xxh3',
+    'xxh64',
+    'md5',
+    'md4',
+)
+#: Compression algorithms in order of preference
+COMPRESSION_PREFERENCE = (
+    'zstd',
+    'lz4',
+    'zlibx',
+    'zlib',
+)
+#: rsync flags choosing the checksum algorithm
+CHECKSUM_CHOICE_FLAGS = (
+    '--checksum-choice',
+    '--cc',
+)
+#: rsync flags choosing the compression algorithm
+COMPRESS_CHOICE_FLAGS = (
+    '--compress-choice',
+    '--zc',
+)
+#: Seconds to wait for rsync --version on remote hosts
+PROBE_TIMEOUT = 30
+
+RSYNC_VERSION_LINE = re.compile(
+    r'version\s+v?(?P<version>[0-9][^\s]*)\s+protocol version\s+(?P<protocol>[0-9]+)'
+)
+RSYNC_PROTOCOL_LINE = re.compile(r'protocol version\s+(?P<protocol>[0-9]+)')
+
+
+@dataclass
+class RsyncCapabilities:
+    """
+    Capabilities of a rsync command reported by rsync --version
+
+    Algorithm lists are empty for rsync versions which do not report them
+    """
+    version: Optional[str] = None
+    protocol: Optional[int] = None
+    features: List[str] = field(default_factory=list)
+    checksums: List[str] = field(default_factory=list)
+    compressions: List[str] = field(default_factory=list)
+
+    def to_json(self) -> str:
+        """
+        Return capabilities as JSON for the state store
+        """
+        return json.dumps(asdict(self))
+
+    @classmethod
+    def from_json(cls, data: str) -> 'RsyncCapabilities':
+        """
+        Load capabilities from JSON stored to the state store
+        """
+        try:
+            return cls(**json.loads(data))
+        except (TypeError, ValueError) as error:
+            raise ValueError(f'Invalid rsync capabilities: {error}') from error
+
+
+def parse_rsync_version(output: str) -> RsyncCapabilities:
+    """
+    Parse capabilities from rsync --version output
+    """
+    capabilities = RsyncCapabilities()
+    sections: Dict[str, List[str]] = {}
+    section = None
+    for line in output.splitlines():
+        if capabilities.protocol is None:
+            match = RSYNC_VERSION_LINE.search(line)
+            if match:
+                capabilities.version = match.group('version')
+                capabilities.protocol = int(match.group('protocol'))
+                continue
+            match = RSYNC_PROTOCOL_LINE.search(line)
+            if match:
+                capabilities.protocol = int(match.group('protocol'))
+                continue
+        if line and not line[0].isspace():
+            section = line[:-1].lower() if line.endswith(':') else None
+            continue
+        if section is not None:
+            sections.setdefault(section, []).append(line.strip())
+
+    capabilities.features = [
+        item.strip() for item in ' '.join(sections.get('capabilities', [])).split(',') if item.strip()
+    ]
+    for attr, name in (('checksums', 'checksum list'), ('compressions', 'compress list')):
+        names = ' '.join(sections.get(name, [])).split()
+        setattr(capabilities, attr, [item for item in names if not item.startswith('(')])
+    return capabilities
+
+
+def has_flag(flags: Iterable[str], names: Iterable[str]) -> bool:
+    """
+    Check if rsync flags contain any of the named long flags
+    """
+    names = tuple(names)
+    return any(flag in names or flag.startswith(tuple(f'{name}=' for name in names)) for flag in flags)
+
+
+def uses_compression(flags: Iterable[str]) -> bool:
+    """
+    Check if rsync flags enable compression
+    """
+    for flag in flags:
+        if flag == '--compress' or flag.startswith('--compress-level') or flag.startswith('--zl'):
+            return True
+        if flag.startswith('-') and not flag.startswith('--') and 'z' in flag[1:]:
+            return True
+    return False
+
+
+def select_algorithm(preference: Iterable[str], local: List[str], remote: List[str]) -> Optional[str]:
+    """
+    Return the first algorithm in order of preference supported by both sides
+    """
+    for name in preference:
+        if name in local and name in remote:
+            return name
+    return None
+
+
+def get_capability_flags(flags: List[str], local: RsyncCapabilities, remote: RsyncCapabilities) -> List[str]:
+    """
+    Return rsync flags choosing the fastest checksum and compression algorithms supported
+    by the local and remote rsync
+
+    Algorithms already chosen in flags are not changed. The compression algorithm is only
+    chosen if compression is enabled in flags.
+    """
+    choices = []
+    if not has_flag(flags, CHECKSUM_CHOICE_FLAGS):
+        checksum = select_algorithm(CHECKSUM_PREFERENCE, local.checksums, remote.checksums)
+        if checksum is not None:
+            choices.append(f'--checksum-choice={checksum}')
+    if uses_compression(flags) and not has_flag(flags, COMPRESS_CHOICE_FLAGS):
+        compression = select_algorithm(COMPRESSION_PREFERENCE, local.compressions, remote.compressions)
+        if compression is not None:
+            choices.append(f'--compress-choice={compression}')
+    return choices
+
+
+def get_remote_rsync_path(flags: List[str]) -> str:
+    """
+    Return the remote rsync command from rsync flags
+    """
+    for flag in flags:
+        if flag.startswith('--rsync-path='):
+            return flag.split('=', 1)[1]
+    return 'rsync'
+
+
+class CapabilityProbe:
+    """
+    Probe rsync capabilities of the local rsync command and target hosts
+
+    Capabilities of remote hosts are loaded from the state store if probed less than ttl
+    seconds ago, otherwise the host is probed and the result is recorded to the store.
+    Each remote rsync command on a host is probed at most once.
+    """
+    def __init__(self,
+                 state: Optional['SyncStateStore'] = None,
+                 rsync_command: str = 'rsync',
+                 ttl: float = 86400) -> None:
+        self.state = state
+        self.rsync_command = rsync_command
+        self.ttl = ttl
+        self.__local__: Optional[RsyncCapabilities] = None
+        self.__failed__: Set[Tuple[str, str]] = set()
+
+    @staticmethod
+    def __run__(args: List[str], description: str) -> str:
+        """
+        Run rsync --version and return the output
+        """
+        try:
+            return run(
+                args,
+                stdin=DEVNULL,
+                stdout=PIPE,
+                stderr=DEVNULL,
+                timeout=PROBE_TIMEOUT,
+                check=True,
+            ).stdout.decode('utf-8', 'replace')
+        except (CalledProcessError, OSError) as error:
+            raise SyncError(f'Error probing rsync capabilities of {description}: {error}') from error
+        except TimeoutExpired as error:
+            raise SyncError(f'Timeout probing rsync capabilities of {description}') from error
+
+    @property
+    def local(self) -> RsyncCapabilities:
+        """
+        Return capabilities of the local rsync command
+        """
+        if self.__local__ is None:
+            self.__local__ = parse_rsync_version(self.__run__([self.rsync_command, '--version'], 'local rsync'))
+        return self.__local__
+
+    @staticmethod
+    def get_probe_command(target: 'Target') -> List[str]:
+        """
+        Return arguments of command running rsync --version on the target host
+        """
+        flags = target.flags
+        command = f'{get_remote_rsync_path(flags)} --version'
+        return get_remote_shell(flags) + [target.remote_host, command]
+
+    def probe(self, target: 'Target') -> RsyncCapabilities:
+        """
+        Probe capabilities of the rsync command on the target host
+        """
+        return parse_rsync_version(self.__run__(self.get_probe_command(target), f'host {target.remote_host}'))
+
+    def __load__(self, host: 'TargetHost', rsync_path: str) -> Optional[RsyncCapabilities]:
+        """
+        Load cached capabilities of the rsync command on host from the state store
+        """
+        if self.state is None:
+            return None
+        try:
+            data = self.state.get_host_capabilities(host.name, rsync_path, self.ttl)
+            return RsyncCapabilities.from_json(data) if data is not None else None
+        except (StateStoreError, ValueError):
+            return None
+
+    def __store__(self, host: 'TargetHost', rsync_path: str, capabilities: RsyncCapabilities) -> None:
+        """
+        Record probed capabilities of the rsync command on host to the state store
+        """
+        if self.state is None:
+            return
+        try:
+            self.state.set_host_capabilities(host.name, rsync_path, capabilities.to_json())
+        except StateStoreError:
+            pass
+
+    def update(self, target: 'Target') -> Optional['TargetHost']:
+        """
+        Set local and remote rsync capabilities for the host and remote rsync command of the
+        target
+
+        Returns the updated target host, or None if the target has no remote host or the
+        remote rsync command of the target was already probed. Raises SyncError if probing
+        fails.
+        """
+        host = target.target_host
+        if host is None:
+            return None
+        rsync_path = target.remote_rsync_path
+        if rsync_path in host.capabilities or (host.name, rsync_path) in self.__failed__:
+            return None
+        try:
+            local = self.local
+            capabilities = self.__load__(host, rsync_path)
+            if capabilities is None:
+                capabilities = self.probe(target)
+                self.__store__(host, rsync_path, capabilities)
+        except SyncError:
+            self.__failed__.add((host.name, rsync_path))
+            raise
+        host.local_capabilities = local
+        host.capabilities[rsync_path] = capabilities
+        return host
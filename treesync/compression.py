@@ -0,0 +1,280 @@
+#
+# Copyright (C) 2020-2023 by Ilkka Tuohela <hile@iki.fi>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+"""
+Choosing rsync compression for remote hosts from measured transfers
+
+Transfer statistics of sync commands to each remote host are recorded in the state store.
+The link bandwidth, the throughput of file data with and without compression and the
+compression ratio measured from the latest transfers decide whether targets on the host
+are synced with compression, the compression level and the suffixes of files which are
+not compressed. Compression configured in the rsync flags of a target is never changed.
+"""
+from dataclasses import dataclass
+from statistics import median
+from typing import Any, Dict, Iterable, List, Optional, TYPE_CHECKING
+
+from .capabilities import uses_compression
+from .constants import DEFAULT_SKIP_COMPRESS
+from .state import TransferSample
+
+if TYPE_CHECKING:  # pragma: no cover
+    from .host import TargetHost
+    from .state import SyncStateStore
+    from .target import Target
+
+#: rsync flags configuring compression, in addition to flags enabling it
+COMPRESSION_FLAGS = (
+    '--no-compress',
+    '--no-z',
+    '--compress-level',
+    '--zl',
+    '--compress-choice',
+    '--zc',
+    '--skip-compress',
+    '--old-compress',
+    '--new-compress',
+)
+#: Minimum bytes of file data in a transfer used for measurements
+MIN_SAMPLE_BYTES = 1024 ** 2
+#: Link bandwidth in bytes per second above which transfers are not compressed
+FAST_LINK_BANDWIDTH = 32 * 1024 ** 2
+#: Link bandwidth in bytes per second below which a higher compression level is used
+SLOW_LINK_BANDWIDTH = 1024 ** 2
+#: Minimum compression ratio for compressing transfers
+MIN_COMPRESSION_RATIO = 1.2
+#: Compressed transfers using less than this share of the link bandwidth are CPU bound
+CPU_BOUND_LINK_USAGE = 0.5
+#: Compression level for CPU bound compressed transfers
+FAST_COMPRESSION_LEVEL = 1
+#: Compression level for slow links
+SLOW_LINK_COMPRESSION_LEVEL = 9
+
+
+def configures_compression(flags: Iterable[str]) -> bool:
+    """
+    Check if rsync flags enable, disable or tune compression
+    """
+    flags = list(flags)
+    if uses_compression(flags):
+        return True
+    return any(
+        flag == name or flag.startswith(f'{name}=')
+        for flag in flags
+        for name in COMPRESSION_FLAGS
+    )
+
+
+def get_median(values: List[float]) -> Optional[float]:
+    """
+    Return median of values, or None for no values
+    """
+    return median(values) if values else None
+
+
+@dataclass
+class HostTransferProfile:
+    """
+    Transfer rates and compression ratio measured from transfers to a host
+
+    Rates are bytes per second. Throughput is the rate of file data, link bandwidth and wire
+    rate are rates of bytes transferred over the link. Values without measurements are None.
+    """
+    samples: int = 0
+    compressed_samples: int = 0
+    link_bandwidth: Optional[float] = None
+    uncompressed_throughput: Optional[float] = None
+    compressed_throughput: Optional[float] = None
+    compressed_wire_rate: Optional[float] = None
+    compression_ratio: Optional[float] = None
+
+    @classmethod
+    def from_samples(cls, samples: Iterable[TransferSample]) -> 'HostTransferProfile':
+        """
+        Calculate the profile from transfers with at least MIN_SAMPLE_BYTES of file data
+        """
+        samples = [
+            sample for sample in samples
+            if sample.literal_data >= MIN_SAMPLE_BYTES and sample.duration > 0 and sample.bytes_transferred > 0
+        ]
+        compressed = [sample for sample in samples if sample.compressed]
+        uncompressed = [sample for sample in samples if not sample.compressed]
+        return cls(
+            samples=len(samples),
+            compressed_samples=len(compressed),
+            link_bandwidth=get_median([item.bytes_transferred / item.duration for item in uncompressed]),
+            uncompressed_throughput=get_median([item.literal_data / item.duration for item in uncompressed]),
+            compressed_throughput=get_median([item.literal_data / item.duration for item in compressed]),
+            compressed_wire_rate=get_median([item.bytes_transferred / item.duration for item in compressed]),
+            compression_ratio=get_median([item.literal_data / item.bytes_transferred for item in compressed]),
+        )
+
+    @property
+    def cpu_bound(self) -> bool:
+        """
+        Check if compressed transfers leave most of the measured link bandwidth unused
+        """
+        if self.link_bandwidth is None or self.compressed_wire_rate is None:
+            return False
+        return self.compressed_wire_rate < self.link_bandwidth * CPU_BOUND_LINK_USAGE
+
+    def as_dict(self) -> Dict[str, Any]:
+        """
+        Return the profile as a dictionary
+        """
+        return {
+            'samples': self.samples,
+            'compressed_samples': self.compressed_samples,
+            'link_bandwidth': self.link_bandwidth,
+            'uncompressed_throughput': self.uncompressed_throughput,
+            'compressed_throughput': self.compressed_throughput,
+            'compressed_wire_rate': self.compressed_wire_rate,
+            'compression_ratio': self.compression_ratio,
+            'cpu_bound': self.cpu_bound,
+        }
+
+
+@dataclass
+class CompressionDecision:
+    """
+    Compression chosen for transfers to a host, with the reason and measurements behind it
+
+    Compress is None when compression is configured in the rsync flags of the target
+    """
+    compress: Optional[bool]
+    reason: str
+    level: Optional[int] = None
+    skip_compress: str = ''
+    profile: Optional[HostTransferProfile] = None
+
+    @property
+    def flags(self) -> List[str]:
+        """
+        Return rsync flags for the decision
+        """
+        if not self.compress:
+            return []
+        flags = ['--compress']
+        if self.level is not None:
+            flags.append(f'--compress-level={self.level}')
+        if self.skip_compress:
+            flags.append(f'--skip-compress={self.skip_compress}')
+        return flags
+
+    def as_dict(self) -> Dict[str, Any]:
+        """
+        Return the decision as a dictionary
+        """
+        return {
+            'compress': self.compress,
+            'level': self.level,
+            'flags': self.flags,
+            'reason': self.reason,
+            'basis': self.profile.as_dict() if self.profile is not None else None,
+        }
+
+
+def format_rate(value: float) -> str:
+    """
+    Format a rate in bytes per second as MB/s
+    """
+    return f'{value / 1024 ** 2:.1f} MB/s'
+
+
+def decide_compression(profile: HostTransferProfile,
+                       skip_compress: str = DEFAULT_SKIP_COMPRESS) -> CompressionDecision:
+    """
+    Decide compression for a host from the transfer profile of the host
+
+    Without measurements transfers are not compressed. Data compressing less than
+    MIN_COMPRESSION_RATIO is not compressed. When transfers with and without compression
+    have been measured, the mode with higher throughput of file data is chosen. Otherwise
+    links measured faster than FAST_LINK_BANDWIDTH are not compressed. CPU bound
+    compression uses a fast compression level and slow links a high compression level.
+    """
+    def decision(compress: bool, reason: str) -> CompressionDecision:
+        level = None
+        if compress:
+            bandwidth = profile.link_bandwidth or profile.compressed_wire_rate
+            if profile.cpu_bound:
+                level = FAST_COMPRESSION_LEVEL
+                reason += ', compression is CPU bound'
+            elif bandwidth is not None and bandwidth < SLOW_LINK_BANDWIDTH:
+                level = SLOW_LINK_COMPRESSION_LEVEL
+                reason += ', slow link'
+        return CompressionDecision(
+            compress=compress,
+            reason=reason,
+            level=level,
+            skip_compress=skip_compress if compress else '',
+            profile=profile,
+        )
+
+    if not profile.samples:
+        return decision(False, 'no measured transfers')
+    if profile.compression_ratio is not None and profile.compression_ratio < MIN_COMPRESSION_RATIO:
+        return decision(False, f'data compresses only {profile.compression_ratio:.2f}x')
+    if profile.compressed_throughput is not None and profile.uncompressed_throughput is not None:
+        compress = profile.compressed_throughput > profile.uncompressed_throughput
+        return decision(
+            compress,
+            f'throughput {format_rate(profile.compressed_throughput)} compressed, '
+            f'{format_rate(profile.uncompressed_throughput)} uncompressed'
+        )
+    if profile.link_bandwidth is not None:
+        bandwidth = profile.link_bandwidth
+        description = 'link bandwidth'
+    else:
+        bandwidth = profile.compressed_wire_rate
+        description = 'compressed transfer rate'
+    compress = bandwidth < FAST_LINK_BANDWIDTH
+    comparison = 'below' if compress else 'above'
+    return decision(
+        compress,
+        f'{description} {format_rate(bandwidth)} {comparison} {format_rate(FAST_LINK_BANDWIDTH)}'
+    )
+
+
+def get_target_compression(target: 'Target') -> Optional[CompressionDecision]:
+    """
+    Return compression decision for a target with adaptive compression
+
+    Returns None if adaptive compression is not enabled for the target or no decision was
+    made for the target host. Targets with compression configured in rsync flags get a
+    decision without flags.
+    """
+    if not target.adaptive_compression:
+        return None
+    host = target.target_host
+    if host is None or host.compression is None:
+        return None
+    if configures_compression(target.plan.flags or []):
+        return CompressionDecision(compress=None, reason='compression configured in rsync flags')
+    return host.compression
+
+
+class CompressionPolicy:
+    """
+    Decide compression for target hosts from transfers recorded in the state store
+
+    Each host is decided at most once
+    """
+    def __init__(self, state: 'SyncStateStore', skip_compress: str = DEFAULT_SKIP_COMPRESS) -> None:
+        self.state = state
+        self.skip_compress = skip_compress
+
+    def update(self, target: 'Target') -> Optional['TargetHost']:
+        """
+        Set compression decision for the host of the target
+
+        Returns the updated target host, or None if the target has no remote host or the
+        host was already updated. Raises StateStoreError if transfers can't be read.
+        """
+        host = target.target_host
+        if host is None or host.compression is not None:
+            return None
+        profile = HostTransferProfile.from_samples(self.state.get_transfers(host.name))
+        host.compression = decide_compression(profile, self.skip_compress)
+        return host
@@ -0,0 +1,47 @@
+#
+# Copyright (C) 2020-2023 by Ilkka Tuohela <hile@iki.fi>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+"""
+Common base classes for treesync configuration sections
+"""
+from typing import Any, Dict, Optional
+
+from sys_toolkit.configuration.base import ConfigurationList
+
+
+class NamedItemsConfigurationList(ConfigurationList):
+    """
+    Configuration list of items with a name attribute and lookup by name
+
+    The name lookup dictionary is built on first lookup after the list was modified
+    """
+    __name_lookup__: Optional[Dict[str, Any]] = None
+
+    def __load__(self, value: Any) -> None:
+        self.__name_lookup__ = None
+        super().__load__(value)
+
+    def __setitem__(self, index: int, value: Any) -> None:
+        self.__name_lookup__ = None
+        super().__setitem__(index, value)
+
+    def insert(self, index: int, value: Any) -> None:
+        self.__name_lookup__ = None
+        super().insert(index, value)
+
+    def append(self, value: Any) -> None:
+        self.__name_lookup__ = None
+        super().append(value)
+
+    def get(self, name: str) -> Optional[Any]:
+        """
+        Get first item matching specified name
+        """
+        if self.__name_lookup__ is None:
+            lookup = {}
+            for item in self:
+                lookup.setdefault(item.name, item)
+            self.__name_lookup__ = lookup
+        return self.__name_lookup__.get(name, None)
@@ -6,13 +6,20 @@
 """
 Configuration defaults for hosts
 """
+from typing import Any, Optional
+
 from sys_toolkit.configuration.base import ConfigurationSection
+
 from ..constants import SKIPPED_PATHS
 
 from ..constants import (
+    DEFAULT_CAPABILITIES_TTL,
     DEFAULT_EXCLUDES,
     DEFAULT_EXCLUDES_FILE,
     DEFAULT_FLAGS,
+    DEFAULT_FULL_SYNC_INTERVAL,
+    DEFAULT_SKIP_COMPRESS,
+    DEFAULT_WATCH_DEBOUNCE,
     TREE_CONFIG_FILE
 )
 
@@ -21,23 +28,97 @@ from ..constants import (
 HOST_CONFIGURATION_DEFAULTS = {
     'rsync_path': None,
     'iconv': None,
+    'max_parallel': None,
+    'probe_capabilities': None,
+    'adaptive_compression': None,
     'flags': [],
     'targets': [],
 }
 
 GLOBAL_DEFAULT_SETTINGS = {
     'rsync_command': 'rsync',
+    'ssh_command': 'ssh',
+    'ssh_multiplexing': False,
     'flags': DEFAULT_FLAGS,
     'never_sync_paths': SKIPPED_PATHS,
     'excluded_paths': DEFAULT_EXCLUDES,
     'tree_config_file': TREE_CONFIG_FILE,
     'tree_excludes_file': DEFAULT_EXCLUDES_FILE,
+    'max_parallel': None,
+    'metrics_file': None,
+    'watch_debounce': DEFAULT_WATCH_DEBOUNCE,
+    'full_sync_interval': DEFAULT_FULL_SYNC_INTERVAL,
+    'probe_capabilities': False,
+    'capabilities_ttl': DEFAULT_CAPABILITIES_TTL,
+    'adaptive_compression': False,
+    'skip_compress': DEFAULT_SKIP_COMPRESS,
 }
 
 
+def format_max_parallel(value: Any) -> Optional[int]:
+    """
+    Format a max_parallel setting value as positive integer
+    """
+    if value is None:
+        return None
+    value = int(value)
+    if value < 1:
+        raise ValueError(f'max_parallel must be a positive integer: {value}')
+    return value
+
+
 class Defaults(ConfigurationSection):
     """
     Tree sync default settings
     """
     __name__ = 'defaults'
     __default_settings__ = GLOBAL_DEFAULT_SETTINGS
+
+    @staticmethod
+    def format_max_parallel(value: Any) -> Optional[int]:
+        """
+        Format global limit for parallel sync commands
+        """
+        return format_max_parallel(value)
+
+    @staticmethod
+    def format_watch_debounce(value: Any) -> float:
+        """
+        Format seconds without changes before watched targets are pushed
+        """
+        value = float(value)
+        if value < 0:
+            raise ValueError(f'watch_debounce must not be negative: {value}')
+        return value
+
+    @staticmethod
+    def format_full_sync_interval(value: Any) -> float:
+        """
+        Format maximum seconds between full pushes of targets pushed incrementally
+        """
+        value = float(value)
+        if value < 0:
+            raise ValueError(f'full_sync_interval must not be negative: {value}')
+        return value
+
+    @staticmethod
+    def format_capabilities_ttl(value: Any) -> float:
+        """
+        Format seconds rsync capabilities probed from target hosts are cached
+        """
+        value = float(value)
+        if value < 0:
+            raise ValueError(f'capabilities_ttl must not be negative: {value}')
+        return value
+
+    @staticmethod
+    def format_skip_compress(value: Any) -> str:
+        """
+        Format suffixes of files not compressed with adaptive compression as a rsync
+        --skip-compress list separated by slashes
+        """
+        value = str(value).strip()
+        suffixes = [item.strip().lstrip('.') for item in value.split('/')] if value else []
+        if any(not suffix or any(char.isspace() for char in suffix) for suffix in suffixes):
+            raise ValueError(f'Invalid skip_compress suffixes: {value}')
+        return '/'.join(suffixes)
@@ -7,14 +7,15 @@
 Hosts configuration section for treesync
 """
 from pathlib import Path
-from typing import List, Optional, TYPE_CHECKING
+from typing import Any, List, Optional, TYPE_CHECKING
 
 from sys_toolkit.configuration.base import ConfigurationSection, ConfigurationList
 
 from ..exceptions import ConfigurationError
 from ..host import Hosts
 
-from .defaults import HOST_CONFIGURATION_DEFAULTS
+from .base import NamedItemsConfigurationList
+from .defaults import HOST_CONFIGURATION_DEFAULTS, format_max_parallel
 from .targets import Target, TargetConfiguration
 
 if TYPE_CHECKING:
@@ -103,6 +104,9 @@ class HostConfiguration(ConfigurationSection):
     name: str = ''
     rsync_path: Optional[str] = None
     iconv: Optional[str] = None
+    max_parallel: Optional[int] = None
+    probe_capabilities: Optional[bool] = None
+    adaptive_compression: Optional[bool] = None
     flags: List[str] = []
     targets: List[HostTargetList] = []
 
@@ -124,6 +128,13 @@ class HostConfiguration(ConfigurationSection):
         """
         return self.__config_root__.sources  # pylint:disable=no-member
 
+    @staticmethod
+    def format_max_parallel(value: Any) -> Optional[int]:
+        """
+        Format limit for parallel sync commands to this host
+        """
+        return format_max_parallel(value)
+
     @property
     def server_config(self) -> Optional[ConfigurationSection]:
         """
@@ -165,7 +176,7 @@ class HostConfiguration(ConfigurationSection):
         return flags
 
 
-class HostsSettings(ConfigurationList):
+class HostsSettings(NamedItemsConfigurationList):
     """
     Configuration for target hosts
     """
@@ -192,7 +203,4 @@ class HostsSettings(ConfigurationList):
         """
         Get specified host by name
         """
-        for host in self:
-            if host.name == name:
-                return host
-        return None
+        return super().get(name)
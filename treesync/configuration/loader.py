@@ -6,12 +6,12 @@
 """
 Configuration loader for treesync
 """
-from fnmatch import fnmatch
 from typing import List, Optional
 
 from sys_toolkit.configuration.yaml import YamlConfiguration
 
 from ..constants import DEFAULT_CONFIGURATION_PATHS
+from ..excludes import ExcludesFileCache
 from ..target import Target, TargetList
 
 from .defaults import Defaults
@@ -43,6 +43,7 @@ class Configuration(YamlConfiguration):
 
     def __init__(self, path=None, parent=None, debug_enabled=False, silent=False) -> None:
         self.__default_paths__ = DEFAULT_CONFIGURATION_PATHS
+        self.excludes_file_cache = ExcludesFileCache()
         super().__init__(path, parent, debug_enabled, silent)
 
     def __repr__(self) -> str:
@@ -58,10 +59,13 @@ class Configuration(YamlConfiguration):
             for host in self.hosts:  # pylint: disable=not-an-iterable
                 for target in host.sync_targets:
                     targets.append(target)
+            names = {(target.hostname, target.name) for target in targets}
             for target in self.targets.sync_targets:  # pylint: disable=not-an-iterable
-                if target not in targets:
+                if (target.hostname, target.name) not in names:
+                    names.add((target.hostname, target.name))
                     targets.append(target)
             targets.sort()
+            targets.build_index()
             self.__sync_targets__ = targets
         return self.__sync_targets__
 
@@ -69,27 +73,4 @@ class Configuration(YamlConfiguration):
         """
         Filter sync targets by list of patterns as strings
         """
-        def match_patterns(patterns, target):
-            """
-            Match target to specified patterns
-            """
-            for pattern in patterns:
-                if target.hostname and fnmatch(target.hostname, pattern):
-                    return True
-                if str(target.name) == pattern or fnmatch(str(target.name), pattern):
-                    return True
-                try:
-                    _host, name = target.name.split(':', 1)
-                    if fnmatch(name, pattern):
-                        return True
-                except ValueError:
-                    pass
-            return False
-
-        matches = []
-        if not patterns:
-            return self.sync_targets
-        for target in self.sync_targets:
-            if match_patterns(patterns, target):
-                matches.append(target)
-        return matches
+        return self.sync_targets.filter(patterns)
@@ -0,0 +1,353 @@
+#
+# Copyright (C) 2020-2023 by Ilkka Tuohela <hile@iki.fi>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+"""
+Compiled snapshot of resolved sync targets for fast configuration loading
+
+The snapshot contains resolved settings of all sync targets and is stored as JSON in the
+user cache directory. The snapshot is keyed on the modification time and hash of the
+loaded configuration files, and an unchanged configuration is loaded from the snapshot
+without parsing the YAML configuration files.
+"""
+import hashlib
+import json
+import os
+
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from typing import Any, Dict, List, Optional, Union
+
+from ..directories import user_cache_directory
+from ..exceptions import ConfigurationError
+from ..excludes import ExcludesFileCache
+from ..host import Hosts
+from ..target import ExcludesFile, Target, TargetList
+
+from . import loader
+from .defaults import Defaults
+
+#: Version of the snapshot file format, snapshots with other versions are ignored
+SNAPSHOT_VERSION = 9
+
+#: Settings from defaults section stored in snapshots
+SNAPSHOT_DEFAULT_SETTINGS = (
+    'rsync_command',
+    'ssh_command',
+    'ssh_multiplexing',
+    'max_parallel',
+    'metrics_file',
+    'watch_debounce',
+    'full_sync_interval',
+    'capabilities_ttl',
+    'skip_compress',
+)
+
+
+class SnapshotTarget(Target):
+    """
+    Sync target with settings loaded from a configuration snapshot
+    """
+    def __init__(self,
+                 data: Dict[str, Any],
+                 defaults: Defaults,
+                 target_hosts: Hosts,
+                 excludes_file_cache: ExcludesFileCache) -> None:
+        super().__init__(
+            data['hostname'],
+            data['name'],
+            data['source'],
+            data['destination'],
+            None
+        )
+        self.__data__ = data
+        self.__defaults__ = defaults
+        self.__target_hosts__ = target_hosts
+        self.__excludes_file_cache__ = excludes_file_cache
+
+    @staticmethod
+    def compile(target: Target) -> Dict[str, Any]:
+        """
+        Compile resolved settings of a target to snapshot data
+        """
+        tree_excludes_file = target.tree_excludes_file
+        return {
+            'hostname': target.hostname,
+            'name': target.name,
+            'source': str(target.source),
+            'destination': target.destination,
+            'flags': target.configured_flags,
+            'excludes': target.configured_excludes,
+            'tree_excludes_file': str(tree_excludes_file) if tree_excludes_file is not None else None,
+            'max_parallel': target.max_parallel,
+            'probe_capabilities': target.probe_capabilities,
+            'adaptive_compression': target.adaptive_compression,
+            'shards': target.shards,
+            'shard_by': target.shard_by,
+            'engine': target.engine,
+            'large_file_size': target.large_file_size,
+            'large_file_block_size': target.large_file_block_size,
+        }
+
+    @property
+    def default_settings(self) -> Defaults:
+        """
+        Return defaults loaded from snapshot
+        """
+        return self.__defaults__
+
+    @property
+    def host_configuration(self) -> None:
+        """
+        Snapshot targets have no host configuration section
+        """
+        return None
+
+    @property
+    def target_hosts(self) -> Hosts:
+        """
+        Return mapping of target host objects for the snapshot
+        """
+        return self.__target_hosts__
+
+    @property
+    def excludes_file_cache(self) -> ExcludesFileCache:
+        """
+        Return cache for rsync excludes files
+        """
+        return self.__excludes_file_cache__
+
+    @property
+    def max_parallel(self) -> Optional[int]:
+        """
+        Return limit for parallel sync commands to the target host
+        """
+        return self.__data__['max_parallel']
+
+    @property
+    def probe_capabilities(self) -> bool:
+        """
+        Return True if rsync capabilities of the target host are probed
+        """
+        return self.__data__['probe_capabilities']
+
+    @property
+    def adaptive_compression(self) -> bool:
+        """
+        Return True if compression is chosen from transfers measured to the target host
+        """
+        return self.__data__['adaptive_compression']
+
+    @property
+    def shards(self) -> Optional[int]:
+        """
+        Return number of parallel rsync commands for pushing the target in shards
+        """
+        return self.__data__['shards']
+
+    @property
+    def shard_by(self) -> str:
+        """
+        Return mode for splitting the target source tree to shards
+        """
+        return self.__data__['shard_by']
+
+    @property
+    def engine(self) -> str:
+        """
+        Return engine for syncing the target
+        """
+        return self.__data__['engine']
+
+    @property
+    def large_file_size(self) -> Optional[int]:
+        """
+        Return size of files pushed with a separate rsync pass for large files
+        """
+        return self.__data__['large_file_size']
+
+    @property
+    def large_file_block_size(self) -> Optional[int]:
+        """
+        Return rsync block size for pushing large files
+        """
+        return self.__data__['large_file_block_size']
+
+    @property
+    def configured_excludes(self) -> List[str]:
+        """
+        Return list of excluded filenames from treesync configuration
+        """
+        return list(self.__data__['excludes'])
+
+    @property
+    def configured_flags(self) -> List[str]:
+        """
+        Return list of rsync flags from treesync configuration
+        """
+        return list(self.__data__['flags'])
+
+    @property
+    def tree_excludes_file(self) -> Optional[ExcludesFile]:
+        """
+        Return tree specific excludes file
+        """
+        path = self.__data__['tree_excludes_file']
+        return ExcludesFile(path) if path is not None else None
+
+
+class ConfigurationSnapshot:
+    """
+    Sync targets loaded from a compiled configuration snapshot
+
+    Implements the parts of Configuration used by the CLI commands
+    """
+    def __init__(self, data: Dict[str, Any]) -> None:
+        self.defaults = Defaults(data['defaults'])
+        self.target_hosts = Hosts()
+        self.excludes_file_cache = ExcludesFileCache()
+        self.sync_targets = TargetList()
+        for target_data in data['targets']:
+            self.sync_targets.append(
+                SnapshotTarget(target_data, self.defaults, self.target_hosts, self.excludes_file_cache)
+            )
+        self.sync_targets.build_index()
+
+    def __repr__(self) -> str:
+        return 'treesync config snapshot'
+
+    @staticmethod
+    def compile(configuration: 'loader.Configuration') -> Dict[str, Any]:
+        """
+        Compile snapshot data from a loaded configuration
+        """
+        return {
+            'defaults': {
+                attr: getattr(configuration.defaults, attr)
+                for attr in SNAPSHOT_DEFAULT_SETTINGS
+            },
+            'targets': [SnapshotTarget.compile(target) for target in configuration.sync_targets],
+        }
+
+    def filter_sync_targets(self, patterns: List[str]) -> List[Target]:
+        """
+        Filter sync targets by list of patterns as strings
+        """
+        return self.sync_targets.filter(patterns)
+
+
+class ConfigurationSnapshotCache:
+    """
+    Cache of compiled configuration snapshots in the user cache directory
+    """
+    def __init__(self, path: Optional[Union[str, Path]] = None) -> None:
+        self.path = Path(path).expanduser() if path is not None else None
+
+    @property
+    def configuration_files(self) -> List[Path]:
+        """
+        Return configuration files loaded by Configuration in load order
+        """
+        files = [Path(path) for path in loader.DEFAULT_CONFIGURATION_PATHS if Path(path).is_file()]
+        if self.path is not None and self.path.exists():
+            files.append(self.path)
+        return files
+
+    @property
+    def cache_file(self) -> Path:
+        """
+        Return snapshot cache file for the configuration files
+        """
+        paths = json.dumps([str(path.resolve()) for path in self.configuration_files])
+        name = hashlib.sha256(paths.encode('utf-8')).hexdigest()
+        return user_cache_directory().joinpath('configuration', f'{name}.json')
+
+    def get_fingerprints(self) -> List[Dict[str, Any]]:
+        """
+        Return modification time, size and hash of the configuration files
+        """
+        fingerprints = []
+        for path in self.configuration_files:
+            stat = path.stat()
+            fingerprints.append({
+                'path': str(path.resolve()),
+                'mtime_ns': stat.st_mtime_ns,
+                'size': stat.st_size,
+                'sha256': hashlib.sha256(path.read_bytes()).hexdigest(),
+            })
+        return fingerprints
+
+    def read(self, fingerprints: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        """
+        Read snapshot data from cache file
+
+        Returns None if the snapshot does not exist, is invalid or does not match the
+        fingerprints of the configuration files
+        """
+        try:
+            with self.cache_file.open('r', encoding='utf-8') as handle:
+                data = json.load(handle)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(data, dict):
+            return None
+        if data.get('version', None) != SNAPSHOT_VERSION or data.get('files', None) != fingerprints:
+            return None
+        return data
+
+    def write(self, data: Dict[str, Any]) -> None:
+        """
+        Write snapshot data atomically to cache file
+
+        Errors writing the cache file are ignored
+        """
+        cache_file = self.cache_file
+        try:
+            cache_file.parent.mkdir(parents=True, exist_ok=True)
+            with NamedTemporaryFile(
+                    mode='w',
+                    encoding='utf-8',
+                    dir=cache_file.parent,
+                    prefix=f'.{cache_file.name}',
+                    delete=False) as handle:
+                json.dump(data, handle)
+            os.replace(handle.name, cache_file)
+        except OSError:
+            pass
+
+    def load(self) -> Union['loader.Configuration', ConfigurationSnapshot]:
+        """
+        Load configuration from a valid snapshot or compile a new snapshot
+
+        Returns the loaded Configuration if a snapshot could not be created
+        """
+        if not self.configuration_files:
+            return loader.Configuration(self.path)
+
+        fingerprints = self.get_fingerprints()
+        data = self.read(fingerprints)
+        if data is not None:
+            return ConfigurationSnapshot(data)
+
+        configuration = loader.Configuration(self.path)
+        try:
+            data = ConfigurationSnapshot.compile(configuration)
+        except (ConfigurationError, ValueError):
+            return configuration
+        # Do not store snapshot if configuration files were modified while loading
+        if self.get_fingerprints() == fingerprints:
+            data.update(version=SNAPSHOT_VERSION, files=fingerprints)
+            self.write(data)
+        return configuration
+
+
+def load_configuration(
+        path: Optional[Union[str, Path]] = None,
+        use_cache: bool = True) -> Union['loader.Configuration', ConfigurationSnapshot]:
+    """
+    Load treesync configuration, using cached configuration snapshot if possible
+    """
+    if not use_cache:
+        return loader.Configuration(path)
+    return ConfigurationSnapshotCache(path).load()
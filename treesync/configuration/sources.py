@@ -8,7 +8,9 @@ Sources configuration for treesync
 """
 from typing import Optional
 
-from sys_toolkit.configuration.base import ConfigurationSection, ConfigurationList
+from sys_toolkit.configuration.base import ConfigurationSection
+
+from .base import NamedItemsConfigurationList
 
 
 class SourceConfiguration(ConfigurationSection):
@@ -30,7 +32,7 @@ class SourceConfiguration(ConfigurationSection):
         return f'{self.name} {self.path}'
 
 
-class SourcesConfigurationSection(ConfigurationList):
+class SourcesConfigurationSection(NamedItemsConfigurationList):
     """
     Configuration for sync sources
     """
@@ -41,7 +43,4 @@ class SourcesConfigurationSection(ConfigurationList):
         """
         Get source configuration matching name
         """
-        for source in self:
-            if source.name == name:
-                return source
-        return None
+        return super().get(name)
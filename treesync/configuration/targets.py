@@ -6,11 +6,16 @@
 """
 Configuration section for treesync targets
 """
-from typing import List, Optional
+from typing import Any, List, Optional
 
 from sys_toolkit.configuration.base import ConfigurationSection
 
+from ..exceptions import ConfigurationError
+from ..largefiles import MAX_BLOCK_SIZE, parse_size
+from ..native import SYNC_ENGINES
+from ..shards import SHARD_MODES
 from ..target import Target
+from .defaults import format_max_parallel
 from .servers import ServersConfigurationSection
 
 
@@ -26,6 +31,11 @@ class TargetConfiguration(ConfigurationSection):
     excludes: List[str] = []
     flags: List[str] = []
     iconv: Optional[str] = None
+    shards: Optional[int] = None
+    shard_by: str = 'directory'
+    engine: str = 'rsync'
+    large_file_size: Optional[int] = None
+    large_file_block_size: Optional[int] = None
 
     __default_settings__ = {
         'ignore_default_flags': False,
@@ -34,6 +44,11 @@ class TargetConfiguration(ConfigurationSection):
         'excludes_file': None,
         'flags': [],
         'iconv': None,
+        'shards': None,
+        'shard_by': 'directory',
+        'engine': 'rsync',
+        'large_file_size': None,
+        'large_file_block_size': None,
     }
     __required_settings__ = (
         'source',
@@ -43,6 +58,57 @@ class TargetConfiguration(ConfigurationSection):
     def __repr__(self) -> str:
         return f'{self.source} {self.destination}'
 
+    @staticmethod
+    def format_shards(value: Any) -> Optional[int]:
+        """
+        Format number of parallel rsync commands for pushing the target in shards
+        """
+        if value is None:
+            return None
+        value = int(value)
+        if value < 1:
+            raise ValueError(f'shards must be a positive integer: {value}')
+        return value
+
+    @staticmethod
+    def format_shard_by(value: Any) -> str:
+        """
+        Format mode for splitting the target source tree to shards
+        """
+        if value not in SHARD_MODES:
+            raise ValueError(f'shard_by must be one of {", ".join(SHARD_MODES)}: {value}')
+        return value
+
+    @staticmethod
+    def format_engine(value: Any) -> str:
+        """
+        Format engine for syncing the target
+        """
+        if value not in SYNC_ENGINES:
+            raise ValueError(f'engine must be one of {", ".join(SYNC_ENGINES)}: {value}')
+        return value
+
+    @staticmethod
+    def format_large_file_size(value: Any) -> Optional[int]:
+        """
+        Format size of files pushed with a separate rsync pass for large files
+        """
+        if value is None:
+            return None
+        return parse_size(value)
+
+    @staticmethod
+    def format_large_file_block_size(value: Any) -> Optional[int]:
+        """
+        Format rsync block size for pushing large files
+        """
+        if value is None:
+            return None
+        value = parse_size(value)
+        if value > MAX_BLOCK_SIZE:
+            raise ValueError(f'large_file_block_size must be at most {MAX_BLOCK_SIZE}: {value}')
+        return value
+
     @property
     def hostname(self) -> str:
         """
@@ -82,6 +148,19 @@ class TargetConfiguration(ConfigurationSection):
                 flags.append(f'--rsync-path={rsync_path}')
         return flags
 
+    @property
+    def destination_server_max_parallel(self) -> Optional[int]:
+        """
+        Return limit for parallel sync commands to destination server
+        """
+        settings = self.destination_server_settings
+        if settings is None:
+            return None
+        try:
+            return format_max_parallel(settings.get('max_parallel', None))
+        except ValueError as error:
+            raise ConfigurationError(f'server {self.hostname} invalid max_parallel: {error}') from error
+
 
 class TargetsConfigurationSection(ConfigurationSection):
     """
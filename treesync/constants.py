@@ -32,6 +32,9 @@ MACOS_META_EXCLUDES = [
     '.TemporaryItems',
     '.Spotlight-V100',
 ]
+#: Maximum age in seconds for unused files in excludes file cache
+EXCLUDES_FILE_CACHE_MAX_AGE = 7 * 24 * 60 * 60
+
 #: Default excluded filenames and directories
 DEFAULT_EXCLUDES = [
     '.pytest_cache/',
@@ -52,3 +55,19 @@ DEFAULT_FLAGS = [
 
 #: Tree specific automatically loaded configuration file in source tree
 TREE_CONFIG_FILE = '.treesync.yml'
+
+#: Default seconds without changes before a watched target is pushed
+DEFAULT_WATCH_DEBOUNCE = 2.0
+
+#: Default maximum seconds between full pushes of targets pushed incrementally
+DEFAULT_FULL_SYNC_INTERVAL = 24 * 60 * 60
+
+#: Default seconds rsync capabilities probed from target hosts are cached
+DEFAULT_CAPABILITIES_TTL = 24 * 60 * 60
+
+#: Default suffixes of already compressed files not compressed with adaptive compression
+DEFAULT_SKIP_COMPRESS = '/'.join((
+    '7z', 'apk', 'avi', 'bz2', 'deb', 'flac', 'gpg', 'gz', 'heic', 'iso', 'jar', 'jpeg', 'jpg',
+    'lz', 'lz4', 'lzma', 'lzo', 'm4a', 'mkv', 'mov', 'mp3', 'mp4', 'ogg', 'png', 'rar', 'rpm',
+    'tbz', 'tgz', 'txz', 'webm', 'webp', 'xz', 'zip', 'zst',
+))
@@ -0,0 +1,50 @@
+#
+# Copyright (C) 2020-2023 by Ilkka Tuohela <hile@iki.fi>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+"""
+User specific directories for treesync cache, data and state files
+"""
+import os
+
+from pathlib import Path
+
+#: Name of treesync subdirectory in user directories
+USER_DIRECTORY_NAME = 'treesync'
+
+
+def user_cache_directory() -> Path:
+    """
+    Return user cache directory for treesync
+
+    The directory follows XDG base directory specification and is not created here
+    """
+    path = os.environ.get('XDG_CACHE_HOME', None)
+    if not path:
+        path = '~/.cache'
+    return Path(path).expanduser().joinpath(USER_DIRECTORY_NAME)
+
+
+def user_data_directory() -> Path:
+    """
+    Return user data directory for treesync
+
+    The directory follows XDG base directory specification and is not created here
+    """
+    path = os.environ.get('XDG_DATA_HOME', None)
+    if not path:
+        path = '~/.local/share'
+    return Path(path).expanduser().joinpath(USER_DIRECTORY_NAME)
+
+
+def user_state_directory() -> Path:
+    """
+    Return user state directory for treesync
+
+    The directory follows XDG base directory specification and is not created here
+    """
+    path = os.environ.get('XDG_STATE_HOME', None)
+    if not path:
+        path = '~/.local/state'
+    return Path(path).expanduser().joinpath(USER_DIRECTORY_NAME)
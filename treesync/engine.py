@@ -0,0 +1,162 @@
+#
+# Copyright (C) 2020-2023 by Ilkka Tuohela <hile@iki.fi>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+"""
+Asynchronous engine for running rsync commands of sync targets with asyncio
+
+The engine runs rsync with asyncio subprocesses, so many targets can be synced from a single
+event loop without a thread per target. Command output is available as an async iterator of
+events. Cancelling the task consuming the events terminates the rsync process.
+"""
+import asyncio
+
+from dataclasses import dataclass
+from subprocess import CalledProcessError
+from typing import AsyncIterator, Callable, List, Optional, TYPE_CHECKING
+
+from .exceptions import SyncError
+from .stats import RsyncStatsParser, SyncResult
+
+if TYPE_CHECKING:  # pragma: no cover
+    from .target import Target
+
+#: Types of events from sync commands
+SYNC_EVENT_TYPES = (
+    'started',
+    'output',
+    'finished',
+)
+#: Seconds to wait for rsync to exit after terminating it before killing it
+TERMINATE_TIMEOUT = 5
+#: Maximum length of rsync output lines
+OUTPUT_LINE_LIMIT = 1024 * 1024
+
+
+@dataclass(frozen=True)
+class SyncEvent:
+    """
+    Event from an asynchronous sync command
+
+    Output events contain a line of rsync output, and the finished event contains the result
+    of the command
+    """
+    type: str
+    target: str
+    action: str
+    line: Optional[str] = None
+    result: Optional[SyncResult] = None
+
+
+class AsyncSyncCommand:
+    """
+    Asynchronous pull or push rsync command for a sync target
+    """
+    def __init__(self, target: 'Target', action: str, dry_run: bool = False, stats: bool = False) -> None:
+        if action not in ('pull', 'push'):
+            raise ValueError(f'Invalid sync action: {action}')
+        self.target = target
+        self.action = action
+        self.dry_run = dry_run
+        self.stats = stats
+        self.process: Optional[asyncio.subprocess.Process] = None
+
+    def __repr__(self) -> str:
+        return f'{self.action} {self.target}'
+
+    @property
+    def args(self) -> List[str]:
+        """
+        Return rsync command arguments
+        """
+        if self.action == 'pull':
+            return self.target.get_pull_command_args(self.dry_run, stats=self.stats)
+        return self.target.get_push_command_args(self.dry_run, stats=self.stats)
+
+    def __event__(self, event_type: str, **kwargs) -> SyncEvent:
+        return SyncEvent(type=event_type, target=str(self.target), action=self.action, **kwargs)
+
+    async def terminate(self) -> None:
+        """
+        Terminate the rsync process if it is running, killing it if it does not exit
+        """
+        process = self.process
+        if process is None or process.returncode is not None:
+            return
+        try:
+            process.terminate()
+            await asyncio.wait_for(process.wait(), TERMINATE_TIMEOUT)
+        except ProcessLookupError:
+            pass
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+
+    async def events(self) -> AsyncIterator[SyncEvent]:
+        """
+        Run the rsync command and yield events with the command output
+
+        Errors from the command are reported in the result of the finished event. If the
+        iteration is cancelled or stopped early the rsync process is terminated. Raises
+        SyncError if the target is synced with a method other than a single rsync command.
+        The method is planned in a thread, because planning may walk the source tree.
+        """
+        loop = asyncio.get_running_loop()
+        method, _plan = await loop.run_in_executor(None, self.target.get_sync_method, self.action)
+        if method != 'rsync':
+            raise SyncError(f'{self} with {method} can not be run asynchronously')
+        args = self.args
+        parser = RsyncStatsParser() if self.stats else None
+        try:
+            self.process = await asyncio.create_subprocess_exec(
+                *args,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.STDOUT,
+                limit=OUTPUT_LINE_LIMIT,
+            )
+        except OSError as error:
+            raise SyncError(f'Error running {self}: {error}') from error
+        try:
+            yield self.__event__('started')
+            while True:
+                data = await self.process.stdout.readline()
+                if not data:
+                    break
+                line = data.decode('utf-8', 'replace')
+                if parser is not None:
+                    parser.feed(line)
+                yield self.__event__('output', line=line)
+            returncode = await self.process.wait()
+        finally:
+            await self.terminate()
+        result = SyncResult(
+            target=str(self.target),
+            action=self.action,
+            args=args,
+            returncode=returncode,
+            stats=parser.stats if parser is not None and parser.found else None,
+        )
+        yield self.__event__('finished', result=result)
+
+    async def run(self, output: Optional[Callable[[str], None]] = None) -> SyncResult:
+        """
+        Run the rsync command and return the result
+
+        Output lines are passed to the output callback. Raises SyncError if the command
+        fails.
+        """
+        events = self.events()
+        result = None
+        try:
+            async for event in events:
+                if event.type == 'output' and output is not None:
+                    output(event.line)
+                elif event.type == 'finished':
+                    result = event.result
+        finally:
+            await events.aclose()
+        if result.returncode != 0:
+            error = CalledProcessError(result.returncode, result.args)
+            raise SyncError(error) from error
+        return result
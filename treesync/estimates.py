@@ -0,0 +1,114 @@
+#
+# Copyright (C) 2020-2023 by Ilkka Tuohela <hile@iki.fi>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+"""
+Estimates of expected duration of sync jobs for ordering parallel jobs
+
+Expected durations are based on recorded durations of earlier successful commands of the
+target. For targets without successful commands the duration is estimated from bytes
+transferred by earlier failed commands or, for pushes, from the size of the source tree,
+divided by the median recorded transfer rate of all targets. Source trees are scanned for
+at most SOURCE_SIZE_MAX_ENTRIES entries and SOURCE_SIZE_TIMEOUT seconds. The size of a
+tree with a truncated scan is a lower bound, and the expected duration of the job is
+marked as a lower bound so that the job is started before jobs with known durations.
+"""
+import time
+
+from statistics import median
+from typing import Iterable, Optional, Tuple
+
+from .exceptions import StateStoreError
+from .scanner import ExcludeMatcher, TreeScanner
+from .scheduler import SyncJob
+from .state import SyncStateStore
+
+#: Number of latest successful commands used for estimates
+ESTIMATE_HISTORY_LENGTH = 5
+#: Transfer rate in bytes per second used when no transfer rates have been recorded
+DEFAULT_TRANSFER_RATE = 50 * 1024 * 1024
+#: Maximum number of tree entries scanned when estimating from the size of the source tree
+SOURCE_SIZE_MAX_ENTRIES = 10000
+#: Maximum seconds spent scanning when estimating from the size of the source tree
+SOURCE_SIZE_TIMEOUT = 1.0
+
+
+class DurationEstimator:
+    """
+    Estimate expected durations of sync jobs from the sync state store
+    """
+    def __init__(self, state: SyncStateStore) -> None:
+        self.state = state
+        self.__transfer_rates__ = {}
+
+    def get_transfer_rate(self, action: str) -> float:
+        """
+        Return median recorded transfer rate for action in bytes per second
+        """
+        if action not in self.__transfer_rates__:
+            samples = self.state.get_throughput_samples(action)
+            self.__transfer_rates__[action] = median(samples) if samples else DEFAULT_TRANSFER_RATE
+        return self.__transfer_rates__[action]
+
+    @staticmethod
+    def get_source_size(job: SyncJob,
+                        max_entries: int = SOURCE_SIZE_MAX_ENTRIES,
+                        timeout: float = SOURCE_SIZE_TIMEOUT) -> Optional[Tuple[int, bool]]:
+        """
+        Return size of files in the target source tree and a flag for a truncated scan
+
+        The scan is truncated after max_entries entries or timeout seconds, in which case
+        the size of the scanned files is returned as a lower bound. Returns None if the tree
+        can't be read.
+        """
+        deadline = time.monotonic() + timeout
+        size = 0
+        try:
+            matcher = ExcludeMatcher(job.target.excluded)
+            for count, entry in enumerate(TreeScanner(job.target.source, matcher).walk(), start=1):
+                if count > max_entries or time.monotonic() > deadline:
+                    return size, True
+                if entry.type == 'f':
+                    size += entry.size
+        except OSError:
+            return None
+        return size, False
+
+    def __estimate__(self, job: SyncJob) -> Tuple[Optional[float], bool]:
+        """
+        Return expected duration of a sync job and a flag for durations which are lower bounds
+        """
+        history = self.state.get_history(str(job.target), job.action, limit=ESTIMATE_HISTORY_LENGTH)
+        durations = [record.duration for record in history if record.succeeded]
+        if durations:
+            return median(durations), False
+        transferred = [record.bytes for record in history if record.bytes]
+        if transferred:
+            return median(transferred) / self.get_transfer_rate(job.action), False
+        if job.action != 'push':
+            return None, False
+        source_size = self.get_source_size(job)
+        if source_size is None:
+            return None, False
+        size, truncated = source_size
+        return size / self.get_transfer_rate(job.action), truncated
+
+    def estimate(self, job: SyncJob) -> Optional[float]:
+        """
+        Return expected duration of a sync job in seconds, or None if it can't be estimated
+        """
+        return self.__estimate__(job)[0]
+
+    def update(self, jobs: Iterable[SyncJob]) -> None:
+        """
+        Set expected durations of sync jobs
+
+        Errors reading the state store leave the expected durations unset
+        """
+        for job in jobs:
+            try:
+                job.expected_duration, job.expected_duration_lower_bound = self.__estimate__(job)
+            except StateStoreError:
+                job.expected_duration = None
+                job.expected_duration_lower_bound = False
@@ -18,3 +18,9 @@ class SyncError(Exception):
     """
     Exceptions caused by rsync commands
     """
+
+
+class StateStoreError(Exception):
+    """
+    Exceptions caused by reading or writing the sync state store
+    """
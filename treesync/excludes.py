@@ -0,0 +1,116 @@
+#
+# Copyright (C) 2020-2023 by Ilkka Tuohela <hile@iki.fi>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+"""
+Content addressed rsync excludes files shared between sync targets and treesync runs
+"""
+import hashlib
+import os
+import threading
+import time
+
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from typing import Dict, Iterable, Optional
+
+from .constants import EXCLUDES_FILE_CACHE_MAX_AGE
+from .directories import user_cache_directory
+
+#: Filename extension for cached excludes files
+EXCLUDES_FILE_EXTENSION = '.exclude'
+
+
+class ExcludesFileCache:
+    """
+    Cache of rsync excludes files named by hash of the file contents
+
+    Each unique list of excluded paths is written once to the cache directory and the same
+    file is used by all targets with identical excludes, in this and later treesync runs.
+    Files are written and closed immediately, no file descriptors are kept open.
+
+    Files used by a run have their modification time updated. Call cleanup() at the end
+    of a run to remove files no other run has used within the maximum age.
+    """
+    def __init__(self, directory: Optional[Path] = None) -> None:
+        self.__directory__ = directory
+        self.__lock__ = threading.Lock()
+        self.used: Dict[str, Path] = {}
+
+    @property
+    def directory(self) -> Path:
+        """
+        Return directory for cached excludes files
+        """
+        if self.__directory__ is None:
+            self.__directory__ = user_cache_directory().joinpath('excludes')
+        return self.__directory__
+
+    @staticmethod
+    def format_content(excluded: Iterable[str]) -> str:
+        """
+        Format excluded paths as excludes file contents
+        """
+        return ''.join(f'{line}\n' for line in excluded)
+
+    def __write__(self, path: Path, content: str) -> None:
+        """
+        Write excludes file atomically
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with NamedTemporaryFile(
+                mode='w',
+                encoding='utf-8',
+                dir=self.directory,
+                prefix=f'.{path.name}',
+                delete=False) as handle:
+            handle.write(content)
+        os.replace(handle.name, path)
+
+    def get(self, excluded: Iterable[str]) -> Path:
+        """
+        Return path to excludes file with specified excluded paths
+
+        The file is written if it does not exist in the cache directory
+        """
+        content = self.format_content(excluded)
+        digest = hashlib.sha256(content.encode('utf-8')).hexdigest()
+        with self.__lock__:
+            path = self.used.get(digest, None)
+            if path is not None:
+                return path
+            path = self.directory.joinpath(f'{digest}{EXCLUDES_FILE_EXTENSION}')
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                self.__write__(path, content)
+            self.used[digest] = path
+        return path
+
+    def cleanup(self, max_age: float = EXCLUDES_FILE_CACHE_MAX_AGE) -> int:
+        """
+        Remove excludes files not used by this run and not used by any run within max_age
+        seconds
+
+        Returns number of removed files
+        """
+        if not self.directory.is_dir():
+            return 0
+        removed = 0
+        expires = time.time() - max_age
+        with self.__lock__:
+            used = set(self.used.values())
+            for path in self.directory.iterdir():
+                if path in used:
+                    continue
+                # Hidden files are temporary files left over from interrupted writes
+                if path.suffix != EXCLUDES_FILE_EXTENSION and not path.name.startswith('.'):
+                    continue
+                try:
+                    if path.stat().st_mtime < expires:
+                        path.unlink()
+                        removed += 1
+                except FileNotFoundError:
+                    pass
+        return removed
@@ -0,0 +1,280 @@
+#
+# Copyright (C) 2020-2023 by Ilkka Tuohela <hile@iki.fi>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+"""
+Fan-out pushes of one source to many identical mirrors with rsync batch files
+
+The source is pushed to a reference mirror with --write-batch, which records the changes
+to a batch file. The batch file is then applied to the other mirrors with --read-batch,
+without rsync comparing the source to each mirror again. Mirrors which may have drifted
+from the reference, or where applying the batch fails, are pushed normally.
+"""
+import threading
+
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Dict, List, Optional, Tuple, TYPE_CHECKING
+from uuid import uuid4
+
+from .exceptions import StateStoreError
+from .scheduler import SyncJob
+
+if TYPE_CHECKING:  # pragma: no cover
+    from .target import Target
+
+#: Minimum number of targets pushed with a fan-out push
+FAN_OUT_MIN_TARGETS = 3
+
+
+def get_fan_out_key(target: 'Target') -> Optional[Tuple]:
+    """
+    Return key for targets pushing the same source with the same settings, or None if the
+    target can't be pushed with a fan-out push
+
+    The source of host targets is the path of the source in the sources section
+    """
+    if target.shards is not None or target.large_file_size is not None or target.engine == 'native':
+        return None
+    plan = target.plan
+    if plan.flags is None:
+        return None
+    return str(target.source), plan.flags, plan.excluded
+
+
+class FanOut:
+    """
+    Push of one source to a reference mirror and other mirrors with a rsync batch file
+    """
+    def __init__(self, reference: 'Target', mirrors: List['Target']) -> None:
+        self.reference = reference
+        self.mirrors = mirrors
+
+    def __repr__(self) -> str:
+        return f'{self.reference.source} to {len(self.mirrors) + 1} mirrors'
+
+    def get_write_batch_args(self, batch_file: Path, stats: bool = False) -> List[str]:
+        """
+        Return rsync arguments for pushing the reference mirror and writing the batch file
+        """
+        args = self.reference.get_push_command_args(stats=stats)
+        args.insert(-2, f'--write-batch={batch_file}')
+        return args
+
+    @staticmethod
+    def get_read_batch_args(mirror: 'Target', batch_file: Path, stats: bool = False) -> List[str]:
+        """
+        Return rsync arguments for applying the batch file to a mirror
+        """
+        args = mirror.get_rsync_cmd_args(stats=stats)
+        args.extend([f'--read-batch={batch_file}', f"""{mirror.destination.rstrip('/')}/"""])
+        return args
+
+
+class FanOutSyncJob(SyncJob):
+    """
+    Push jobs of targets with the same source, run as a fan-out push
+
+    The job pushes the reference mirror. The jobs of the other mirrors are returned as next
+    jobs after the reference has been pushed, and run by the scheduler with the limits of
+    their hosts. The batch file is removed when the last mirror job has finished. The jobs
+    of the targets are reported and recorded as separate jobs.
+
+    Successful pushes of the targets record the identifier of the fan-out push. The batch
+    file is only applied to mirrors whose last successful push was in the same fan-out push
+    as the last successful push of the reference mirror.
+    """
+    def __init__(self, fan_out: FanOut, jobs: List[SyncJob]) -> None:
+        super().__init__(jobs[0].target, 'push', dry_run=jobs[0].dry_run, stats=jobs[0].stats)
+        self.fan_out_push = fan_out
+        self.jobs = jobs
+        self.expected_duration = jobs[0].expected_duration
+        self.expected_duration_lower_bound = jobs[0].expected_duration_lower_bound
+        self.fan_out_run = uuid4().hex
+        for job in jobs:
+            job.fan_out_run = self.fan_out_run
+        self.batch_file: Optional[Path] = None
+        self.__in_sync__: Dict[int, bool] = {}
+        self.__directory__: Optional[TemporaryDirectory] = None
+        self.__mirror_jobs__: List[FanOutMirrorJob] = []
+        self.__pending__ = 0
+        self.__lock__ = threading.Lock()
+
+    def __repr__(self) -> str:
+        return f'push {self.fan_out_push}'
+
+    @property
+    def members(self) -> List[SyncJob]:
+        """
+        Return the job of the reference mirror
+        """
+        return self.jobs[:1]
+
+    def get_next_jobs(self) -> List[SyncJob]:
+        """
+        Return jobs pushing the other mirrors after the reference mirror has been pushed
+        """
+        return list(self.__mirror_jobs__)
+
+    @staticmethod
+    def is_in_sync(job: SyncJob, reference: SyncJob) -> bool:
+        """
+        Check if the mirror of a job was last pushed successfully in the same fan-out push as
+        the reference mirror
+
+        Mirrors pushed after that on their own, or without a recorded fan-out push, may be in
+        a different state than the reference mirror
+        """
+        if job.state is None:
+            return False
+        try:
+            run = job.state.get_fan_out_run(str(job.target))
+            reference_run = job.state.get_fan_out_run(str(reference.target))
+        except StateStoreError:
+            return False
+        return run is not None and run == reference_run
+
+    @staticmethod
+    def __run_with_args__(job: SyncJob, args: List[str]) -> SyncJob:
+        """
+        Run a job with specified rsync arguments, recording the result only if it succeeds
+        """
+        state = job.state
+        job.state = None
+        job.rsync_args = args
+        try:
+            job.run(capture_output=True)
+        finally:
+            job.state = state
+            job.rsync_args = None
+        if not job.failed and not job.dry_run:
+            job.__record_state__(None)
+        return job
+
+    def __run_mirror__(self, job: SyncJob) -> SyncJob:
+        """
+        Apply the batch file to a mirror, falling back to a normal push
+        """
+        if self.batch_file is not None and self.__in_sync__[id(job)]:
+            job.fan_out = 'batch'
+            self.__run_with_args__(job, self.fan_out_push.get_read_batch_args(job.target, self.batch_file, self.stats))
+            if not job.failed:
+                return job
+            job.fan_out = 'fallback, applying batch failed'
+            job.error = None
+            job.result = None
+        elif job.fan_out is None:
+            job.fan_out = 'fallback'
+        return job.run(capture_output=True)
+
+    def __release__(self) -> None:
+        """
+        Remove the batch file after the last mirror job has finished
+        """
+        with self.__lock__:
+            self.__pending__ -= 1
+            if self.__pending__ > 0 or self.__directory__ is None:
+                return
+            directory = self.__directory__
+            self.__directory__ = None
+        directory.cleanup()
+
+    def run(self, capture_output: bool = False) -> 'SyncJob':
+        """
+        Push the reference mirror writing a batch file and prepare jobs of the other mirrors
+        """
+        reference, mirrors = self.jobs[0], self.jobs[1:]
+        self.__in_sync__ = {id(job): self.is_in_sync(job, reference) for job in mirrors}
+        self.__directory__ = TemporaryDirectory(prefix='treesync-fan-out-')
+        batch_file = Path(self.__directory__.name, 'batch')
+        reference.fan_out = 'reference'
+        self.__run_with_args__(reference, self.fan_out_push.get_write_batch_args(batch_file, self.stats))
+        if reference.failed:
+            reference.fan_out = 'reference failed'
+            reference.error = None
+            reference.result = None
+            reference.run(capture_output=True)
+        if not reference.failed and reference.fan_out == 'reference' and batch_file.is_file():
+            self.batch_file = batch_file
+        for job in mirrors:
+            if not self.__in_sync__[id(job)]:
+                job.fan_out = 'fallback, mirror may have drifted'
+        self.__mirror_jobs__ = [FanOutMirrorJob(self, job) for job in mirrors]
+        self.__pending__ = len(mirrors) + 1
+        self.__release__()
+        self.timestamp = reference.timestamp
+        self.started = reference.started
+        self.finished = reference.finished
+        return self
+
+
+class FanOutMirrorJob(SyncJob):
+    """
+    Push of a mirror in a fan-out push, run after the reference mirror has been pushed
+    """
+    def __init__(self, fan_out_job: FanOutSyncJob, job: SyncJob) -> None:
+        super().__init__(job.target, 'push', dry_run=job.dry_run, stats=job.stats)
+        self.fan_out_job = fan_out_job
+        self.job = job
+        self.expected_duration = job.expected_duration
+        self.expected_duration_lower_bound = job.expected_duration_lower_bound
+
+    def __repr__(self) -> str:
+        return repr(self.job)
+
+    @property
+    def members(self) -> List[SyncJob]:
+        """
+        Return the job of the mirror
+        """
+        return [self.job]
+
+    def run(self, capture_output: bool = False) -> 'SyncJob':
+        """
+        Apply the batch file to the mirror or push it normally
+        """
+        try:
+            self.fan_out_job.__run_mirror__(self.job)
+        finally:
+            self.fan_out_job.__release__()
+        self.timestamp = self.job.timestamp
+        self.started = self.job.started
+        self.finished = self.job.finished
+        return self
+
+
+def plan_fan_out(jobs: List[SyncJob]) -> List[SyncJob]:
+    """
+    Combine push jobs of targets with the same source and settings to fan-out jobs
+
+    Each fan-out job replaces the first of its jobs in the returned list. Dry runs, jobs
+    skipping unchanged trees, pushing incrementally or seeding empty destinations and jobs
+    already combined to other jobs are not combined.
+    """
+    groups: Dict[Tuple, List[SyncJob]] = {}
+    for job in jobs:
+        if job.action != 'push' or job.dry_run or job.skip_unchanged or job.journal is not None:
+            continue
+        if job.members != [job] or job.seed:
+            continue
+        key = get_fan_out_key(job.target)
+        if key is not None:
+            groups.setdefault(key, []).append(job)
+
+    fan_outs: Dict[int, FanOutSyncJob] = {}
+    grouped = set()
+    for members in groups.values():
+        if len(members) < FAN_OUT_MIN_TARGETS:
+            continue
+        fan_out = FanOut(members[0].target, [job.target for job in members[1:]])
+        fan_outs[id(members[0])] = FanOutSyncJob(fan_out, members)
+        grouped.update(id(job) for job in members)
+
+    planned = []
+    for job in jobs:
+        if id(job) in fan_outs:
+            planned.append(fan_outs[id(job)])
+        elif id(job) not in grouped:
+            planned.append(job)
+    return planned
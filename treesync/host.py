@@ -7,16 +7,36 @@
 Target host configured in treesync settings
 """
 from collections.abc import Iterator, MutableMapping
-from typing import Optional
+from typing import Dict, Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:  # pragma: no cover
+    from .capabilities import RsyncCapabilities
+    from .compression import CompressionDecision
+    from .ssh import SSHControlMaster
 
 
 # pylint: disable=too-few-public-methods
 class TargetHost:
     """
     Treesync sync target host
+
+    Probed rsync capabilities of the host are stored by the remote rsync command
     """
     def __init__(self, name: str) -> None:
         self.name = name
+        self.control_master: Optional['SSHControlMaster'] = None
+        self.capabilities: Dict[str, 'RsyncCapabilities'] = {}
+        self.local_capabilities: Optional['RsyncCapabilities'] = None
+        self.compression: Optional['CompressionDecision'] = None
+
+    @property
+    def rsh(self) -> Optional[str]:
+        """
+        Return rsync remote shell command for a connected ssh master connection
+        """
+        if self.control_master is not None and self.control_master.connected:
+            return self.control_master.rsh
+        return None
 
     def __repr__(self) -> str:
         return self.name
@@ -0,0 +1,108 @@
+#
+# Copyright (C) 2020-2023 by Ilkka Tuohela <hile@iki.fi>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+"""
+Index for looking up sync targets by host and name
+"""
+from collections import defaultdict
+from fnmatch import filter as fnmatch_filter
+from typing import Dict, Iterable, List, Optional, Sequence, Set, TYPE_CHECKING
+
+if TYPE_CHECKING:  # pragma: no cover
+    from .target import Target
+
+#: Characters with special meaning in fnmatch patterns
+GLOB_CHARACTERS = ('*', '?', '[')
+
+
+def is_glob_pattern(pattern: str) -> bool:
+    """
+    Check if pattern contains fnmatch special characters
+    """
+    return any(character in pattern for character in GLOB_CHARACTERS)
+
+
+class TargetIndex:
+    """
+    Index of sync targets by hostname, full target name, short target name and target
+    name host prefix
+
+    The index stores positions of targets in the indexed sequence, and lookups return
+    targets in the same order as in the sequence.
+    """
+    def __init__(self, targets: Sequence['Target']) -> None:
+        self.targets = targets
+        self.by_host: Dict[str, List[int]] = defaultdict(list)
+        self.by_name: Dict[str, List[int]] = defaultdict(list)
+        self.by_short_name: Dict[str, List[int]] = defaultdict(list)
+        self.by_prefix: Dict[str, List[int]] = defaultdict(list)
+
+        for position, target in enumerate(targets):
+            name = str(target.name)
+            if target.hostname:
+                self.by_host[target.hostname].append(position)
+            self.by_name[name].append(position)
+            if ':' in name:
+                prefix, short_name = name.split(':', 1)
+                self.by_prefix[prefix].append(position)
+                self.by_short_name[short_name].append(position)
+
+    def get(self, name: str) -> Optional['Target']:
+        """
+        Return first target with specified full name
+        """
+        positions = self.by_name.get(name, None)
+        if not positions:
+            return None
+        return self.targets[positions[0]]
+
+    @staticmethod
+    def __lookup__(index: Dict[str, List[int]], keys: Iterable[str]) -> Set[int]:
+        """
+        Return positions for keys in index
+        """
+        positions = set()
+        for key in keys:
+            positions.update(index.get(key, ()))
+        return positions
+
+    def __match_names__(self, pattern: str) -> Set[int]:
+        """
+        Return positions of targets with full name matching a glob pattern
+
+        If the pattern host prefix is a literal string, only the names with the same prefix
+        are checked.
+        """
+        if ':' in pattern:
+            prefix = pattern.split(':', 1)[0]
+            if not is_glob_pattern(prefix):
+                names = {str(self.targets[position].name) for position in self.by_prefix.get(prefix, ())}
+                return self.__lookup__(self.by_name, fnmatch_filter(names, pattern))
+        return self.__lookup__(self.by_name, fnmatch_filter(self.by_name, pattern))
+
+    def match(self, pattern: str) -> Set[int]:
+        """
+        Return positions of targets matching pattern by hostname, full name or short name
+        """
+        if not is_glob_pattern(pattern):
+            return (
+                self.__lookup__(self.by_host, (pattern,)) |
+                self.__lookup__(self.by_name, (pattern,)) |
+                self.__lookup__(self.by_short_name, (pattern,))
+            )
+        return (
+            self.__lookup__(self.by_host, fnmatch_filter(self.by_host, pattern)) |
+            self.__match_names__(pattern) |
+            self.__lookup__(self.by_short_name, fnmatch_filter(self.by_short_name, pattern))
+        )
+
+    def filter(self, patterns: Iterable[str]) -> List['Target']:
+        """
+        Return targets matching any of the patterns in indexed order
+        """
+        positions = set()
+        for pattern in patterns:
+            positions |= self.match(pattern)
+        return [self.targets[position] for position in sorted(positions)]
@@ -0,0 +1,286 @@
+#
+# Copyright (C) 2020-2023 by Ilkka Tuohela <hile@iki.fi>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+"""
+Incremental pushes of sync targets with a journal of changed paths
+
+Paths changed in a target source tree are collected to a journal in the sync state store,
+by the tree watcher or by comparing the source tree to the manifest of the tree saved after
+the last successful push. An incremental push passes only the changed paths to rsync with
+--files-from, so rsync does not walk the whole local and remote trees.
+
+A full push is run instead when the journal has overflowed, the push settings of the target
+have changed, the paths can't be pushed incrementally or the last full push is older than
+the full sync interval.
+"""
+import gzip
+import hashlib
+import json
+import os
+import time
+
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, IO, Iterable, List, Optional, Set, Tuple, TYPE_CHECKING
+from urllib.parse import quote
+
+from .constants import DEFAULT_FULL_SYNC_INTERVAL
+from .directories import user_data_directory
+from .exceptions import StateStoreError
+from .scanner import ExcludeMatcher, TreeScanner, get_push_settings, has_unsupported_flags
+from .state import SyncStateStore
+
+if TYPE_CHECKING:  # pragma: no cover
+    from .target import Target
+
+#: Maximum number of changed paths pushed incrementally
+JOURNAL_MAX_PATHS = 10000
+#: Version of the manifest file format, manifests with other versions are ignored
+MANIFEST_VERSION = 1
+
+#: Manifest entries by path as type, mode, size, modification time and link target
+ManifestEntries = Dict[str, list]
+
+
+def has_delete_flags(flags: Iterable[str]) -> bool:
+    """
+    Check if rsync flags delete files missing from the source
+    """
+    return any(flag.startswith('--del') for flag in flags)
+
+
+def diff_manifest_entries(old: ManifestEntries, new: ManifestEntries) -> Tuple[List[str], List[str]]:
+    """
+    Compare manifest entries, returning changed and deleted paths
+    """
+    changed = [path for path, entry in new.items() if old.get(path, None) != entry]
+    deleted = [path for path in old if path not in new]
+    return changed, deleted
+
+
+class PushManifest:
+    """
+    Entries of a target source tree saved after the last successful incremental push
+
+    The manifest is stored as a gzip compressed JSON file in the user data directory. The
+    manifest is only valid for the push settings it was saved with.
+    """
+    def __init__(self, target: 'Target', directory: Optional[Path] = None) -> None:
+        self.target = target
+        self.__directory__ = directory
+
+    def __repr__(self) -> str:
+        return str(self.path)
+
+    @property
+    def path(self) -> Path:
+        """
+        Return path to the manifest file
+        """
+        if self.__directory__ is None:
+            self.__directory__ = user_data_directory().joinpath('manifests')
+        return self.__directory__.joinpath(f"{quote(str(self.target), safe='')}.json.gz")
+
+    @staticmethod
+    def scan(scanner: TreeScanner) -> ManifestEntries:
+        """
+        Scan manifest entries of a tree
+
+        Raises OSError if the tree can't be read
+        """
+        return {
+            entry.path: [entry.type, entry.mode, entry.size, entry.mtime_ns, entry.link]
+            for entry in scanner.walk()
+        }
+
+    def load(self, settings: str) -> Optional[ManifestEntries]:
+        """
+        Load manifest entries saved with specified settings
+
+        Returns None if the manifest does not exist, can't be read or was saved with other
+        settings
+        """
+        try:
+            with gzip.open(self.path, 'rt', encoding='utf-8') as handle:
+                data = json.load(handle)
+        except (OSError, EOFError, ValueError):
+            return None
+        if not isinstance(data, dict):
+            return None
+        if data.get('version', None) != MANIFEST_VERSION or data.get('settings', None) != settings:
+            return None
+        return data.get('entries', None)
+
+    def save(self, settings: str, entries: ManifestEntries) -> None:
+        """
+        Save manifest entries atomically
+        """
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        temporary = self.path.with_name(f'.{self.path.name}.{os.getpid()}')
+        try:
+            with gzip.open(temporary, 'wt', encoding='utf-8') as handle:
+                json.dump({'version': MANIFEST_VERSION, 'settings': settings, 'entries': entries}, handle)
+            os.replace(temporary, self.path)
+        finally:
+            if temporary.exists():
+                temporary.unlink()
+
+
+@dataclass
+class PushPlan:
+    """
+    Plan for a push of a target
+
+    Paths are the changed paths for an incremental push. For full pushes reason explains
+    why the target is pushed in full. Journal paths are the journal entries included in
+    the plan and manifest the scanned tree entries to save after the push.
+    """
+    settings: str
+    full: bool = False
+    reason: Optional[str] = None
+    paths: List[str] = field(default_factory=list)
+    journal_paths: List[str] = field(default_factory=list)
+    manifest: Optional[ManifestEntries] = None
+
+    def __repr__(self) -> str:
+        if self.full:
+            return f'full push: {self.reason}'
+        return f'incremental push of {len(self.paths)} paths'
+
+
+class PushJournal:
+    """
+    Plan incremental pushes of a target from the journal of changed paths
+
+    With scan the source tree is compared to the manifest of the last successful push, and
+    the manifest is updated after the push. Without scan only paths recorded to the journal,
+    for example by the tree watcher, are pushed.
+    """
+    def __init__(self,
+                 target: 'Target',
+                 state: SyncStateStore,
+                 scan: bool = True,
+                 full_sync_interval: float = DEFAULT_FULL_SYNC_INTERVAL,
+                 manifest_directory: Optional[Path] = None) -> None:
+        self.target = target
+        self.state = state
+        self.scan = scan
+        self.full_sync_interval = full_sync_interval
+        self.manifest = PushManifest(target, manifest_directory)
+
+    def __repr__(self) -> str:
+        return f'{self.target} journal'
+
+    def get_settings(self) -> str:
+        """
+        Return digest of push settings of the target
+        """
+        return hashlib.sha256(get_push_settings(self.target).encode('utf-8', 'surrogateescape')).hexdigest()
+
+    def expand_paths(self, scanner: TreeScanner, paths: Iterable[str]) -> Tuple[Set[str], Set[str]]:
+        """
+        Return existing and deleted paths, adding contents of directories
+
+        Directory contents are walked only until the maximum number of journal paths is
+        exceeded
+        """
+        existing = set()
+        deleted = set()
+        for path in paths:
+            absolute = os.path.join(str(self.target.source), path)
+            if not os.path.lexists(absolute):
+                deleted.add(path)
+                continue
+            existing.add(path)
+            if os.path.isdir(absolute) and not os.path.islink(absolute):
+                for entry in scanner.walk(path):
+                    existing.add(entry.path)
+                    if len(existing) > JOURNAL_MAX_PATHS:
+                        break
+            if len(existing) > JOURNAL_MAX_PATHS:
+                break
+        return existing, deleted
+
+    def plan(self) -> PushPlan:
+        """
+        Plan the next push of the target
+
+        Raises StateStoreError if the journal can't be read
+        """
+        plan = PushPlan(settings=self.get_settings())
+        flags = self.target.plan.flags
+        matcher = ExcludeMatcher(self.target.excluded)
+        scanner = TreeScanner(self.target.source, matcher)
+        if flags is None or has_unsupported_flags(flags) or not matcher.exact:
+            plan.full, plan.reason = True, 'rsync flags or filter rules not supported'
+            return plan
+
+        journal = self.state.get_journal(str(self.target))
+        plan.journal_paths = journal.paths
+        paths = set(journal.paths)
+        if self.scan:
+            try:
+                plan.manifest = self.manifest.scan(scanner)
+            except OSError:
+                plan.full, plan.reason = True, 'source tree can not be scanned'
+                return plan
+
+        if journal.settings != plan.settings:
+            plan.full, plan.reason = True, 'push settings changed'
+        elif journal.last_full_sync is None or time.time() - journal.last_full_sync >= self.full_sync_interval:
+            plan.full, plan.reason = True, 'full sync interval reached'
+        elif journal.overflowed:
+            plan.full, plan.reason = True, 'journal overflowed'
+        if plan.full:
+            return plan
+
+        if self.scan:
+            previous = self.manifest.load(plan.settings)
+            if previous is None:
+                plan.full, plan.reason = True, 'no manifest of previous push'
+                return plan
+            changed, deleted = diff_manifest_entries(previous, plan.manifest)
+            paths.update(changed)
+            paths.update(deleted)
+
+        try:
+            existing, deleted = self.expand_paths(scanner, sorted(paths))
+        except OSError:
+            plan.full, plan.reason = True, 'changed paths can not be read'
+            return plan
+        if len(existing) > JOURNAL_MAX_PATHS:
+            plan.full, plan.reason = True, 'too many changed paths'
+        elif deleted and has_delete_flags(flags):
+            plan.full, plan.reason = True, 'deleted paths'
+        else:
+            plan.paths = sorted(existing)
+        return plan
+
+    @staticmethod
+    def write_files_from(plan: PushPlan, handle: IO) -> None:
+        """
+        Write paths of an incremental push to a rsync --files-from file with --from0
+        """
+        for path in plan.paths:
+            handle.write(os.fsencode(path) + b'\0')
+        handle.flush()
+
+    def commit(self, plan: PushPlan) -> None:
+        """
+        Update the journal and manifest after a successful push
+
+        Raises StateStoreError if the journal or manifest can't be updated
+        """
+        self.state.clear_journal(
+            str(self.target),
+            plan.settings,
+            plan.journal_paths,
+            full_sync=time.time() if plan.full else None,
+        )
+        if plan.manifest is not None:
+            try:
+                self.manifest.save(plan.settings, plan.manifest)
+            except OSError as error:
+                raise StateStoreError(f'Error saving manifest {self.manifest}: {error}') from error
@@ -0,0 +1,179 @@
+#
+# Copyright (C) 2020-2023 by Ilkka Tuohela <hile@iki.fi>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+"""
+Pushing large files of a target with a separate rsync pass tuned for delta transfers
+
+Files at least as large as the large file size of the target are hidden from the normal
+push with filter rules, which also protect them from deletion. The large files are then
+pushed with a second rsync command listing them with --files-from, updating the
+destination files in place with the delta transfer algorithm and a larger block size, so
+a small change in a large disk image does not rewrite a temporary copy of the file.
+"""
+import re
+import time
+
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from typing import Any, IO, List, Optional, TYPE_CHECKING
+
+from .scanner import ExcludeMatcher, TreeScanner, has_unsupported_flags
+from .shards import escape_filter_pattern
+from .stats import SyncPass, SyncResult, merge_stats
+
+if TYPE_CHECKING:  # pragma: no cover
+    from .target import Target
+
+#: Default rsync block size for delta transfers of large files, the maximum allowed by rsync
+LARGE_FILE_BLOCK_SIZE = 131072
+#: Maximum rsync block size
+MAX_BLOCK_SIZE = 131072
+#: rsync flags for pushing large files
+LARGE_FILE_FLAGS = (
+    '--inplace',
+    '--partial',
+    '--no-whole-file',
+)
+#: Multipliers for size suffixes
+SIZE_SUFFIXES = {
+    '': 1,
+    'K': 1024,
+    'M': 1024 ** 2,
+    'G': 1024 ** 3,
+    'T': 1024 ** 4,
+}
+SIZE_PATTERN = re.compile(r'^(?P<value>[0-9]+)\s*(?P<suffix>[KMGT]?)B?$', re.IGNORECASE)
+
+
+def parse_size(value: Any) -> int:
+    """
+    Parse a size in bytes, with an optional K, M, G or T suffix
+
+    Raises ValueError for invalid sizes
+    """
+    if isinstance(value, int) and not isinstance(value, bool):
+        size = value
+    else:
+        match = SIZE_PATTERN.match(str(value).strip())
+        if not match:
+            raise ValueError(f'Invalid size: {value}')
+        size = int(match.group('value')) * SIZE_SUFFIXES[match.group('suffix').upper()]
+    if size < 1:
+        raise ValueError(f'Size must be positive: {value}')
+    return size
+
+
+def find_large_files(target: 'Target', size: int) -> Optional[List[str]]:
+    """
+    Return relative paths of files in the target source tree at least size bytes large
+
+    Returns None if the source tree can't be scanned with the target flags and excludes
+    """
+    flags = target.plan.flags
+    if flags is None or has_unsupported_flags(flags):
+        return None
+    matcher = ExcludeMatcher(target.plan.excluded)
+    if not matcher.exact:
+        return None
+    paths = []
+    try:
+        for entry in TreeScanner(target.source, matcher).walk():
+            if entry.type == 'f' and entry.size is not None and entry.size >= size:
+                # Paths with newlines can't be written to rsync filter files
+                if '\n' in entry.path:
+                    return None
+                paths.append(entry.path)
+    except OSError:
+        return None
+    return paths
+
+
+class LargeFilePush:
+    """
+    Push a target with a normal pass excluding large files and a pass for the large files
+    """
+    def __init__(self, target: 'Target', paths: List[str], block_size: int = LARGE_FILE_BLOCK_SIZE) -> None:
+        self.target = target
+        self.paths = paths
+        self.block_size = block_size
+
+    def __repr__(self) -> str:
+        return f'{self.target} with {len(self.paths)} large files'
+
+    @property
+    def source_and_destination(self) -> List[str]:
+        """
+        Return source and destination arguments for rsync
+        """
+        return [
+            f"""{str(self.target.source).rstrip('/')}/""",
+            f"""{self.target.destination.rstrip('/')}/""",
+        ]
+
+    def get_filter_rules(self) -> List[str]:
+        """
+        Return rsync filter rules hiding large files from the normal pass and protecting
+        them from deletion
+        """
+        rules = []
+        for path in self.paths:
+            pattern = f'/{escape_filter_pattern(path)}'
+            rules.extend([f'H {pattern}', f'P {pattern}'])
+        return rules
+
+    def get_files_args(self, filter_file: Path, dry_run: bool = False) -> List[str]:
+        """
+        Return rsync command arguments for the normal pass with filter rules in filter_file
+        """
+        args = self.target.get_rsync_cmd_args(dry_run=dry_run, stats=True)
+        args.append(f'--filter=merge {filter_file}')
+        return args + self.source_and_destination
+
+    def get_large_files_args(self, files_from: Path, dry_run: bool = False) -> List[str]:
+        """
+        Return rsync command arguments for the large files listed in files_from
+        """
+        args = self.target.get_rsync_cmd_args(dry_run=dry_run, stats=True, files_from=files_from)
+        args.extend(LARGE_FILE_FLAGS)
+        args.append(f'--block-size={self.block_size}')
+        return args + self.source_and_destination
+
+    def __run_pass__(self, name: str, args: List[str], output: Optional[IO]) -> SyncPass:
+        """
+        Run rsync command for a pass, measuring the duration of the command
+        """
+        start = time.monotonic()
+        stats = self.target.run_sync_command_streamed(*args, output=output, stats=True)
+        return SyncPass(name=name, args=args, duration=time.monotonic() - start, stats=stats)
+
+    def run(self, dry_run: bool = False, output: Optional[IO] = None, stats: bool = False) -> SyncResult:
+        """
+        Run the normal pass and the large file pass
+
+        The large file pass is not run if the normal pass fails. Both passes are run with
+        statistics for measuring their throughput. The result contains the arguments of the
+        large file pass and, with stats, statistics summed from both passes.
+        """
+        with NamedTemporaryFile(mode='w', encoding='utf-8', prefix='treesync-large-filter-') as filter_file:
+            filter_file.write(''.join(f'{rule}\n' for rule in self.get_filter_rules()))
+            filter_file.flush()
+            files_pass = self.__run_pass__('files', self.get_files_args(Path(filter_file.name), dry_run), output)
+        with NamedTemporaryFile(prefix='treesync-large-files-from-') as files_from:
+            files_from.write(b''.join(path.encode('utf-8', 'surrogateescape') + b'\0' for path in self.paths))
+            files_from.flush()
+            large_pass = self.__run_pass__(
+                'large files',
+                self.get_large_files_args(Path(files_from.name), dry_run),
+                output
+            )
+        passes = [files_pass, large_pass]
+        return SyncResult(
+            target=str(self.target),
+            action='push',
+            args=large_pass.args,
+            stats=merge_stats(item.stats for item in passes) if stats else None,
+            passes=passes,
+            duration=sum(item.duration for item in passes),
+        )
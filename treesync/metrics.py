@@ -0,0 +1,129 @@
+#
+# Copyright (C) 2020-2023 by Ilkka Tuohela <hile@iki.fi>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+"""
+Export of sync metrics in Prometheus text format for the node exporter textfile collector
+
+Metrics are generated from the results of sync commands recorded in the sync state store,
+so the file contains metrics for all targets synced by any treesync run.
+"""
+import os
+
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from typing import Dict, List, Optional, Tuple, Union
+
+from .state import SyncStateStore
+
+#: Prefix for names of exported metrics
+METRICS_PREFIX = 'treesync'
+
+#: Exported metrics with metric type and help text
+TARGET_METRICS = {
+    'target_last_duration_seconds': ('gauge', 'Duration of the latest sync command of the target'),
+    'target_last_exit_code': ('gauge', 'Exit code of the latest sync command of the target'),
+    'target_last_success_timestamp_seconds': ('gauge', 'Time the latest successful sync command finished'),
+    'target_last_bytes_transferred': ('gauge', 'Bytes sent and received by the latest sync command'),
+    'target_last_files_transferred': ('gauge', 'Files transferred by the latest sync command'),
+    'target_runs_total': ('counter', 'Number of sync commands run for the target'),
+    'target_failures_total': ('counter', 'Number of failed sync commands for the target'),
+}
+RUN_METRICS = {
+    'run_timestamp_seconds': ('gauge', 'Time the latest treesync run finished'),
+    'run_duration_seconds': ('gauge', 'Duration of the latest treesync run'),
+    'run_targets': ('gauge', 'Number of targets in the latest treesync run by status'),
+    'run_bytes_transferred': ('gauge', 'Bytes sent and received in the latest treesync run'),
+}
+
+
+def format_labels(labels: Dict[str, str]) -> str:
+    """
+    Format metric labels with escaped label values
+    """
+    values = []
+    for name, value in labels.items():
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        values.append(f'{name}="{value}"')
+    return '{' + ','.join(values) + '}'
+
+
+class MetricsFile:
+    """
+    Prometheus text format metrics file generated from the sync state store
+
+    The file is replaced atomically, so the collector never reads a partially written file
+    """
+    def __init__(self, path: Union[str, Path], state: SyncStateStore) -> None:
+        self.path = Path(path).expanduser()
+        self.state = state
+
+    def __repr__(self) -> str:
+        return str(self.path)
+
+    def get_samples(self) -> Dict[str, List[Tuple[Dict[str, str], float]]]:
+        """
+        Return metric samples by metric name
+        """
+        samples: Dict[str, List[Tuple[Dict[str, str], float]]] = {
+            name: [] for name in list(TARGET_METRICS) + list(RUN_METRICS)
+        }
+        for counters in self.state.get_counters():
+            labels = {'target': counters.target, 'action': counters.action}
+            values: Dict[str, Optional[float]] = {
+                'target_runs_total': counters.runs,
+                'target_failures_total': counters.failures,
+                'target_last_success_timestamp_seconds': counters.last_success,
+            }
+            if counters.last is not None:
+                values.update({
+                    'target_last_duration_seconds': counters.last.duration,
+                    'target_last_exit_code': counters.last.exit_code,
+                    'target_last_bytes_transferred': counters.last.bytes,
+                    'target_last_files_transferred': counters.last.files,
+                })
+            for name, value in values.items():
+                if value is not None:
+                    samples[name].append((labels, value))
+
+        for summary in self.state.get_run_summaries():
+            labels = {'action': summary.action}
+            samples['run_timestamp_seconds'].append((labels, summary.finished))
+            samples['run_duration_seconds'].append((labels, summary.duration))
+            samples['run_bytes_transferred'].append((labels, summary.bytes))
+            for status in ('succeeded', 'failed', 'skipped'):
+                samples['run_targets'].append(({**labels, 'status': status}, getattr(summary, status)))
+        return samples
+
+    def format(self) -> str:
+        """
+        Return metrics in Prometheus text format
+        """
+        lines = []
+        metrics = {**TARGET_METRICS, **RUN_METRICS}
+        for name, samples in self.get_samples().items():
+            if not samples:
+                continue
+            metric_type, description = metrics[name]
+            lines.append(f'# HELP {METRICS_PREFIX}_{name} {description}')
+            lines.append(f'# TYPE {METRICS_PREFIX}_{name} {metric_type}')
+            for labels, value in samples:
+                lines.append(f'{METRICS_PREFIX}_{name}{format_labels(labels)} {value}')
+        return ''.join(f'{line}\n' for line in lines)
+
+    def write(self) -> None:
+        """
+        Write metrics file atomically
+        """
+        content = self.format()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with NamedTemporaryFile(
+                mode='w',
+                encoding='utf-8',
+                dir=self.path.parent,
+                prefix=f'.{self.path.name}',
+                delete=False) as handle:
+            handle.write(content)
+        os.chmod(handle.name, 0o644)
+        os.replace(handle.name, self.path)
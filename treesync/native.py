@@ -0,0 +1,575 @@
+#
+# Copyright (C) 2020-2023 by Ilkka Tuohela <hile@iki.fi>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+"""
+Native sync engine for targets with local destinations
+
+The engine copies a source tree to a local destination directory without running rsync,
+implementing the rsync options used by treesync targets: archive mode, deletion of
+extraneous files and excludes. Files are compared with the rsync quick check of size and
+modification time and changed files are copied whole, as rsync does for local copies.
+File data is copied with FICLONE reflinks or os.copy_file_range where the filesystem
+supports them, falling back to reading and writing the data. Directories are walked by a
+pool of worker threads.
+
+Targets with rsync flags or filter rules not implemented by the engine are synced with
+rsync.
+"""
+import errno
+import os
+import shutil
+import stat
+import sys
+import threading
+
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, FrozenSet, IO, Iterable, List, Optional, Tuple, TYPE_CHECKING
+
+from .exceptions import SyncError
+from .scanner import ExcludeMatcher
+from .stats import SyncStats
+
+if TYPE_CHECKING:  # pragma: no cover
+    from .target import Target
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+#: Sync engines for targets
+SYNC_ENGINES = (
+    'rsync',
+    'native',
+)
+#: ioctl request to clone a file with reflinks on Linux
+FICLONE = 0x40049409
+#: Maximum bytes copied with one copy_file_range call
+COPY_RANGE_SIZE = 1024 * 1024 * 1024
+#: Bytes copied at once when copying data by reading and writing
+COPY_BUFFER_SIZE = 1024 * 1024
+#: Number of worker threads walking directories and copying files
+NATIVE_WORKERS = 8
+#: Errors from reflinks and copy_file_range when the filesystem does not support them
+COPY_FALLBACK_ERRORS = (
+    errno.EBADF,
+    errno.EINVAL,
+    errno.ENOSYS,
+    errno.EOPNOTSUPP,
+    errno.ENOTTY,
+    errno.EXDEV,
+)
+
+#: rsync long flags implemented by the native engine, with the implemented options
+NATIVE_LONG_FLAGS = {
+    '--archive': ('recursive', 'links', 'perms', 'times', 'group', 'owner', 'devices', 'specials'),
+    '--recursive': ('recursive',),
+    '--links': ('links',),
+    '--perms': ('perms',),
+    '--times': ('times',),
+    '--group': ('group',),
+    '--owner': ('owner',),
+    '--devices': ('devices',),
+    '--specials': ('specials',),
+    '--delete': ('delete',),
+    '--delete-before': ('delete',),
+    '--delete-during': ('delete',),
+    '--delete-delay': ('delete',),
+    '--delete-after': ('delete',),
+    '--delete-excluded': ('delete', 'delete_excluded'),
+    '--verbose': ('verbose',),
+    '--human-readable': (),
+    '--protect-args': (),
+    '--secluded-args': (),
+    '--stats': (),
+    '--whole-file': (),
+}
+#: rsync short flags implemented by the native engine, with the implemented options
+NATIVE_SHORT_FLAGS = {
+    'a': NATIVE_LONG_FLAGS['--archive'],
+    'r': ('recursive',),
+    'l': ('links',),
+    'p': ('perms',),
+    't': ('times',),
+    'g': ('group',),
+    'o': ('owner',),
+    'D': ('devices', 'specials'),
+    'v': ('verbose',),
+    'h': (),
+    's': (),
+    'W': (),
+}
+
+
+def parse_native_options(flags: Iterable[str]) -> Optional[FrozenSet[str]]:
+    """
+    Parse options of the native engine from rsync flags
+
+    Returns None if any of the flags is not implemented by the engine
+    """
+    options = set()
+    for flag in flags:
+        if flag.startswith('--'):
+            if flag not in NATIVE_LONG_FLAGS:
+                return None
+            options.update(NATIVE_LONG_FLAGS[flag])
+        elif flag.startswith('-') and len(flag) > 1:
+            for character in flag[1:]:
+                if character not in NATIVE_SHORT_FLAGS:
+                    return None
+                options.update(NATIVE_SHORT_FLAGS[character])
+        else:
+            return None
+    if 'recursive' not in options:
+        return None
+    return frozenset(options)
+
+
+def is_local_destination(destination: str) -> bool:
+    """
+    Check if a rsync destination is a local path
+    """
+    if '::' in destination or destination.startswith('rsync://'):
+        return False
+    try:
+        host, _path = destination.split(':', 1)
+    except ValueError:
+        return True
+    # Local paths containing a colon have a slash before the colon
+    return '/' in host
+
+
+def copy_file_data(source: int, destination: int, reflink: bool = True) -> str:
+    """
+    Copy data of an open file to an empty file, returning the method used for copying
+
+    Reflinks are tried first, then os.copy_file_range and finally reading and writing
+    the data
+    """
+    if reflink and fcntl is not None and sys.platform.startswith('linux'):
+        try:
+            fcntl.ioctl(destination, FICLONE, source)
+            return 'reflink'
+        except OSError as error:
+            if error.errno not in COPY_FALLBACK_ERRORS:
+                raise
+    if hasattr(os, 'copy_file_range'):
+        copied = 0
+        try:
+            while True:
+                count = os.copy_file_range(source, destination, COPY_RANGE_SIZE)
+                if count == 0:
+                    return 'copy_file_range'
+                copied += count
+        except OSError as error:
+            if copied or error.errno not in COPY_FALLBACK_ERRORS:
+                raise
+    while True:
+        data = os.read(source, COPY_BUFFER_SIZE)
+        if not data:
+            return 'copy'
+        view = memoryview(data)
+        while view:
+            view = view[os.write(destination, view):]
+
+
+class NativeSyncEngine:
+    """
+    Sync a source directory to a local destination directory without rsync
+
+    Options are the rsync options parsed with parse_native_options. Excluded paths are
+    not copied and, unless delete_excluded is set, not deleted from the destination.
+    """
+    def __init__(self,
+                 source: Path,
+                 destination: Path,
+                 options: Iterable[str],
+                 matcher: ExcludeMatcher,
+                 workers: int = NATIVE_WORKERS,
+                 reflink: bool = True) -> None:
+        self.source = Path(source)
+        self.destination = Path(destination)
+        self.options = frozenset(options)
+        self.matcher = matcher
+        self.workers = workers
+        self.reflink = reflink
+        self.copy_methods: Counter = Counter()
+        self.dry_run = False
+        self.__umask__ = os.umask(0)
+        os.umask(self.__umask__)
+        self.__is_root__ = os.geteuid() == 0
+        self.__lock__ = threading.Lock()
+        self.__condition__ = threading.Condition(self.__lock__)
+        self.__pending__ = 0
+        self.__executor__: Optional[ThreadPoolExecutor] = None
+        self.__output__: Optional[IO] = None
+        self.__stats__ = SyncStats()
+        self.__errors__: List[str] = []
+        self.__failures__: List[Exception] = []
+        self.__directories__: List[Tuple[str, os.stat_result]] = []
+
+    def __repr__(self) -> str:
+        return f'native {self.source} -> {self.destination}'
+
+    def __write__(self, text: str) -> None:
+        """
+        Write output line
+        """
+        with self.__lock__:
+            self.__output__.write(f'{text}\n')
+
+    def __log__(self, text: str) -> None:
+        """
+        Write output line in verbose mode
+        """
+        if 'verbose' in self.options:
+            self.__write__(text)
+
+    def __error__(self, text: str) -> None:
+        """
+        Record and write an error message
+        """
+        with self.__lock__:
+            self.__errors__.append(text)
+        self.__write__(f'treesync: {text}')
+
+    def __count__(self, **counters: int) -> None:
+        """
+        Increment counters of transfer statistics
+        """
+        with self.__lock__:
+            for name, value in counters.items():
+                setattr(self.__stats__, name, (getattr(self.__stats__, name) or 0) + value)
+
+    def __submit__(self, callback: Callable, *args) -> None:
+        """
+        Run a callback in the worker pool
+        """
+        with self.__condition__:
+            self.__pending__ += 1
+        self.__executor__.submit(self.__run_task__, callback, *args)
+
+    def __run_task__(self, callback: Callable, *args) -> None:
+        """
+        Run a task in the worker pool, recording errors
+        """
+        try:
+            callback(*args)
+        except OSError as error:
+            self.__error__(str(error))
+        except Exception as error:  # pylint: disable=broad-except
+            with self.__lock__:
+                self.__failures__.append(error)
+        finally:
+            with self.__condition__:
+                self.__pending__ -= 1
+                if self.__pending__ == 0:
+                    self.__condition__.notify_all()
+
+    def is_excluded(self, path: str, name: str, is_directory: bool) -> bool:
+        """
+        Check if a relative path is excluded
+        """
+        return self.matcher.match(path, name, is_directory)
+
+    def set_attributes(self, path: str, status: os.stat_result) -> None:
+        """
+        Set owner, group, permissions and modification time of a path from source status
+        """
+        is_link = stat.S_ISLNK(status.st_mode)
+        if 'owner' in self.options or 'group' in self.options:
+            uid = status.st_uid if 'owner' in self.options and self.__is_root__ else -1
+            gid = status.st_gid if 'group' in self.options else -1
+            try:
+                os.chown(path, uid, gid, follow_symlinks=False)
+            except PermissionError:
+                # Non-root users can only set groups they are members of, as with rsync
+                if uid != -1:
+                    raise
+        if not is_link:
+            mode = stat.S_IMODE(status.st_mode)
+            if 'perms' not in self.options:
+                mode &= ~self.__umask__
+            os.chmod(path, mode)
+        if 'times' in self.options and (not is_link or os.utime in os.supports_follow_symlinks):
+            os.utime(path, ns=(status.st_atime_ns, status.st_mtime_ns), follow_symlinks=False)
+
+    def remove(self, relative: str, entry: os.DirEntry) -> None:
+        """
+        Delete an extraneous path from the destination
+        """
+        is_directory = entry.is_dir(follow_symlinks=False)
+        self.__log__(f'deleting {relative}/' if is_directory else f'deleting {relative}')
+        self.__count__(deleted_files=1)
+        if self.dry_run:
+            return
+        if is_directory:
+            shutil.rmtree(entry.path)
+        else:
+            os.unlink(entry.path)
+
+    def __replace_path__(self, path: str, is_directory: bool) -> None:
+        """
+        Remove a destination path of different type before replacing it
+        """
+        if self.dry_run:
+            return
+        if is_directory:
+            shutil.rmtree(path)
+        else:
+            os.unlink(path)
+
+    def copy_file(self, relative: str, status: os.stat_result) -> None:
+        """
+        Copy a regular file to a temporary file in the destination directory and rename it
+        """
+        self.__log__(relative)
+        self.__count__(files_transferred=1, transferred_file_size=status.st_size)
+        if self.dry_run:
+            return
+        source = os.path.join(self.source, relative)
+        destination = os.path.join(self.destination, relative)
+        directory, name = os.path.split(destination)
+        temporary = os.path.join(directory, f'.{name}.{threading.get_ident()}')
+        source_fd = os.open(source, os.O_RDONLY)
+        try:
+            destination_fd = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            try:
+                method = copy_file_data(source_fd, destination_fd, self.reflink)
+            finally:
+                os.close(destination_fd)
+            self.set_attributes(temporary, status)
+            os.replace(temporary, destination)
+        finally:
+            os.close(source_fd)
+            if os.path.lexists(temporary):
+                os.unlink(temporary)
+        with self.__lock__:
+            self.copy_methods[method] += 1
+
+    def sync_file(self, relative: str, status: os.stat_result, existing: Optional[os.DirEntry]) -> None:
+        """
+        Copy a regular file if it differs from the destination by size or modification time
+
+        Attributes of unchanged files are updated without copying the data
+        """
+        self.__count__(files=1, total_file_size=status.st_size)
+        if existing is not None:
+            current = existing.stat(follow_symlinks=False)
+            if stat.S_ISREG(current.st_mode):
+                if current.st_size == status.st_size and current.st_mtime_ns == status.st_mtime_ns:
+                    if not self.dry_run and self.__attributes_differ__(current, status):
+                        self.set_attributes(existing.path, status)
+                    return
+            else:
+                self.__replace_path__(existing.path, existing.is_dir(follow_symlinks=False))
+        else:
+            self.__count__(created_files=1)
+        self.__submit__(self.copy_file, relative, status)
+
+    def __attributes_differ__(self, current: os.stat_result, status: os.stat_result) -> bool:
+        """
+        Check if owner, group or permissions of an unchanged destination file differ
+        """
+        if 'perms' in self.options and stat.S_IMODE(current.st_mode) != stat.S_IMODE(status.st_mode):
+            return True
+        if 'group' in self.options and current.st_gid != status.st_gid:
+            return True
+        return 'owner' in self.options and self.__is_root__ and current.st_uid != status.st_uid
+
+    def sync_link(self, relative: str, status: os.stat_result, existing: Optional[os.DirEntry]) -> None:
+        """
+        Create a symbolic link if it differs from the destination
+        """
+        self.__count__(files=1)
+        if 'links' not in self.options:
+            self.__write__(f'skipping non-regular file "{relative}"')
+            return
+        source = os.path.join(self.source, relative)
+        destination = os.path.join(self.destination, relative)
+        link = os.readlink(source)
+        if existing is not None:
+            if existing.is_symlink() and os.readlink(destination) == link:
+                return
+            self.__replace_path__(existing.path, existing.is_dir(follow_symlinks=False))
+        else:
+            self.__count__(created_files=1)
+        self.__log__(f'{relative} -> {link}')
+        if not self.dry_run:
+            os.symlink(link, destination)
+            self.set_attributes(destination, status)
+
+    def sync_special(self, relative: str, status: os.stat_result, existing: Optional[os.DirEntry]) -> None:
+        """
+        Create a device or special file if it differs from the destination
+        """
+        self.__count__(files=1)
+        is_device = stat.S_ISCHR(status.st_mode) or stat.S_ISBLK(status.st_mode)
+        if ('devices' if is_device else 'specials') not in self.options:
+            self.__write__(f'skipping non-regular file "{relative}"')
+            return
+        destination = os.path.join(self.destination, relative)
+        if existing is not None:
+            current = existing.stat(follow_symlinks=False)
+            if stat.S_IFMT(current.st_mode) == stat.S_IFMT(status.st_mode) and current.st_rdev == status.st_rdev:
+                return
+            self.__replace_path__(existing.path, existing.is_dir(follow_symlinks=False))
+        else:
+            self.__count__(created_files=1)
+        self.__log__(relative)
+        if not self.dry_run:
+            os.mknod(destination, status.st_mode, status.st_rdev)
+            self.set_attributes(destination, status)
+
+    def sync_directory(self, relative: str) -> None:
+        """
+        Sync contents of a directory, deleting extraneous destination paths and submitting
+        files and subdirectories to the worker pool
+        """
+        source = os.path.join(self.source, relative) if relative else str(self.source)
+        destination = os.path.join(self.destination, relative) if relative else str(self.destination)
+        with os.scandir(source) as iterator:
+            entries = sorted(iterator, key=lambda entry: entry.name)
+        existing: Dict[str, os.DirEntry] = {}
+        if os.path.isdir(destination):
+            with os.scandir(destination) as iterator:
+                existing = {entry.name: entry for entry in iterator}
+
+        included = {}
+        for entry in entries:
+            path = os.path.join(relative, entry.name) if relative else entry.name
+            if not self.is_excluded(path, entry.name, entry.is_dir(follow_symlinks=False)):
+                included[entry.name] = entry
+        if 'delete' in self.options:
+            for name, entry in sorted(existing.items()):
+                if name in included:
+                    continue
+                path = os.path.join(relative, name) if relative else name
+                if 'delete_excluded' in self.options or not self.is_excluded(
+                        path, name, entry.is_dir(follow_symlinks=False)):
+                    self.remove(path, entry)
+
+        for name, entry in included.items():
+            path = os.path.join(relative, name) if relative else name
+            status = entry.stat(follow_symlinks=False)
+            current = existing.get(name, None)
+            try:
+                if stat.S_ISDIR(status.st_mode):
+                    self.__sync_subdirectory__(path, status, current)
+                elif stat.S_ISLNK(status.st_mode):
+                    self.sync_link(path, status, current)
+                elif stat.S_ISREG(status.st_mode):
+                    self.sync_file(path, status, current)
+                else:
+                    self.sync_special(path, status, current)
+            except OSError as error:
+                self.__error__(f'{path}: {error}')
+
+    def __sync_subdirectory__(self, relative: str, status: os.stat_result, existing: Optional[os.DirEntry]) -> None:
+        """
+        Create a destination directory and submit syncing its contents
+        """
+        self.__count__(files=1)
+        destination = os.path.join(self.destination, relative)
+        if existing is not None and not existing.is_dir(follow_symlinks=False):
+            self.__replace_path__(existing.path, False)
+            existing = None
+        if existing is None:
+            self.__count__(created_files=1)
+            self.__log__(f'{relative}/')
+            if not self.dry_run:
+                os.mkdir(destination, 0o700)
+        with self.__lock__:
+            self.__directories__.append((relative, status))
+        self.__submit__(self.sync_directory, relative)
+
+    def run(self, dry_run: bool = False, output: Optional[IO] = None) -> SyncStats:
+        """
+        Sync the source directory to the destination directory
+
+        Returns statistics of the sync. Raises SyncError if the source directory does not
+        exist or any path could not be synced.
+        """
+        self.dry_run = dry_run
+        self.__output__ = output if output is not None else sys.stdout
+        self.__stats__ = SyncStats(
+            files=0,
+            created_files=0,
+            deleted_files=0,
+            files_transferred=0,
+            total_file_size=0,
+            transferred_file_size=0,
+        )
+        self.__errors__ = []
+        self.__failures__ = []
+        self.__directories__ = []
+        self.copy_methods = Counter()
+        try:
+            source_status = os.stat(self.source)
+        except OSError as error:
+            raise SyncError(f'Error reading source directory {self.source}: {error}') from error
+        if not stat.S_ISDIR(source_status.st_mode):
+            raise SyncError(f'Source is not a directory: {self.source}')
+        if not self.destination.is_dir():
+            self.__log__(f'created directory {self.destination}')
+            if not dry_run:
+                try:
+                    self.destination.mkdir()
+                except OSError as error:
+                    raise SyncError(f'Error creating destination {self.destination}: {error}') from error
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='treesync-native') as executor:
+            self.__executor__ = executor
+            self.__submit__(self.sync_directory, '')
+            with self.__condition__:
+                while self.__pending__:
+                    self.__condition__.wait()
+        self.__executor__ = None
+        if self.__failures__:
+            raise self.__failures__[0]
+
+        if not dry_run:
+            # Directory attributes are set deepest first, after their contents were written
+            self.__directories__.sort(key=lambda item: item[0].count(os.sep), reverse=True)
+            for relative, status in self.__directories__ + [('', source_status)]:
+                try:
+                    self.set_attributes(os.path.join(self.destination, relative), status)
+                except OSError as error:
+                    self.__error__(f'{relative or "."}: {error}')
+
+        stats = self.__stats__
+        stats.bytes_sent = stats.transferred_file_size
+        stats.bytes_received = 0
+        if stats.transferred_file_size:
+            stats.speedup = round(stats.total_file_size / stats.transferred_file_size, 2)
+        self.__log__(f'total size is {stats.total_file_size}  speedup is {stats.speedup or 0:.2f}')
+        if self.__errors__:
+            raise SyncError(f'{self}: {len(self.__errors__)} errors, first error: {self.__errors__[0]}')
+        return stats
+
+
+def get_native_engine(target: 'Target', source: Path, destination: str) -> Optional[NativeSyncEngine]:
+    """
+    Return native sync engine for syncing source to destination of the target
+
+    Returns None if the target does not use the native engine, the destination of the
+    target is not local, or the rsync flags or excludes of the target are not implemented by
+    the engine. The destination of the target is checked for both pushes and pulls, because
+    a pull copies from the destination of the target to the source.
+    """
+    if target.engine != 'native' or not is_local_destination(str(target.destination)):
+        return None
+    flags = target.plan.flags
+    if flags is None:
+        return None
+    options = parse_native_options(flags)
+    if options is None:
+        return None
+    matcher = ExcludeMatcher(target.plan.excluded)
+    if not matcher.exact:
+        return None
+    return NativeSyncEngine(source, Path(destination), options, matcher)
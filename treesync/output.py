@@ -0,0 +1,178 @@
+#
+# Copyright (C) 2020-2023 by Ilkka Tuohela <hile@iki.fi>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+"""
+Capture of rsync command output to per-target log files
+
+Output of the commands is read from non-blocking pipes and written to rotating log files
+in the user state directory. The last lines of output are kept in memory to be shown if
+the command fails.
+"""
+import os
+import selectors
+import time
+
+from collections import deque
+from pathlib import Path
+from subprocess import Popen
+from typing import Callable, Dict, IO, Optional
+from urllib.parse import quote
+
+from .directories import user_state_directory
+
+#: Number of last output lines kept in memory for each command
+OUTPUT_BUFFER_LINES = 50
+#: Maximum size of a log file in bytes before it is rotated
+LOG_FILE_MAX_SIZE = 1024 * 1024
+#: Number of rotated log files kept for each target
+LOG_FILE_BACKUP_COUNT = 5
+#: Bytes read from the output pipes at once
+READ_CHUNK_SIZE = 64 * 1024
+
+
+def read_process_output(process: Popen, callback: Callable[[str], None]) -> None:
+    """
+    Read stdout and stderr pipes of a process without blocking on either pipe
+
+    Complete lines are passed to the callback with the line ending as they are read. The
+    function returns when all pipes of the process have been closed.
+    """
+    selector = selectors.DefaultSelector()
+    buffers: Dict[int, bytes] = {}
+    for stream in (process.stdout, process.stderr):
+        if stream is not None:
+            os.set_blocking(stream.fileno(), False)
+            selector.register(stream.fileno(), selectors.EVENT_READ)
+            buffers[stream.fileno()] = b''
+    try:
+        while selector.get_map():
+            for key, _events in selector.select():
+                try:
+                    data = os.read(key.fd, READ_CHUNK_SIZE)
+                except BlockingIOError:
+                    continue
+                if not data:
+                    selector.unregister(key.fd)
+                    remaining = buffers.pop(key.fd)
+                    if remaining:
+                        callback(remaining.decode('utf-8', 'replace'))
+                    continue
+                lines = (buffers[key.fd] + data).split(b'\n')
+                buffers[key.fd] = lines.pop()
+                for line in lines:
+                    callback(f"{line.decode('utf-8', 'replace')}\n")
+    finally:
+        selector.close()
+
+
+class LogFile:
+    """
+    Log file rotated when the file grows over the maximum size
+
+    Rotated files are named with numeric suffixes, the oldest files are removed
+    """
+    def __init__(self,
+                 path: Path,
+                 max_size: int = LOG_FILE_MAX_SIZE,
+                 backup_count: int = LOG_FILE_BACKUP_COUNT) -> None:
+        self.path = Path(path)
+        self.max_size = max_size
+        self.backup_count = backup_count
+        self.size = 0
+        self.__handle__: Optional[IO] = None
+
+    def __repr__(self) -> str:
+        return str(self.path)
+
+    def open(self) -> None:
+        """
+        Open the log file for appending, rotating it first if it is over maximum size
+        """
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            self.size = self.path.stat().st_size
+        except FileNotFoundError:
+            self.size = 0
+        if self.size >= self.max_size:
+            self.rotate()
+        else:
+            self.__handle__ = self.path.open('a', encoding='utf-8')
+
+    def close(self) -> None:
+        """
+        Close the log file
+        """
+        if self.__handle__ is not None:
+            self.__handle__.close()
+            self.__handle__ = None
+
+    def rotate(self) -> None:
+        """
+        Rotate log files and open a new empty log file
+        """
+        self.close()
+        for index in range(self.backup_count - 1, 0, -1):
+            backup = self.path.with_name(f'{self.path.name}.{index}')
+            if backup.exists():
+                os.replace(backup, self.path.with_name(f'{self.path.name}.{index + 1}'))
+        if self.backup_count > 0 and self.path.exists():
+            os.replace(self.path, self.path.with_name(f'{self.path.name}.1'))
+        else:
+            self.path.unlink(missing_ok=True)
+        self.__handle__ = self.path.open('a', encoding='utf-8')
+        self.size = 0
+
+    def write(self, text: str) -> None:
+        """
+        Write text to the log file
+        """
+        if self.__handle__ is None:
+            self.open()
+        if self.size >= self.max_size:
+            self.rotate()
+        self.__handle__.write(text)
+        self.size += len(text.encode('utf-8', 'replace'))
+
+
+class TargetOutput:
+    """
+    Output of sync commands for a target, written to the target log file
+
+    The last lines of output are kept in a ring buffer. Use as a context manager to open
+    and close the log file.
+    """
+    def __init__(self,
+                 name: str,
+                 directory: Optional[Path] = None,
+                 lines: int = OUTPUT_BUFFER_LINES) -> None:
+        self.name = name
+        self.directory = Path(directory) if directory is not None else user_state_directory().joinpath('logs')
+        self.buffer = deque(maxlen=lines)
+        self.line_count = 0
+        self.log = LogFile(self.directory.joinpath(f"{quote(name, safe='')}.log"))
+
+    def __enter__(self) -> 'TargetOutput':
+        self.log.open()
+        self.log.write(f"=== {time.strftime('%Y-%m-%d %H:%M:%S')} {self.name}\n")
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.log.close()
+
+    @property
+    def tail(self) -> str:
+        """
+        Return last lines of output
+        """
+        return ''.join(self.buffer)
+
+    def write(self, text: str) -> None:
+        """
+        Write output lines to the log file and the ring buffer
+        """
+        self.log.write(text)
+        for line in text.splitlines(keepends=True):
+            self.buffer.append(line)
+            self.line_count += 1
@@ -0,0 +1,119 @@
+#
+# Copyright (C) 2020-2023 by Ilkka Tuohela <hile@iki.fi>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+"""
+Machine readable JSONL reports of treesync runs
+
+The report contains one JSON record per line. A record is written for each sync job when
+the job finishes, and a summary record is written when the run ends.
+"""
+import json
+import time
+
+from pathlib import Path
+from typing import Any, Dict, IO, Optional, Union
+
+from .scheduler import SyncJob
+from .state import RunSummary
+
+
+class RunReport:
+    """
+    JSONL report of sync jobs in a treesync run
+
+    Records are flushed to the file as they are written. With append the records are added
+    to an existing report file, for example by later runs of the watch command.
+    """
+    def __init__(self, path: Union[str, Path], action: str, append: bool = False) -> None:
+        self.path = Path(path)
+        self.append = append
+        self.summary = RunSummary(action=action, started=time.time())
+        self.__handle__: Optional[IO] = None
+
+    def __repr__(self) -> str:
+        return str(self.path)
+
+    def __enter__(self) -> 'RunReport':
+        self.open()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def open(self) -> None:
+        """
+        Open the report file, replacing any existing file unless appending
+        """
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.__handle__ = self.path.open('a' if self.append else 'w', encoding='utf-8')
+
+    def close(self) -> None:
+        """
+        Write the summary record and close the report file
+        """
+        if self.__handle__ is None:
+            return
+        self.write(self.get_summary_record())
+        self.__handle__.close()
+        self.__handle__ = None
+
+    def write(self, record: Dict[str, Any]) -> None:
+        """
+        Write a record to the report file
+        """
+        self.__handle__.write(f'{json.dumps(record)}\n')
+        self.__handle__.flush()
+
+    @staticmethod
+    def get_job_record(job: SyncJob) -> Dict[str, Any]:
+        """
+        Return report record for a finished sync job
+        """
+        stats = job.result.stats if job.result is not None else None
+        compression = job.target.compression
+        return {
+            'type': 'target',
+            'target': str(job.target),
+            'host': job.host,
+            'action': job.action,
+            'command': list(job.result.args) if job.result is not None else None,
+            'dry_run': job.dry_run,
+            'started': job.timestamp,
+            'finished': job.timestamp + job.duration,
+            'duration': job.duration,
+            'status': job.status,
+            'exit_code': None if job.skipped else job.exit_code,
+            'error': str(job.error) if job.error is not None else None,
+            'stats': stats.as_dict() if stats is not None else None,
+            'seed': job.seeded.as_dict() if job.seeded is not None else None,
+            'throughput': job.throughput,
+            'passes': [item.as_dict() for item in job.result.passes] if job.result is not None else [],
+            'compression': compression.as_dict() if compression is not None else None,
+        }
+
+    def get_summary_record(self) -> Dict[str, Any]:
+        """
+        Return summary record for the run
+        """
+        self.summary.finished = time.time()
+        return {
+            'type': 'summary',
+            'action': self.summary.action,
+            'targets': self.summary.targets,
+            'succeeded': self.summary.succeeded,
+            'failed': self.summary.failed,
+            'skipped': self.summary.skipped,
+            'bytes_transferred': self.summary.bytes,
+            'started': self.summary.started,
+            'finished': self.summary.finished,
+            'duration': self.summary.duration,
+        }
+
+    def add_job(self, job: SyncJob) -> None:
+        """
+        Write record for a finished sync job and add the job to the run summary
+        """
+        self.summary.add(job.status, job.bytes_transferred)
+        self.write(self.get_job_record(job))
@@ -0,0 +1,284 @@
+#
+# Copyright (C) 2020-2023 by Ilkka Tuohela <hile@iki.fi>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+"""
+Scanner for detecting changes in sync target source trees without running rsync
+
+The scanner walks the source tree with os.scandir, skipping paths matched by the target
+excludes, and calculates a digest of the path, type, mode, size and modification time of
+all entries. The digest is compared to the digest recorded in the sync state store after
+the last successful push to skip pushing trees with no changes.
+"""
+import hashlib
+import json
+import os
+import re
+import stat
+
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable, Iterator, List, Optional, Pattern, Tuple, TYPE_CHECKING
+
+if TYPE_CHECKING:  # pragma: no cover
+    from .target import Target
+
+#: rsync long flags changing which files are transferred in ways the scanner can't detect
+UNSUPPORTED_LONG_FLAGS = (
+    '--copy-dirlinks',
+    '--copy-links',
+    '--copy-unsafe-links',
+    '--exclude-from',
+    '--files-from',
+    '--filter',
+    '--include',
+    '--include-from',
+)
+#: rsync short flags changing which files are transferred in ways the scanner can't detect
+UNSUPPORTED_SHORT_FLAGS = 'FLfk'
+
+
+def translate_pattern(pattern: str) -> str:
+    """
+    Translate a rsync wildcard pattern to a regular expression
+
+    Single * and ? do not match path separators, ** matches anything
+    """
+    result = ''
+    index = 0
+    while index < len(pattern):
+        character = pattern[index]
+        index += 1
+        if character == '*':
+            if pattern[index:index + 1] == '*':
+                while pattern[index:index + 1] == '*':
+                    index += 1
+                result += '.*'
+            else:
+                result += '[^/]*'
+        elif character == '?':
+            result += '[^/]'
+        elif character == '[':
+            start = index
+            if pattern[start:start + 1] in ('!', '^'):
+                start += 1
+            if pattern[start:start + 1] == ']':
+                start += 1
+            end = pattern.find(']', start)
+            if end < 0:
+                result += re.escape(character)
+                continue
+            content = pattern[index:end]
+            if content[:1] in ('!', '^'):
+                content = f'^{content[1:]}'
+            result += f'[{content.replace(chr(92), chr(92) * 2)}]'
+            index = end + 1
+        elif character == '\\' and index < len(pattern):
+            result += re.escape(pattern[index])
+            index += 1
+        else:
+            result += re.escape(character)
+    return result
+
+
+class ExcludePattern:
+    """
+    A single rsync exclude pattern
+
+    Patterns starting with / are anchored to the root of the tree, patterns ending with /
+    only match directories. Patterns containing / or ** are matched against the end of the
+    relative path, other patterns against the file name.
+    """
+    def __init__(self, pattern: str) -> None:
+        self.pattern = pattern
+        self.directory_only = pattern.endswith('/')
+        pattern = pattern.rstrip('/')
+        self.anchored = pattern.startswith('/')
+        pattern = pattern.lstrip('/')
+        self.match_path = self.anchored or '/' in pattern or '**' in pattern
+        expression = translate_pattern(pattern)
+        if self.match_path and not self.anchored:
+            expression = f'(?:.*/)?{expression}'
+        self.regexp: Pattern = re.compile(f'{expression}$', re.DOTALL)
+
+    def __repr__(self) -> str:
+        return self.pattern
+
+    def match(self, path: str, name: str, is_directory: bool) -> bool:
+        """
+        Check if pattern matches a relative path in the tree
+        """
+        if self.directory_only and not is_directory:
+            return False
+        return self.regexp.match(path if self.match_path else name) is not None
+
+
+class ExcludeMatcher:
+    """
+    Matcher for excluded paths in rsync excludes file format
+
+    The matcher understands plain exclude patterns and '- ' prefixed exclude rules. Include
+    rules and other filter rules can't be evaluated by the matcher and mark it inexact.
+    """
+    def __init__(self, excluded: Iterable[str]) -> None:
+        self.patterns: List[ExcludePattern] = []
+        self.exact = True
+        for line in excluded:
+            line = str(line)
+            if not line or line[0] in ('#', ';'):
+                continue
+            if line.startswith('- '):
+                line = line[2:]
+            elif line.startswith(('+ ', '! ', ': ', '. ', 'P ', 'R ', 'H ', 'S ')) or line == '!':
+                self.exact = False
+                continue
+            if line.endswith('/***'):
+                self.patterns.append(ExcludePattern(line[:-4]))
+                line = f'{line[:-4]}/**'
+            self.patterns.append(ExcludePattern(line))
+
+    def match(self, path: str, name: str, is_directory: bool) -> bool:
+        """
+        Check if a relative path in the tree is excluded
+        """
+        return any(pattern.match(path, name, is_directory) for pattern in self.patterns)
+
+
+def has_unsupported_flags(flags: Iterable[str]) -> bool:
+    """
+    Check if rsync flags change the transferred files in ways the scanner can't detect
+    """
+    for flag in flags:
+        if flag.startswith('--'):
+            if flag.split('=', 1)[0] in UNSUPPORTED_LONG_FLAGS:
+                return True
+        elif flag.startswith('-') and any(character in UNSUPPORTED_SHORT_FLAGS for character in flag[1:]):
+            return True
+    return False
+
+
+@dataclass(frozen=True)
+class TreeEntry:
+    """
+    Entry in a source tree
+
+    Type is d for directories, l for symbolic links and f for other files. Size and
+    modification time are only set for files and link target only for symbolic links.
+    """
+    path: str
+    type: str
+    mode: int
+    size: Optional[int] = None
+    mtime_ns: Optional[int] = None
+    link: Optional[str] = None
+
+
+@dataclass(frozen=True)
+class TreeScan:
+    """
+    Result of scanning a source tree
+    """
+    digest: str
+    files: int
+    directories: int
+    size: int
+
+
+class TreeScanner:
+    """
+    Scan a directory tree with os.scandir, skipping excluded paths
+
+    Entries are processed in sorted order, so the digest of an unchanged tree is stable.
+    Symbolic links are not followed.
+    """
+    def __init__(self, path: Path, matcher: ExcludeMatcher) -> None:
+        self.path = Path(path)
+        self.matcher = matcher
+
+    def walk(self, path: str = '') -> Iterator[TreeEntry]:
+        """
+        Iterate entries of the tree, or entries below a relative path in the tree
+
+        Raises OSError if the tree can't be read
+        """
+        stack: List[Tuple[str, str]] = [
+            (os.path.join(str(self.path), path) if path else str(self.path), f'{path}/' if path else '')
+        ]
+        while stack:
+            directory, prefix = stack.pop()
+            with os.scandir(directory) as iterator:
+                entries = sorted(iterator, key=lambda entry: entry.name)
+            subdirectories = []
+            for entry in entries:
+                path = f'{prefix}{entry.name}'
+                is_directory = entry.is_dir(follow_symlinks=False)
+                if self.matcher.match(path, entry.name, is_directory):
+                    continue
+                details = entry.stat(follow_symlinks=False)
+                if is_directory:
+                    yield TreeEntry(path=path, type='d', mode=details.st_mode)
+                    subdirectories.append((entry.path, f'{path}/'))
+                elif stat.S_ISLNK(details.st_mode):
+                    yield TreeEntry(path=path, type='l', mode=details.st_mode, link=os.readlink(entry.path))
+                else:
+                    yield TreeEntry(
+                        path=path,
+                        type='f',
+                        mode=details.st_mode,
+                        size=details.st_size,
+                        mtime_ns=details.st_mtime_ns,
+                    )
+            # Stack is processed last in first out
+            stack.extend(reversed(subdirectories))
+
+    def scan(self) -> TreeScan:
+        """
+        Scan the tree and calculate the digest of tree entries
+
+        Raises OSError if the tree can't be read
+        """
+        digest = hashlib.sha256()
+        files = directories = size = 0
+        for entry in self.walk():
+            if entry.type == 'd':
+                directories += 1
+                line = f'd\0{entry.path}\0{entry.mode:o}\n'
+            elif entry.type == 'l':
+                files += 1
+                line = f'l\0{entry.path}\0{entry.link}\n'
+            else:
+                files += 1
+                size += entry.size
+                line = f'f\0{entry.path}\0{entry.mode:o}\0{entry.size}\0{entry.mtime_ns}\n'
+            digest.update(line.encode('utf-8', 'surrogateescape'))
+        return TreeScan(digest=digest.hexdigest(), files=files, directories=directories, size=size)
+
+
+def get_push_settings(target: 'Target') -> str:
+    """
+    Return resolved push settings of the target as JSON string
+    """
+    plan = target.plan
+    flags = list(plan.flags) if plan.flags is not None else None
+    return json.dumps([str(target.source), target.destination, flags, list(plan.excluded)])
+
+
+def get_target_digest(target: 'Target') -> Optional[str]:
+    """
+    Return digest of the target source tree and resolved push settings
+
+    Returns None if the target tree can't be checked for changes by scanning it
+    """
+    plan = target.plan
+    if plan.flags is None or has_unsupported_flags(plan.flags):
+        return None
+    matcher = ExcludeMatcher(plan.excluded)
+    if not matcher.exact:
+        return None
+    try:
+        scan = TreeScanner(target.source, matcher).scan()
+    except OSError:
+        return None
+    settings = get_push_settings(target)
+    return hashlib.sha256(f'{settings}\n{scan.digest}'.encode('utf-8', 'surrogateescape')).hexdigest()
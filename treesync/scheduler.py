@@ -0,0 +1,627 @@
+#
+# Copyright (C) 2020-2023 by Ilkka Tuohela <hile@iki.fi>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+"""
+Scheduler to run sync target push and pull commands in parallel
+"""
+import heapq
+import sys
+import time
+
+from collections import Counter, OrderedDict, deque
+from pathlib import Path
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from tempfile import NamedTemporaryFile, TemporaryFile
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, TYPE_CHECKING
+
+from .capabilities import uses_compression
+from .exceptions import StateStoreError, SyncError
+from .journal import PushJournal, PushPlan
+from .output import TargetOutput
+from .scanner import get_target_digest
+from .seed import SeedResult, get_tar_seeder
+from .state import SyncRecord, SyncStateStore, TransferSample
+from .stats import SyncResult
+
+if TYPE_CHECKING:  # pragma: no cover
+    from .target import Target
+
+#: Valid sync job actions
+SYNC_ACTIONS = (
+    'pull',
+    'push',
+)
+
+
+class SyncJob:
+    """
+    A single pull or push command for a sync target
+
+    With log_output the command output is written to the target log file instead of the
+    terminal, and the last lines of output are available in the output attribute. With
+    stats rsync transfer statistics are parsed to the result of the job. If a state
+    store is given, results of the sync command are recorded to the store, except for dry
+    runs. With skip_unchanged the source tree of a push job is scanned
+    before the push and rsync is not run if the tree has not changed since the last
+    successful push. With a journal a push job only pushes the paths changed since the last
+    push, or is skipped if there are no changes. Jobs pushed in a batch with other targets
+    refer to the batch job running the command. Jobs with rsync_args run the specified rsync
+    arguments instead of the command of the target, with the role of the job in a fan-out
+    push in fan_out and the identifier of the fan-out push in fan_out_run. With seed an
+    empty destination of a push job is seeded with a tar stream of the source tree before
+    the rsync push, with the result of seeding in seeded.
+    """
+    def __init__(self,
+                 target: 'Target',
+                 action: str,
+                 dry_run: bool = False,
+                 state: Optional[SyncStateStore] = None,
+                 skip_unchanged: bool = False,
+                 stats: bool = False,
+                 log_output: bool = False,
+                 journal: Optional[PushJournal] = None,
+                 seed: bool = False) -> None:
+        if action not in SYNC_ACTIONS:
+            raise ValueError(f'Invalid sync action: {action}')
+        self.target = target
+        self.action = action
+        self.dry_run = dry_run
+        self.state = state
+        self.skip_unchanged = skip_unchanged and action == 'push'
+        self.stats = stats
+        self.log_output = log_output
+        self.journal = journal if action == 'push' else None
+        self.seed = seed and action == 'push' and not dry_run
+        self.seeded: Optional[SeedResult] = None
+        self.push_plan: Optional[PushPlan] = None
+        self.batch: Optional['SyncJob'] = None
+        self.rsync_args: Optional[List[str]] = None
+        self.fan_out: Optional[str] = None
+        self.fan_out_run: Optional[str] = None
+        self.log_file: Optional[Path] = None
+        self.expected_duration: Optional[float] = None
+        self.expected_duration_lower_bound = False
+        self.skipped = False
+        self.result: Optional[SyncResult] = None
+        self.output = ''
+        self.error: Optional[SyncError] = None
+        self.state_error: Optional[StateStoreError] = None
+        self.timestamp: Optional[float] = None
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+
+    def __repr__(self) -> str:
+        if self.action == 'pull':
+            return f'pull {self.target.destination} -> {self.target.source}'
+        return f'push {self.target.source} -> {self.target.destination}'
+
+    @property
+    def host(self) -> Optional[str]:
+        """
+        Return destination server of the job target
+
+        Returns None for local and rsync daemon destinations
+        """
+        return self.target.remote_host
+
+    @property
+    def max_parallel(self) -> Optional[int]:
+        """
+        Return limit for parallel jobs configured for the job target
+        """
+        return self.target.max_parallel
+
+    @property
+    def members(self) -> List['SyncJob']:
+        """
+        Return jobs of the targets synced by this job
+        """
+        return [self]
+
+    @property
+    def streams(self) -> int:
+        """
+        Return number of rsync commands the job may run at the same time
+
+        Push jobs of targets pushed in shards run up to the shard workers of the target
+        """
+        if self.action != 'push' or self.journal is not None or self.rsync_args is not None:
+            return 1
+        return self.target.shard_workers or 1
+
+    def get_next_jobs(self) -> List['SyncJob']:
+        """
+        Return jobs to run after this job has finished
+        """
+        return []
+
+    @property
+    def duration(self) -> Optional[float]:
+        """
+        Return duration of the job in seconds, or None if job has not finished
+        """
+        if self.started is None or self.finished is None:
+            return None
+        return self.finished - self.started
+
+    @property
+    def failed(self) -> bool:
+        """
+        Check if the job failed
+        """
+        return self.error is not None
+
+    @property
+    def exit_code(self) -> int:
+        """
+        Return exit code of the sync command
+        """
+        if self.error is None:
+            return 0
+        return getattr(self.error.__cause__, 'returncode', 1)
+
+    @property
+    def status(self) -> str:
+        """
+        Return status of the finished job as succeeded, failed or skipped
+        """
+        if self.skipped:
+            return 'skipped'
+        return 'failed' if self.failed else 'succeeded'
+
+    @property
+    def bytes_transferred(self) -> Optional[int]:
+        """
+        Return number of bytes transferred by the job, or None if not known
+        """
+        if self.result is None or self.result.stats is None:
+            return None
+        return self.result.stats.bytes_transferred
+
+    @property
+    def throughput(self) -> Dict[str, float]:
+        """
+        Return bytes transferred per second by seeding with tar, by rsync and by each rsync
+        pass of targets pushed with several passes
+        """
+        throughput = {}
+        duration = self.duration
+        if self.seeded is not None and self.seeded.throughput is not None:
+            throughput['tar'] = self.seeded.throughput
+            if duration is not None:
+                duration -= self.seeded.duration
+        if self.result is not None and self.result.duration is not None:
+            duration = self.result.duration
+        bytes_transferred = self.bytes_transferred
+        if bytes_transferred is not None and duration:
+            throughput['rsync'] = bytes_transferred / duration
+        for sync_pass in self.result.passes if self.result is not None else []:
+            if sync_pass.throughput is not None:
+                throughput[f'rsync {sync_pass.name}'] = sync_pass.throughput
+        return throughput
+
+    @property
+    def summary(self) -> str:
+        """
+        Return one line summary of the finished job
+        """
+        if self.skipped:
+            return f'{self}: unchanged, skipped'
+        if self.failed:
+            status = f'failed with exit code {self.exit_code}'
+        else:
+            status = 'ok'
+        summary = f'{self}: {status} in {self.duration:.2f}s'
+        if self.push_plan is not None:
+            summary += f' ({self.push_plan})'
+        if self.batch is not None:
+            summary += f' (batch of {len(self.batch.members)} targets)'
+            if self.stats:
+                summary += ', statistics not available for targets in a batch'
+        if self.fan_out is not None:
+            summary += f' (fan-out {self.fan_out})'
+        if self.result is not None and self.result.passes:
+            summary += f' ({len(self.result.passes)} passes)'
+        if self.seeded is not None:
+            summary += f' (seeded {self.seeded.files} files, {self.seeded.bytes} bytes in {self.seeded.duration:.2f}s)'
+        stats = self.result.stats if self.result is not None else None
+        if stats is not None and stats.bytes_transferred is not None:
+            summary += f', {stats.files_transferred} files, {stats.bytes_transferred} bytes transferred'
+        return summary
+
+    def run(self, capture_output: bool = False) -> 'SyncJob':
+        """
+        Run the sync job
+
+        With capture_output the rsync output is collected to the output attribute instead
+        of passing it to the terminal, allowing jobs to run in parallel without mixing the
+        output of different targets.
+        """
+        self.timestamp = time.time()
+        self.started = time.monotonic()
+        digest = None
+        try:
+            digest = self.__check_tree_digest__()
+            if not self.skipped:
+                self.__plan_push__()
+            if self.skipped:
+                return self
+            if self.log_output:
+                with TargetOutput(str(self.target)) as output:
+                    self.log_file = output.log.path
+                    try:
+                        self.__run_action__(output)
+                    finally:
+                        self.output = output.tail
+            elif capture_output:
+                with TemporaryFile(mode='w+', prefix='treesync-output-') as output:
+                    try:
+                        self.__run_action__(output)
+                    finally:
+                        output.seek(0)
+                        self.output = output.read()
+            else:
+                self.__run_action__()
+        except SyncError as error:
+            self.error = error
+        except OSError as error:
+            self.error = SyncError(f'Error running {self}: {error}')
+        finally:
+            self.finished = time.monotonic()
+            if self.skipped and self.push_plan is not None and not self.dry_run:
+                self.__commit_push_plan__()
+        if not self.dry_run:
+            self.__record_state__(digest)
+        return self
+
+    def __plan_push__(self) -> None:
+        """
+        Plan incremental push from the journal of changed paths
+
+        The job is skipped if no paths have changed. If the journal can't be read, the target
+        is pushed in full.
+        """
+        if self.journal is None:
+            return
+        try:
+            self.push_plan = self.journal.plan()
+        except StateStoreError as error:
+            self.state_error = error
+            return
+        self.skipped = not self.push_plan.full and not self.push_plan.paths
+
+    def __commit_push_plan__(self) -> None:
+        """
+        Update the journal of changed paths after a successful push
+        """
+        try:
+            self.journal.commit(self.push_plan)
+        except StateStoreError as error:
+            self.state_error = error
+
+    def __check_tree_digest__(self) -> Optional[str]:
+        """
+        Calculate digest of the source tree and check if the tree was modified since last push
+
+        Returns the calculated digest, or None if the tree can't be checked
+        """
+        if not self.skip_unchanged or self.state is None:
+            return None
+        digest = get_target_digest(self.target)
+        if digest is not None:
+            try:
+                self.skipped = digest == self.state.get_digest(str(self.target))
+            except StateStoreError as error:
+                self.state_error = error
+        return digest
+
+    def __record_state__(self, digest: Optional[str]) -> None:
+        """
+        Record result of the sync command and tree digest after a successful push
+        """
+        if self.state is None:
+            return
+        stats = self.result.stats if self.result is not None else None
+        try:
+            self.state.record(SyncRecord(
+                target=str(self.target),
+                action=self.action,
+                started=self.timestamp,
+                finished=self.timestamp + self.duration,
+                duration=self.duration,
+                exit_code=self.exit_code,
+                bytes=stats.bytes_transferred if stats is not None else None,
+                files=stats.files_transferred if stats is not None else None,
+            ))
+            if digest is not None and not self.failed:
+                self.state.set_digest(str(self.target), digest)
+            if self.action == 'push' and not self.skipped:
+                self.state.set_fan_out_run(str(self.target), None if self.failed else self.fan_out_run)
+            sample = self.__get_transfer_sample__()
+            if sample is not None:
+                self.state.record_transfer(sample)
+        except StateStoreError as error:
+            self.state_error = error
+        if self.push_plan is not None and not self.failed:
+            self.__commit_push_plan__()
+
+    def __get_transfer_sample__(self) -> Optional[TransferSample]:
+        """
+        Return transfer statistics of a successful sync command to a remote host, or None if
+        the command did not report the statistics
+
+        The duration of the sample is the time spent running rsync commands. Fan-out pushes
+        and pushes without measured rsync time, such as sharded pushes running several
+        commands at once, are not sampled.
+        """
+        host = self.target.remote_host
+        stats = self.result.stats if self.result is not None else None
+        if host is None or stats is None or self.failed or self.fan_out_run is not None:
+            return None
+        if self.result.duration is None:
+            return None
+        if stats.literal_data is None or stats.bytes_sent is None or stats.bytes_received is None:
+            return None
+        return TransferSample(
+            host=host,
+            finished=self.timestamp + self.duration,
+            duration=self.result.duration,
+            compressed=uses_compression(self.result.args),
+            literal_data=stats.literal_data,
+            bytes_sent=stats.bytes_sent,
+            bytes_received=stats.bytes_received,
+        )
+
+    def __seed_destination__(self, output=None) -> None:
+        """
+        Seed an empty destination with a tar stream of the source tree
+
+        Errors seeding the destination are written to the output and the target is pushed
+        with rsync normally
+        """
+        seeder = get_tar_seeder(self.target)
+        if seeder is None:
+            return
+        try:
+            if seeder.is_destination_empty():
+                self.seeded = seeder.seed(output)
+        except SyncError as error:
+            print(f'{error}, pushing with rsync', file=output if output is not None else sys.stdout)
+
+    def __run_action__(self, output=None) -> None:
+        """
+        Run the push or pull method of the target
+
+        Incremental pushes pass the changed paths to rsync in a temporary --files-from file
+        """
+        if self.rsync_args is not None:
+            self.result = self.target.run_sync(self.action, self.rsync_args, output=output, stats=self.stats)
+            return
+        if self.seed and (self.push_plan is None or self.push_plan.full):
+            self.__seed_destination__(output)
+        if self.push_plan is None or self.push_plan.full:
+            callback = getattr(self.target, self.action)
+            self.result = callback(dry_run=self.dry_run, output=output, stats=self.stats)
+            return
+        with NamedTemporaryFile(prefix='treesync-files-from-') as files_from:
+            self.journal.write_files_from(self.push_plan, files_from)
+            self.result = self.target.push(
+                dry_run=self.dry_run,
+                output=output,
+                stats=self.stats,
+                files_from=Path(files_from.name),
+            )
+
+
+class SyncScheduler:
+    """
+    Run sync jobs with a bounded pool of worker threads
+
+    With a single job the sync commands are run in the calling thread and rsync output is
+    passed directly to the terminal. With multiple jobs the output of each command is
+    captured and available in the finished callback after the command has completed.
+
+    Parallel jobs are started round-robin between the destination servers, honoring the
+    max_parallel limit of each server. The max_parallel argument is a global cap for the
+    number of jobs. Jobs running several rsync commands at the same time count as one job
+    per command for the host limits and the number of jobs, and jobs with more commands
+    than the number of jobs only run alone. Jobs with an expected duration are started
+    longest expected first.
+
+    The started and finished callbacks are always called from the thread calling run().
+    For batch jobs the finished callback is called for each target of the batch. Jobs
+    returned by get_next_jobs() of a finished job are queued and run as other jobs.
+    """
+    def __init__(self,
+                 jobs: int = 1,
+                 max_parallel: Optional[int] = None,
+                 started: Optional[Callable[[SyncJob], None]] = None,
+                 finished: Optional[Callable[[SyncJob], None]] = None) -> None:
+        if jobs < 1:
+            raise ValueError(f'Invalid number of parallel jobs: {jobs}')
+        if max_parallel is not None:
+            jobs = min(jobs, max_parallel)
+        self.jobs = jobs
+        self.started = started
+        self.finished = finished
+
+    @property
+    def capture_output(self) -> bool:
+        """
+        Check if output of the sync commands is captured
+        """
+        return self.jobs > 1
+
+    def __job_started__(self, job: SyncJob) -> None:
+        if self.started is not None:
+            self.started(job)
+
+    def __job_finished__(self, job: SyncJob) -> None:
+        if self.finished is not None:
+            self.finished(job)
+
+    def run(self, jobs: Iterable[SyncJob]) -> List[SyncJob]:
+        """
+        Run specified sync jobs, returning the jobs in the order they finished
+        """
+        pending = deque(jobs)
+        completed = []
+        if not self.capture_output:
+            while pending:
+                job = pending.popleft()
+                self.__job_started__(job)
+                job.run()
+                for member in job.members:
+                    completed.append(member)
+                    self.__job_finished__(member)
+                pending.extendleft(reversed(job.get_next_jobs()))
+            return completed
+
+        queues: Dict[Optional[str], deque] = OrderedDict()
+        limits = get_server_limits(pending)
+        for job in order_by_expected_duration(pending):
+            queues.setdefault(job.host, deque()).append(job)
+        running_hosts: Counter = Counter()
+        running: Dict[Future, SyncJob] = {}
+        with ThreadPoolExecutor(max_workers=self.jobs, thread_name_prefix='treesync') as executor:
+            while queues or running:
+                while True:
+                    free = self.jobs - sum(self.__get_slots__(job) for job in running.values())
+                    job = self.__next_job__(queues, limits, running_hosts, free, self.jobs)
+                    if job is None:
+                        break
+                    running_hosts[job.host] += job.streams
+                    self.__job_started__(job)
+                    running[executor.submit(job.run, capture_output=True)] = job
+                done, _not_done = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job = running.pop(future)
+                    running_hosts[job.host] -= job.streams
+                    future.result()
+                    for member in job.members:
+                        completed.append(member)
+                        self.__job_finished__(member)
+                    next_jobs = job.get_next_jobs()
+                    limits = get_server_limits(next_jobs, limits)
+                    for next_job in next_jobs:
+                        queue = queues.setdefault(next_job.host, deque())
+                        queue.append(next_job)
+                        queues[next_job.host] = deque(order_by_expected_duration(queue))
+        return completed
+
+    def __get_slots__(self, job: SyncJob) -> int:
+        """
+        Return number of jobs a job counts as, at most the number of jobs
+        """
+        return min(job.streams, self.jobs)
+
+    @staticmethod
+    def __next_job__(queues: Dict[Optional[str], deque],
+                     limits: Dict[Optional[str], Optional[int]],
+                     running_hosts: Counter,
+                     free: int,
+                     capacity: int) -> Optional[SyncJob]:
+        """
+        Pick next job to start from the per server job queues
+
+        The job with longest expected duration is picked from jobs fitting to the free job
+        slots and the limit of their server. Jobs which alone exceed the limit of their server
+        are only started when no other jobs run on the server. Servers are rotated on each call
+        so that with equal expected durations servers with many targets do not starve other
+        servers. Returns None if no pending job can be started.
+        """
+        selected = None
+        for host, queue in queues.items():
+            streams = queue[0].streams
+            if min(streams, capacity) > free:
+                continue
+            limit = limits.get(host)
+            if limit is not None and running_hosts[host] and running_hosts[host] + streams > limit:
+                continue
+            if selected is None or get_duration_order(queue[0]) > get_duration_order(queues[selected[0]][0]):
+                selected = (host, queue)
+        if selected is None:
+            return None
+        host, queue = selected
+        job = queue.popleft()
+        if queue:
+            queues.move_to_end(host)
+        else:
+            del queues[host]
+        return job
+
+
+def get_server_limits(jobs: Iterable[SyncJob],
+                      limits: Optional[Dict[Optional[str], Optional[int]]] = None,
+                      ) -> Dict[Optional[str], Optional[int]]:
+    """
+    Return limits for parallel jobs to the destination servers of the jobs
+
+    Targets synced to the same server may be configured in different hosts and targets
+    entries, and the lowest limit of the targets applies to all jobs to the server. Jobs
+    without a destination server share the limit stored for None. Limits from the optional
+    limits argument are included in the returned limits.
+    """
+    limits = dict(limits) if limits is not None else {}
+    for job in jobs:
+        limit = job.max_parallel
+        if limits.get(job.host) is None:
+            limits[job.host] = limit
+        elif limit is not None:
+            limits[job.host] = min(limits[job.host], limit)
+    return limits
+
+
+def get_duration_order(job: SyncJob) -> Tuple[bool, float]:
+    """
+    Return key for ordering jobs by expected duration, with unknown durations as zero
+
+    Jobs with expected durations which are lower bounds have greater keys than all other jobs
+    """
+    return (
+        job.expected_duration_lower_bound,
+        job.expected_duration if job.expected_duration is not None else 0,
+    )
+
+
+def order_by_expected_duration(jobs: Iterable[SyncJob]) -> List[SyncJob]:
+    """
+    Return jobs ordered by expected duration, longest first
+
+    Jobs with expected durations which are only lower bounds, estimated from truncated scans
+    of large source trees, are ordered first. Jobs with equal or unknown expected durations
+    are kept in the original order.
+    """
+    return sorted(jobs, key=get_duration_order, reverse=True)
+
+
+def estimate_run_time(jobs: Iterable[SyncJob], workers: int, duration: Callable[[SyncJob], float]) -> float:
+    """
+    Estimate total run time of running jobs in specified order with a number of workers
+
+    The simulation starts the first pending job allowed by the server limits whenever a
+    worker is free, with job durations returned by the duration callback
+    """
+    pending = list(jobs)
+    limits = get_server_limits(pending)
+    running: List[Tuple[float, int, Optional[str]]] = []
+    running_hosts: Counter = Counter()
+    now = 0.0
+    while pending or running:
+        started = None
+        if len(running) < workers:
+            for job in pending:
+                limit = limits.get(job.host)
+                if limit is None or running_hosts[job.host] < limit:
+                    started = job
+                    break
+        if started is not None:
+            pending.remove(started)
+            running_hosts[started.host] += 1
+            heapq.heappush(running, (now + duration(started), len(pending), started.host))
+            continue
+        now, _index, host = heapq.heappop(running)
+        running_hosts[host] -= 1
+    return now
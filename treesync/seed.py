@@ -0,0 +1,206 @@
+#
+# Copyright (C) 2020-2023 by Ilkka Tuohela <hile@iki.fi>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+"""
+Seeding empty push destinations with a tar stream
+
+The first push of a tree with many small files to an empty destination is slow with the
+per-file rsync protocol. Seeding streams the source tree, filtered by the target excludes,
+as a tar archive over the remote shell of the target and unpacks it in the destination.
+A normal rsync push is run after seeding to verify the destination and to set anything
+tar did not copy.
+"""
+import shlex
+import tarfile
+import time
+
+from dataclasses import dataclass, fields
+from pathlib import Path
+from subprocess import DEVNULL, PIPE, Popen, TimeoutExpired, run
+from tempfile import TemporaryFile
+from typing import Any, Dict, IO, List, Optional, TYPE_CHECKING
+
+from .exceptions import StateStoreError, SyncError
+from .native import is_local_destination
+from .scanner import ExcludeMatcher, TreeScanner
+from .ssh import get_remote_shell
+
+if TYPE_CHECKING:  # pragma: no cover
+    from .state import SyncStateStore
+    from .target import Target
+
+#: Command to unpack the tar stream in the destination
+TAR_EXTRACT_COMMAND = 'tar'
+#: Seconds to wait for the probe checking if a remote destination is empty
+SEED_PROBE_TIMEOUT = 30
+
+
+@dataclass
+class SeedResult:
+    """
+    Result of seeding a destination with a tar stream
+    """
+    files: int = 0
+    bytes: int = 0
+    duration: float = 0.0
+
+    @property
+    def throughput(self) -> Optional[float]:
+        """
+        Return bytes of file data streamed per second
+        """
+        if not self.duration:
+            return None
+        return self.bytes / self.duration
+
+    def as_dict(self) -> Dict[str, Any]:
+        """
+        Return result as a dictionary
+        """
+        data = {field.name: getattr(self, field.name) for field in fields(self)}
+        data['throughput'] = self.throughput
+        return data
+
+
+def has_successful_push(target: 'Target', state: Optional['SyncStateStore']) -> bool:
+    """
+    Check if the state store has a recorded successful push of the target
+    """
+    if state is None:
+        return False
+    try:
+        return any(record.succeeded for record in state.get_history(str(target), 'push'))
+    except StateStoreError:
+        return False
+
+
+class TarSeeder:
+    """
+    Seed the destination of a target with a tar stream of the source tree
+
+    Paths excluded from the target are not included in the stream. Only targets with a
+    local or remote shell destination and excludes understood by ExcludeMatcher can be
+    seeded.
+    """
+    def __init__(self, target: 'Target', matcher: ExcludeMatcher) -> None:
+        self.target = target
+        self.matcher = matcher
+        self.host = target.remote_host
+        destination = str(target.destination)
+        self.path = (destination.split(':', 1)[1] or '.') if self.host is not None else destination
+
+    def __repr__(self) -> str:
+        return f'seed {self.target.source} -> {self.target.destination}'
+
+    def get_remote_command(self, command: str) -> List[str]:
+        """
+        Return arguments running a shell command on the destination host
+        """
+        if self.host is None:
+            return ['sh', '-c', command]
+        return get_remote_shell(self.target.flags) + [self.host, command]
+
+    def get_probe_command(self) -> List[str]:
+        """
+        Return arguments of a command exiting with code 0 if the destination is empty
+        """
+        path = shlex.quote(self.path)
+        return self.get_remote_command(f'test ! -e {path} || test -z "$(ls -A {path})"')
+
+    def get_extract_command(self) -> List[str]:
+        """
+        Return arguments of a command unpacking a tar stream from stdin to the destination
+        """
+        path = shlex.quote(self.path)
+        return self.get_remote_command(f'mkdir -p {path} && {TAR_EXTRACT_COMMAND} -x -p -f - -C {path}')
+
+    def is_destination_empty(self) -> bool:
+        """
+        Check if the destination does not exist or is an empty directory
+
+        Raises SyncError if the probe command can't be run
+        """
+        try:
+            process = run(
+                self.get_probe_command(),
+                stdin=DEVNULL,
+                stdout=DEVNULL,
+                stderr=DEVNULL,
+                timeout=SEED_PROBE_TIMEOUT,
+                check=False,
+            )
+        except (OSError, ValueError) as error:
+            raise SyncError(f'{self} error checking destination: {error}') from error
+        except TimeoutExpired as error:
+            raise SyncError(f'{self} timeout checking destination') from error
+        return process.returncode == 0
+
+    def seed(self, output: Optional[IO] = None) -> SeedResult:
+        """
+        Stream the source tree to the destination as a tar archive
+
+        Error messages of the unpacking command are written to output. Raises SyncError if
+        the tree can't be read or unpacking the stream fails.
+        """
+        result = SeedResult()
+        start = time.monotonic()
+        with TemporaryFile(mode='w+', prefix='treesync-seed-') as errors:
+            try:
+                process = Popen(self.get_extract_command(), stdin=PIPE, stdout=DEVNULL, stderr=errors)
+            except OSError as error:
+                raise SyncError(f'{self} error running tar: {error}') from error
+            try:
+                with tarfile.open(fileobj=process.stdin, mode='w|', format=tarfile.PAX_FORMAT) as archive:
+                    source = Path(self.target.source)
+                    for entry in TreeScanner(source, self.matcher).walk():
+                        archive.add(source.joinpath(entry.path), arcname=entry.path, recursive=False)
+                        if entry.type == 'f':
+                            result.files += 1
+                            result.bytes += entry.size
+            except (OSError, tarfile.TarError) as error:
+                process.kill()
+                process.wait()
+                raise SyncError(f'{self} error streaming source tree: {error}') from error
+            finally:
+                if not process.stdin.closed:
+                    process.stdin.close()
+            returncode = process.wait()
+            result.duration = time.monotonic() - start
+            if returncode != 0:
+                errors.seek(0)
+                if output is not None:
+                    output.write(errors.read())
+                raise SyncError(f'{self} unpacking tar stream failed with exit code {returncode}')
+        return result
+
+
+def get_tar_seeder(target: 'Target') -> Optional[TarSeeder]:
+    """
+    Return tar seeder for the target, or None if the target can't be seeded
+
+    Targets with rsync daemon destinations, excludes with include or other filter rules and
+    local targets synced with the native engine are not seeded.
+    """
+    destination = str(target.destination)
+    if target.remote_host is None and not is_local_destination(destination):
+        return None
+    if target.remote_host is None and target.engine == 'native':
+        return None
+    plan = target.plan
+    if plan.flags is None:
+        return None
+    matcher = ExcludeMatcher(plan.excluded)
+    if not matcher.exact:
+        return None
+    return TarSeeder(target, matcher)
+
+
+def is_seed_candidate(target: 'Target', state: Optional['SyncStateStore']) -> bool:
+    """
+    Check if the target may have an empty destination to be seeded
+
+    Targets with a recorded successful push are not seeded
+    """
+    return get_tar_seeder(target) is not None and not has_successful_push(target, state)
@@ -0,0 +1,244 @@
+#
+# Copyright (C) 2020-2023 by Ilkka Tuohela <hile@iki.fi>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+"""
+Pushing large sync targets as concurrent rsync commands for shards of the source tree
+
+The top-level directories of the source tree are split to shards, either one shard per
+directory or a number of buckets balanced by size or file count of the directories. Each
+shard is pushed with its own rsync command, limited to the directories of the shard with
+filter rules, so deletions within the directories are handled by the shard. A final
+non-recursive pass pushes top-level files and deletes top-level entries removed from the
+source.
+"""
+import os
+import sys
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from tempfile import NamedTemporaryFile, TemporaryFile
+from typing import IO, Iterable, List, Optional, TYPE_CHECKING
+
+from .exceptions import SyncError
+from .output import TargetOutput
+from .scanner import ExcludeMatcher, TreeScanner, has_unsupported_flags
+from .stats import SyncResult, SyncStats, merge_stats
+
+if TYPE_CHECKING:  # pragma: no cover
+    from .target import Target
+
+#: Modes for splitting source trees to shards
+SHARD_MODES = (
+    'directory',
+    'size',
+    'files',
+)
+#: rsync flags incompatible with limiting shards with filter rules
+UNSHARDABLE_FLAGS = (
+    '--delete-excluded',
+)
+#: Characters with special meaning in rsync filter patterns
+FILTER_WILDCARDS = '*?['
+
+
+def escape_filter_pattern(path: str) -> str:
+    """
+    Escape wildcards in a path for rsync filter rules
+
+    Backslashes are escape characters only in patterns containing wildcards
+    """
+    if not any(character in path for character in FILTER_WILDCARDS):
+        return path
+    return ''.join(f'\\{character}' if character in f'{FILTER_WILDCARDS}\\' else character for character in path)
+
+
+@dataclass
+class Shard:
+    """
+    Top-level directories of a source tree pushed with one rsync command
+    """
+    names: List[str] = field(default_factory=list)
+    size: int = 0
+    files: int = 0
+
+    def __repr__(self) -> str:
+        return ' '.join(self.names)
+
+    def get_filter_rules(self) -> List[str]:
+        """
+        Return rsync include rules for the directories of the shard
+        """
+        return [f'/{escape_filter_pattern(name)}' for name in self.names]
+
+
+def balance_shards(shards: Iterable[Shard], count: int, mode: str) -> List[Shard]:
+    """
+    Combine shards to count buckets balanced by size or file count
+
+    Largest shards are added first to the smallest bucket
+    """
+    buckets = [Shard() for _index in range(count)]
+    for shard in sorted(shards, key=lambda shard: getattr(shard, mode), reverse=True):
+        bucket = min(buckets, key=lambda bucket: getattr(bucket, mode))
+        bucket.names.extend(shard.names)
+        bucket.size += shard.size
+        bucket.files += shard.files
+    return [bucket for bucket in buckets if bucket.names]
+
+
+def plan_shards(target: 'Target', count: int, mode: str = 'directory') -> Optional[List[Shard]]:
+    """
+    Split top-level directories of the target source tree to shards
+
+    Returns None if the target can't be pushed in shards
+    """
+    if mode not in SHARD_MODES:
+        raise ValueError(f'Invalid shard mode: {mode}')
+    flags = target.plan.flags
+    if flags is None or has_unsupported_flags(flags) or any(flag in UNSHARDABLE_FLAGS for flag in flags):
+        return None
+    matcher = ExcludeMatcher(target.excluded)
+    if not matcher.exact:
+        return None
+    scanner = TreeScanner(target.source, matcher)
+
+    shards = []
+    try:
+        with os.scandir(target.source) as iterator:
+            entries = sorted(iterator, key=lambda entry: entry.name)
+        for entry in entries:
+            if not entry.is_dir(follow_symlinks=False) or matcher.match(entry.name, entry.name, True):
+                continue
+            # Directory names with newlines can't be written to rsync filter files
+            if '\n' in entry.name:
+                return None
+            shard = Shard(names=[entry.name])
+            if mode != 'directory':
+                for tree_entry in scanner.walk(entry.name):
+                    if tree_entry.type != 'd':
+                        shard.files += 1
+                        shard.size += tree_entry.size or 0
+            shards.append(shard)
+    except OSError:
+        return None
+    if len(shards) < 2:
+        return None
+    if mode == 'directory':
+        return shards
+    return balance_shards(shards, count, mode)
+
+
+class ShardedPush:
+    """
+    Push a target as concurrent rsync commands for shards of the source tree, followed by a
+    final pass for top-level files and deletions
+
+    At most workers shard commands are run at the same time. The output of each command is
+    written to the output when the command finishes.
+    """
+    def __init__(self, target: 'Target', shards: List[Shard], workers: int) -> None:
+        self.target = target
+        self.shards = shards
+        self.workers = workers
+        self.__outputs__: List[str] = []
+
+    def __repr__(self) -> str:
+        return f'{self.target} in {len(self.shards)} shards'
+
+    @property
+    def paths(self) -> List[str]:
+        """
+        Return source and destination arguments for rsync
+        """
+        return [
+            f"""{str(self.target.source).rstrip('/')}/""",
+            f"""{self.target.destination.rstrip('/')}/""",
+        ]
+
+    def get_shard_args(self, filter_file: Path, dry_run: bool = False, stats: bool = False) -> List[str]:
+        """
+        Return rsync command arguments for a shard with include rules in filter_file
+        """
+        args = self.target.get_rsync_cmd_args(dry_run=dry_run, stats=stats)
+        args.extend([f'--include-from={filter_file}', '--exclude=/*'])
+        return args + self.paths
+
+    def get_final_args(self, dry_run: bool = False, stats: bool = False) -> List[str]:
+        """
+        Return rsync command arguments for the final non-recursive pass
+        """
+        args = self.target.get_rsync_cmd_args(dry_run=dry_run, stats=stats)
+        args.extend(['--no-recursive', '--dirs'])
+        return args + self.paths
+
+    def __run_command__(self, args: List[str], stats: bool) -> Optional[SyncStats]:
+        """
+        Run rsync command, collecting the output through a temporary file
+        """
+        with TemporaryFile(mode='w+', prefix='treesync-shard-') as handle:
+            try:
+                return self.target.run_sync_command_streamed(*args, output=handle, stats=stats)
+            finally:
+                handle.seek(0)
+                self.__outputs__.append(handle.read())
+
+    def __run_shard__(self, shard: Shard, dry_run: bool, stats: bool) -> Optional[SyncStats]:
+        """
+        Run rsync command for a shard
+        """
+        with NamedTemporaryFile(mode='w', encoding='utf-8', prefix='treesync-shard-filter-') as filter_file:
+            filter_file.write(''.join(f'{rule}\n' for rule in shard.get_filter_rules()))
+            filter_file.flush()
+            return self.__run_command__(self.get_shard_args(Path(filter_file.name), dry_run, stats), stats)
+
+    @staticmethod
+    def __write_output__(output: Optional[IO], text: str) -> None:
+        """
+        Write output of a finished command
+        """
+        if not text:
+            return
+        if output is None:
+            output = sys.stdout
+        output.write(text)
+        if not isinstance(output, TargetOutput):
+            output.flush()
+
+    def run(self, dry_run: bool = False, output: Optional[IO] = None, stats: bool = False) -> SyncResult:
+        """
+        Push the shards and run the final pass
+
+        The final pass is not run if any shard fails. The result contains the arguments of
+        the final pass and statistics summed from all commands.
+        """
+        self.__outputs__ = []
+        results: List[Optional[SyncStats]] = []
+        errors: List[SyncError] = []
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='treesync-shard') as executor:
+            futures = [executor.submit(self.__run_shard__, shard, dry_run, stats) for shard in self.shards]
+            for future in futures:
+                try:
+                    results.append(future.result())
+                except SyncError as error:
+                    errors.append(error)
+        for text in self.__outputs__:
+            self.__write_output__(output, text)
+        if errors:
+            raise errors[0]
+
+        self.__outputs__ = []
+        args = self.get_final_args(dry_run, stats)
+        try:
+            results.append(self.__run_command__(args, stats))
+        finally:
+            for text in self.__outputs__:
+                self.__write_output__(output, text)
+        return SyncResult(
+            target=str(self.target),
+            action='push',
+            args=args,
+            stats=merge_stats(results) if stats else None,
+        )
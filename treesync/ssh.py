@@ -0,0 +1,179 @@
+#
+# Copyright (C) 2020-2023 by Ilkka Tuohela <hile@iki.fi>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+"""
+Shared SSH connections for rsync commands to remote hosts
+"""
+import hashlib
+import os
+import shlex
+import shutil
+import time
+
+from pathlib import Path
+from subprocess import run, CalledProcessError, DEVNULL
+from tempfile import mkdtemp
+from typing import Dict, List, Optional, TYPE_CHECKING
+
+from .exceptions import SyncError
+
+if TYPE_CHECKING:  # pragma: no cover
+    from .host import TargetHost
+
+#: Default remote shell command, as with rsync
+DEFAULT_REMOTE_SHELL = 'ssh'
+#: Flags to rsync to set the remote shell command
+RSYNC_RSH_FLAGS = (
+    '-e',
+    '--rsh',
+)
+
+
+def has_rsh_flag(flags: List[str]) -> bool:
+    """
+    Check if rsync flags define a custom remote shell command
+    """
+    for flag in flags:
+        if flag in RSYNC_RSH_FLAGS or flag.startswith('--rsh=') or flag.startswith('-e'):
+            return True
+    return False
+
+
+def get_remote_shell(flags: List[str]) -> List[str]:
+    """
+    Return remote shell command from rsync flags, or the default remote shell
+    """
+    for index, flag in enumerate(flags):
+        if flag.startswith('--rsh='):
+            return shlex.split(flag.split('=', 1)[1])
+        if flag in RSYNC_RSH_FLAGS and index + 1 < len(flags):
+            return shlex.split(flags[index + 1])
+        if flag.startswith('-e') and flag not in RSYNC_RSH_FLAGS:
+            return shlex.split(flag[2:])
+    return shlex.split(os.environ.get('RSYNC_RSH', DEFAULT_REMOTE_SHELL))
+
+
+class SSHControlMaster:
+    """
+    SSH ControlMaster connection to a remote host
+
+    The master connection is started in background and reused by all rsync commands to
+    the host with the rsh command from the rsh property.
+    """
+    def __init__(self, host: str, control_path: Path, ssh_command: str = 'ssh') -> None:
+        self.host = host
+        self.control_path = control_path
+        self.ssh_command = ssh_command
+        self.setup_time: Optional[float] = None
+        self.connected = False
+
+    def __repr__(self) -> str:
+        return f'ssh {self.host}'
+
+    @property
+    def rsh(self) -> str:
+        """
+        Return rsync remote shell command using the master connection
+        """
+        return f'{self.ssh_command} -o ControlMaster=no -o ControlPath={self.control_path}'
+
+    def __run_ssh__(self, *args: str) -> None:
+        """
+        Run ssh command with the control path for the host
+        """
+        try:
+            run(
+                [self.ssh_command, '-o', f'ControlPath={self.control_path}', *args, self.host],
+                stdin=DEVNULL,
+                check=True
+            )
+        except (CalledProcessError, OSError) as error:
+            raise SyncError(f'{self} error running ssh: {error}') from error
+
+    def connect(self) -> None:
+        """
+        Start the master connection, recording the time used for setting up the connection
+        """
+        if self.connected:
+            return
+        start = time.monotonic()
+        self.__run_ssh__('-o', 'ControlMaster=yes', '-o', 'ControlPersist=yes', '-f', '-N')
+        self.setup_time = time.monotonic() - start
+        self.connected = True
+
+    def close(self) -> None:
+        """
+        Stop the master connection
+        """
+        if not self.connected:
+            return
+        self.connected = False
+        self.__run_ssh__('-O', 'exit')
+
+
+class SSHMultiplexer:
+    """
+    Manage SSH master connections to the target hosts for a treesync run
+
+    Control sockets are created in a private temporary directory, which is removed when
+    the multiplexer is closed. Use as context manager to close all connections.
+    """
+    def __init__(self, ssh_command: str = 'ssh') -> None:
+        self.ssh_command = ssh_command
+        self.directory: Optional[Path] = None
+        self.masters: Dict[str, SSHControlMaster] = {}
+
+    def __enter__(self) -> 'SSHMultiplexer':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    @property
+    def setup_time(self) -> float:
+        """
+        Return total time used for setting up the master connections
+        """
+        return sum(master.setup_time for master in self.masters.values() if master.setup_time is not None)
+
+    def get_control_path(self, host: str) -> Path:
+        """
+        Return control socket path for host
+
+        The socket name is hashed to keep the path short enough for unix sockets
+        """
+        if self.directory is None:
+            self.directory = Path(mkdtemp(prefix='treesync-ssh-'))
+        return self.directory.joinpath(hashlib.sha1(host.encode('utf-8')).hexdigest()[:16])
+
+    def connect(self, host: 'TargetHost') -> SSHControlMaster:
+        """
+        Open master connection to target host, linking the connection to the host
+
+        Raises SyncError if the connection could not be opened
+        """
+        master = self.masters.get(host.name)
+        if master is None:
+            master = SSHControlMaster(host.name, self.get_control_path(host.name), self.ssh_command)
+            self.masters[host.name] = master
+        master.connect()
+        host.control_master = master
+        return master
+
+    def close(self) -> None:
+        """
+        Close all master connections and remove the control socket directory
+        """
+        errors = []
+        for master in self.masters.values():
+            try:
+                master.close()
+            except SyncError as error:
+                errors.append(error)
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+        if errors:
+            raise SyncError(f'Error closing ssh connections: {errors}')
@@ -0,0 +1,686 @@
+#
+# Copyright (C) 2020-2023 by Ilkka Tuohela <hile@iki.fi>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+"""
+Persistent store for results of earlier sync commands of targets
+
+The state is stored in a SQLite database in the user data directory. The database uses
+write ahead logging and a busy timeout, so several treesync processes can read and record
+state at the same time. Each thread uses its own database connection.
+"""
+import sqlite3
+import threading
+import time
+
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Iterable, Iterator, List, Optional
+
+from .directories import user_data_directory
+from .exceptions import StateStoreError
+
+#: Filename of the state database in the user data directory
+STATE_DATABASE_NAME = 'state.sqlite'
+#: Version of the state database schema
+STATE_SCHEMA_VERSION = 7
+#: Seconds to wait for locks held by other processes
+STATE_BUSY_TIMEOUT = 30
+#: Number of sync command records stored per target and action
+STATE_HISTORY_LENGTH = 100
+
+STATE_SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS sync_runs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        target TEXT NOT NULL,
+        action TEXT NOT NULL,
+        started REAL NOT NULL,
+        finished REAL NOT NULL,
+        duration REAL NOT NULL,
+        exit_code INTEGER NOT NULL,
+        bytes INTEGER,
+        files INTEGER
+    )
+    """,
+    'CREATE INDEX IF NOT EXISTS sync_runs_target ON sync_runs (target, action, finished)',
+    """
+    CREATE TABLE IF NOT EXISTS sync_counters (
+        target TEXT NOT NULL,
+        action TEXT NOT NULL,
+        runs INTEGER NOT NULL DEFAULT 0,
+        failures INTEGER NOT NULL DEFAULT 0,
+        last_success REAL,
+        PRIMARY KEY (target, action)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS run_summaries (
+        action TEXT PRIMARY KEY,
+        started REAL NOT NULL,
+        finished REAL NOT NULL,
+        targets INTEGER NOT NULL,
+        succeeded INTEGER NOT NULL,
+        failed INTEGER NOT NULL,
+        skipped INTEGER NOT NULL,
+        bytes INTEGER NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS tree_digests (
+        target TEXT PRIMARY KEY,
+        digest TEXT NOT NULL,
+        updated REAL NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS push_journals (
+        target TEXT PRIMARY KEY,
+        settings TEXT,
+        overflowed INTEGER NOT NULL DEFAULT 0,
+        last_full_sync REAL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS journal_paths (
+        target TEXT NOT NULL,
+        path TEXT NOT NULL,
+        PRIMARY KEY (target, path)
+    ) WITHOUT ROWID
+    """,
+    # Capabilities were cached by host only before schema version 7
+    'DROP TABLE IF EXISTS host_capabilities',
+    """
+    CREATE TABLE IF NOT EXISTS host_rsync_capabilities (
+        host TEXT NOT NULL,
+        rsync_path TEXT NOT NULL,
+        capabilities TEXT NOT NULL,
+        probed REAL NOT NULL,
+        PRIMARY KEY (host, rsync_path)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS host_transfers (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        host TEXT NOT NULL,
+        finished REAL NOT NULL,
+        duration REAL NOT NULL,
+        compressed INTEGER NOT NULL,
+        literal_data INTEGER NOT NULL,
+        bytes_sent INTEGER NOT NULL,
+        bytes_received INTEGER NOT NULL
+    )
+    """,
+    'CREATE INDEX IF NOT EXISTS host_transfers_host ON host_transfers (host, finished)',
+    """
+    CREATE TABLE IF NOT EXISTS fan_out_runs (
+        target TEXT PRIMARY KEY,
+        run TEXT NOT NULL,
+        updated REAL NOT NULL
+    )
+    """,
+)
+
+
+@dataclass(frozen=True)
+class SyncRecord:
+    """
+    Recorded result of a sync command for a target
+
+    Timestamps are seconds since epoch. Transferred bytes and file count are None if they
+    were not reported by the sync command.
+    """
+    target: str
+    action: str
+    started: float
+    finished: float
+    duration: float
+    exit_code: int
+    bytes: Optional[int] = None
+    files: Optional[int] = None
+
+    @property
+    def succeeded(self) -> bool:
+        """
+        Check if the sync command succeeded
+        """
+        return self.exit_code == 0
+
+
+@dataclass(frozen=True)
+class TransferSample:
+    """
+    Transfer statistics of a successful sync command to a remote host
+
+    Literal data is the file data transferred without the delta transfer matches, before
+    compression. Bytes sent and received are the bytes transferred over the link.
+    """
+    host: str
+    finished: float
+    duration: float
+    compressed: bool
+    literal_data: int
+    bytes_sent: int
+    bytes_received: int
+
+    @property
+    def bytes_transferred(self) -> int:
+        """
+        Return total number of bytes transferred over the link
+        """
+        return self.bytes_sent + self.bytes_received
+
+
+@dataclass
+class TargetCounters:
+    """
+    Cumulative counters and latest result of sync commands for a target and action
+    """
+    target: str
+    action: str
+    runs: int
+    failures: int
+    last_success: Optional[float]
+    last: Optional[SyncRecord]
+
+
+@dataclass
+class RunSummary:
+    """
+    Summary of sync jobs in a treesync run
+    """
+    action: str
+    started: float
+    finished: Optional[float] = None
+    succeeded: int = 0
+    failed: int = 0
+    skipped: int = 0
+    bytes: int = 0
+
+    @property
+    def targets(self) -> int:
+        """
+        Return number of targets in the run
+        """
+        return self.succeeded + self.failed + self.skipped
+
+    @property
+    def duration(self) -> Optional[float]:
+        """
+        Return duration of the run in seconds, or None if the run has not finished
+        """
+        if self.finished is None:
+            return None
+        return self.finished - self.started
+
+    def add(self, status: str, transferred: Optional[int] = None) -> None:
+        """
+        Add a finished sync job with status succeeded, failed or skipped to the summary
+        """
+        if status not in ('succeeded', 'failed', 'skipped'):
+            raise ValueError(f'Invalid sync job status: {status}')
+        setattr(self, status, getattr(self, status) + 1)
+        if transferred is not None:
+            self.bytes += transferred
+
+
+@dataclass
+class JournalState:
+    """
+    Journal of paths changed in a target source tree since the last incremental push
+
+    Settings is the digest of the push settings of the last push. Overflowed is set when
+    changes were not recorded to the journal.
+    """
+    target: str
+    settings: Optional[str] = None
+    overflowed: bool = False
+    last_full_sync: Optional[float] = None
+    paths: List[str] = field(default_factory=list)
+
+
+class SyncStateStore:
+    """
+    SQLite database with per target sync command history, counters, tree digests and journals
+    of changed paths, fan-out pushes, summaries of the latest runs, and rsync capabilities and
+    transfer statistics of remote hosts
+
+    Targets are identified by the target name. Errors accessing the database are raised
+    as StateStoreError.
+    """
+    def __init__(self, path: Optional[Path] = None) -> None:
+        self.__path__ = Path(path) if path is not None else None
+        self.__local__ = threading.local()
+        self.__lock__ = threading.Lock()
+        self.__connections__: List[sqlite3.Connection] = []
+
+    @property
+    def path(self) -> Path:
+        """
+        Return path to the state database
+        """
+        if self.__path__ is None:
+            self.__path__ = user_data_directory().joinpath(STATE_DATABASE_NAME)
+        return self.__path__
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """
+        Return database connection for the calling thread, opening it if necessary
+        """
+        connection = getattr(self.__local__, 'connection', None)
+        if connection is None:
+            connection = self.__connect__()
+            self.__local__.connection = connection
+            with self.__lock__:
+                self.__connections__.append(connection)
+        return connection
+
+    def __connect__(self) -> sqlite3.Connection:
+        """
+        Open database connection and create the schema if necessary
+        """
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            connection = sqlite3.connect(
+                str(self.path),
+                timeout=STATE_BUSY_TIMEOUT,
+                isolation_level=None,
+                check_same_thread=False,
+            )
+            connection.execute(f'PRAGMA busy_timeout = {STATE_BUSY_TIMEOUT * 1000}')
+            connection.execute('PRAGMA journal_mode = WAL')
+            connection.execute('PRAGMA synchronous = NORMAL')
+            if connection.execute('PRAGMA user_version').fetchone()[0] != STATE_SCHEMA_VERSION:
+                with self.__transaction__(connection):
+                    for statement in STATE_SCHEMA:
+                        connection.execute(statement)
+                    connection.execute(f'PRAGMA user_version = {STATE_SCHEMA_VERSION}')
+        except (OSError, sqlite3.Error) as error:
+            raise StateStoreError(f'Error opening state database {self.path}: {error}') from error
+        return connection
+
+    @staticmethod
+    @contextmanager
+    def __transaction__(connection: sqlite3.Connection) -> Iterator[sqlite3.Connection]:
+        """
+        Run statements in a write transaction
+
+        The write lock is taken when the transaction starts, so concurrent writers wait
+        for the busy timeout instead of failing on lock upgrade
+        """
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def close(self) -> None:
+        """
+        Close all database connections opened by the store
+        """
+        with self.__lock__:
+            connections = self.__connections__
+            self.__connections__ = []
+        for connection in connections:
+            connection.close()
+        self.__local__ = threading.local()
+
+    def record(self, record: SyncRecord) -> None:
+        """
+        Record result of a sync command
+
+        Old records exceeding the history length of the target and action are removed
+        """
+        try:
+            with self.__transaction__(self.connection) as connection:
+                connection.execute(
+                    """
+                    INSERT INTO sync_runs (target, action, started, finished, duration, exit_code, bytes, files)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    (
+                        record.target, record.action, record.started, record.finished,
+                        record.duration, record.exit_code, record.bytes, record.files,
+                    )
+                )
+                connection.execute(
+                    """
+                    DELETE FROM sync_runs WHERE target = ? AND action = ? AND id NOT IN (
+                        SELECT id FROM sync_runs WHERE target = ? AND action = ?
+                        ORDER BY finished DESC LIMIT ?
+                    )
+                    """,
+                    (record.target, record.action, record.target, record.action, STATE_HISTORY_LENGTH)
+                )
+                connection.execute(
+                    """
+                    INSERT INTO sync_counters (target, action, runs, failures, last_success)
+                    VALUES (?, ?, 1, ?, ?)
+                    ON CONFLICT (target, action) DO UPDATE SET
+                        runs = runs + 1,
+                        failures = failures + excluded.failures,
+                        last_success = COALESCE(excluded.last_success, last_success)
+                    """,
+                    (
+                        record.target, record.action, 0 if record.succeeded else 1,
+                        record.finished if record.succeeded else None,
+                    )
+                )
+        except sqlite3.Error as error:
+            raise StateStoreError(f'Error recording sync state for {record.target}: {error}') from error
+
+    def get_history(self, target: str, action: str, limit: int = STATE_HISTORY_LENGTH) -> List[SyncRecord]:
+        """
+        Return recorded results of sync commands for target, latest first
+        """
+        try:
+            rows = self.connection.execute(
+                """
+                SELECT target, action, started, finished, duration, exit_code, bytes, files
+                FROM sync_runs WHERE target = ? AND action = ? ORDER BY finished DESC LIMIT ?
+                """,
+                (str(target), action, limit)
+            ).fetchall()
+        except sqlite3.Error as error:
+            raise StateStoreError(f'Error reading sync state for {target}: {error}') from error
+        return [SyncRecord(*row) for row in rows]
+
+    def get_last(self, target: str, action: str) -> Optional[SyncRecord]:
+        """
+        Return latest recorded result of a sync command for target
+        """
+        history = self.get_history(target, action, limit=1)
+        return history[0] if history else None
+
+    def get_digest(self, target: str) -> Optional[str]:
+        """
+        Return tree digest recorded after last successful push of target
+        """
+        try:
+            row = self.connection.execute(
+                'SELECT digest FROM tree_digests WHERE target = ?',
+                (str(target),)
+            ).fetchone()
+        except sqlite3.Error as error:
+            raise StateStoreError(f'Error reading tree digest for {target}: {error}') from error
+        return row[0] if row is not None else None
+
+    def set_digest(self, target: str, digest: str) -> None:
+        """
+        Record tree digest of target after a successful push
+        """
+        try:
+            with self.__transaction__(self.connection) as connection:
+                connection.execute(
+                    'INSERT OR REPLACE INTO tree_digests (target, digest, updated) VALUES (?, ?, ?)',
+                    (str(target), digest, time.time())
+                )
+        except sqlite3.Error as error:
+            raise StateStoreError(f'Error recording tree digest for {target}: {error}') from error
+
+    def get_fan_out_run(self, target: str) -> Optional[str]:
+        """
+        Return identifier of the fan-out push of the last successful push of target, or
+        None if the target was last pushed without a fan-out push
+        """
+        try:
+            row = self.connection.execute(
+                'SELECT run FROM fan_out_runs WHERE target = ?',
+                (target,)
+            ).fetchone()
+        except sqlite3.Error as error:
+            raise StateStoreError(f'Error reading fan-out run for {target}: {error}') from error
+        return row[0] if row is not None else None
+
+    def set_fan_out_run(self, target: str, run: Optional[str]) -> None:
+        """
+        Record identifier of the fan-out push of target, or clear it with None
+        """
+        try:
+            with self.__transaction__(self.connection) as connection:
+                if run is None:
+                    connection.execute('DELETE FROM fan_out_runs WHERE target = ?', (target,))
+                else:
+                    connection.execute(
+                        'INSERT OR REPLACE INTO fan_out_runs (target, run, updated) VALUES (?, ?, ?)',
+                        (target, run, time.time())
+                    )
+        except sqlite3.Error as error:
+            raise StateStoreError(f'Error recording fan-out run for {target}: {error}') from error
+
+    def get_host_capabilities(self, host: str, rsync_path: str, max_age: float) -> Optional[str]:
+        """
+        Return capabilities of the rsync command on host probed at most max_age seconds ago
+        """
+        try:
+            row = self.connection.execute(
+                """
+                SELECT capabilities FROM host_rsync_capabilities
+                WHERE host = ? AND rsync_path = ? AND probed >= ?
+                """,
+                (str(host), rsync_path, time.time() - max_age)
+            ).fetchone()
+        except sqlite3.Error as error:
+            raise StateStoreError(f'Error reading capabilities of host {host}: {error}') from error
+        return row[0] if row is not None else None
+
+    def set_host_capabilities(self, host: str, rsync_path: str, capabilities: str) -> None:
+        """
+        Record probed capabilities of the rsync command on host
+        """
+        try:
+            with self.__transaction__(self.connection) as connection:
+                connection.execute(
+                    """
+                    INSERT OR REPLACE INTO host_rsync_capabilities (host, rsync_path, capabilities, probed)
+                    VALUES (?, ?, ?, ?)
+                    """,
+                    (str(host), rsync_path, capabilities, time.time())
+                )
+        except sqlite3.Error as error:
+            raise StateStoreError(f'Error recording capabilities of host {host}: {error}') from error
+
+    def record_transfer(self, sample: TransferSample) -> None:
+        """
+        Record transfer statistics of a sync command to a remote host
+
+        Old samples exceeding the history length of the host are removed
+        """
+        try:
+            with self.__transaction__(self.connection) as connection:
+                connection.execute(
+                    """
+                    INSERT INTO host_transfers (
+                        host, finished, duration, compressed, literal_data, bytes_sent, bytes_received
+                    ) VALUES (?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    (
+                        sample.host, sample.finished, sample.duration, int(sample.compressed),
+                        sample.literal_data, sample.bytes_sent, sample.bytes_received,
+                    )
+                )
+                connection.execute(
+                    """
+                    DELETE FROM host_transfers WHERE host = ? AND id NOT IN (
+                        SELECT id FROM host_transfers WHERE host = ? ORDER BY finished DESC LIMIT ?
+                    )
+                    """,
+                    (sample.host, sample.host, STATE_HISTORY_LENGTH)
+                )
+        except sqlite3.Error as error:
+            raise StateStoreError(f'Error recording transfer to host {sample.host}: {error}') from error
+
+    def get_transfers(self, host: str, limit: int = STATE_HISTORY_LENGTH) -> List[TransferSample]:
+        """
+        Return recorded transfer statistics of sync commands to host, latest first
+        """
+        try:
+            rows = self.connection.execute(
+                """
+                SELECT host, finished, duration, compressed, literal_data, bytes_sent, bytes_received
+                FROM host_transfers WHERE host = ? ORDER BY finished DESC LIMIT ?
+                """,
+                (str(host), limit)
+            ).fetchall()
+        except sqlite3.Error as error:
+            raise StateStoreError(f'Error reading transfers to host {host}: {error}') from error
+        return [
+            TransferSample(host, finished, duration, bool(compressed), literal_data, sent, received)
+            for host, finished, duration, compressed, literal_data, sent, received in rows
+        ]
+
+    def get_counters(self) -> List[TargetCounters]:
+        """
+        Return counters and latest results of all recorded targets and actions
+        """
+        try:
+            rows = self.connection.execute(
+                'SELECT target, action, runs, failures, last_success FROM sync_counters ORDER BY target, action'
+            ).fetchall()
+        except sqlite3.Error as error:
+            raise StateStoreError(f'Error reading sync counters: {error}') from error
+        return [TargetCounters(*row, last=self.get_last(row[0], row[1])) for row in rows]
+
+    def record_run(self, summary: RunSummary) -> None:
+        """
+        Record summary of a finished treesync run, replacing earlier summary for the action
+        """
+        try:
+            with self.__transaction__(self.connection) as connection:
+                connection.execute(
+                    """
+                    INSERT OR REPLACE INTO run_summaries
+                    (action, started, finished, targets, succeeded, failed, skipped, bytes)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    (
+                        summary.action, summary.started, summary.finished, summary.targets,
+                        summary.succeeded, summary.failed, summary.skipped, summary.bytes,
+                    )
+                )
+        except sqlite3.Error as error:
+            raise StateStoreError(f'Error recording run summary: {error}') from error
+
+    def get_run_summaries(self) -> List[RunSummary]:
+        """
+        Return summaries of latest recorded runs for each action
+        """
+        try:
+            rows = self.connection.execute(
+                """
+                SELECT action, started, finished, succeeded, failed, skipped, bytes
+                FROM run_summaries ORDER BY action
+                """
+            ).fetchall()
+        except sqlite3.Error as error:
+            raise StateStoreError(f'Error reading run summaries: {error}') from error
+        return [RunSummary(*row) for row in rows]
+
+    def get_throughput_samples(self, action: str, limit: int = 1000) -> List[float]:
+        """
+        Return transfer rates in bytes per second of latest successful sync commands with
+        transfer statistics
+        """
+        try:
+            rows = self.connection.execute(
+                """
+                SELECT bytes, duration FROM sync_runs
+                WHERE action = ? AND exit_code = 0 AND bytes > 0 AND duration > 0
+                ORDER BY finished DESC LIMIT ?
+                """,
+                (action, limit)
+            ).fetchall()
+        except sqlite3.Error as error:
+            raise StateStoreError(f'Error reading sync state: {error}') from error
+        return [transferred / duration for transferred, duration in rows]
+
+    def get_journal(self, target: str) -> JournalState:
+        """
+        Return journal of changed paths for target
+        """
+        try:
+            row = self.connection.execute(
+                'SELECT settings, overflowed, last_full_sync FROM push_journals WHERE target = ?',
+                (str(target),)
+            ).fetchone()
+            paths = self.connection.execute(
+                'SELECT path FROM journal_paths WHERE target = ? ORDER BY path',
+                (str(target),)
+            ).fetchall()
+        except sqlite3.Error as error:
+            raise StateStoreError(f'Error reading journal for {target}: {error}') from error
+        journal = JournalState(target=str(target), paths=[path for path, in paths])
+        if row is not None:
+            journal.settings, journal.overflowed, journal.last_full_sync = row[0], bool(row[1]), row[2]
+        return journal
+
+    def add_journal_paths(self, target: str, paths: Optional[Iterable[str]], max_paths: int) -> None:
+        """
+        Add changed paths to the journal of target
+
+        If paths is None or the journal would contain more than max_paths paths, the journal
+        is marked overflowed and the paths are not stored
+        """
+        try:
+            with self.__transaction__(self.connection) as connection:
+                connection.execute(
+                    'INSERT OR IGNORE INTO push_journals (target) VALUES (?)',
+                    (str(target),)
+                )
+                overflowed = connection.execute(
+                    'SELECT overflowed FROM push_journals WHERE target = ?',
+                    (str(target),)
+                ).fetchone()[0]
+                if not overflowed and paths is not None:
+                    connection.executemany(
+                        'INSERT OR IGNORE INTO journal_paths (target, path) VALUES (?, ?)',
+                        ((str(target), path) for path in paths)
+                    )
+                    count = connection.execute(
+                        'SELECT COUNT(*) FROM journal_paths WHERE target = ?',
+                        (str(target),)
+                    ).fetchone()[0]
+                    if count <= max_paths:
+                        return
+                connection.execute('UPDATE push_journals SET overflowed = 1 WHERE target = ?', (str(target),))
+                connection.execute('DELETE FROM journal_paths WHERE target = ?', (str(target),))
+        except sqlite3.Error as error:
+            raise StateStoreError(f'Error recording journal for {target}: {error}') from error
+
+    def clear_journal(self,
+                      target: str,
+                      settings: str,
+                      paths: Iterable[str],
+                      full_sync: Optional[float] = None) -> None:
+        """
+        Remove pushed paths from the journal of target after a successful push
+
+        Paths added to the journal after the push was planned are kept. With full_sync the
+        overflow flag is cleared and the time of the last full sync is updated.
+        """
+        try:
+            with self.__transaction__(self.connection) as connection:
+                connection.execute(
+                    'INSERT OR IGNORE INTO push_journals (target) VALUES (?)',
+                    (str(target),)
+                )
+                connection.execute(
+                    'UPDATE push_journals SET settings = ? WHERE target = ?',
+                    (settings, str(target))
+                )
+                if full_sync is not None:
+                    connection.execute(
+                        'UPDATE push_journals SET overflowed = 0, last_full_sync = ? WHERE target = ?',
+                        (full_sync, str(target))
+                    )
+                connection.executemany(
+                    'DELETE FROM journal_paths WHERE target = ? AND path = ?',
+                    ((str(target), path) for path in paths)
+                )
+        except sqlite3.Error as error:
+            raise StateStoreError(f'Error recording journal for {target}: {error}') from error
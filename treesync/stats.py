@@ -0,0 +1,197 @@
+#
+# Copyright (C) 2020-2023 by Ilkka Tuohela <hile@iki.fi>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+"""
+Parsing of rsync --stats output and results of sync commands
+"""
+import re
+
+from dataclasses import dataclass, field, fields
+from typing import Any, Dict, Iterable, List, Optional
+
+#: Flag to make rsync report transfer statistics
+RSYNC_STATS_FLAG = '--stats'
+#: Flag to make rsync report statistics as exact numbers instead of values with unit suffixes
+RSYNC_NO_HUMAN_READABLE_FLAG = '--no-human-readable'
+
+#: Statistics lines of rsync --stats output mapped to SyncStats attributes
+RSYNC_STATS_LINES = {
+    'Number of files': 'files',
+    'Number of created files': 'created_files',
+    'Number of deleted files': 'deleted_files',
+    'Number of regular files transferred': 'files_transferred',
+    'Number of files transferred': 'files_transferred',
+    'Total file size': 'total_file_size',
+    'Total transferred file size': 'transferred_file_size',
+    'Literal data': 'literal_data',
+    'Matched data': 'matched_data',
+    'Total bytes sent': 'bytes_sent',
+    'Total bytes received': 'bytes_received',
+}
+RSYNC_STATS_LINE = re.compile(r'^(?P<label>[A-Z][A-Za-z ]+): (?P<value>[0-9][0-9,.]*[A-Za-z]*)')
+RSYNC_INTEGER = re.compile(r'^([0-9]+|[0-9]{1,3}(,[0-9]{3})+|[0-9]{1,3}(\.[0-9]{3})+)$')
+RSYNC_SPEEDUP_LINE = re.compile(r'^total size is [0-9,.]+\s+speedup is (?P<speedup>[0-9][0-9,.]*)')
+
+
+@dataclass
+class SyncStats:
+    """
+    Transfer statistics reported by rsync --stats
+
+    Values not reported by rsync are None
+    """
+    files: Optional[int] = None
+    created_files: Optional[int] = None
+    deleted_files: Optional[int] = None
+    files_transferred: Optional[int] = None
+    total_file_size: Optional[int] = None
+    transferred_file_size: Optional[int] = None
+    literal_data: Optional[int] = None
+    matched_data: Optional[int] = None
+    bytes_sent: Optional[int] = None
+    bytes_received: Optional[int] = None
+    speedup: Optional[float] = None
+
+    @property
+    def bytes_transferred(self) -> Optional[int]:
+        """
+        Return total number of bytes sent and received by rsync
+        """
+        if self.bytes_sent is None and self.bytes_received is None:
+            return None
+        return (self.bytes_sent or 0) + (self.bytes_received or 0)
+
+    def as_dict(self) -> Dict[str, Any]:
+        """
+        Return statistics as a dictionary
+        """
+        return {field.name: getattr(self, field.name) for field in fields(self)}
+
+
+def merge_stats(stats: Iterable[Optional[SyncStats]]) -> Optional[SyncStats]:
+    """
+    Sum statistics of several rsync commands
+
+    Returns None if none of the commands reported statistics. Speedup is calculated from
+    the summed total file size and bytes transferred.
+    """
+    stats = [item for item in stats if item is not None]
+    if not stats:
+        return None
+    merged = SyncStats()
+    for item in fields(SyncStats):
+        if item.name == 'speedup':
+            continue
+        values = [getattr(value, item.name) for value in stats if getattr(value, item.name) is not None]
+        if values:
+            setattr(merged, item.name, sum(values))
+    if merged.total_file_size is not None and merged.bytes_transferred:
+        merged.speedup = round(merged.total_file_size / merged.bytes_transferred, 2)
+    return merged
+
+
+class RsyncStatsParser:
+    """
+    Streaming parser for rsync --stats output
+
+    Lines of rsync output are passed to feed() as they are read, all other output lines
+    are ignored
+    """
+    def __init__(self) -> None:
+        self.stats = SyncStats()
+        self.found = False
+
+    @staticmethod
+    def __parse_integer__(value: str) -> int:
+        """
+        Parse an integer with thousands separators
+
+        Raises ValueError for values which are not exact integers, for example values with
+        unit suffixes reported by rsync --human-readable
+        """
+        if not RSYNC_INTEGER.match(value):
+            raise ValueError(f'Invalid rsync statistics value: {value}')
+        return int(value.replace(',', '').replace('.', ''))
+
+    def feed(self, line: str) -> None:
+        """
+        Parse a line of rsync output
+
+        Values which are not exact integers are not reported
+        """
+        line = line.strip()
+        match = RSYNC_STATS_LINE.match(line)
+        if match:
+            attr = RSYNC_STATS_LINES.get(match.group('label'), None)
+            if attr is not None:
+                try:
+                    setattr(self.stats, attr, self.__parse_integer__(match.group('value')))
+                except ValueError:
+                    return
+                self.found = True
+            return
+        match = RSYNC_SPEEDUP_LINE.match(line)
+        if match:
+            self.stats.speedup = float(match.group('speedup').replace(',', ''))
+            self.found = True
+
+    def parse(self, lines: List[str]) -> Optional[SyncStats]:
+        """
+        Parse lines of rsync output, returning the statistics or None if no statistics were
+        found
+        """
+        for line in lines:
+            self.feed(line)
+        return self.stats if self.found else None
+
+
+@dataclass
+class SyncResult:
+    """
+    Result of a rsync pull or push command for a sync target
+
+    Statistics are available only if the command was run with statistics enabled. Targets
+    synced with several rsync commands have the result of each command in passes. Duration
+    is the time spent running rsync commands, or None if the time was not measured.
+    """
+    target: str
+    action: str
+    args: List[str]
+    returncode: int = 0
+    stats: Optional[SyncStats] = None
+    passes: List['SyncPass'] = field(default_factory=list)
+    duration: Optional[float] = None
+
+
+@dataclass
+class SyncPass:
+    """
+    Result of one rsync command of a sync run with several commands
+    """
+    name: str
+    args: List[str]
+    duration: float
+    stats: Optional[SyncStats] = None
+
+    @property
+    def throughput(self) -> Optional[float]:
+        """
+        Return bytes transferred per second, or None if not known
+        """
+        if self.stats is None or self.stats.bytes_transferred is None or not self.duration:
+            return None
+        return self.stats.bytes_transferred / self.duration
+
+    def as_dict(self) -> Dict[str, Any]:
+        """
+        Return result of the pass as a dictionary
+        """
+        return {
+            'name': self.name,
+            'command': list(self.args),
+            'duration': self.duration,
+            'throughput': self.throughput,
+            'stats': self.stats.as_dict() if self.stats is not None else None,
+        }
@@ -7,27 +7,51 @@
 Tree sync target
 """
 import sys
+import time
 
 from collections.abc import MutableSequence
+from dataclasses import dataclass
 from operator import ge, gt, le, lt
 from pathlib import Path
-from typing import List, Optional, TYPE_CHECKING
+from typing import AsyncIterator, Callable, IO, List, Optional, Tuple, TYPE_CHECKING
 
-from tempfile import NamedTemporaryFile
-from subprocess import run, CalledProcessError
+from subprocess import PIPE, CalledProcessError, Popen, run
 
 from sys_toolkit.textfile import LineTextFile
 
+from .capabilities import get_capability_flags, get_remote_rsync_path
+from .compression import CompressionDecision, get_target_compression
+from .engine import AsyncSyncCommand, SyncEvent
 from .exceptions import SyncError
+from .index import TargetIndex
+from .largefiles import LARGE_FILE_BLOCK_SIZE, LargeFilePush, find_large_files
+from .native import get_native_engine
+from .output import TargetOutput, read_process_output
+from .shards import ShardedPush, plan_shards
+from .ssh import has_rsh_flag
+from .stats import RSYNC_NO_HUMAN_READABLE_FLAG, RSYNC_STATS_FLAG, RsyncStatsParser, SyncResult, SyncStats
 
 if TYPE_CHECKING:  # pragma: no cover
     from treesync.configuration.targets import TargetConfiguration
+    from treesync.excludes import ExcludesFileCache
+    from treesync.host import Hosts, TargetHost
 
 
-class ExcludesFile(Path):
+class ExcludesFile(type(Path())):
     """
     Rsync excludes parser
     """
+    @property
+    def signature(self) -> Optional[Tuple[int, int, int]]:
+        """
+        Return inode, size and modification time of the file, or None if file does not exist
+        """
+        try:
+            stat = self.stat()
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
     @property
     def excludes(self) -> List[LineTextFile]:
         """
@@ -38,25 +62,18 @@ class ExcludesFile(Path):
         return []
 
 
-# pylint: disable=too-few-public-methods
-class TemporaryExcludesFile:
-    """
-    A temporary excludes file, merging excludes flags from various
-    sources for rsync
+@dataclass(frozen=True)
+class TargetPlan:
     """
-    def __init__(self, target) -> None:
-        self.target = target
-        # pylint: disable=consider-using-with
-        self.__tempfile__ = NamedTemporaryFile(mode='w', prefix=f'treesync-{self.target.name}')
-        for line in self.target.excluded:
-            self.__tempfile__.write(f'{line}\n')
-        self.__tempfile__.flush()
+    Resolved rsync flags and excluded paths for a sync target
 
-    def __repr__(self) -> str:
-        """
-        Return path to temporary file
-        """
-        return self.__tempfile__.name
+    The plan is computed once per target and shared by the pull, push and show commands.
+    The tree excludes file signature is used to detect changes to the excludes file.
+    Flags are None if the target configuration defines no rsync flags.
+    """
+    flags: Optional[Tuple[str, ...]]
+    excluded: Tuple[str, ...]
+    tree_excludes_file_signature: Optional[Tuple[int, int, int]] = None
 
 
 class Target:
@@ -76,6 +93,8 @@ class Target:
         self.destination = destination
         self.settings = settings if settings else {}
         self.__excludes_file__ = None
+        self.__excludes_file_plan__ = None
+        self.__plan__ = None
 
     def __repr__(self) -> str:
         return self.name
@@ -130,18 +149,183 @@ class Target:
         return self.settings.__config_root__.hosts.get(self.hostname)
 
     @property
-    def excluded(self) -> List[Path]:
+    def remote_host(self) -> Optional[str]:
         """
-        Return list of excluded filenames applicable to target
+        Return remote shell host from destination
+
+        Returns None for local destinations and rsync daemon destinations
+        """
+        destination = str(self.destination)
+        if '::' in destination or destination.startswith('rsync://'):
+            return None
+        try:
+            host, _path = destination.split(':', 1)
+        except ValueError:
+            return None
+        # Local paths containing a colon have a slash before the colon
+        if not host or '/' in host:
+            return None
+        return host
+
+    @property
+    def remote_rsync_path(self) -> str:
+        """
+        Return rsync command run on the remote host
+        """
+        return get_remote_rsync_path(self.plan.flags or [])
+
+    @property
+    def target_hosts(self) -> 'Hosts':
+        """
+        Return mapping of target host objects
+        """
+        return self.settings.__config_root__.hosts.hosts
+
+    @property
+    def target_host(self) -> Optional['TargetHost']:
+        """
+        Return target host object for remote shell destination host
+        """
+        remote_host = self.remote_host
+        if remote_host is None:
+            return None
+        return self.target_hosts.get(remote_host)
+
+    @property
+    def max_parallel(self) -> Optional[int]:
+        """
+        Return limit for parallel sync commands to the target host
+
+        The limit from hosts configuration section overrides the servers section
+        """
+        host_configuration = self.host_configuration
+        if host_configuration is not None and host_configuration.max_parallel is not None:
+            return host_configuration.max_parallel
+        return self.settings.destination_server_max_parallel
+
+    @property
+    def probe_capabilities(self) -> bool:
+        """
+        Return True if rsync capabilities of the target host are probed for choosing algorithms
+
+        The setting from hosts configuration section overrides the defaults section
+        """
+        host_configuration = self.host_configuration
+        if host_configuration is not None and host_configuration.probe_capabilities is not None:
+            return bool(host_configuration.probe_capabilities)
+        return bool(getattr(self.default_settings, 'probe_capabilities', False))
+
+    @property
+    def adaptive_compression(self) -> bool:
+        """
+        Return True if compression is chosen from transfers measured to the target host
+
+        The setting from hosts configuration section overrides the defaults section
+        """
+        host_configuration = self.host_configuration
+        if host_configuration is not None and host_configuration.adaptive_compression is not None:
+            return bool(host_configuration.adaptive_compression)
+        return bool(getattr(self.default_settings, 'adaptive_compression', False))
+
+    @property
+    def compression(self) -> Optional[CompressionDecision]:
+        """
+        Return adaptive compression decision for the target, or None without a decision
+        """
+        return get_target_compression(self)
+
+    @property
+    def shards(self) -> Optional[int]:
+        """
+        Return number of parallel rsync commands for pushing the target in shards, or None if
+        the target is not pushed in shards
+        """
+        return getattr(self.settings, 'shards', None)
+
+    @property
+    def shard_workers(self) -> Optional[int]:
+        """
+        Return number of concurrent rsync commands for pushing the target in shards, limited
+        by the max_parallel limit of the target host, or None if the target is not pushed in
+        shards
+        """
+        shards = self.shards
+        if shards is None:
+            return None
+        return min(shards, self.max_parallel or shards)
+
+    @property
+    def shard_by(self) -> str:
+        """
+        Return mode for splitting the target source tree to shards
+        """
+        return getattr(self.settings, 'shard_by', 'directory')
+
+    @property
+    def engine(self) -> str:
+        """
+        Return engine for syncing the target
+        """
+        return getattr(self.settings, 'engine', 'rsync')
+
+    @property
+    def large_file_size(self) -> Optional[int]:
+        """
+        Return size of files pushed with a separate rsync pass, or None if large files are
+        not pushed separately
+        """
+        return getattr(self.settings, 'large_file_size', None)
+
+    @property
+    def large_file_block_size(self) -> int:
+        """
+        Return rsync block size for pushing large files
+        """
+        block_size = getattr(self.settings, 'large_file_block_size', None)
+        return block_size if block_size is not None else LARGE_FILE_BLOCK_SIZE
+
+    @property
+    def configured_excludes(self) -> List[str]:
+        """
+        Return list of excluded filenames from treesync configuration
         """
         excluded = list(self.default_settings.never_sync_paths)
         if not self.settings.ignore_default_excludes:
             excluded.extend(self.default_settings.excluded_paths)
         if self.settings.excludes:
             excluded.extend(self.settings.excludes)
-        if self.tree_excludes_file is not None:
-            excluded.extend(self.tree_excludes_file.excludes)
-        return sorted(set(excluded))
+        return excluded
+
+    @property
+    def plan(self) -> TargetPlan:
+        """
+        Return resolved flags and excluded paths for the target
+
+        The plan is created again only if the tree excludes file has been modified
+        """
+        tree_excludes_file = self.tree_excludes_file
+        signature = tree_excludes_file.signature if tree_excludes_file is not None else None
+        if self.__plan__ is None or self.__plan__.tree_excludes_file_signature != signature:
+            excluded = set(self.configured_excludes)
+            if signature is not None:
+                excluded.update(tree_excludes_file.excludes)
+            try:
+                flags = tuple(self.configured_flags)
+            except ValueError:
+                flags = None
+            self.__plan__ = TargetPlan(
+                flags=flags,
+                excluded=tuple(sorted(excluded)),
+                tree_excludes_file_signature=signature,
+            )
+        return self.__plan__
+
+    @property
+    def excluded(self) -> List[Path]:
+        """
+        Return list of excluded filenames applicable to target
+        """
+        return list(self.plan.excluded)
 
     @property
     def tree_excludes_file(self) -> Optional[ExcludesFile]:
@@ -160,118 +344,319 @@ class Target:
         return None
 
     @property
-    def excludes_file(self) -> TemporaryExcludesFile:
+    def excludes_file_cache(self) -> 'ExcludesFileCache':
         """
-        Return temporary excludes file for commands
+        Return cache for rsync excludes files
         """
-        if self.__excludes_file__ is None:
-            self.__excludes_file__ = TemporaryExcludesFile(self)
+        return self.settings.__config_root__.excludes_file_cache
+
+    @property
+    def excludes_file(self) -> Path:
+        """
+        Return path to rsync excludes file for commands
+        """
+        plan = self.plan
+        if self.__excludes_file__ is None or self.__excludes_file_plan__ is not plan:
+            self.__excludes_file__ = self.excludes_file_cache.get(plan.excluded)
+            self.__excludes_file_plan__ = plan
         return self.__excludes_file__
 
     @property
-    def flags(self) -> List[str]:
+    def configured_flags(self) -> List[str]:
         """
-        Return list of rsync flags for commands
+        Return list of rsync flags from treesync configuration
         """
         flags = []
         if not self.settings.ignore_default_excludes:
-            flags.extend(list(self.default_settings.flags))
-        for flag in self.settings.flags:
-            if flag not in flags:
-                flags.append(flag)
+            flags.extend(self.default_settings.flags)
+        flags.extend(self.settings.flags)
         if self.host_configuration:
-            for flag in self.host_configuration.destination_server_flags:
-                if flag not in flags:
-                    flags.append(flag)
-        for flag in self.settings.destination_server_flags:
-            if flag not in flags:
-                flags.append(flag)
+            flags.extend(self.host_configuration.destination_server_flags)
+        flags.extend(self.settings.destination_server_flags)
+        # Remove duplicate flags, preserving order of first occurrence
+        flags = list(dict.fromkeys(flags))
         if not flags:
             raise ValueError(f'Target defines no rsync flags: {self}')
         if self.settings.iconv:
             flags.append(f'--iconv={self.settings.iconv}')
+        return flags
+
+    @property
+    def flags(self) -> List[str]:
+        """
+        Return list of rsync flags for commands
+        """
+        if self.plan.flags is None:
+            raise ValueError(f'Target defines no rsync flags: {self}')
+        flags = list(self.plan.flags)
+        target_host = self.target_host
+        if target_host is not None and target_host.rsh is not None and not has_rsh_flag(flags):
+            flags.append(f'--rsh={target_host.rsh}')
+        compression = self.compression
+        if compression is not None:
+            flags.extend(compression.flags)
+        capabilities = target_host.capabilities.get(self.remote_rsync_path) if target_host is not None else None
+        if capabilities is not None and target_host.local_capabilities:
+            flags.extend(get_capability_flags(flags, target_host.local_capabilities, capabilities))
         flags.append(f'--exclude-from={self.excludes_file}')
         return flags
 
     @staticmethod
-    def run_sync_command(*args):
+    def run_sync_command(*args, output: Optional[IO] = None):
         """
         Run rsync command
+
+        If output is given, both stdout and stderr of the command are written to it
         """
         try:
             return run(
                 args,
-                stdout=sys.stdout,
-                stderr=sys.stderr,
+                stdout=output if output is not None else sys.stdout,
+                stderr=output if output is not None else sys.stderr,
                 check=True
             )
         except CalledProcessError as error:
             raise SyncError(error) from error
 
-    def get_rsync_cmd_args(self, dry_run: bool = False):
+    @staticmethod
+    def run_sync_command_streamed(*args, output=None, stats: bool = False) -> Optional[SyncStats]:
+        """
+        Run rsync command, reading the command output from non-blocking pipes
+
+        Output lines are written to output as they are read, or to stdout if output is not
+        given. With stats the rsync transfer statistics are parsed from the output and
+        returned, or None if rsync did not report statistics.
+        """
+        parser = RsyncStatsParser() if stats else None
+        stream = output if output is not None else sys.stdout
+
+        def write_line(line: str) -> None:
+            if parser is not None:
+                parser.feed(line)
+            stream.write(line)
+
+        with Popen(args, stdout=PIPE, stderr=PIPE if output is not None else sys.stderr) as process:
+            read_process_output(process, write_line)
+            returncode = process.wait()
+        if returncode != 0:
+            error = CalledProcessError(returncode, args)
+            raise SyncError(error) from error
+        if parser is not None and parser.found:
+            return parser.stats
+        return None
+
+    def get_rsync_cmd_args(self, dry_run: bool = False, stats: bool = False, files_from: Optional[Path] = None):
         """
         Return rsync command and arguments excluding source and destination
+
+        With files_from only the paths listed in the file, separated by null characters, are
+        transferred. With stats the statistics are reported as exact numbers even if the target
+        flags enable human readable numbers.
         """
         args = [self.default_settings.rsync_command] + self.flags
         if dry_run:
             args.append('--dry-run')
+        if stats:
+            if RSYNC_STATS_FLAG not in args:
+                args.append(RSYNC_STATS_FLAG)
+            args.append(RSYNC_NO_HUMAN_READABLE_FLAG)
+        if files_from is not None:
+            args.extend(['--from0', f'--files-from={files_from}'])
         return args
 
-    def get_pull_command_args(self, dry_run: bool = False):
+    def get_pull_command_args(self, dry_run: bool = False, stats: bool = False):
         """
         Return 'pull' command arguments
         """
-        args = self.get_rsync_cmd_args(dry_run=dry_run)
+        args = self.get_rsync_cmd_args(dry_run=dry_run, stats=stats)
         args.extend([
             f"""{self.destination.rstrip('/')}/""",
             f"""{str(self.source).rstrip('/')}/""",
         ])
         return args
 
-    def get_push_command_args(self, dry_run: bool = False) -> List[str]:
+    def get_push_command_args(self,
+                              dry_run: bool = False,
+                              stats: bool = False,
+                              files_from: Optional[Path] = None) -> List[str]:
         """
         Return 'push' command arguments
         """
-        args = self.get_rsync_cmd_args(dry_run=dry_run)
+        args = self.get_rsync_cmd_args(dry_run=dry_run, stats=stats, files_from=files_from)
         args.extend([
             f"""{str(self.source).rstrip('/')}/""",
             f"""{self.destination.rstrip('/')}/""",
         ])
         return args
 
-    def pull(self, dry_run: bool = False) -> None:
+    def run_sync(self,
+                 action: str,
+                 args: List[str],
+                 output: Optional[IO] = None,
+                 stats: bool = False) -> SyncResult:
+        """
+        Run pull or push rsync command with specified arguments and return the result
+
+        Output of the command is read through pipes when statistics are parsed or the output
+        is written to a target log
+        """
+        result = SyncResult(target=str(self), action=action, args=args)
+        start = time.monotonic()
+        if stats or isinstance(output, TargetOutput):
+            result.stats = self.run_sync_command_streamed(*args, output=output, stats=stats)
+        else:
+            self.run_sync_command(*args, output=output)
+        result.duration = time.monotonic() - start
+        return result
+
+    def run_native(self,
+                   action: str,
+                   source: Path,
+                   destination: str,
+                   dry_run: bool = False,
+                   output: Optional[IO] = None,
+                   stats: bool = False) -> Optional[SyncResult]:
+        """
+        Sync a local destination with the native engine and return the result
+
+        Returns None if the target is not synced with the native engine
+        """
+        engine = get_native_engine(self, source, destination)
+        if engine is None:
+            return None
+        args = ['native', f"""{str(source).rstrip('/')}/""", f"""{destination.rstrip('/')}/"""]
+        result = SyncResult(target=str(self), action=action, args=args)
+        sync_stats = engine.run(dry_run=dry_run, output=output)
+        if stats:
+            result.stats = sync_stats
+        return result
+
+    def get_sync_method(self, action: str, files_from: Optional[Path] = None) -> Tuple[str, Optional[list]]:
+        """
+        Return the method used for syncing the target and the plan of the method
+
+        The method is 'native' for the native engine, 'large files' for a push with a separate
+        large file pass, with the large file paths as plan, 'shards' for a sharded push, with
+        the shards as plan, or 'rsync' for a single rsync command. Raises SyncError if the
+        source directory of a push does not exist.
+        """
+        if action == 'push':
+            if not self.source.is_dir():
+                raise SyncError(f'Source directory does not exist: {self.source}')
+            source, destination = self.source, self.destination
+        else:
+            source, destination = Path(self.destination), str(self.source)
+        if files_from is not None:
+            return 'rsync', None
+        if get_native_engine(self, source, destination) is not None:
+            return 'native', None
+        if action == 'push' and self.large_file_size is not None:
+            paths = find_large_files(self, self.large_file_size)
+            if paths:
+                return 'large files', paths
+        if action == 'push' and self.shards is not None:
+            shards = plan_shards(self, self.shards, self.shard_by)
+            if shards is not None:
+                return 'shards', shards
+        return 'rsync', None
+
+    def pull(self, dry_run: bool = False, output: Optional[IO] = None, stats: bool = False) -> SyncResult:
         """
         Pull data from destination to source with rsync
+
+        With stats the transfer statistics reported by rsync are included in the result.
+        Targets with the native engine and a local destination are pulled without rsync.
         """
-        self.run_sync_command(*self.get_pull_command_args(dry_run))
+        method, _plan = self.get_sync_method('pull')
+        if method == 'native':
+            return self.run_native('pull', Path(self.destination), str(self.source), dry_run, output, stats)
+        return self.run_sync('pull', self.get_pull_command_args(dry_run, stats=stats), output, stats)
 
-    def push(self, dry_run: bool = False) -> None:
+    def push(self,
+             dry_run: bool = False,
+             output: Optional[IO] = None,
+             stats: bool = False,
+             files_from: Optional[Path] = None) -> SyncResult:
         """
         Push data from source to destination with rsync
+
+        With stats the transfer statistics reported by rsync are included in the result. With
+        files_from only the paths listed in the file are pushed. Targets with shards enabled
+        are pushed in shards if the source tree can be split to shards. Targets with the native
+        engine and a local destination are pushed without rsync. Targets with a large file size
+        push files of at least that size with a separate rsync pass.
+        """
+        method, plan = self.get_sync_method('push', files_from)
+        if method == 'native':
+            return self.run_native('push', self.source, self.destination, dry_run, output, stats)
+        if method == 'large files':
+            return LargeFilePush(self, plan, self.large_file_block_size).run(dry_run, output, stats)
+        if method == 'shards':
+            return ShardedPush(self, plan, workers=self.shard_workers).run(
+                dry_run=dry_run,
+                output=output,
+                stats=stats
+            )
+        args = self.get_push_command_args(dry_run, stats=stats, files_from=files_from)
+        return self.run_sync('push', args, output, stats)
+
+    def sync_events(self, action: str, dry_run: bool = False, stats: bool = False) -> AsyncIterator[SyncEvent]:
         """
-        if not self.source.is_dir():
-            raise SyncError(f'Source directory does not exist: {self.source}')
-        return self.run_sync_command(*self.get_push_command_args(dry_run))
+        Run pull or push rsync command asynchronously, returning async iterator of events
+
+        Raises SyncError if the target is synced with a method other than a single rsync
+        command
+        """
+        return AsyncSyncCommand(self, action, dry_run=dry_run, stats=stats).events()
+
+    async def pull_async(self,
+                         dry_run: bool = False,
+                         stats: bool = False,
+                         output: Optional[Callable[[str], None]] = None) -> SyncResult:
+        """
+        Pull data from destination to source with rsync asynchronously
+
+        Output lines are passed to the output callback. Raises SyncError if the target is
+        synced with a method other than a single rsync command.
+        """
+        return await AsyncSyncCommand(self, 'pull', dry_run=dry_run, stats=stats).run(output)
+
+    async def push_async(self,
+                         dry_run: bool = False,
+                         stats: bool = False,
+                         output: Optional[Callable[[str], None]] = None) -> SyncResult:
+        """
+        Push data from source to destination with rsync asynchronously
+
+        Output lines are passed to the output callback. Raises SyncError if the target is
+        synced with a method other than a single rsync command.
+        """
+        return await AsyncSyncCommand(self, 'push', dry_run=dry_run, stats=stats).run(output)
 
 
 class TargetList(MutableSequence):
     """
     List of targets with lookup
+
+    Lookups use a TargetIndex, which is built on first lookup after the list was modified
     """
     def __init__(self):
         self.__items__ = []
+        self.__index__ = None
 
     def __delitem__(self, index):
         """
         Delete specified item from cache
         """
         self.__items__.__delitem__(index)
+        self.__index__ = None
 
     def __setitem__(self, index, value):
         """
         Set specified value to given index
         """
         self.__items__.__setitem__(index, value)
+        self.__index__ = None
 
     def __getitem__(self, index):
         """
@@ -291,23 +676,49 @@ class TargetList(MutableSequence):
         """
         return iter(self.__items__)
 
+    @property
+    def index(self) -> TargetIndex:
+        """
+        Return index for target lookups
+        """
+        if self.__index__ is None:
+            self.build_index()
+        return self.__index__
+
+    def build_index(self) -> TargetIndex:
+        """
+        Build index for target lookups
+        """
+        self.__index__ = TargetIndex(self.__items__)
+        return self.__index__
+
     def insert(self, index, value):
         """
         Append target to items
         """
         self.__items__.insert(index, value)
+        self.__index__ = None
 
     def sort(self, key=None, reverse=False):
         """
         Sort targets
         """
         self.__items__.sort(key=key, reverse=reverse)
+        self.__index__ = None
 
     def get(self, name: str) -> Optional[Target]:
         """
         Find first target matching specified name
         """
-        for item in self:
-            if str(item) == name:
-                return item
-        return None
+        return self.index.get(name)
+
+    def filter(self, patterns: List[str]) -> List[Target]:
+        """
+        Filter targets by list of patterns as strings
+
+        Patterns are matched to the target hostname, full target name and the target name
+        without host prefix. Returns all targets if no patterns are given.
+        """
+        if not patterns:
+            return self
+        return self.index.filter(patterns)
@@ -0,0 +1,419 @@
+#
+# Copyright (C) 2020-2023 by Ilkka Tuohela <hile@iki.fi>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+"""
+Watching sync target source trees for changes with inotify
+
+Each directory in the source trees is watched with inotify, skipping directories excluded
+from the target. Changes are coalesced per target: a target is reported as changed when
+no changes have been seen for the debounce window, or when the first unreported change is
+older than the maximum delay. Optionally the changed paths are collected for incremental
+pushes, up to a maximum number of paths per target.
+
+Watched directories are stored as parent watch descriptor and directory name, so memory
+used per directory does not depend on the depth of the tree. No per-event state is kept.
+"""
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import time
+
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Set, Tuple, TYPE_CHECKING
+
+from .constants import DEFAULT_WATCH_DEBOUNCE
+from .exceptions import SyncError
+from .scanner import ExcludeMatcher
+
+if TYPE_CHECKING:  # pragma: no cover
+    from .target import Target
+
+# inotify flags from linux/inotify.h
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+#: Events watched in source tree directories
+WATCH_EVENTS = (
+    IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+    IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+)
+#: Flags for adding watches
+WATCH_FLAGS = IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK
+
+#: Size of buffer for reading inotify events
+EVENT_BUFFER_SIZE = 64 * 1024
+#: Header of an inotify event: watch descriptor, mask, cookie and name length
+EVENT_HEADER = struct.Struct('iIII')
+
+#: Maximum seconds a change is delayed by new changes before the target is reported
+DEFAULT_MAX_DELAY = 60.0
+
+
+@dataclass(frozen=True)
+class InotifyEvent:
+    """
+    Event read from an inotify file descriptor
+    """
+    wd: int
+    mask: int
+    cookie: int
+    name: str
+
+    @property
+    def is_directory(self) -> bool:
+        """
+        Check if the event is for a directory
+        """
+        return bool(self.mask & IN_ISDIR)
+
+
+class Inotify:
+    """
+    Non-blocking inotify file descriptor using libc with ctypes
+
+    Raises SyncError if inotify is not available
+    """
+    def __init__(self) -> None:
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            self.__add_watch__ = libc.inotify_add_watch
+            self.__rm_watch__ = libc.inotify_rm_watch
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        except (OSError, AttributeError) as error:
+            raise SyncError(f'inotify is not available: {error}') from error
+        if fd < 0:
+            code = ctypes.get_errno()
+            raise SyncError(f'Error initializing inotify: {os.strerror(code)}')
+        self.fd = fd
+
+    def fileno(self) -> int:
+        """
+        Return the inotify file descriptor
+        """
+        return self.fd
+
+    def close(self) -> None:
+        """
+        Close the inotify file descriptor, removing all watches
+        """
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def add_watch(self, path: str, mask: int) -> int:
+        """
+        Add or update a watch for path, returning the watch descriptor
+
+        Raises OSError if the watch can't be added
+        """
+        wd = self.__add_watch__(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            code = ctypes.get_errno()
+            raise OSError(code, os.strerror(code), path)
+        return wd
+
+    def remove_watch(self, wd: int) -> None:
+        """
+        Remove a watch, ignoring watches already removed by the kernel
+        """
+        self.__rm_watch__(self.fd, wd)
+
+    def read(self) -> List[InotifyEvent]:
+        """
+        Read available events without blocking
+        """
+        try:
+            data = os.read(self.fd, EVENT_BUFFER_SIZE)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            events.append(InotifyEvent(wd=wd, mask=mask, cookie=cookie, name=name))
+        return events
+
+
+class WatchedTree:
+    """
+    Watched directories of a sync target source tree
+
+    Directories are stored by watch descriptor as parent watch descriptor and directory name.
+    A directory moved within the tree keeps its watch descriptor and the entry is updated when
+    the move is seen.
+    """
+    def __init__(self, target: 'Target') -> None:
+        self.target = target
+        self.matcher = ExcludeMatcher(target.excluded)
+        self.root: Optional[int] = None
+        self.directories: Dict[int, Tuple[Optional[int], str]] = {}
+        self.incomplete = False
+
+    def __repr__(self) -> str:
+        return str(self.target)
+
+    def get_path(self, wd: int) -> Optional[str]:
+        """
+        Return path of a watched directory relative to the source, or None if not watched
+        """
+        parts = []
+        while wd != self.root:
+            entry = self.directories.get(wd, None)
+            if entry is None:
+                return None
+            wd, name = entry
+            parts.append(name)
+        return '/'.join(reversed(parts))
+
+    def get_event_path(self, wd: int, name: str, is_directory: bool) -> Optional[str]:
+        """
+        Return relative path for an event for name in a watched directory
+
+        Returns None if the directory is not watched or the path is excluded
+        """
+        path = self.get_path(wd)
+        if path is None or not name:
+            return path
+        path = f'{path}/{name}' if path else name
+        if self.matcher.match(path, name, is_directory):
+            return None
+        return path
+
+
+class TreeWatcher:
+    """
+    Watch source trees of sync targets for changes with inotify
+
+    Call wait() to get the targets changed since the previous call. With max_paths the
+    changed paths of targets are collected and returned by pop_changed_paths().
+    """
+    def __init__(self,
+                 targets: List['Target'],
+                 debounce: float = DEFAULT_WATCH_DEBOUNCE,
+                 max_delay: float = DEFAULT_MAX_DELAY,
+                 max_paths: Optional[int] = None) -> None:
+        self.debounce = debounce
+        self.max_delay = max(max_delay, debounce)
+        self.max_paths = max_paths
+        self.paths: Dict[int, Optional[Set[str]]] = {}
+        self.inotify = Inotify()
+        self.trees = [WatchedTree(target) for target in targets]
+        self.watches: Dict[int, Set[int]] = {}
+        self.pending: Dict[int, Tuple[float, float]] = {}
+        for index in range(len(self.trees)):
+            self.add_tree(index)
+
+    def __enter__(self) -> 'TreeWatcher':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    @property
+    def watch_count(self) -> int:
+        """
+        Return number of inotify watches
+        """
+        return len(self.watches)
+
+    def close(self) -> None:
+        """
+        Close the inotify file descriptor
+        """
+        self.inotify.close()
+        self.watches.clear()
+
+    def __add_watch__(self, index: int, path: str) -> Optional[int]:
+        """
+        Add watch for a directory of a tree
+
+        Returns None if the directory can't be watched. If the inotify watch limit is reached
+        the tree is marked incomplete.
+        """
+        tree = self.trees[index]
+        try:
+            wd = self.inotify.add_watch(path, WATCH_EVENTS | WATCH_FLAGS)
+        except OSError as error:
+            if error.errno == errno.ENOSPC:
+                tree.incomplete = True
+            return None
+        self.watches.setdefault(wd, set()).add(index)
+        return wd
+
+    def add_directory(self, index: int, parent: Optional[int], name: str) -> None:
+        """
+        Watch a directory of a tree and all directories below it not excluded from the target
+
+        Directories are walked depth first with a stack, so memory used for the walk is
+        bounded by the depth of the tree and number of directories in a single directory.
+        """
+        tree = self.trees[index]
+        source = str(tree.target.source)
+        stack: List[Tuple[Optional[int], str]] = [(parent, name)]
+        while stack and not tree.incomplete:
+            parent, name = stack.pop()
+            if parent is None:
+                relative_path = ''
+            else:
+                parent_path = tree.get_path(parent)
+                if parent_path is None:
+                    continue
+                relative_path = f'{parent_path}/{name}' if parent_path else name
+            directory = os.path.join(source, relative_path) if relative_path else source
+            wd = self.__add_watch__(index, directory)
+            if wd is None:
+                continue
+            if parent is None:
+                tree.root = wd
+            else:
+                tree.directories[wd] = (parent, name)
+            try:
+                with os.scandir(directory) as iterator:
+                    for entry in iterator:
+                        if not entry.is_dir(follow_symlinks=False):
+                            continue
+                        path = f'{relative_path}/{entry.name}' if relative_path else entry.name
+                        if not tree.matcher.match(path, entry.name, True):
+                            stack.append((wd, entry.name))
+            except OSError:
+                continue
+
+    def add_tree(self, index: int) -> None:
+        """
+        Watch the source tree of a target
+        """
+        self.add_directory(index, None, '')
+
+    def remove_watch(self, wd: int) -> None:
+        """
+        Forget a watch descriptor removed by the kernel
+        """
+        for index in self.watches.pop(wd, set()):
+            tree = self.trees[index]
+            tree.directories.pop(wd, None)
+            if tree.root == wd:
+                tree.root = None
+                tree.directories.clear()
+
+    def mark_changed(self, index: int, timestamp: float, path: Optional[str] = None) -> None:
+        """
+        Mark a tree changed at timestamp
+
+        If changed paths are collected and path is None or the tree has too many changed
+        paths, the changed paths of the tree are marked unknown
+        """
+        first, _last = self.pending.get(index, (timestamp, timestamp))
+        self.pending[index] = (first, timestamp)
+        if self.max_paths is None:
+            return
+        paths = self.paths.setdefault(index, set())
+        if paths is None:
+            return
+        if path is None or len(paths) >= self.max_paths:
+            self.paths[index] = None
+        else:
+            paths.add(path)
+
+    def pop_changed_paths(self, target: 'Target') -> Optional[List[str]]:
+        """
+        Return and clear paths changed in the target source tree since the previous call
+
+        Returns None if the changed paths are not known
+        """
+        for index, tree in enumerate(self.trees):
+            if tree.target is target:
+                paths = self.paths.pop(index, set())
+                return sorted(paths) if paths is not None else None
+        return []
+
+    def process_event(self, event: InotifyEvent, timestamp: float) -> None:
+        """
+        Process an inotify event
+        """
+        if event.mask & IN_Q_OVERFLOW:
+            # Events were lost, the trees are rescanned for new directories
+            for index in range(len(self.trees)):
+                self.mark_changed(index, timestamp)
+                self.add_tree(index)
+            return
+        if event.mask & IN_IGNORED:
+            self.remove_watch(event.wd)
+            return
+        for index in list(self.watches.get(event.wd, ())):
+            tree = self.trees[index]
+            path = tree.get_event_path(event.wd, event.name, event.is_directory)
+            if path is None:
+                continue
+            self.mark_changed(index, timestamp, path if path else None)
+            if event.is_directory and event.mask & (IN_CREATE | IN_MOVED_TO):
+                self.add_directory(index, event.wd, event.name)
+
+    def get_timeout(self, now: float) -> Optional[float]:
+        """
+        Return seconds until the next pending tree is due, or None if no trees are pending
+        """
+        if not self.pending:
+            return None
+        due = min(
+            min(last + self.debounce, first + self.max_delay)
+            for first, last in self.pending.values()
+        )
+        return max(due - now, 0)
+
+    def get_changed(self, now: float) -> List['Target']:
+        """
+        Return targets with pending changes that are due and clear them from pending changes
+        """
+        changed = []
+        for index, (first, last) in list(self.pending.items()):
+            if now >= last + self.debounce or now >= first + self.max_delay:
+                del self.pending[index]
+                changed.append(index)
+        return [self.trees[index].target for index in sorted(changed)]
+
+    def wait(self, timeout: Optional[float] = None) -> List['Target']:
+        """
+        Wait for changes in the watched trees and return changed targets
+
+        Returns an empty list if no targets were changed within timeout seconds
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            now = time.monotonic()
+            changed = self.get_changed(now)
+            if changed:
+                return changed
+            wait = self.get_timeout(now)
+            if deadline is not None:
+                remaining = max(deadline - now, 0)
+                wait = remaining if wait is None else min(wait, remaining)
+            readable, _writable, _errors = select.select([self.inotify], [], [], wait)
+            if readable:
+                now = time.monotonic()
+                for event in self.inotify.read():
+                    self.process_event(event, now)
+            elif deadline is not None and time.monotonic() >= deadline:
+                return self.get_changed(time.monotonic())